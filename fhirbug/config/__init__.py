@@ -22,9 +22,10 @@ def import_models():
     return importlib.import_module(models_path)
 
 
-def import_searches():
+def import_backend(module):
     """
-    Dynamic import of the searches module based on the backend selected in the configuration
+    Dynamic import of a module of the backend selected in the configuration, eg
+    ``import_backend("models")`` for ``fhirbug.db.backends.SQLAlchemy.models``
     """
     global settings
     if not settings:
@@ -36,9 +37,16 @@ def import_searches():
     except AttributeError:
         raise ConfigurationError("settings.DB_BACKEND has not been defined.")
 
-    if db_backend.lower() == "sqlalchemy":
-        return importlib.import_module("fhirbug.db.backends.SQLAlchemy.searches")
-    elif db_backend.lower() == "djangoorm":
-        return importlib.import_module("fhirbug.db.backends.DjangoORM.searches")
-    elif db_backend.lower() == "pymodm":
-        return importlib.import_module("fhirbug.db.backends.pymodm.searches")
+    backends = {"sqlalchemy": "SQLAlchemy", "djangoorm": "DjangoORM", "pymodm": "pymodm"}
+    try:
+        backend = backends[db_backend.lower()]
+    except KeyError:
+        raise ConfigurationError(f"{db_backend} is not a supported DB_BACKEND.")
+    return importlib.import_module(f"fhirbug.db.backends.{backend}.{module}")
+
+
+def import_searches():
+    """
+    Dynamic import of the searches module based on the backend selected in the configuration
+    """
+    return import_backend("searches")
@@ -8,6 +8,104 @@ DEFAULT_BUNDLE_SIZE = 20
 # TODO: Disable limiting when set to 0
 MAX_BUNDLE_SIZE = 100
 
+# How many threads may be used to run independent queries of the same request
+# concurrently, for example the queries of each resource type in $everything or the
+# _include and _revinclude queries of a page. Set to 1 to run them sequentially.
+MAX_QUERY_WORKERS = 4
+
+# How many threads may be used to process the entries of a batch Bundle concurrently.
+# Set to 1 to process them sequentially.
+BATCH_WORKERS = 1
+
+# Run the writes of each create, update and delete request in a single transaction
+# that is committed once, when the request is done, instead of committing every write
+# as it is made. Backends without transactions, like pymodm, write as before.
+UNIT_OF_WORK = False
+
+# How conditional deletes, eg DELETE Patient?identifier=123, treat several matches.
+# "single" refuses to delete them with 412 Precondition Failed, "multiple" deletes all
+# of them, with a single DELETE statement if the mapping and the backend allow it.
+CONDITIONAL_DELETE = "single"
+
+# How searches treat parameters the mapping has no searcher for, unless the request
+# asks otherwise with a "Prefer: handling=strict" or "handling=lenient" header.
+# "lenient" ignores them and adds a warning to the Bundle, "strict" refuses the search
+# with 400 Bad Request. Invalid values of supported parameters are always refused.
+SEARCH_HANDLING = "lenient"
+
+# Bulk data $export. Files are written to a directory for each job under EXPORT_PATH,
+# which defaults to a directory in the system's temporary directory, and job directories
+# are only accessible by the user the server runs as. If EXPORT_PATH is
+# served over HTTP, set EXPORT_URL to its url so manifests link to it instead of file:// urls.
+EXPORT_PATH = None
+EXPORT_URL = None
+# How many files may be written concurrently, across all export jobs
+EXPORT_WORKERS = 4
+# Resources with integer primary keys are split in files of about this many resources
+EXPORT_PARTITION_SIZE = 100000
+# How many rows are fetched from the database at a time
+EXPORT_BATCH_SIZE = 1000
+
+# Bulk NDJSON $import. The operation may only read files under IMPORT_PATH and is
+# disabled if it is not set. Job manifests and error files are kept under EXPORT_PATH.
+IMPORT_PATH = None
+# How many rows of each resource type are inserted at a time
+IMPORT_BATCH_SIZE = 1000
+# How many processes validate the imported lines, defaults to the number of CPUs
+IMPORT_WORKERS = None
+
+# Cache the rendered resources of Resource/id reads, see fhirbug.models.cache. Set it
+# to "local" for an LRU cache in the memory of each process, or to a cache object such
+# as a fhirbug.models.cache.SharedCache. Disabled if None.
+READ_CACHE = None
+# The bounds of the "local" read cache
+READ_CACHE_MAX_ENTRIES = 10000
+READ_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Seconds after which cached reads of mappings without a __Version__ or __LastUpdated__
+# attribute expire. Only the cache of the process that wrote a resource is invalidated,
+# so with a "local" cache other processes may serve it that stale. None keeps them until
+# they are evicted.
+READ_CACHE_TTL = 60
+
+# Cache pages of search results for SEARCH_CACHE_TTL seconds, see fhirbug.models.cache.
+# It accepts the same values as READ_CACHE. Disabled if None.
+SEARCH_CACHE = None
+SEARCH_CACHE_TTL = 10
+# The bounds of the "local" search cache
+SEARCH_CACHE_MAX_ENTRIES = 1000
+SEARCH_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# A function that receives the FhirRequestQuery of a search and returns who is searching,
+# eg a user id, which is part of the keys of cached searches. If None, the Authorization
+# header of the request is used.
+SEARCH_CACHE_CONTEXT = None
+
+# Write the AuditEvents of requests in a background thread, see fhirbug.server.audit.
+# Set it to a callable that receives a list of AuditEvents, such as a
+# fhirbug.server.audit.NDJSONSink or ModelSink. Disabled if None.
+AUDIT_SINK = None
+# How many events may wait to be written, and how many are written at a time
+AUDIT_QUEUE_SIZE = 10000
+AUDIT_BATCH_SIZE = 100
+# The most seconds an event waits before its batch is written
+AUDIT_FLUSH_INTERVAL = 1.0
+# The fraction of the events of successful requests that are written. The events of
+# requests that failed are always written.
+AUDIT_SAMPLE_RATE = 1.0
+# What happens when the queue is full: "drop" the new event, "drop_oldest" event in the
+# queue, or "block" the request for up to AUDIT_BLOCK_TIMEOUT seconds and then drop it
+AUDIT_OVERFLOW = "drop"
+AUDIT_BLOCK_TIMEOUT = 1.0
+
+# Full text searches (_content and _text) return at most this many results
+FULLTEXT_MAX_RESULTS = 1000
+
+# The text search configuration used for full text indexes on PostgreSQL
+FULLTEXT_LANGUAGE = "english"
+
+# Path to the search-parameters.json file of the FHIR specification, which
+# defines the search parameters that can be stored in the search index tables
+SEARCH_PARAMETERS_PATH = None
+
 # Path to the models module
 MODELS_PATH = "models"
 
@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, connection, transaction
 from fhirbug.db.backends.DjangoORM.pagination import paginate
 from fhirbug.models.mixins import FhirAbstractBaseMixin, FhirBaseModelMixin
 from fhirbug.exceptions import DoesNotExistError
@@ -13,6 +13,13 @@ class AbstractBaseModel(models.Model, FhirAbstractBaseMixin):
     class Meta:
         abstract = True
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the loaded values so updates only write the fields that changed
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
     @classmethod
     def _get_orm_query(cls):
         return cls.objects
@@ -24,10 +31,56 @@ class AbstractBaseModel(models.Model, FhirAbstractBaseMixin):
         except cls.DoesNotExist:
             raise DoesNotExistError(resource_type=cls.__name__, pk=pk)
 
+    @classmethod
+    def _get_version(cls, pk):
+        names = cls._version_attributes()
+        row = cls.objects.filter(pk=pk).values_list(*filter(None, names)).first()
+        if row is None:
+            raise DoesNotExistError(resource_type=cls.__name__, pk=pk)
+        values = iter(row)
+        return tuple(next(values) if name else None for name in names)
+
+    @classmethod
+    def _slice(cls, query, offset, limit):
+        return list(query.all()[offset : offset + limit])
+
+    @classmethod
+    def _count(cls, query):
+        return query.count()
+
+    @classmethod
+    def _close_thread_session(cls):
+        connection.close()
+
+    @classmethod
+    def _iterate(cls, query, batch_size):
+        return query.order_by("pk").iterator(chunk_size=batch_size)
+
+    @classmethod
+    def _pk_bounds(cls, query):
+        if not isinstance(cls._meta.pk, models.IntegerField):
+            return None
+        bounds = query.aggregate(low=models.Min("pk"), high=models.Max("pk"))
+        return None if bounds["low"] is None else (bounds["low"], bounds["high"])
+
+    @classmethod
+    def _filter_pk_range(cls, query, low, high):
+        return query.filter(pk__gte=low, pk__lt=high)
+
+    @classmethod
+    def atomic(cls):
+        return transaction.atomic()
+
     @classmethod
     def _delete_item(cls, item):
         item.delete()
 
+    @classmethod
+    def _delete_query(cls, query):
+        # The count of the other models is of the rows deleted by cascades
+        _, deleted = query.all().delete()
+        return deleted.get(cls._meta.label, 0)
+
 
 class FhirBaseModel(AbstractBaseModel, FhirBaseModelMixin):
     class Meta:
@@ -47,8 +100,21 @@ class FhirBaseModel(AbstractBaseModel, FhirBaseModelMixin):
 
     @classmethod
     def _after_update(cls, instance):
-        try:
+        loaded = getattr(instance, "_loaded_values", None)
+        if loaded is None:
             instance.save()
-        except Exception as e:
-            raise e
+            return instance
+        changed = [
+            field.attname
+            for field in cls._meta.concrete_fields
+            if field.attname in loaded
+            and getattr(instance, field.attname) != loaded[field.attname]
+        ]
+        # Saving with no update_fields does nothing
+        instance.save(update_fields=changed)
+        loaded.update({name: getattr(instance, name) for name in changed})
         return instance
+
+    @classmethod
+    def _bulk_insert(cls, instances):
+        cls.objects.bulk_create(instances)
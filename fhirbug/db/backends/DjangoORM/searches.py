@@ -35,6 +35,7 @@ def NumericSearch(column):
 
         return sql_query.filter(**{column: to_float(value)})
 
+    search.search_type = "number"
     return search
 
 
@@ -49,6 +50,7 @@ def NumericSearchWithQuantity(column, convert_value=None, alter_query=None):
                 sql_query = alter_query(query, value, quantity)
         return NumericSearch(column).search(cls, field_name, value, sql_query, query)
 
+    search.search_type = "quantity"
     return search
 
 
@@ -93,6 +95,7 @@ def DateSearch(column):
             }
         )
 
+    search_datetime.search_type = "date"
     return search_datetime
 
 
@@ -125,6 +128,7 @@ def StringSearch(*column_names):
             filter |= Q(**{"{}__startswith".format(col): value})
         return sql_query.filter(filter)
 
+    search.search_type = "string"
     return search
 
 
@@ -151,6 +155,7 @@ def NameSearch(column):
 
         return sql_query.filter(**{"{}__contains".format(column): value})
 
+    search_name.search_type = "string"
     return search_name
 
 
@@ -159,3 +164,61 @@ def SimpleSearch(column):
         return sql_query.filter(**{"{}".format(column): value})
 
     return search
+
+
+def ChainedSearch(column, target_cls):
+    """
+    Search on a parameter of the resource referenced by ``column``, eg
+    ``Observation?subject:Patient.name=smith``.
+
+    The search is applied on a queryset of ``target_cls`` that is then used as an
+    ``IN`` subquery, so the whole chain is executed as a single statement.
+    """
+
+    def search(cls, field_name, value, sql_query, query):
+        target_query = target_cls.apply_search(
+            field_name, value, target_cls._get_orm_query(), query
+        )
+        return sql_query.filter(
+            **{"{}__in".format(column): target_query.values("pk")}
+        )
+
+    return search
+
+
+def ReverseChainedSearch(source_cls, column):
+    """
+    Search for resources that are referenced by ``column`` of a ``source_cls``
+    matching a parameter, eg ``Patient?_has:Observation:subject:code=1234-5``.
+
+    The search is applied on a queryset of ``source_cls`` that is then used as an
+    ``IN`` subquery, so the whole chain is executed as a single statement.
+    """
+
+    def search(cls, field_name, value, sql_query, query):
+        source_query = source_cls.apply_search(
+            field_name, value, source_cls._get_orm_query(), query
+        )
+        return sql_query.filter(pk__in=source_query.values(column))
+
+    return search
+
+
+def CompartmentSearch(*column_names):
+    """
+    Search for resources that belong to a compartment, eg ``Patient/123/Observation``.
+    ``column_names`` are the columns of the references that make a resource a member
+    of the compartment, so all of them are combined in a single ``OR`` predicate.
+    """
+    if len(column_names) == 0:
+        raise TypeError(
+            "CompartmentSearch takes at least one positional argument (0 given)"
+        )
+
+    def search(cls, field_name, value, sql_query, query):
+        filter = Q(**{column_names[0]: value})
+        for col in column_names[1:]:
+            filter |= Q(**{col: value})
+        return sql_query.filter(filter)
+
+    return search
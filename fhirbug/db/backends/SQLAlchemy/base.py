@@ -1,10 +1,23 @@
 import os
+import random
+import threading
+import time
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session, object_mapper, sessionmaker, scoped_session
 from sqlalchemy.ext.declarative import declarative_base, DeclarativeMeta
 
 from fhirbug.config import settings
+from fhirbug.db.routing import is_read_only
+
+# The SQLALCHEMY_CONFIG settings passed to create_engine as keyword arguments
+ENGINE_OPTIONS = {
+    "POOL_SIZE": "pool_size",
+    "MAX_OVERFLOW": "max_overflow",
+    "POOL_TIMEOUT": "pool_timeout",
+    "POOL_RECYCLE": "pool_recycle",
+    "POOL_PRE_PING": "pool_pre_ping",
+}
 
 
 class AbstractModelMeta(DeclarativeMeta):
@@ -18,9 +31,158 @@ class AbstractModelMeta(DeclarativeMeta):
 
 Base = declarative_base(metaclass=AbstractModelMeta)
 
-# Create the db connection
-engine = create_engine(settings.SQLALCHEMY_CONFIG["URI"])
-session = scoped_session(sessionmaker(bind=engine))
+
+def engine_options(config):
+    """
+    Return the keyword arguments for ``create_engine`` set in ``SQLALCHEMY_CONFIG``.
+
+    >>> engine_options({"URI": "sqlite://", "POOL_SIZE": 10, "POOL_PRE_PING": True})
+    {'pool_size': 10, 'pool_pre_ping': True}
+    """
+    return {
+        option: config[setting]
+        for setting, option in ENGINE_OPTIONS.items()
+        if setting in config
+    }
+
+
+# The tables written in this process, with the time of their last write
+_written_tables = {}
+
+
+def recently_written(mapper):
+    """
+    Return whether the tables of ``mapper``, or any table if it is ``None``, have been
+    written in the last ``SQLALCHEMY_CONFIG['REPLICA_LAG']`` seconds, so replicas may
+    not have caught up with them yet.
+    """
+    lag = settings.SQLALCHEMY_CONFIG.get("REPLICA_LAG", 1)
+    since = time.monotonic() - lag
+    if mapper is None:
+        return any(written > since for written in _written_tables.values())
+    return any(
+        _written_tables.get(table.name, 0) > since
+        for table in getattr(mapper, "tables", [])
+    )
+
+
+class RoutingSession(Session):
+    """
+    A session that sends the queries made inside :func:`fhirbug.db.routing.read_only`
+    blocks to a random replica in ``replicas``. Writes, reads in a transaction that
+    has written and reads of tables written in the last ``REPLICA_LAG`` seconds go to
+    the primary engine.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.bind is None:
+            self.bind = get_engine()
+        replicas = get_replicas()
+        if (
+            replicas
+            and is_read_only()
+            and not self._flushing
+            and not self.info.get("wrote")
+            and not recently_written(mapper)
+        ):
+            return random.choice(replicas)
+        return super().get_bind(mapper=mapper, clause=clause, **kwargs)
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def remember_writes(session, flush_context):
+    mark_written(
+        session,
+        [
+            table
+            for instance in [*session.new, *session.dirty, *session.deleted]
+            for table in object_mapper(instance).tables
+        ],
+    )
+
+
+def mark_written(session, tables):
+    """
+    Send the reads of ``tables`` to the primary engine for ``REPLICA_LAG`` seconds, and
+    the reads of the transaction of ``session`` until it ends. Flushes call it, bulk
+    statements that bypass them must call it themselves.
+    """
+    session.info["wrote"] = True
+    now = time.monotonic()
+    for table in tables:
+        _written_tables[table.name] = now
+
+
+@event.listens_for(RoutingSession, "after_commit")
+@event.listens_for(RoutingSession, "after_rollback")
+def forget_writes(session):
+    session.info.pop("wrote", None)
+
+
+# The engines are created the first time they are used, so that importing this module
+# does not connect to the database and pre-forking servers can import it before they fork
+_engine = None
+_replicas = None
+_lock = threading.Lock()
+
+
+def get_engine():
+    """
+    Return the engine of the primary database, creating it on first use.
+    """
+    global _engine
+    with _lock:
+        if _engine is None:
+            config = settings.SQLALCHEMY_CONFIG
+            _engine = create_engine(config["URI"], **engine_options(config))
+        return _engine
+
+
+def get_replicas():
+    """
+    Return the engines of the ``REPLICAS`` of ``SQLALCHEMY_CONFIG``, creating them on
+    first use.
+    """
+    global _replicas
+    with _lock:
+        if _replicas is None:
+            config = settings.SQLALCHEMY_CONFIG
+            _replicas = [
+                create_engine(uri, **engine_options(config))
+                for uri in config.get("REPLICAS", [])
+            ]
+        return _replicas
+
+
+def reset_engines():
+    """
+    Forget the connections and sessions inherited from the parent process, without
+    closing them, since the parent may still be using them. The engines open new
+    connections when the child uses them.
+
+    It runs in the child process after every ``os.fork()``.
+    """
+    global _lock
+    _lock = threading.Lock()
+    session.registry.clear()
+    for engine in [_engine, *(_replicas or [])]:
+        if engine is not None:
+            engine.dispose(close=False)
+
+
+def __getattr__(name):
+    # ``engine`` and ``replicas`` are created lazily but can still be imported by name
+    if name == "engine":
+        return get_engine()
+    if name == "replicas":
+        return get_replicas()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+session = scoped_session(sessionmaker(class_=RoutingSession))
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_engines)
 
 # Provide the base class for AbstractBaseClass to inherit
 # You must do this BEFORE importing any models
@@ -0,0 +1,151 @@
+"""
+Full text index for the ``_content`` and ``_text`` search parameters.
+
+The text of every indexed resource is kept in a single table, ``fhirbug_fulltext``,
+which is created on first use. Depending on the database it is:
+
+  - An FTS5 virtual table on SQLite
+  - A table of ``tsvector`` columns with GIN indexes on PostgreSQL
+  - A plain table that is searched using ``LIKE`` on any other database
+
+Mappings are indexed when they declare a :func:`fhirbug.db.backends.SQLAlchemy.searches.FullTextSearch`
+searcher and the index is updated in the same transaction as the resource.
+"""
+from sqlalchemy import text, cast, inspect, Float, String
+
+from fhirbug.config import settings
+from fhirbug.db.backends.SQLAlchemy.base import session
+from fhirbug.utils import fulltext_values
+
+TABLE = "fhirbug_fulltext"
+FIELDS = ("content", "text")
+
+_DDL = {
+    "sqlite": [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {TABLE} "
+        "USING fts5(resource_type UNINDEXED, resource_id UNINDEXED, content, text)"
+    ],
+    "postgresql": [
+        f"CREATE TABLE IF NOT EXISTS {TABLE} (resource_type VARCHAR(64) NOT NULL, "
+        "resource_id VARCHAR(64) NOT NULL, content TSVECTOR, text TSVECTOR, "
+        "PRIMARY KEY (resource_type, resource_id))",
+        f"CREATE INDEX IF NOT EXISTS {TABLE}_content ON {TABLE} USING GIN (content)",
+        f"CREATE INDEX IF NOT EXISTS {TABLE}_text ON {TABLE} USING GIN (text)",
+    ],
+    "default": [
+        f"CREATE TABLE IF NOT EXISTS {TABLE} (resource_type VARCHAR(64) NOT NULL, "
+        "resource_id VARCHAR(64) NOT NULL, content TEXT, text TEXT, "
+        "PRIMARY KEY (resource_type, resource_id))"
+    ],
+}
+
+_ready = False
+
+
+def _dialect():
+    name = session.get_bind().dialect.name
+    return name if name in _DDL else "default"
+
+
+def create_index():
+    """
+    Create the index table if it does not exist. The table is created in the current
+    transaction so it is only kept if the session is committed.
+    """
+    global _ready
+    if _ready:
+        return
+    if inspect(session.connection()).has_table(TABLE):
+        _ready = True
+        return
+    for statement in _DDL[_dialect()]:
+        session.execute(text(statement))
+
+
+def _resource_id(instance):
+    return str(inspect(instance).identity[0])
+
+
+def update_index(instance, resource_type):
+    """
+    Replace the indexed text of ``instance``. Does not commit the session.
+    """
+    create_index()
+    remove_from_index(instance, resource_type)
+    content, narrative = fulltext_values(instance.to_fhir().as_json())
+    if _dialect() == "postgresql":
+        values = "to_tsvector(:language, :content), to_tsvector(:language, :text)"
+    else:
+        values = ":content, :text"
+    session.execute(
+        text(
+            f"INSERT INTO {TABLE} (resource_type, resource_id, content, text) "
+            f"VALUES (:resource_type, :resource_id, {values})"
+        ),
+        {
+            "resource_type": resource_type,
+            "resource_id": _resource_id(instance),
+            "content": content,
+            "text": narrative,
+            "language": settings.FULLTEXT_LANGUAGE,
+        },
+    )
+
+
+def remove_from_index(instance, resource_type):
+    """
+    Remove ``instance`` from the index. Does not commit the session.
+    """
+    create_index()
+    session.execute(
+        text(
+            f"DELETE FROM {TABLE} "
+            "WHERE resource_type = :resource_type AND resource_id = :resource_id"
+        ),
+        {"resource_type": resource_type, "resource_id": _resource_id(instance)},
+    )
+
+
+def _fts5_query(value):
+    # Quote every term so user input is never parsed as FTS5 query syntax
+    return " ".join('"{}"'.format(term.replace('"', '""')) for term in value.split())
+
+
+def search(cls, field, value, sql_query):
+    """
+    Filter ``sql_query`` to the resources whose ``field`` matches ``value``, best matches first.
+    At most ``settings.FULLTEXT_MAX_RESULTS`` results are returned.
+    """
+    if field not in FIELDS:
+        raise ValueError(f"Can not search the full text index by {field}")
+    create_index()
+    dialect = _dialect()
+    params = {
+        "resource_type": cls._get_resource_cls().__name__,
+        "limit": settings.FULLTEXT_MAX_RESULTS,
+    }
+    if dialect == "sqlite":
+        rank, condition = "rank", f"{field} MATCH :query"
+        params["query"] = _fts5_query(value)
+    elif dialect == "postgresql":
+        tsquery = "plainto_tsquery(:language, :query)"
+        rank, condition = f"-ts_rank({field}, {tsquery})", f"{field} @@ {tsquery}"
+        params.update(query=value, language=settings.FULLTEXT_LANGUAGE)
+    else:
+        rank, condition = "0", f"{field} LIKE :query"
+        params["query"] = f"%{value}%"
+
+    ranked = (
+        text(
+            f"SELECT resource_id, {rank} AS rank FROM {TABLE} "
+            f"WHERE {condition} AND resource_type = :resource_type "
+            "ORDER BY rank LIMIT :limit"
+        )
+        .bindparams(**params)
+        .columns(resource_id=String, rank=Float)
+        .subquery()
+    )
+    pk = inspect(cls).primary_key[0]
+    return sql_query.join(ranked, cast(pk, String) == ranked.c.resource_id).order_by(
+        ranked.c.rank
+    )
@@ -12,18 +12,39 @@
   SQLALCHEMY_CONFIG = {
     'URI':  # The connection string for xc_Oracle
     'BASE_CLASS':  # A string containing the module path to a declarative base class.
+    'POOL_SIZE':  # Optional, the number of connections kept open in the pool
+    'MAX_OVERFLOW':  # Optional, how many connections may be opened beyond POOL_SIZE
+    'POOL_TIMEOUT':  # Optional, seconds to wait for a free connection
+    'POOL_RECYCLE':  # Optional, seconds after which a connection is replaced
+    'POOL_PRE_PING':  # Optional, test connections before they are used
+    'REPLICAS':  # Optional, a list of connection strings of read replicas
+    'REPLICA_LAG':  # Optional, seconds after a write during which reads of the
+                    # written tables stay on the primary. Defaults to 1.
   }
 
+  Read requests are sent to a random replica, see :mod:`fhirbug.db.routing`.
+  The engines are created on first use, and forked processes drop the connections
+  they inherit from their parent.
+
 
 """
 
 
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import inspect, func
+
 from fhirbug.db.backends.SQLAlchemy.pagination import paginate
-from fhirbug.db.backends.SQLAlchemy.base import Base, session
+from fhirbug.db.backends.SQLAlchemy.base import Base, mark_written, session
+from fhirbug.db.backends.SQLAlchemy import fulltext, search_index
 
 from fhirbug.models.mixins import FhirAbstractBaseMixin, FhirBaseModelMixin
 from fhirbug.exceptions import DoesNotExistError
 
+# True while the writes of the current context are part of an atomic() block
+_atomic = ContextVar("fhirbug_sqlalchemy_atomic", default=False)
+
 
 class AbstractBaseModel(Base, FhirAbstractBaseMixin):
     """
@@ -45,14 +66,106 @@ class AbstractBaseModel(Base, FhirAbstractBaseMixin):
         return item
 
     @classmethod
-    def _delete_item(cls, item):
-        session.delete(item)
+    def _get_version(cls, pk):
+        names = cls._version_attributes()
+        columns = [getattr(cls, name) for name in names if name]
+        pk_column = inspect(cls).primary_key[0]
+        row = session.query(*columns).filter(pk_column == pk).first()
+        if row is None:
+            raise DoesNotExistError(pk, cls.__name__)
+        values = iter(row)
+        return tuple(next(values) if name else None for name in names)
+
+    @classmethod
+    def _slice(cls, query, offset, limit):
+        return query.limit(limit).offset(offset).all()
+
+    @classmethod
+    def _count(cls, query):
+        return query.order_by(None).count()
+
+    @classmethod
+    def _close_thread_session(cls):
+        session.remove()
+
+    @classmethod
+    def _iterate(cls, query, batch_size):
+        pk = inspect(cls).primary_key[0]
+        return query.order_by(pk).yield_per(batch_size)
+
+    @classmethod
+    def _pk_bounds(cls, query):
+        pk = inspect(cls).primary_key[0]
         try:
+            if pk.type.python_type is not int:
+                return None
+        except NotImplementedError:
+            return None
+        low, high = query.order_by(None).with_entities(func.min(pk), func.max(pk)).one()
+        return None if low is None else (low, high)
+
+    @classmethod
+    def _filter_pk_range(cls, query, low, high):
+        pk = inspect(cls).primary_key[0]
+        return query.filter(pk >= low, pk < high)
+
+    @classmethod
+    @contextmanager
+    def atomic(cls):
+        if _atomic.get():
+            yield
+            return
+        token = _atomic.set(True)
+        try:
+            yield
             session.commit()
-        except Exception as e:
+        except BaseException:
             session.rollback()
+            raise
+        finally:
+            _atomic.reset(token)
+
+    @classmethod
+    def _flush(cls):
+        session.flush()
+
+    @classmethod
+    def _commit(cls, instance=None):
+        """
+        Commit the session, unless the write is part of an :meth:`atomic` block, in
+        which case the block commits it. If ``instance`` is given, its indexes are
+        updated in the same transaction.
+        """
+        try:
+            if instance is not None:
+                cls._update_indexes(instance)
+            if not _atomic.get():
+                session.commit()
+        except Exception as e:
+            if not _atomic.get():
+                session.rollback()
             raise e
 
+    @classmethod
+    def _delete_item(cls, item):
+        session.delete(item)
+        cls._commit()
+
+    @classmethod
+    def _delete_query(cls, query):
+        pk = inspect(cls).primary_key[0]
+        # Filter by the primary keys of the results, so searches that join other
+        # tables can be deleted too
+        ids = query.order_by(None).with_entities(pk)
+        deleted = (
+            session.query(cls)
+            .filter(pk.in_(ids.scalar_subquery()))
+            .delete(synchronize_session=False)
+        )
+        mark_written(session, inspect(cls).tables)
+        cls._commit()
+        return deleted
+
 
 class FhirBaseModel(AbstractBaseModel, FhirBaseModelMixin):
     __abstract__ = True
@@ -60,22 +173,51 @@ class FhirBaseModel(AbstractBaseModel, FhirBaseModelMixin):
     @classmethod
     def _after_create(cls, instance):
         session.add(instance)
-        try:
-            session.commit()
-        except Exception as e:
-            session.rollback()
-            raise e
+        cls._commit(instance)
         return instance
 
     @classmethod
     def _after_update(cls, instance):
-        try:
-            session.commit()
-        except Exception as e:
-            session.rollback()
-            raise e
+        cls._commit(instance)
         return instance
 
+    @classmethod
+    def _bulk_insert(cls, instances):
+        with cls.atomic():
+            if cls._fulltext_indexed() or cls._indexed_parameters():
+                # Indexing needs the primary keys of the new rows
+                session.add_all(instances)
+                for instance in instances:
+                    cls._update_indexes(instance)
+            else:
+                # Bulk saves do not flush, so the writes are not tracked
+                session.bulk_save_objects(instances)
+                mark_written(session, inspect(cls).tables)
+
+    @classmethod
+    def _delete_item(cls, item):
+        resource_type = cls._get_resource_cls().__name__
+        if cls._fulltext_indexed():
+            fulltext.remove_from_index(item, resource_type)
+        if cls._indexed_parameters():
+            search_index.remove_from_index(item, resource_type)
+        return super()._delete_item(item)
+
+    @classmethod
+    def _update_indexes(cls, instance):
+        """
+        Update the full text and search parameter indexes of ``instance`` in the current transaction.
+        """
+        resource_type = cls._get_resource_cls().__name__
+        params = cls._indexed_parameters()
+        if not params and not cls._fulltext_indexed():
+            return
+        session.flush()
+        if cls._fulltext_indexed():
+            fulltext.update_index(instance, resource_type)
+        if params:
+            search_index.update_index(instance, resource_type, params)
+
     @classmethod
     def paginate(cls, *args, **kwargs):
         return paginate(*args, **kwargs)
@@ -0,0 +1,266 @@
+"""
+Search index tables.
+
+The values of indexed search parameters are extracted from resources when they are
+written, using :mod:`fhirbug.models.search_index`, and stored in a narrow table per
+parameter type, so any parameter can be searched without a column of its own:
+
+  - ``fhirbug_spidx_string``: ``value`` (normalized) and ``exact``
+  - ``fhirbug_spidx_token``: ``system`` and ``code``
+  - ``fhirbug_spidx_date``: the ``low`` and ``high`` bounds of the value
+  - ``fhirbug_spidx_quantity``: ``value``, ``system`` and ``code``
+  - ``fhirbug_spidx_reference``: the ``target``, eg ``Patient/123``
+
+Mappings are indexed when they declare :func:`fhirbug.db.backends.SQLAlchemy.searches.IndexedSearch`
+searchers. Resources that existed before can be indexed with :func:`reindex`.
+"""
+from sqlalchemy import (
+    MetaData,
+    Table,
+    Column,
+    Index,
+    String,
+    Float,
+    DateTime,
+    select,
+    delete,
+    cast,
+    inspect,
+    and_,
+    not_,
+)
+
+from fhirbug.db.backends.SQLAlchemy.base import session
+from fhirbug.exceptions import QueryValidationError
+from fhirbug.models.search_index import (
+    get_search_parameter,
+    extract_index_values,
+    normalize_string,
+    date_range,
+)
+
+metadata = MetaData()
+
+
+def _table(param_type, *columns):
+    name = f"fhirbug_spidx_{param_type}"
+    return Table(
+        name,
+        metadata,
+        Column("resource_type", String(64), nullable=False),
+        Column("resource_id", String(64), nullable=False),
+        Column("param", String(100), nullable=False),
+        *columns,
+        Index(f"{name}_resource", "resource_type", "resource_id"),
+        Index(
+            f"{name}_value",
+            "resource_type",
+            "param",
+            *[column.name for column in columns[:2]],
+        ),
+    )
+
+
+tables = {
+    "string": _table(
+        "string", Column("value", String(255)), Column("exact", String(255))
+    ),
+    "token": _table(
+        "token", Column("code", String(255)), Column("system", String(255))
+    ),
+    "date": _table("date", Column("low", DateTime), Column("high", DateTime)),
+    "quantity": _table(
+        "quantity",
+        Column("value", Float),
+        Column("code", String(255)),
+        Column("system", String(255)),
+    ),
+    "reference": _table("reference", Column("target", String(255))),
+}
+
+_ready = False
+
+
+def create_index():
+    """
+    Create the index tables if they do not exist.
+    """
+    global _ready
+    if not _ready:
+        metadata.create_all(session.connection())
+        _ready = True
+
+
+def _resource_id(instance):
+    return str(inspect(instance).identity[0])
+
+
+def remove_from_index(instance, resource_type):
+    """
+    Remove ``instance`` from the index. Does not commit the session.
+    """
+    create_index()
+    resource_id = _resource_id(instance)
+    for table in tables.values():
+        session.execute(
+            delete(table).where(
+                table.c.resource_type == resource_type,
+                table.c.resource_id == resource_id,
+            )
+        )
+
+
+def update_index(instance, resource_type, params):
+    """
+    Replace the indexed values of the search parameters ``params`` of ``instance``.
+    Does not commit the session.
+    """
+    remove_from_index(instance, resource_type)
+    resource_id = _resource_id(instance)
+    values = extract_index_values(instance.to_fhir().as_json(), params)
+    for param_type, rows in values.items():
+        if rows:
+            session.execute(
+                tables[param_type].insert(),
+                [
+                    {"resource_type": resource_type, "resource_id": resource_id, **row}
+                    for row in rows
+                ],
+            )
+
+
+def reindex(Model, batch_size=500):
+    """
+    Rebuild the index entries of all the resources of ``Model``, for example after
+    adding an indexed search parameter to its mapping.
+
+    :param Model: The mapping to reindex
+    :param int batch_size: How many resources to index before each commit
+    :returns: The number of resources that were indexed
+    """
+    params = Model._indexed_parameters()
+    resource_type = Model._get_resource_cls().__name__
+    mapper = inspect(Model)
+    pk = mapper.primary_key[0]
+    pk_name = mapper.get_property_by_column(pk).key
+    count = 0
+    last = None
+    while True:
+        # Each batch starts after the last key of the previous one instead of at an
+        # offset, so every batch is an index range scan
+        query = Model._get_orm_query().order_by(pk)
+        if last is not None:
+            query = query.filter(pk > last)
+        items = query.limit(batch_size).all()
+        for item in items:
+            update_index(item, resource_type, params)
+        session.commit()
+        count += len(items)
+        if len(items) < batch_size:
+            return count
+        last = getattr(items[-1], pk_name)
+
+
+def _prefix(value):
+    if value[:2] in ("eq", "ne", "lt", "gt", "le", "ge", "sa", "eb"):
+        return value[:2], value[2:]
+    return "eq", value
+
+
+def _string_condition(table, value, modifier):
+    if modifier == "exact":
+        return table.c.exact == value
+    value = normalize_string(value)
+    if modifier == "contains":
+        return table.c.value.like(f"%{value}%")
+    return table.c.value.like(f"{value}%")
+
+
+def _token_condition(table, value, modifier):
+    if "|" not in value:
+        return table.c.code == value
+    system, code = value.split("|", 1)
+    conditions = [table.c.system == system if system else table.c.system.is_(None)]
+    if code:
+        conditions.append(table.c.code == code)
+    return and_(*conditions)
+
+
+def _date_condition(table, value, modifier):
+    prefix, value = _prefix(value)
+    low, high = date_range(value)
+    return {
+        "eq": and_(table.c.low >= low, table.c.high <= high),
+        "ne": not_(and_(table.c.low >= low, table.c.high <= high)),
+        "lt": table.c.low < low,
+        "gt": table.c.high > high,
+        "le": table.c.low <= high,
+        "ge": table.c.high >= low,
+        "sa": table.c.low > high,
+        "eb": table.c.high < low,
+    }[prefix]
+
+
+def _quantity_condition(table, value, modifier):
+    prefix, value = _prefix(value)
+    number, *unit = value.split("|")
+    try:
+        number = float(number)
+    except ValueError:
+        raise QueryValidationError(f"{number} is an invalid numerical parameter")
+    conditions = [
+        {
+            "eq": table.c.value == number,
+            "ne": table.c.value != number,
+            "lt": table.c.value < number,
+            "gt": table.c.value > number,
+            "le": table.c.value <= number,
+            "ge": table.c.value >= number,
+            "sa": table.c.value > number,
+            "eb": table.c.value < number,
+        }[prefix]
+    ]
+    if len(unit) == 2:
+        system, code = unit
+        if system:
+            conditions.append(table.c.system == system)
+        if code:
+            conditions.append(table.c.code == code)
+    return and_(*conditions)
+
+
+def _reference_condition(table, value, modifier):
+    value = "/".join(value.split("/")[-2:])
+    if modifier and "/" not in value:
+        value = f"{modifier}/{value}"
+    if "/" in value:
+        return table.c.target == value
+    return table.c.target.like(f"%/{value}")
+
+
+conditions = {
+    "string": _string_condition,
+    "token": _token_condition,
+    "date": _date_condition,
+    "quantity": _quantity_condition,
+    "reference": _reference_condition,
+}
+
+
+def search(cls, param, value, sql_query, modifier=None):
+    """
+    Filter ``sql_query`` to the resources that have an indexed value of the search
+    parameter ``param`` matching ``value``. Matches the ``:exact`` and ``:contains``
+    modifiers of string parameters and the type modifier of references.
+    """
+    resource_type = cls._get_resource_cls().__name__
+    param_type, paths = get_search_parameter(resource_type, param)
+    create_index()
+    table = tables[param_type]
+    ids = select(table.c.resource_id).where(
+        table.c.resource_type == resource_type,
+        table.c.param == param,
+        conditions[param_type](table, value, modifier),
+    )
+    pk = inspect(cls).primary_key[0]
+    return sql_query.filter(cast(pk, String).in_(ids))
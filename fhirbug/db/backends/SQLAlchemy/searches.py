@@ -1,7 +1,7 @@
 import isodate
 import calendar
 from datetime import timedelta, datetime
-from sqlalchemy import or_, not_, and_
+from sqlalchemy import or_, not_, and_, inspect
 from fhirbug.exceptions import QueryValidationError
 from fhirbug.utils import date_ceil, transform_date
 
@@ -36,6 +36,7 @@ def NumericSearch(column):
 
         return sql_query.filter(col == to_float(value))
 
+    search.search_type = "number"
     return search
 
 
@@ -50,6 +51,7 @@ def NumericSearchWithQuantity(column, convert_value=None, alter_query=None):
                 sql_query = alter_query(query, value, quantity)
         return NumericSearch(column).search(cls, field_name, value, sql_query, query)
 
+    search.search_type = "quantity"
     return search
 
 
@@ -87,6 +89,7 @@ def DateSearch(column):
         (col <= date_ceil(value, trim=False)),
 )
 
+    search_datetime.search_type = "date"
     return search_datetime
 
 
@@ -110,6 +113,7 @@ def StringSearch(*column_names):
             return sql_query.filter(or_(col == value for col in columns))
         return sql_query.filter(or_(col.startswith(value) for col in columns))
 
+    search.search_type = "string"
     return search
 
 
@@ -136,6 +140,7 @@ def NameSearch(column):
 
         return sql_query.filter(col.contains(value))
 
+    search_name.search_type = "string"
     return search_name
 
 
@@ -145,3 +150,105 @@ def SimpleSearch(column):
         return sql_query.filter(col == value)
 
     return search
+
+
+def ChainedSearch(column, target_cls):
+    """
+    Search on a parameter of the resource referenced by ``column``, eg
+    ``Observation?subject:Patient.name=smith``.
+
+    The search is applied on a query of ``target_cls`` that is then used as an
+    ``IN`` subquery, so the whole chain is executed as a single statement.
+    """
+
+    def search(cls, field_name, value, sql_query, query):
+        target_query = target_cls.apply_search(
+            field_name, value, target_cls._get_orm_query(), query
+        )
+        pk = inspect(target_cls).primary_key[0]
+        col = getattr(cls, column)
+        return sql_query.filter(col.in_(target_query.with_entities(pk)))
+
+    return search
+
+
+def ReverseChainedSearch(source_cls, column):
+    """
+    Search for resources that are referenced by ``column`` of a ``source_cls``
+    matching a parameter, eg ``Patient?_has:Observation:subject:code=1234-5``.
+
+    The search is applied on a query of ``source_cls`` that is then used as an
+    ``IN`` subquery, so the whole chain is executed as a single statement.
+    """
+
+    def search(cls, field_name, value, sql_query, query):
+        source_query = source_cls.apply_search(
+            field_name, value, source_cls._get_orm_query(), query
+        )
+        pk = inspect(cls).primary_key[0]
+        col = getattr(source_cls, column)
+        return sql_query.filter(pk.in_(source_query.with_entities(col)))
+
+    return search
+
+
+def CompartmentSearch(*column_names):
+    """
+    Search for resources that belong to a compartment, eg ``Patient/123/Observation``.
+    ``column_names`` are the columns of the references that make a resource a member
+    of the compartment, so all of them are combined in a single ``OR`` predicate.
+    """
+    if len(column_names) == 0:
+        raise TypeError(
+            "CompartmentSearch takes at least one positional argument (0 given)"
+        )
+
+    def search(cls, field_name, value, sql_query, query):
+        columns = [getattr(cls, column) for column in column_names]
+        return sql_query.filter(or_(*[col == value for col in columns]))
+
+    return search
+
+
+def FullTextSearch(field="content"):
+    """
+    Search the full text index, ranking the best matches first. Use ``field="content"``
+    for the ``_content`` parameter, which matches any text in the resource, and
+    ``field="text"`` for the ``_text`` parameter, which only matches the narrative.
+
+    Declaring this searcher adds the mapping to the index, see :mod:`fhirbug.db.backends.SQLAlchemy.fulltext`.
+    """
+
+    def search(cls, field_name, value, sql_query, query):
+        from fhirbug.db.backends.SQLAlchemy import fulltext
+
+        return fulltext.search(cls, field, value, sql_query)
+
+    search.fulltext_field = field
+    search.search_type = "special"
+    return search
+
+
+def IndexedSearch(param=None):
+    """
+    Search a parameter using the search index tables instead of a column of the model,
+    see :mod:`fhirbug.db.backends.SQLAlchemy.search_index`. The type of the parameter and
+    the paths its values are extracted from are read from its definition in
+    ``settings.SEARCH_PARAMETERS_PATH``.
+
+    :param str param: The code of the search parameter, defaults to the name of the attribute
+                      the searcher is declared on. It is required if the attribute has a
+                      ``search_regex``, or its values could not be indexed under the code
+                      it is searched by.
+    """
+
+    def search(cls, field_name, value, sql_query, query):
+        from fhirbug.db.backends.SQLAlchemy import search_index
+
+        name, _, modifier = field_name.partition(":")
+        return search_index.search(
+            cls, param or name, value, sql_query, modifier or None
+        )
+
+    search.indexed_parameter = param
+    return search
@@ -3,7 +3,11 @@ from bson.errors import InvalidId
 
 from fhirbug.models.attributes import Attribute
 from fhirbug.config import settings, import_models
-from fhirbug.exceptions import MappingValidationError, DoesNotExistError
+from fhirbug.exceptions import (
+    MappingValidationError,
+    DoesNotExistError,
+    QueryValidationError,
+)
 
 
 class ObjectIdReferenceAttribute(Attribute):
@@ -119,3 +123,61 @@ class ObjectIdReferenceAttribute(Attribute):
                 print(f"{e.resource_type}/{e.pk} was not found on the server.")
 
         return super(ObjectIdReferenceAttribute, self).__set__(instance, value)
+
+    def references(self, resource_type):
+        """
+        Return True if this attribute can reference resources of type ``resource_type``
+        """
+        return resource_type in self.possible_types
+
+    @property
+    def reference_column(self):
+        """
+        The name of the field holding the referenced ObjectId
+        """
+        if not isinstance(self.pk_getter, str):
+            raise QueryValidationError(
+                f"{self._attribute_name} does not support chained searches"
+            )
+        return self.pk_getter
+
+    def chained_searcher(self, resource_type=None):
+        """
+        Return a searcher that filters on a search parameter of the referenced resource.
+        It is used for chained searches like ``Observation?subject:Patient.name=smith``.
+        If the reference has more than one possible types, ``resource_type`` must be provided.
+
+        :param resource_type: The resource type specified in the chain, if any
+        """
+        from fhirbug.db.backends.pymodm.searches import ChainedSearch
+
+        if resource_type is None:
+            if len(self.possible_types) != 1:
+                raise QueryValidationError(
+                    f"{self._attribute_name} can reference more than one resource types, "
+                    "you must specify one in the chained parameter"
+                )
+            resource_type = self.possible_types[0]
+        if not self.references(resource_type):
+            raise QueryValidationError(
+                f"{self._attribute_name} can not reference a {resource_type}"
+            )
+        models = import_models()
+        return ChainedSearch(self.reference_column, getattr(models, resource_type))
+
+    def reverse_chained_searcher(self, owner_cls, resource_type):
+        """
+        Return a searcher that filters resources of type ``resource_type`` that are
+        referenced by this attribute of an ``owner_cls`` matching a search parameter.
+        It is used for reverse chained searches like ``Patient?_has:Observation:subject:code=1234-5``.
+
+        :param owner_cls: The model class this attribute belongs to
+        :param resource_type: The type of the resource being searched
+        """
+        from fhirbug.db.backends.pymodm.searches import ReverseChainedSearch
+
+        if not self.references(resource_type):
+            raise QueryValidationError(
+                f"{self._attribute_name} can not reference a {resource_type}"
+            )
+        return ReverseChainedSearch(owner_cls, self.reference_column)
@@ -0,0 +1,91 @@
+"""
+Full text index for the ``_content`` and ``_text`` search parameters.
+
+The text of every indexed resource is kept in a side collection, ``fhirbug_fulltext``,
+holding a document per resource and indexed field with a compound text index, so a
+search only scans the entries of a single resource type and field.
+
+Mappings are indexed when they declare a :func:`fhirbug.db.backends.pymodm.searches.FullTextSearch`
+searcher.
+"""
+from pymongo import ASCENDING, TEXT
+
+from fhirbug.config import settings
+from fhirbug.utils import fulltext_values
+
+COLLECTION = "fhirbug_fulltext"
+FIELDS = ("content", "text")
+
+_ready = set()
+
+
+def get_collection(cls):
+    """
+    Return the index collection in the database of ``cls``, creating its index if needed.
+    """
+    database = cls._mongometa.collection.database
+    collection = database[COLLECTION]
+    if database.name not in _ready:
+        collection.create_index(
+            [("resource_type", ASCENDING), ("field", ASCENDING), ("value", TEXT)]
+        )
+        _ready.add(database.name)
+    return collection
+
+
+def update_index(instance, resource_type):
+    """
+    Replace the indexed text of ``instance``.
+    """
+    collection = get_collection(instance.__class__)
+    remove_from_index(instance, resource_type)
+    values = fulltext_values(instance.to_fhir().as_json())
+    collection.insert_many(
+        [
+            {
+                "resource_type": resource_type,
+                "resource_id": instance.pk,
+                "field": field,
+                "value": value,
+            }
+            for field, value in zip(FIELDS, values)
+        ]
+    )
+
+
+def remove_from_index(instance, resource_type):
+    """
+    Remove ``instance`` from the index.
+    """
+    get_collection(instance.__class__).delete_many(
+        {"resource_type": resource_type, "resource_id": instance.pk}
+    )
+
+
+def search(cls, field, value, sql_query):
+    """
+    Filter ``sql_query`` to the resources whose ``field`` matches ``value``.
+
+    The ids of the best ``settings.FULLTEXT_MAX_RESULTS`` matches are fetched from the
+    index sorted by their text score and then used in an ``$in`` filter. Since MongoDB
+    can not sort by the position in an ``$in`` list, the ranking only decides which
+    resources are returned and the results keep the default order.
+    """
+    if field not in FIELDS:
+        raise ValueError(f"Can not search the full text index by {field}")
+    score = {"score": {"$meta": "textScore"}}
+    matches = (
+        get_collection(cls)
+        .find(
+            {
+                "resource_type": cls._get_resource_cls().__name__,
+                "field": field,
+                "$text": {"$search": value},
+            },
+            {"resource_id": True, **score},
+        )
+        .sort([("score", {"$meta": "textScore"})])
+        .limit(settings.FULLTEXT_MAX_RESULTS)
+    )
+    ids = [match["resource_id"] for match in matches]
+    return sql_query.raw({"_id": {"$in": ids}})
@@ -1,11 +1,31 @@
 from pymodm.errors import DoesNotExist
 from bson.objectid import ObjectId
 from bson.errors import InvalidId
+from pymongo.errors import BulkWriteError
 from fhirbug.db.backends.pymodm.pagination import paginate
+from fhirbug.db.backends.pymodm import fulltext
 from fhirbug.models.mixins import FhirAbstractBaseMixin, FhirBaseModelMixin
 from fhirbug.exceptions import DoesNotExistError
 
 
+def inserted_before(instance, error):
+    """
+    Whether the :class:`BulkWriteError` of inserting ``instance`` on its own means that
+    it had already been inserted, by a batch that failed after it. Inserts are ordered,
+    so the documents of a batch before the one that failed are kept.
+    """
+    errors = error.details.get("writeErrors", [])
+    return (
+        getattr(instance, "_generated_pk", False)
+        and len(errors) == 1
+        and errors[0].get("code") == 11000
+        and (
+            errors[0].get("keyPattern") == {"_id": 1}
+            or " index: _id_ " in errors[0].get("errmsg", "")
+        )
+    )
+
+
 class AbstractBaseModel(FhirAbstractBaseMixin):
     """
   The base class to provide functionality to
@@ -26,10 +46,36 @@ class AbstractBaseModel(FhirAbstractBaseMixin):
         except (DoesNotExist, InvalidId):
             raise DoesNotExistError(resource_type=cls.__name__, pk=pk)
 
+    @classmethod
+    def _get_version(cls, pk):
+        try:
+            names = filter(None, cls._version_attributes())
+            return cls.objects.only(*names).get({"_id": ObjectId(pk)}).get_version()
+        except (DoesNotExist, InvalidId):
+            raise DoesNotExistError(resource_type=cls.__name__, pk=pk)
+
+    @classmethod
+    def _slice(cls, query, offset, limit):
+        return list(query.skip(offset).limit(limit))
+
+    @classmethod
+    def _count(cls, query):
+        return query.count()
+
+    @classmethod
+    def _iterate(cls, query, batch_size):
+        # Read the raw documents from the cursor batch_size at a time
+        cursor = query.order_by([("_id", 1)])._get_raw_cursor().batch_size(batch_size)
+        return (cls.from_document(document) for document in cursor)
+
     @classmethod
     def _delete_item(cls, item):
         item.delete()
 
+    @classmethod
+    def _delete_query(cls, query):
+        return query.delete()
+
 class FhirBaseModel(AbstractBaseModel, FhirBaseModelMixin):
     class Meta:
         abstract = True
@@ -41,9 +87,38 @@ class FhirBaseModel(AbstractBaseModel, FhirBaseModelMixin):
     @classmethod
     def _after_create(cls, instance):
         instance.save()
+        if cls._fulltext_indexed():
+            fulltext.update_index(instance, cls._get_resource_cls().__name__)
         return instance
 
     @classmethod
     def _after_update(cls, instance):
         instance.save()
+        if cls._fulltext_indexed():
+            fulltext.update_index(instance, cls._get_resource_cls().__name__)
         return instance
+
+    @classmethod
+    def _bulk_insert(cls, instances):
+        # insert_many does not set the ids of the new documents on the instances. They
+        # are needed for indexing, and to tell which documents of a batch that failed
+        # part way were inserted before it failed
+        for instance in instances:
+            if instance.pk is None:
+                instance.pk = ObjectId()
+                instance._generated_pk = True
+        try:
+            cls.objects.bulk_create(instances)
+        except BulkWriteError as e:
+            # Batches that fail are inserted again one document at a time
+            if len(instances) > 1 or not inserted_before(instances[0], e):
+                raise
+        if cls._fulltext_indexed():
+            for instance in instances:
+                fulltext.update_index(instance, cls._get_resource_cls().__name__)
+
+    @classmethod
+    def _delete_item(cls, item):
+        if cls._fulltext_indexed():
+            fulltext.remove_from_index(item, cls._get_resource_cls().__name__)
+        return super()._delete_item(item)
@@ -1,6 +1,8 @@
 import isodate
 import calendar
 from datetime import timedelta, datetime
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
 from fhirbug.exceptions import QueryValidationError
 from fhirbug.utils import date_ceil, transform_date
 
@@ -35,6 +37,7 @@ def NumericSearch(column):
 
         return sql_query.raw({column: to_float(value)})
 
+    search.search_type = "number"
     return search
 
 
@@ -49,6 +52,7 @@ def NumericSearchWithQuantity(column, convert_value=None, alter_query=None):
                 sql_query = alter_query(query, value, quantity)
         return NumericSearch(column).search(cls, field_name, value, sql_query, query)
 
+    search.search_type = "quantity"
     return search
 
 
@@ -74,6 +78,7 @@ def DateSearch(column):
             return sql_query.raw({column: {"$gte": floor, "$lte": ceil}})
         return sql_query.raw({column: {"$gte": transform_date(value, to_datetime=True), "$lte": date_ceil(value, trim=False)}})
 
+    search_datetime.search_type = "date"
     return search_datetime
 
 
@@ -100,6 +105,7 @@ def StringSearch(*column_names):
         filter = {"$or": [{col: {"$regex": regex}} for col in column_names]}
         return sql_query.raw(filter)
 
+    search.search_type = "string"
     return search
 
 
@@ -126,6 +132,7 @@ def NameSearch(column):
 
         return sql_query.filter({column: {"$text": value}})
 
+    search_name.search_type = "string"
     return search_name
 
 
@@ -142,3 +149,85 @@ def EmbeddedSearch(column):
         else:
             field = 'id'
         return sql_query.filter({column: {field: value}})
+
+    return search
+
+
+def ChainedSearch(column, target_cls):
+    """
+    Search on a parameter of the resource referenced by ``column``, eg
+    ``Observation?subject:Patient.name=smith``.
+
+    Mongo can not use a query on a different collection as a filter, so this is
+    done in two phases. The ids of the matching ``target_cls`` documents are
+    fetched with a single ``distinct`` command and then used in an ``$in`` filter.
+    """
+
+    def search(cls, field_name, value, sql_query, query):
+        target_query = target_cls.apply_search(
+            field_name, value, target_cls._get_orm_query(), query
+        )
+        ids = target_query._collection.distinct("_id", target_query.raw_query)
+        return sql_query.raw({column: {"$in": ids}})
+
+    return search
+
+
+def ReverseChainedSearch(source_cls, column):
+    """
+    Search for resources that are referenced by ``column`` of a ``source_cls``
+    matching a parameter, eg ``Patient?_has:Observation:subject:code=1234-5``.
+
+    The referenced ids are collected from the matching ``source_cls`` documents
+    with a single ``distinct`` command and then used in an ``$in`` filter.
+    """
+
+    def search(cls, field_name, value, sql_query, query):
+        source_query = source_cls.apply_search(
+            field_name, value, source_cls._get_orm_query(), query
+        )
+        ids = source_query._collection.distinct(column, source_query.raw_query)
+        return sql_query.raw({"_id": {"$in": ids}})
+
+    return search
+
+
+def CompartmentSearch(*column_names):
+    """
+    Search for resources that belong to a compartment, eg ``Patient/123/Observation``.
+    ``column_names`` are the fields of the references that make a resource a member
+    of the compartment, so all of them are combined in a single ``$or`` filter.
+    """
+    if len(column_names) == 0:
+        raise TypeError(
+            "CompartmentSearch takes at least one positional argument (0 given)"
+        )
+
+    def search(cls, field_name, value, sql_query, query):
+        try:
+            value = ObjectId(value)
+        except InvalidId:
+            raise QueryValidationError(f"{value} is an invalid resource identifier")
+        filter = {"$or": [{col: value} for col in column_names]}
+        return sql_query.raw(filter)
+
+    return search
+
+
+def FullTextSearch(field="content"):
+    """
+    Search the full text index. Use ``field="content"`` for the ``_content`` parameter,
+    which matches any text in the resource, and ``field="text"`` for the ``_text``
+    parameter, which only matches the narrative.
+
+    Declaring this searcher adds the mapping to the index, see :mod:`fhirbug.db.backends.pymodm.fulltext`.
+    """
+
+    def search(cls, field_name, value, sql_query, query):
+        from fhirbug.db.backends.pymodm import fulltext
+
+        return fulltext.search(cls, field, value, sql_query)
+
+    search.fulltext_field = field
+    search.search_type = "special"
+    return search
@@ -0,0 +1,35 @@
+"""
+Mark the parts of a request that only read, so backends may route their queries to
+read replicas of the database.
+"""
+import contextvars
+from contextlib import contextmanager
+
+# True while the current context only reads
+_read_only = contextvars.ContextVar("fhirbug_read_only", default=False)
+
+
+@contextmanager
+def read_only():
+    """
+    A context manager marking the queries run inside it as reads that may be served
+    by a read replica. Backends still send writes made inside it to the primary.
+
+    The mark is part of the context that :func:`fhirbug.utils.concurrent_map` copies to
+    its worker threads, so the queries of includes and compartment searches that run
+    on them go to the replicas too. Tables written by the process in the last
+    ``REPLICA_LAG`` seconds are tracked for the whole process, so those queries still
+    read them from the primary.
+    """
+    token = _read_only.set(True)
+    try:
+        yield
+    finally:
+        _read_only.reset(token)
+
+
+def is_read_only():
+    """
+    Return whether the current context is inside a :func:`read_only` block.
+    """
+    return _read_only.get()
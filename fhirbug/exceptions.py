@@ -16,6 +16,14 @@ class QueryValidationError(Exception):
     pass
 
 
+class UnsupportedParameterError(QueryValidationError):
+    """
+    A search parameter or modifier that the requested resource can not be searched by
+    """
+
+    pass
+
+
 class MappingValidationError(Exception):
     """
     A fhir mapping has been set up wrong
@@ -4,9 +4,11 @@ from fhirbug.exceptions import (
     MappingValidationError,
     UnsupportedOperationError,
     MappingException,
+    QueryValidationError,
 )
 from fhirbug.Fhir import resources as fhir
 from fhirbug.config import import_searches, import_models, settings
+from fhirbug.models import includes
 from fhirbug.server import get_request_context
 
 
@@ -36,6 +38,9 @@ def audited(func):
         ):
             res = getattr(desc, method)(instance._model, ctx, prop_name)
             if res != True:
+                if method == "audit_set":
+                    # Nothing was set
+                    desc._mark_tracked(instance)
                 return None
         return func(desc, instance, arg)
 
@@ -155,6 +160,31 @@ class Attribute:
     >>> b.p = 3
     >>> b._model.column_name
     15
+
+    Change detection
+    ----------------
+
+    Values that are equal to the current value of the column, or to the output of the
+    getter for callable setters, are not set. The names of the attributes that did
+    change are added to the ``_changed`` set of the instance, if it has one, and the
+    names of all the attributes that were set to its ``_tracked`` set:
+
+    >>> class Bla:
+    ...   _model = SN(column_name=12)
+    ...   p = Attribute('column_name', 'column_name')
+    ...
+    >>> b = Bla()
+    >>> b._changed = set()
+    >>> b.p = 12
+    >>> b._changed
+    set()
+    >>> b.p = 13
+    >>> b._changed
+    {'p'}
+
+    Subclasses that override ``__set__`` without calling ``Attribute.__set__`` are not
+    tracked, so updates assume that they changed something and always save them, see
+    :meth:`update_from_resource <fhirbug.models.mixins.FhirBaseModelMixin.update_from_resource>`.
     """
 
     def __init__(
@@ -176,6 +206,9 @@ class Attribute:
 
     @audited
     def __get__(self, instance, owner):
+        return self._get_value(instance)
+
+    def _get_value(self, instance):
         getter = self.getter
         # Strings are column names
         if isinstance(getter, str):
@@ -193,6 +226,7 @@ class Attribute:
 
     @audited
     def __set__(self, instance, value):
+        self._mark_tracked(instance)
         try:
             setter = self.setter
             assert setter is not None
@@ -207,18 +241,51 @@ class Attribute:
 
         # Strings are column names
         if isinstance(setter, str):
-            setattr(instance._model, setter, value)
+            self._set_column(instance, setter, value)
         # Callables should be called
         if callable(setter):
+            if self.getter is not None and self._getter_equals(instance, value):
+                return
             setter(instance, value)
+            self._mark_changed(instance)
         # Two-tuples contain a column name and a callable or const. Set the column to the result of the callable or const
         if isinstance(setter, (tuple, list)):
             column, func = setter
             if isinstance(func, const):
-                setattr(instance._model, column, func.value)
+                self._set_column(instance, column, func.value)
             else:
                 res = func(getattr(instance._model, column), value)
-                setattr(instance._model, column, res)
+                self._set_column(instance, column, res)
+
+    def _set_column(self, instance, column, value):
+        """
+        Set a column of the model unless it already holds ``value``.
+        """
+        if not _changes(getattr(instance._model, column, None), value):
+            return
+        setattr(instance._model, column, value)
+        self._mark_changed(instance)
+
+    def _getter_equals(self, instance, value):
+        """
+        Return whether the getter already returns ``value``, comparing the json of Fhir
+        elements. Getters that fail are assumed to return something else.
+        """
+        try:
+            current = self._get_value(instance)
+        except Exception:
+            return False
+        return not _changes(_as_json(current), _as_json(value))
+
+    def _mark_changed(self, instance):
+        changed = getattr(instance, "_changed", None)
+        if changed is not None:
+            changed.add(getattr(self, "_attribute_name", None))
+
+    def _mark_tracked(self, instance):
+        tracked = getattr(instance, "_tracked", None)
+        if tracked is not None:
+            tracked.add(getattr(self, "_attribute_name", None))
 
     def __set_name__(self, owner, name):
         """
@@ -248,6 +315,35 @@ class Attribute:
                     return k
 
 
+# Values that can not be changed in place, so a setter that returns the value it was
+# given has not changed anything
+IMMUTABLE_TYPES = (str, bytes, int, float, bool, type(None))
+
+
+def _changes(current, new):
+    """
+    Return whether setting ``new`` over ``current`` changes anything. Values of
+    different types are always considered different, and so are mutable values that a
+    setter returns after changing them in place.
+    """
+    if new is current:
+        return not isinstance(new, IMMUTABLE_TYPES)
+    if type(new) is not type(current):
+        return True
+    try:
+        return bool(new != current)
+    except Exception:
+        return True
+
+
+def _as_json(value):
+    if isinstance(value, list):
+        return [_as_json(item) for item in value]
+    if hasattr(value, "as_json"):
+        return value.as_json()
+    return value
+
+
 class const:
     """
     const can be used as a getter for an attribute that should always return the same value
@@ -334,11 +430,17 @@ class ReferenceAttribute(Attribute):
         if (
             self.name in instance._model._contained_names
         ):  # The resource should be contained
-            # Get the item
-            item = self.cls._get_orm_query().get(id)
+            # Use the item if it has been fetched with the rest of the page
+            prefetched = includes.prefetched_include(instance._model, self.cls, id)
+            if prefetched is not None:
+                as_fhir, display = prefetched
+            else:
+                # Get the item
+                item = self.cls._get_orm_query().get(id)
 
-            # TODO: try..catch
-            as_fhir = item.to_fhir()
+                # TODO: try..catch
+                as_fhir = item.to_fhir()
+                display = item._as_display() if hasattr(item, "_as_display") else None
 
             instance._model._refcount += 1
 
@@ -349,8 +451,8 @@ class ReferenceAttribute(Attribute):
             reference = {"reference": f"#ref{instance._model._refcount}"}
 
             # Add a display if possible
-            if hasattr(item, "_as_display"):
-                reference["display"] = item._as_display()
+            if display is not None:
+                reference["display"] = display
 
             return reference
 
@@ -382,17 +484,70 @@ class ReferenceAttribute(Attribute):
         except AttributeError:
             pass
 
-        if hasattr(reference, "reference"):
-            ref = reference.reference
+        ref = getattr(reference, "reference", None)
+        if ref:
             if ref.startswith("#"):
                 # TODO read internal reference
                 pass
+            elif value is None:
+                # A literal reference, eg ``Patient/123``
+                resource_type, _, id = "/".join(ref.split("/")[-2:]).partition("/")
+                if id and self.references(resource_type):
+                    value = id
 
         if value is None:
             raise MappingValidationError("Invalid reference")
 
         if self.setter:
-            Attribute(setter=self.setter).__set__(instance, value)
+            attribute = Attribute(setter=self.setter)
+            attribute._attribute_name = getattr(self, "_attribute_name", None)
+            attribute.__set__(instance, value)
+
+    @property
+    def reference_column(self):
+        """
+        The name of the column holding the id of the referenced resource
+        """
+        return self.id
+
+    def references(self, resource_type):
+        """
+        Return True if this attribute can reference resources of type ``resource_type``
+        """
+        return resource_type in (
+            self.cls.__name__,
+            getattr(self.cls, "__Resource__", None),
+        )
+
+    def chained_searcher(self, resource_type=None):
+        """
+        Return a searcher that filters on a search parameter of the referenced resource.
+        It is used for chained searches like ``Observation?subject:Patient.name=smith``.
+
+        :param resource_type: The resource type specified in the chain, if any
+        """
+        if resource_type and not self.references(resource_type):
+            raise QueryValidationError(
+                f"{self._attribute_name} can not reference a {resource_type}"
+            )
+        searches = import_searches()
+        return searches.ChainedSearch(self.id, self.cls)
+
+    def reverse_chained_searcher(self, owner_cls, resource_type):
+        """
+        Return a searcher that filters resources of type ``resource_type`` that are
+        referenced by this attribute of an ``owner_cls`` matching a search parameter.
+        It is used for reverse chained searches like ``Patient?_has:Observation:subject:code=1234-5``.
+
+        :param owner_cls: The model class this attribute belongs to
+        :param resource_type: The type of the resource being searched
+        """
+        if not self.references(resource_type):
+            raise QueryValidationError(
+                f"{self._attribute_name} can not reference a {resource_type}"
+            )
+        searches = import_searches()
+        return searches.ReverseChainedSearch(owner_cls, self.id)
 
 
 class DateAttribute(Attribute):
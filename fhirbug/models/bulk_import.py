@@ -0,0 +1,394 @@
+"""
+Import resources from NDJSON files in bulk, for loading large amounts of data much
+faster than creating them one request at a time.
+
+Lines are parsed and validated as Fhir resources on a pool of ``settings.IMPORT_WORKERS``
+processes. Valid resources are mapped to new instances through the setters of their
+``FhirMap``, audited with ``audit_create`` like any other creation, and inserted in
+batches of ``settings.IMPORT_BATCH_SIZE`` rows per resource type with the bulk insert of
+the backend: ``bulk_save_objects`` on SQLAlchemy, ``bulk_create`` on Django and
+``insert_many`` on pymodm. Every batch is committed on its own. Lines that can not be
+imported are written to an error file as OperationOutcomes and the rest of the file is
+imported anyway.
+
+Imports can be run from the command line::
+
+    python -m fhirbug.models.bulk_import --settings myproject.settings Patient.ndjson
+
+or with the ``$import`` operation, by posting a Parameters resource to ``$import``::
+
+    {
+        "resourceType": "Parameters",
+        "parameter": [{"name": "input", "part": [
+            {"name": "type", "valueCode": "Patient"},
+            {"name": "url", "valueUri": "file:///data/import/Patient.ndjson"}
+        ]}]
+    }
+
+``$import`` only reads files under ``settings.IMPORT_PATH`` and is disabled when it is not
+set. Like ``$export``, it runs in the background and returns the url of the job's status,
+``$import-poll-status/<job id>``, which returns a manifest with the number of resources
+imported from each file once the job is complete.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+try:
+    import resource as _resource
+except ImportError:  # Not available on Windows
+    _resource = None
+
+# The Fhir resources and the mappings are imported when they are used, so that the
+# command line can configure the settings before they are read.
+from fhirbug.config import import_backend, settings
+from fhirbug.exceptions import QueryValidationError, UnsupportedOperationError
+
+ERRORS_FILE = "errors.ndjson"
+
+
+def validate_lines(lines):
+    """
+    Parse and validate NDJSON lines as Fhir resources. It runs in the worker processes.
+
+    :param list lines: ``(line number, line)`` tuples
+    :returns: A list of ``(line number, resource, error)`` tuples, where ``resource`` is
+              ``None`` if the line is not a valid resource and ``error`` says why
+    """
+    from fhirbug.Fhir import resources
+
+    results = []
+    for number, line in lines:
+        try:
+            data = json.loads(line)
+            resource_type = data.get("resourceType")
+            Resource = getattr(resources, str(resource_type), None)
+            if not isinstance(Resource, type) or not hasattr(Resource, "resource_type"):
+                raise ValueError(f"{resource_type} is not a valid resourceType")
+            results.append((number, Resource(data), None))
+        except Exception as e:
+            results.append((number, None, f"{e}"))
+    return results
+
+
+def read_chunks(lines, size):
+    """
+    Group the non empty lines of a file in chunks of ``size`` ``(line number, line)`` tuples.
+    """
+    chunk = []
+    for number, line in enumerate(lines, 1):
+        if line.strip():
+            chunk.append((number, line))
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def validated(lines, workers, chunk_size):
+    """
+    Validate ``lines`` on a pool of ``workers`` processes, in order, with at most two chunks
+    per worker in flight so that files of any size can be streamed.
+
+    :returns: An iterator of ``(line number, resource, error)`` tuples
+    """
+    chunks = read_chunks(lines, chunk_size)
+    if workers <= 1:
+        for chunk in chunks:
+            yield from validate_lines(chunk)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(validate_lines, chunk))
+            if len(pending) >= workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def peak_memory():
+    """
+    The peak memory used by this process in bytes, or ``None`` if it is not known.
+    """
+    if _resource is None:
+        return None
+    usage = _resource.getrusage(_resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes and Linux kilobytes
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+class BulkImport:
+    """
+    Import NDJSON lines into the mappings of the models module.
+
+    :param str errors: Path to the file the OperationOutcomes of the lines that failed are
+                       appended to. It is only created if a line fails.
+    :param int batch_size: How many rows of each type are inserted at a time,
+                           ``settings.IMPORT_BATCH_SIZE`` by default
+    :param int workers: How many processes validate lines, ``settings.IMPORT_WORKERS`` by
+                        default. Lines are validated in this process if it is 1 or less.
+    :param query: Passed to ``from_resource`` and the auditing methods of the mappings
+    """
+
+    def __init__(self, errors=None, batch_size=None, workers=None, query=None):
+        from fhirbug.models import export
+
+        self.models = export.exported_models()
+        self.errors_path = errors
+        self.batch_size = batch_size or settings.IMPORT_BATCH_SIZE
+        if workers is None:
+            workers = settings.IMPORT_WORKERS or os.cpu_count() or 1
+        self.workers = workers
+        self.query = query
+        #: The number of resources imported
+        self.count = 0
+        #: The number of lines that failed
+        self.error_count = 0
+        self.started = time.perf_counter()
+        self._errors = None
+
+    def run(self, lines, resource_type=None, source=""):
+        """
+        Import an iterable of NDJSON lines, eg an open file.
+
+        :param str resource_type: If given, every line must be a resource of this type
+        :param str source: The name of the file, used in error messages
+        :returns: The number of resources that were imported
+        """
+        before = self.count
+        batches = {}
+        for number, resource, error in validated(lines, self.workers, self.batch_size):
+            if resource is not None:
+                name = resource.resource_type
+                if resource_type and name != resource_type:
+                    error = f"Expected a {resource_type} resource, found {name}"
+                elif name not in self.models:
+                    error = f"{name} resources are not supported"
+            if error is not None:
+                self.error(source, number, error)
+                continue
+
+            Model = self.models[name]
+            try:
+                instance = Model.from_resource(resource, query=self.query)
+            except Exception as e:
+                self.error(source, number, e)
+                continue
+            batch = batches.setdefault(name, [])
+            batch.append((number, instance))
+            if len(batch) >= self.batch_size:
+                self.insert(Model, batch, source)
+                batch.clear()
+
+        for name, batch in batches.items():
+            if batch:
+                self.insert(self.models[name], batch, source)
+        return self.count - before
+
+    def insert(self, Model, batch, source):
+        """
+        Insert a batch of new instances. If the batch fails, its rows are inserted one at
+        a time so that only the rows that fail are skipped.
+        """
+        from fhirbug.models import cache
+
+        try:
+            Model._bulk_insert([instance for number, instance in batch])
+            self.count += len(batch)
+        except Exception:
+            for number, instance in batch:
+                try:
+                    Model._bulk_insert([instance])
+                    self.count += 1
+                except Exception as e:
+                    self.error(source, number, e)
+        cache.invalidate(Model)
+
+    def error(self, source, number, error):
+        self.error_count += 1
+        if self.errors_path is None:
+            return
+        if self._errors is None:
+            self._errors = open(self.errors_path, "a", encoding="utf-8")
+        from fhirbug.models import export
+
+        location = f"{source}:{number}" if source else f"{number}"
+        outcome = export.error_outcome(f"{location}: {error}")
+        outcome["issue"][0]["code"] = "invalid"
+        self._errors.write(json.dumps(outcome) + "\n")
+
+    def close(self):
+        if self._errors is not None:
+            self._errors.close()
+            self._errors = None
+
+    def report(self):
+        """
+        :returns: A dict with the number of resources imported, the number of lines that failed,
+                  the elapsed seconds, the resources imported per second and the peak memory
+                  in bytes
+        """
+        seconds = time.perf_counter() - self.started
+        return {
+            "count": self.count,
+            "errors": self.error_count,
+            "seconds": seconds,
+            "rate": self.count / seconds if seconds else 0,
+            "peak_memory": peak_memory(),
+        }
+
+
+def import_inputs(body):
+    """
+    Read the files to import from the Parameters resource posted to ``$import``.
+
+    :returns: A list of ``(resource type, path, url)`` tuples
+    """
+    if not settings.IMPORT_PATH:
+        raise UnsupportedOperationError("$import is not enabled on this server.")
+    if not isinstance(body, dict) or body.get("resourceType") != "Parameters":
+        raise QueryValidationError("$import expects a Parameters resource.")
+
+    root = os.path.realpath(settings.IMPORT_PATH)
+    inputs = []
+    for parameter in body.get("parameter", []):
+        if parameter.get("name") != "input":
+            continue
+        parts = {part.get("name"): part for part in parameter.get("part", [])}
+        resource_type = parts.get("type", {}).get("valueCode")
+        url = parts.get("url", {}).get("valueUri") or parts.get("url", {}).get("valueUrl")
+        if not url:
+            raise QueryValidationError("Every input of $import must have a url.")
+        parsed = urlparse(url)
+        if parsed.scheme not in ("", "file"):
+            raise QueryValidationError(f"Only local files can be imported, not {url}")
+        path = os.path.realpath(os.path.join(root, url2pathname(parsed.path)))
+        if os.path.commonpath([root, path]) != root or not os.path.isfile(path):
+            raise QueryValidationError(f"{url} is not a file that can be imported.")
+        inputs.append((resource_type, path, url))
+    if not inputs:
+        raise QueryValidationError("$import requires at least one input.")
+    return inputs
+
+
+def run_import(job_id, inputs, request_url, query=None):
+    """
+    Import the files of a ``$import`` job and write its manifest, or the error that stopped it.
+    """
+    from fhirbug.models import export
+
+    path = export.job_path(job_id)
+    transaction_time = datetime.now(timezone.utc)
+    importer = BulkImport(errors=os.path.join(path, ERRORS_FILE), query=query)
+    try:
+        output = []
+        for resource_type, file_path, url in inputs:
+            with open(file_path, encoding="utf-8") as f:
+                count = importer.run(f, resource_type, os.path.basename(file_path))
+            output.append({"type": resource_type, "inputUrl": url, "count": count})
+        importer.close()
+        errors = []
+        if importer.error_count:
+            errors.append(
+                {
+                    "type": "OperationOutcome",
+                    "url": export.file_url(job_id, ERRORS_FILE),
+                    "count": importer.error_count,
+                }
+            )
+        export.save_json(
+            os.path.join(path, export.MANIFEST),
+            {
+                "transactionTime": transaction_time.isoformat(),
+                "request": request_url,
+                "requiresAccessToken": False,
+                "output": output,
+                "error": errors,
+            },
+        )
+    except Exception as e:
+        importer.close()
+        export.save_json(
+            os.path.join(path, export.ERROR), export.error_outcome(f"The import failed: {e}")
+        )
+    finally:
+        import_backend("models").AbstractBaseModel._close_thread_session()
+
+
+def start_import(body, request_url, query=None):
+    """
+    Start a ``$import`` job in the background.
+
+    :param dict body: The Parameters resource that was posted
+    :param str request_url: The url of the request
+    :returns: The id of the job
+    """
+    from fhirbug.models import export
+
+    inputs = import_inputs(body)
+    job_id = uuid.uuid4().hex
+    export.make_job_path(job_id)
+    threading.Thread(
+        target=run_import,
+        args=(job_id, inputs, request_url, query),
+        name=f"fhirbug-import-{job_id}",
+        daemon=True,
+    ).start()
+    return job_id
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m fhirbug.models.bulk_import",
+        description="Import resources from NDJSON files.",
+    )
+    parser.add_argument("files", nargs="+", help="The NDJSON files to import")
+    parser.add_argument(
+        "--settings", help="The module path of the fhirbug settings, eg myproject.settings"
+    )
+    parser.add_argument("--type", help="Only accept resources of this type")
+    parser.add_argument("--batch-size", type=int, help="How many rows to insert at a time")
+    parser.add_argument("--workers", type=int, help="How many processes validate lines")
+    parser.add_argument(
+        "--errors",
+        default="import-errors.ndjson",
+        help="The file lines that fail are written to (default: %(default)s)",
+    )
+    args = parser.parse_args(argv)
+    if args.settings:
+        settings.configure(args.settings)
+
+    importer = BulkImport(
+        errors=args.errors, batch_size=args.batch_size, workers=args.workers
+    )
+    for path in args.files:
+        with open(path, encoding="utf-8") as f:
+            count = importer.run(f, args.type, os.path.basename(path))
+        print(f"{path}: {count} resources imported")
+    importer.close()
+
+    report = importer.report()
+    memory = report["peak_memory"]
+    print(
+        f"Imported {report['count']} resources in {report['seconds']:.1f}s "
+        f"({report['rate']:.0f} resources/s), {report['errors']} errors"
+        + (f", peak memory {memory / 2 ** 20:.0f} MB" if memory else "")
+    )
+    if report["errors"]:
+        print(f"The lines that failed have been written to {args.errors}")
+    return 1 if report["errors"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
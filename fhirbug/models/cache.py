@@ -0,0 +1,416 @@
+"""
+Caches of rendered resources and search results.
+
+Read cache
+----------
+
+Reads of ``Resource/id`` can be served from a cache of the rendered resources, so that
+hot resources such as the current Practitioner, Organizations and Locations are not
+fetched and mapped on every request.
+
+It is disabled by default. Set ``settings.READ_CACHE`` to enable it:
+
+- ``"local"`` keeps a :class:`LocalCache` in the memory of each process, bounded by
+  ``READ_CACHE_MAX_ENTRIES`` entries and ``READ_CACHE_MAX_BYTES`` bytes.
+- A :class:`SharedCache` keeps entries in a cache shared by all processes, such as
+  memcached or redis, through a small client object.
+- Any other object with the ``get``, ``set``, ``delete`` and ``stats`` methods of
+  :class:`LocalCache` can be used as well.
+
+Entries are keyed by the resource type, the id, the ``_elements`` of the request and
+the version of the resource, if the mapping declares a ``__Version__`` or
+``__LastUpdated__`` attribute. Versioned mappings read the current version with a small
+query before each hit, so they never serve stale resources.
+
+Entries of other mappings are invalidated when a resource is updated or deleted through
+fhirbug, but only in the cache of the process that wrote it, and writes made to the
+database by other applications are not noticed at all. They expire after
+``READ_CACHE_TTL`` seconds, so with a ``"local"`` cache and several worker processes,
+or other applications writing to the database, they may be that stale. Declare a version
+attribute or use a :class:`SharedCache` where that matters.
+
+Reads of mappings that define ``audit_read`` are never cached, since auditing may
+depend on the user and change what is rendered, and neither are reads that ask for
+``_include`` or ``_revinclude``.
+
+Search cache
+------------
+
+Pages of search results can be cached as well, so that identical searches, like the
+polling of worklists, are not run again every few seconds. It is enabled by setting
+``settings.SEARCH_CACHE`` in the same way, and cached pages expire after
+``SEARCH_CACHE_TTL`` seconds.
+
+Pages are keyed by the parsed search parameters and modifiers of the request in
+canonical order, and by who is searching, which is the ``Authorization`` header of
+the request unless ``settings.SEARCH_CACHE_CONTEXT`` is set to a function that returns
+it for a :class:`fhirbug.server.requestparser.FhirRequestQuery`. Any write to a resource
+type invalidates the cached searches that involve it, including chained searches,
+``_has``, ``_include`` and ``_revinclude``.
+
+Mappings whose ``audit_read`` depends on more than the search context should opt out
+by setting ``__SearchCache__ = False``.
+
+Hits, misses and invalidations of both caches are counted and returned by :func:`stats`.
+"""
+import hashlib
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from fhirbug.config import settings
+from fhirbug.exceptions import DoesNotExistError
+from fhirbug.server.requestparser import parse_chained_param, parse_reverse_chained_param
+
+# Modifiers that add other resources to a read, which are not invalidated with it
+UNCACHED_MODIFIERS = ("_include", "_revinclude")
+
+# The generation of searches whose resource types are not known, which any write invalidates
+ANY_TYPE = "*"
+
+
+class LocalCache:
+    """
+    A thread safe LRU cache of strings in the memory of the process.
+
+    :param int max_entries: The most entries that are kept
+    :param int max_bytes: The most characters of values that are kept, roughly the
+                          memory used by them in bytes
+    :param int timeout: Seconds after which entries expire, by default they don't
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024, timeout=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :returns: The value of ``key``, or ``None`` if it is not cached or has expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        timeout = timeout or self.timeout
+        expires = time.monotonic() + timeout if timeout else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if len(value) > self.max_bytes:
+                return
+            self._entries[key] = (value, expires)
+            self.size += len(value)
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        value, expires = self._entries.pop(key)
+        self.size -= len(value)
+
+    def stats(self):
+        return {"entries": len(self._entries), "bytes": self.size}
+
+
+class SharedCache:
+    """
+    Keep entries in a cache shared by processes.
+
+    ``client`` must have the methods ``get(key)``, ``set(key, value, timeout)`` and
+    ``delete(key)`` of :class:`LocalCache`, so adapting the client of memcached or redis
+    takes a few lines, and a :class:`LocalCache` can stand in for it in development.
+    Errors of the client are ignored, so requests are still served if the cache is down.
+
+    :param client: The cache client
+    :param str prefix: Prepended to all keys, to share a cache between applications
+    :param int timeout: Seconds after which entries expire
+    """
+
+    def __init__(self, client, prefix="fhirbug:", timeout=None):
+        self.client = client
+        self.prefix = prefix
+        self.timeout = timeout
+        self.errors = 0
+
+    def get(self, key):
+        try:
+            return self.client.get(self.prefix + key)
+        except Exception:
+            self.errors += 1
+            return None
+
+    def set(self, key, value, timeout=None):
+        try:
+            self.client.set(self.prefix + key, value, timeout or self.timeout)
+        except Exception:
+            self.errors += 1
+
+    def delete(self, key):
+        try:
+            self.client.delete(self.prefix + key)
+        except Exception:
+            self.errors += 1
+
+    def stats(self):
+        return {"errors": self.errors}
+
+
+class Metrics:
+    """
+    Thread safe counters of cache hits and misses.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def add(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def reset(self):
+        with self._lock:
+            self.counts = {"hits": 0, "misses": 0, "invalidations": 0}
+
+
+read_metrics = Metrics()
+search_metrics = Metrics()
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def read_cache():
+    """
+    Return the cache of reads configured in ``settings.READ_CACHE``, or ``None`` if it
+    is disabled.
+    """
+    configured = settings.READ_CACHE
+    if configured != "local":
+        return configured
+    with _caches_lock:
+        if "read" not in _caches:
+            _caches["read"] = LocalCache(
+                settings.READ_CACHE_MAX_ENTRIES, settings.READ_CACHE_MAX_BYTES
+            )
+        return _caches["read"]
+
+
+def search_cache():
+    """
+    Return the cache of searches configured in ``settings.SEARCH_CACHE``, or ``None``
+    if it is disabled.
+    """
+    configured = settings.SEARCH_CACHE
+    if configured != "local":
+        return configured
+    with _caches_lock:
+        if "search" not in _caches:
+            _caches["search"] = LocalCache(
+                settings.SEARCH_CACHE_MAX_ENTRIES,
+                settings.SEARCH_CACHE_MAX_BYTES,
+                settings.SEARCH_CACHE_TTL,
+            )
+        return _caches["search"]
+
+
+def read_key(Model, id):
+    return f"read:{Model.__name__}/{id}"
+
+
+def is_cacheable(Model, query):
+    return not hasattr(Model, "audit_read") and not any(
+        modifier in query.modifiers for modifier in UNCACHED_MODIFIERS
+    )
+
+
+def cached_read(Model, query, render):
+    """
+    Return the JSON of the resource read by ``query`` from the cache, or render it with
+    ``render()`` and cache it.
+
+    Each entry holds the renderings of a resource for each ``_elements`` parameter it
+    was requested with, along with the version they were rendered from.
+    """
+    cache = read_cache()
+    if cache is None or not is_cacheable(Model, query):
+        return render()
+
+    version = None
+    if Model.is_versioned():
+        try:
+            version = "|".join(map(str, Model._get_version(query.resourceId)))
+        except DoesNotExistError:
+            # Let render() report it
+            return render()
+
+    key = read_key(Model, query.resourceId)
+    variant = ",".join(sorted(query.modifiers.get("_elements", [])))
+    cached = cache.get(key)
+    entry = json.loads(cached) if cached else None
+    if entry is None or entry["version"] != version:
+        entry = {"version": version, "variants": {}}
+    elif variant in entry["variants"]:
+        read_metrics.add("hits")
+        return entry["variants"][variant]
+
+    read_metrics.add("misses")
+    content = render()
+    entry["variants"][variant] = content
+    # Versioned entries are checked on every hit, the others expire
+    timeout = None if version is not None else settings.READ_CACHE_TTL
+    cache.set(key, json.dumps(entry), timeout)
+    return content
+
+
+def searched_types(Model, query):
+    """
+    Return the resource types whose changes may change the results of a search, which
+    include :data:`ANY_TYPE` if some of them are not known.
+    """
+    types = {Model.__name__}
+    if query.compartment:
+        types.add(query.compartment[0])
+    for param in query.chained_params:
+        chain = parse_chained_param(param)
+        while chain:
+            reference, resource_type, param = chain
+            types.add(resource_type or ANY_TYPE)
+            chain = parse_chained_param(param)
+    for param in query.reverse_chained_params:
+        chain = parse_reverse_chained_param(param)
+        while chain:
+            resource_type, reference, param = chain
+            types.add(resource_type)
+            chain = parse_reverse_chained_param(param)
+        if parse_chained_param(param):
+            types.add(ANY_TYPE)
+    for value in query.modifiers.get("_revinclude", []):
+        types.add(value.split(":")[0])
+    if query.modifiers.get("_include"):
+        types.add(ANY_TYPE)
+    return types
+
+
+def search_context(query):
+    """
+    Return who is searching, so that results are never served to users that may not
+    be allowed to see them.
+    """
+    if settings.SEARCH_CACHE_CONTEXT is not None:
+        return settings.SEARCH_CACHE_CONTEXT(query)
+    headers = getattr(getattr(query, "context", None), "headers", None) or {}
+    return headers.get("authorization")
+
+
+def generation_key(resource_type):
+    return f"generation:{resource_type}"
+
+
+def generation(cache, resource_type):
+    """
+    Return the token of the current generation of the searches that involve
+    ``resource_type``. A new token is created on every write, so the pages that were
+    cached with the previous one are never found again and expire.
+    """
+    token = cache.get(generation_key(resource_type))
+    if token is None:
+        token = uuid.uuid4().hex
+        cache.set(generation_key(resource_type), token)
+    return token
+
+
+def search_key(cache, Model, query):
+    types = sorted(searched_types(Model, query))
+    key = json.dumps(
+        [
+            Model.__name__,
+            query.compartment,
+            query.search_params,
+            query.modifiers,
+            search_context(query),
+            [generation(cache, resource_type) for resource_type in types],
+        ],
+        sort_keys=True,
+        default=str,
+    )
+    return "search:" + hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def cached_search(Model, query, render):
+    """
+    Return the searchset Bundle of ``query`` from the cache, or render it with
+    ``render()`` and cache it for ``settings.SEARCH_CACHE_TTL`` seconds.
+    """
+    cache = search_cache()
+    if cache is None or getattr(Model, "__SearchCache__", True) is False:
+        return render()
+
+    key = search_key(cache, Model, query)
+    cached = cache.get(key)
+    if cached is not None:
+        search_metrics.add("hits")
+        return json.loads(cached)
+
+    search_metrics.add("misses")
+    content = render()
+    cache.set(key, json.dumps(content), settings.SEARCH_CACHE_TTL)
+    return content
+
+
+def invalidate(Model, id=None):
+    """
+    Remove the cached renderings of resource ``id`` of ``Model`` and invalidate the
+    cached searches that involve its type. It is called whenever a resource is
+    created, with no ``id``, updated or deleted.
+    """
+    cache = read_cache()
+    if cache is not None and id is not None:
+        read_metrics.add("invalidations")
+        cache.delete(read_key(Model, id))
+
+    cache = search_cache()
+    if cache is not None:
+        search_metrics.add("invalidations")
+        for resource_type in (Model.__name__, ANY_TYPE):
+            cache.set(generation_key(resource_type), uuid.uuid4().hex)
+
+
+def stats():
+    """
+    Return the metrics of the caches, eg::
+
+        {
+            "read": {"hits": 12, "misses": 3, "invalidations": 1, "entries": 3, "bytes": 2048},
+            "search": {"hits": 0, "misses": 0, "invalidations": 0},
+        }
+    """
+    return {
+        name: {**metrics.counts, **(cache.stats() if cache is not None else {})}
+        for name, metrics, cache in (
+            ("read", read_metrics, read_cache()),
+            ("search", search_metrics, search_cache()),
+        )
+    }
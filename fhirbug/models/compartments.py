@@ -0,0 +1,219 @@
+"""
+Searches across all the resource types of a compartment, eg ``Patient/123/*``
+or ``Patient/123/$everything``
+"""
+from fhirbug.config import import_searches, settings
+from fhirbug.constants import AUDIT_SUCCESS
+from fhirbug.exceptions import (
+    QueryValidationError,
+    DoesNotExistError,
+    MappingValidationError,
+    AuthorizationError,
+)
+from fhirbug.Fhir.resources import PaginatedBundle
+from fhirbug.models.mixins import get_pagination_info
+from fhirbug.models.registry import get_registry
+from fhirbug.server.requestparser import generate_query_string, split_join
+from fhirbug.utils import concurrent_map
+
+
+def compartment_members(resource_type):
+    """
+    Find all the mappings that can be members of the compartment of ``resource_type``.
+
+    :param str resource_type: The compartment type, eg ``'Patient'``
+    :returns: A list of ``(Model, searcher)`` tuples sorted by the name of the model
+    """
+    members = {}
+    for mapping in get_registry().mappings.values():
+        searcher = mapping.Model.compartment_searcher(resource_type)
+        if searcher is not None:
+            members[mapping.Model.__name__] = (mapping.Model, searcher)
+    return [members[name] for name in sorted(members)]
+
+
+def multi_type_searchset(queries, query, base_url, leading_items=None, url_queries=""):
+    """
+    Paginate the results of several ORM queries, possibly of different resource types,
+    as if they were a single result set and return a searchset Bundle.
+
+    Every query is counted, but only the queries that have results in the requested
+    page are fetched, each with a single query using the backend's limit and offset.
+    Queries of different types are independent, so they run concurrently on a thread
+    pool bounded by ``settings.MAX_QUERY_WORKERS``. Since ORM sessions are not thread
+    safe, queries are passed as functions that build them in the thread they run in.
+
+    :param list queries: A list of ``(Model, build_query)`` tuples where ``build_query`` is a
+                         callable returning an ORM query for ``Model``
+    :param query: The :class:`fhirbug.server.requestparser.FhirRequestQuery` of the current request
+    :param str base_url: The url that pagination links are relative to, eg ``Patient/123/*``
+    :param list leading_items: Fhir resources that are placed before the query results
+    :param str url_queries: Extra parameters to add to the pagination links, eg ``&_type=Observation``
+    :returns: A searchset Bundle in json form
+    """
+    page, count, next_offset, prev_offset = get_pagination_info(query)
+    # search-offset is 1-based
+    start = next_offset - count - 1
+    workers = settings.MAX_QUERY_WORKERS
+    release = lambda task: task[0]._close_thread_session()
+
+    totals = concurrent_map(
+        lambda task: task[0]._count(task[1]()), queries, workers, cleanup=release
+    )
+
+    leading_items = leading_items or []
+    items = leading_items[start : start + count]
+    total = len(leading_items)
+    # Find the part of the page that falls on the results of each query
+    page_slices = []
+    remaining = count - len(items)
+    for (Model, build_query), model_total in zip(queries, totals):
+        if remaining > 0 and start < total + model_total:
+            model_offset = max(start - total, 0)
+            limit = min(remaining, model_total - model_offset)
+            page_slices.append((Model, build_query, model_offset, limit))
+            remaining -= limit
+        total += model_total
+
+    def fetch(task):
+        Model, build_query, offset, limit = task
+        return [
+            item.to_fhir(query=query)
+            for item in Model._slice(build_query(), offset, limit)
+            if not hasattr(item, "audit_read")
+            or item.audit_read(query).outcome == AUDIT_SUCCESS
+        ]
+
+    for results in concurrent_map(fetch, page_slices, workers, cleanup=release):
+        items += results
+
+    url_queries = generate_query_string(query) + url_queries
+    params = {
+        "items": items,
+        "total": total,
+        "has_next": start + count < total,
+        "has_previous": start > 0,
+        "next_page": f"{base_url}?_count={count}&search-offset={next_offset}{url_queries}",
+        "previous_page": f"{base_url}?_count={count}&search-offset={prev_offset}{url_queries}",
+    }
+    return PaginatedBundle(pagination=params).as_json()
+
+
+def compartment_queries(compartment_type, compartment_id, query, types=None):
+    """
+    Build the queries for the members of a compartment, filtered by the compartment
+    predicate and by any of the requested search parameters each type supports.
+
+    :param list types: If provided, only include these resource types
+    :returns: A list of ``(Model, build_query)`` tuples as expected by :func:`multi_type_searchset`
+    """
+    queries = []
+    for Model, searcher in compartment_members(compartment_type):
+        if types is not None and Model._get_resource_cls().__name__ not in types:
+            continue
+
+        def build_query(Model=Model, searcher=searcher):
+            sql_query = searcher(
+                Model, compartment_type, compartment_id, Model._get_orm_query(), query
+            )
+            for search, values in query.search_params.items():
+                if Model.has_searcher(search):
+                    for value in values:
+                        sql_query = Model.apply_search(search, value, sql_query, query)
+            return sql_query
+
+        queries.append((Model, build_query))
+    return queries
+
+
+def since_query(Model, build_query, since, query):
+    """
+    Wrap ``build_query`` so that it only returns resources updated at or after ``since``,
+    using the ``_lastUpdated`` searcher of ``Model``, or else the column declared as its
+    ``__LastUpdated__`` attribute. Arguments of the wrapper are passed to ``build_query``.
+
+    :raises: :exc:`fhirbug.exceptions.QueryValidationError` if ``Model`` has neither
+    """
+    value = f"ge{since}"
+    if Model.has_searcher("_lastUpdated"):
+        return lambda *args: Model.apply_search(
+            "_lastUpdated", value, build_query(*args), query
+        )
+    column = getattr(Model, "__LastUpdated__", None)
+    if column is None:
+        raise QueryValidationError(
+            f"{Model.__name__} resources can not be filtered by _since."
+        )
+    search = import_searches().DateSearch(column)
+    return lambda *args: search(Model, "_lastUpdated", value, build_query(*args), query)
+
+
+class Compartment:
+    """
+    Handles searches across all the resource types of a compartment, eg ``Patient/123/*``.
+    It provides a ``get`` method like :meth:`fhirbug.models.mixins.FhirBaseModelMixin.get`
+    so it can be used in place of a model by the request handlers.
+
+    Each member type is searched with a single query filtered by the compartment predicate
+    and by any of the requested search parameters the type supports.
+    """
+
+    @classmethod
+    def get(cls, query, *args, **kwargs):
+        if not query.compartment:
+            raise QueryValidationError("Searching all resource types is not supported.")
+        compartment_type, compartment_id = query.compartment
+
+        queries = compartment_queries(compartment_type, compartment_id, query)
+        base_url = f"{compartment_type}/{compartment_id}/*"
+        return multi_type_searchset(queries, query, base_url)
+
+
+class Everything:
+    """
+    Handles the `$everything <https://www.hl7.org/fhir/patient-operation-everything.html>`_
+    operation, eg ``Patient/123/$everything``. It returns the requested resource followed by
+    every resource in its compartment as a paged searchset Bundle.
+
+    Supports the ``_type``, ``_since`` and ``_count`` parameters. ``_since`` is applied
+    by :func:`since_query` to each type, and refused if a type does not support it.
+    """
+
+    @classmethod
+    def get(cls, query, *args, **kwargs):
+        Model = getattr(get_registry().models, query.resource)
+        try:
+            item = Model._get_item_from_pk(query.resourceId)
+        except DoesNotExistError:
+            raise MappingValidationError(
+                f'Resource "{query.resource}/{query.resourceId}" does not exist.'
+            )
+        if hasattr(item, "audit_read"):
+            auditEvent = item.audit_read(query)
+            if auditEvent.outcome != AUDIT_SUCCESS:
+                raise AuthorizationError(auditEvent=auditEvent)
+
+        types = query.modifiers.get("_type")
+        types = split_join(types) if types else None
+        since = query.modifiers.get("_since")
+
+        queries = compartment_queries(query.resource, query.resourceId, query, types)
+        if since:
+            queries = [
+                (Model, since_query(Model, build_query, since[0], query))
+                for Model, build_query in queries
+            ]
+
+        leading_items = []
+        if types is None or query.resource in types:
+            leading_items = [item.to_fhir(query=query)]
+
+        base_url = f"{query.resource}/{query.resourceId}/$everything"
+        url_queries = "".join(
+            f"&{param}={','.join(query.modifiers[param])}"
+            for param in ["_type", "_since"]
+            if param in query.modifiers
+        )
+        return multi_type_searchset(
+            queries, query, base_url, leading_items, url_queries
+        )
@@ -0,0 +1,465 @@
+"""
+The `Bulk Data $export <https://hl7.org/fhir/uv/bulkdata/export.html>`_ operation.
+
+Exports are requested at system level (``$export``), for all patients
+(``Patient/$export``) or for the members of a group (``Group/123/$export``) and run in
+the background. The kick-off request returns the url of the job's status, which is
+polled until the job is complete and then returns a manifest listing the NDJSON files.
+
+Every resource type is written by separate workers on a thread pool bounded by
+``settings.EXPORT_WORKERS``. Types with integer primary keys are split in ranges of about
+``settings.EXPORT_PARTITION_SIZE`` rows, each written to its own file, and rows are read
+with server side cursors, ``settings.EXPORT_BATCH_SIZE`` at a time, so an export never
+holds a whole table in memory.
+
+Files are written under ``settings.EXPORT_PATH``, in a directory per job. Each job writes
+its manifest, or the error that stopped it, to that directory, so the status of a job
+can be read, and the job cancelled, by any process sharing it. If ``settings.EXPORT_URL`` is set, it is the url
+``EXPORT_PATH`` is served from and is used for the file urls of the manifest, otherwise
+``file://`` urls are used.
+
+``Patient/$export`` includes every resource of the types that can be members of a
+Patient compartment.
+"""
+import contextvars
+import json
+import math
+import os
+import re
+import shutil
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+from fhirbug.config import settings
+from fhirbug.constants import AUDIT_SUCCESS
+from fhirbug.exceptions import (
+    QueryValidationError,
+    DoesNotExistError,
+    MappingValidationError,
+    AuthorizationError,
+)
+from fhirbug.models.compartments import compartment_members, since_query
+from fhirbug.models.registry import get_registry
+from fhirbug.server.requestparser import split_join
+from fhirbug.utils import transform_date
+
+OUTPUT_FORMATS = ("application/fhir+ndjson", "application/ndjson", "ndjson")
+MANIFEST = "manifest.json"
+ERROR = "error.json"
+# Written by cancel_export so writers in any process sharing EXPORT_PATH stop
+CANCELLED = "cancelled"
+
+#: The jobs that are running in this process, by id
+jobs = {}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+def executor():
+    """
+    The thread pool shared by the writers of all the export jobs of this process.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.EXPORT_WORKERS, thread_name_prefix="fhirbug-export"
+            )
+        return _executor
+
+
+def export_path():
+    return settings.EXPORT_PATH or os.path.join(tempfile.gettempdir(), "fhirbug_export")
+
+
+def job_path(job_id):
+    """
+    Return the directory of a job. Raises a :class:`DoesNotExistError` if ``job_id``
+    is not a valid job id, so that it can never point outside of ``EXPORT_PATH``.
+    """
+    if not re.fullmatch(r"[0-9a-f]{32}", job_id or ""):
+        raise DoesNotExistError(job_id, "$export")
+    return os.path.join(export_path(), job_id)
+
+
+def make_job_path(job_id):
+    """
+    Create the directory of a job. Exported files hold the resources of any patient, so
+    it is only accessible by the user the server runs as, like ``EXPORT_PATH`` if it
+    has to be created.
+
+    :returns: The path of the directory
+    """
+    os.makedirs(export_path(), mode=0o700, exist_ok=True)
+    path = job_path(job_id)
+    os.mkdir(path, mode=0o700)
+    return path
+
+
+def file_url(job_id, file_name):
+    """
+    The url of a file of a job, under ``settings.EXPORT_URL`` if it is set.
+    """
+    if settings.EXPORT_URL:
+        return f"{settings.EXPORT_URL.rstrip('/')}/{job_id}/{file_name}"
+    return Path(job_path(job_id), file_name).resolve().as_uri()
+
+
+def save_json(path, content):
+    """
+    Write ``content`` to a json file. A temporary file is written first so readers
+    never see a partial file.
+    """
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(content, f)
+    os.replace(path + ".tmp", path)
+
+
+def error_outcome(diagnostics):
+    return {
+        "resourceType": "OperationOutcome",
+        "issue": [{"severity": "error", "code": "exception", "diagnostics": diagnostics}],
+    }
+
+
+def exported_models():
+    """
+    Return all the mappings of the models module by resource type.
+    """
+    return {
+        resource_type: mapping.Model
+        for resource_type, mapping in get_registry().by_resource.items()
+    }
+
+
+def pk_partitions(Model, build_query):
+    """
+    Split the results of a query in ranges of primary keys of about
+    ``settings.EXPORT_PARTITION_SIZE`` rows each.
+
+    :returns: A list of functions that build the query of each range
+    """
+    query = build_query()
+    bounds = Model._pk_bounds(query)
+    if bounds is None or not hasattr(Model, "_filter_pk_range"):
+        return [build_query]
+    low, high = bounds
+    count = Model._count(query)
+    parts = max(1, min(math.ceil(count / settings.EXPORT_PARTITION_SIZE), high - low + 1))
+    step = math.ceil((high - low + 1) / parts)
+    return [
+        lambda start=start: Model._filter_pk_range(build_query(), start, start + step)
+        for start in range(low, high + 1, step)
+    ]
+
+
+class ExportJob:
+    """
+    An export that is running in this process.
+
+    :param query: The :class:`fhirbug.server.requestparser.FhirRequestQuery` of the kick-off request
+    :param str request_url: The url of the kick-off request
+    :param list sources: A list of ``(resource type, Model, plan)`` tuples where ``plan``
+                         returns a list of functions, one for each file, that return an
+                         iterable of the items to write
+    """
+
+    def __init__(self, query, request_url, sources):
+        self.id = uuid.uuid4().hex
+        self.query = query
+        self.request_url = request_url
+        self.sources = sources
+        self.path = job_path(self.id)
+        self.transaction_time = datetime.now(timezone.utc)
+        #: Set once the job has been cancelled
+        self.cancelled = threading.Event()
+        #: The number of files to write, once the job has been planned
+        self.total = None
+        self.completed = 0
+        self._lock = threading.Lock()
+
+    def run(self):
+        """
+        Plan the files of the export, write them on the export thread pool and write
+        the manifest, or the error that stopped the job.
+        """
+        try:
+            tasks = []
+            for resource_type, Model, plan in self.sources:
+                for items in plan():
+                    tasks.append((resource_type, Model, items, len(tasks) + 1))
+                Model._close_thread_session()
+            self.total = len(tasks)
+
+            futures = [
+                executor().submit(contextvars.copy_context().run, self.write, *task)
+                for task in tasks
+            ]
+            try:
+                output = [future.result() for future in futures]
+            except BaseException:
+                self.cancelled.set()
+                for future in futures:
+                    future.cancel()
+                raise
+            if self.is_cancelled():
+                raise ExportCancelled()
+
+            save_json(
+                os.path.join(self.path, MANIFEST),
+                {
+                    "transactionTime": self.transaction_time.isoformat(),
+                    "request": self.request_url,
+                    "requiresAccessToken": False,
+                    "output": [file for file in output if file is not None],
+                    "error": [],
+                },
+            )
+        except ExportCancelled:
+            shutil.rmtree(self.path, ignore_errors=True)
+        except Exception as e:
+            save_json(
+                os.path.join(self.path, ERROR), error_outcome(f"The export failed: {e}")
+            )
+        finally:
+            jobs.pop(self.id, None)
+
+    def write(self, resource_type, Model, items, index):
+        """
+        Write the resources returned by ``items()`` to an NDJSON file.
+
+        :returns: The manifest entry of the file, or ``None`` if it would be empty
+        """
+        file_name = f"{resource_type}.{index}.ndjson"
+        path = os.path.join(self.path, file_name)
+        count = 0
+        try:
+            with open(path, "w", encoding="utf-8") as f:
+                for item in items():
+                    if count % settings.EXPORT_BATCH_SIZE == 0 and self.is_cancelled():
+                        raise ExportCancelled()
+                    if (
+                        hasattr(item, "audit_read")
+                        and item.audit_read(self.query).outcome != AUDIT_SUCCESS
+                    ):
+                        continue
+                    f.write(json.dumps(item.to_fhir(query=self.query).as_json()))
+                    f.write("\n")
+                    count += 1
+        finally:
+            Model._close_thread_session()
+        with self._lock:
+            self.completed += 1
+        if count == 0:
+            os.remove(path)
+            return None
+        return {"type": resource_type, "url": file_url(self.id, file_name), "count": count}
+
+    def is_cancelled(self):
+        if not self.cancelled.is_set() and os.path.exists(
+            os.path.join(self.path, CANCELLED)
+        ):
+            self.cancelled.set()
+        return self.cancelled.is_set()
+
+
+def query_sources(Model, build_query):
+    """
+    The plan of a type that is exported by iterating over the results of a query.
+    """
+    batch_size = settings.EXPORT_BATCH_SIZE
+
+    def plan():
+        return [
+            lambda build_query=build_query: Model._iterate(build_query(), batch_size)
+            for build_query in pk_partitions(Model, build_query)
+        ]
+
+    return plan
+
+
+def group_sources(Model, searcher, patient_ids, query):
+    """
+    The plan of a type that is exported for the members of a group. Patients are split
+    in a chunk for each export worker and their compartments are read one at a time.
+    """
+    batch_size = settings.EXPORT_BATCH_SIZE
+    since = query.modifiers.get("_since")
+    size = max(1, math.ceil(len(patient_ids) / settings.EXPORT_WORKERS))
+    chunks = [patient_ids[i : i + size] for i in range(0, len(patient_ids), size)]
+
+    def build_query(patient_id):
+        return searcher(Model, "Patient", patient_id, Model._get_orm_query(), query)
+
+    if since and searcher is not None:
+        build_query = since_query(Model, build_query, since[0], query)
+
+    def patient_items(patient_ids):
+        for patient_id in patient_ids:
+            if searcher is None:
+                # The Patient resources themselves
+                try:
+                    yield Model._get_item_from_pk(patient_id)
+                except DoesNotExistError:
+                    pass
+                continue
+            yield from Model._iterate(build_query(patient_id), batch_size)
+
+    return lambda: [lambda chunk=chunk: patient_items(chunk) for chunk in chunks]
+
+
+def group_members(query):
+    """
+    Return the ids of the Patients that are members of the requested Group.
+    """
+    Group = exported_models().get("Group")
+    if Group is None:
+        raise MappingValidationError("Group resources are not supported.")
+    try:
+        group = Group._get_item_from_pk(query.resourceId)
+    except DoesNotExistError:
+        raise MappingValidationError(f'Resource "Group/{query.resourceId}" does not exist.')
+    if hasattr(group, "audit_read"):
+        auditEvent = group.audit_read(query)
+        if auditEvent.outcome != AUDIT_SUCCESS:
+            raise AuthorizationError(auditEvent=auditEvent)
+    references = [
+        member.get("entity", {}).get("reference", "")
+        for member in group.to_fhir().as_json().get("member", [])
+    ]
+    return [
+        reference.split("/")[-1]
+        for reference in references
+        if reference.split("/")[-2:-1] == ["Patient"]
+    ]
+
+
+def export_sources(query):
+    """
+    Validate the parameters of a kick-off request and return the sources of the export,
+    as expected by :class:`ExportJob`.
+    """
+    output_format = query.modifiers.get("_outputFormat")
+    if output_format and output_format[0] not in OUTPUT_FORMATS:
+        raise QueryValidationError(
+            f"{output_format[0]} is not a supported _outputFormat, use application/fhir+ndjson"
+        )
+    since = query.modifiers.get("_since")
+    if since:
+        transform_date(since[0], trim=False)
+
+    if query.resource == "$export":
+        level = "system"
+    elif query.resource == "Patient" and query.resourceId == "$export":
+        level = "patient"
+    elif query.resource == "Group" and query.operation == "$export":
+        level = "group"
+    else:
+        raise QueryValidationError(
+            "$export is only supported at system level and on Patient and Group."
+        )
+
+    models = exported_models()
+    types = query.modifiers.get("_type")
+    types = split_join(types) if types else None
+    for resource_type in types or []:
+        if resource_type not in models:
+            raise QueryValidationError(f"{resource_type} resources can not be exported.")
+
+    if level == "system":
+        members = [(Model, None) for Model in models.values()]
+    else:
+        members = [(models["Patient"], None)] if "Patient" in models else []
+        members += compartment_members("Patient")
+    if level == "group":
+        patient_ids = group_members(query)
+
+    sources = []
+    for Model, searcher in members:
+        resource_type = Model._get_resource_cls().__name__
+        if types is not None and resource_type not in types:
+            continue
+        if level == "group":
+            plan = group_sources(Model, searcher, patient_ids, query)
+        else:
+            build_query = Model._get_orm_query
+            if since:
+                build_query = since_query(Model, build_query, since[0], query)
+            plan = query_sources(Model, build_query)
+        sources.append((resource_type, Model, plan))
+    return sources
+
+
+def start_export(query, request_url):
+    """
+    Start an export job in the background.
+
+    :param query: The :class:`fhirbug.server.requestparser.FhirRequestQuery` of the kick-off request
+    :param str request_url: The url of the kick-off request
+    :returns: The :class:`ExportJob`
+    """
+    job = ExportJob(query, request_url, export_sources(query))
+    make_job_path(job.id)
+    jobs[job.id] = job
+    context = contextvars.copy_context()
+    threading.Thread(
+        target=context.run, args=(job.run,), name=f"fhirbug-export-{job.id}", daemon=True
+    ).start()
+    return job
+
+
+def export_status(job_id):
+    """
+    Return the status of an export job.
+
+    :returns: A ``(response json, status code, headers)`` tuple. The status is ``202``
+              while the job is running, ``200`` with the manifest when it is complete
+              and ``500`` if it failed.
+    """
+    path = job_path(job_id)
+    if os.path.exists(os.path.join(path, CANCELLED)):
+        raise DoesNotExistError(job_id, "$export")
+    for file_name, status in ((MANIFEST, 200), (ERROR, 500)):
+        try:
+            with open(os.path.join(path, file_name), encoding="utf-8") as f:
+                return json.load(f), status, {}
+        except FileNotFoundError:
+            pass
+    if not os.path.isdir(path):
+        raise DoesNotExistError(job_id, "$export")
+
+    job = jobs.get(job_id)
+    if job is not None and job.total is not None:
+        progress = f"{job.completed} of {job.total} files written"
+    else:
+        progress = "in progress"
+    outcome = {
+        "resourceType": "OperationOutcome",
+        "issue": [{"severity": "information", "code": "informational", "diagnostics": progress}],
+    }
+    return outcome, 202, {"X-Progress": progress, "Retry-After": "1"}
+
+
+def cancel_export(job_id):
+    """
+    Cancel a running export job, or delete the files of a finished one.
+    """
+    path = job_path(job_id)
+    if not os.path.isdir(path) or os.path.exists(os.path.join(path, CANCELLED)):
+        raise DoesNotExistError(job_id, "$export")
+    if any(os.path.exists(os.path.join(path, name)) for name in (MANIFEST, ERROR)):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        # The job removes its files once its writers have stopped
+        open(os.path.join(path, CANCELLED), "w").close()
+        if job_id in jobs:
+            jobs[job_id].cancelled.set()
@@ -0,0 +1,128 @@
+"""
+Fetch the resources included in a page of results concurrently.
+
+Every ``_include`` of a reference and every ``_revinclude`` of each rendered resource
+takes a query of its own. They do not depend on each other, so instead of running them
+one after the other while each resource is rendered, :func:`prefetch` plans them for
+the whole page up front, runs them on a thread pool bounded by
+``settings.MAX_QUERY_WORKERS`` and hands the rendered results to the instances, which
+add them to their ``contained`` resources as before.
+
+Each query runs with the database session of its worker thread, which is released
+when it is done. References that are included more than once in a page are fetched
+once. References of attributes other than :class:`ReferenceAttribute
+<fhirbug.models.attributes.ReferenceAttribute>` are still fetched while rendering.
+"""
+import copy
+
+from fhirbug.config import import_backend, settings
+from fhirbug.models.registry import get_registry
+from fhirbug.utils import concurrent_map
+
+INCLUDE = "include"
+REVINCLUDE = "revinclude"
+
+
+def plan(items, query):
+    """
+    Return the keys of the fetches needed to render ``items`` for ``query``, without
+    duplicates:
+
+    - ``("include", Model, id)`` for a contained reference
+    - ``("revinclude", resource_type, field, id)`` for the resources that reference
+      the item ``id`` by ``field``
+    """
+    from fhirbug.models.attributes import ReferenceAttribute
+
+    included = query.modifiers.get("_include", [])
+    revincluded = [
+        value.split(":")[:2] for value in query.modifiers.get("_revinclude", [])
+    ]
+    keys = {}
+    for item in items:
+        if included:
+            for attribute in item.FhirMap.__dict__.values():
+                if (
+                    isinstance(attribute, ReferenceAttribute)
+                    and attribute.name in included
+                ):
+                    id = getattr(item, attribute.id)
+                    keys[(INCLUDE, attribute.cls, id)] = None
+        if revincluded:
+            id = item.Fhir.id
+            for resource_type, field in revincluded:
+                keys[(REVINCLUDE, resource_type, field, id)] = None
+    return list(keys)
+
+
+def fetch(key, query=None):
+    """
+    Run the query of a key of :func:`plan` and render its results. ``query`` is passed
+    on to the searchers of revincludes.
+
+    :returns: A ``(resource, display)`` tuple for includes, or ``None`` if the item
+              does not exist, and a list of resources for revincludes
+    """
+    if key[0] == INCLUDE:
+        _, Model, id = key
+        item = Model._get_orm_query().get(id)
+        if item is None:
+            return None
+        display = item._as_display() if hasattr(item, "_as_display") else None
+        return item.to_fhir(), display
+
+    _, resource_type, field, id = key
+    Resource = getattr(get_registry().models, resource_type)
+    if field not in Resource.searchables():
+        return []
+    items = Resource.searchables()[field](
+        Resource, field, id, Resource._get_orm_query(), query
+    ).all()
+    return [item.to_fhir() for item in items]
+
+
+def prefetch(items, query):
+    """
+    Fetch the included and revincluded resources of ``items`` concurrently and store
+    them on the items, where :meth:`to_fhir
+    <fhirbug.models.mixins.FhirBaseModelMixin.to_fhir>` finds them. Nothing is
+    fetched if the page needs less than two queries.
+    """
+    if query is None or not (
+        query.modifiers.get("_include") or query.modifiers.get("_revinclude")
+    ):
+        return
+    keys = plan(items, query)
+    if len(keys) < 2 or settings.MAX_QUERY_WORKERS <= 1:
+        return
+    Base = import_backend("models").AbstractBaseModel
+    results = concurrent_map(
+        lambda key: fetch(key, query),
+        keys,
+        settings.MAX_QUERY_WORKERS,
+        cleanup=lambda key: Base._close_thread_session(),
+    )
+    prefetched = dict(zip(keys, results))
+    for item in items:
+        item._prefetched = prefetched
+
+
+def prefetched_include(instance, Model, id):
+    """
+    Return a copy of the ``(resource, display)`` of a contained reference that was
+    prefetched for ``instance``, or ``None``.
+    """
+    found = getattr(instance, "_prefetched", {}).get((INCLUDE, Model, id))
+    if found is None:
+        return None
+    resource, display = found
+    return copy.deepcopy(resource), display
+
+
+def prefetched_revinclude(instance, resource_type, field, id):
+    """
+    Return the resources revincluded by ``field`` of ``resource_type`` that were
+    prefetched for ``instance``, or ``None``.
+    """
+    key = (REVINCLUDE, resource_type, field, id)
+    return getattr(instance, "_prefetched", {}).get(key)
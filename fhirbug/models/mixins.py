@@ -1,18 +1,28 @@
 import re
+from contextlib import contextmanager
+from datetime import datetime, timezone
 
 from fhirbug.constants import AUDIT_SUCCESS
 from fhirbug.Fhir import resources
 from fhirbug.models.attributes import Attribute
-from fhirbug.config import import_models
+from fhirbug.config import import_models, import_searches
+from fhirbug.models import includes, registry, validation
 from fhirbug.exceptions import (
     DoesNotExistError,
     MappingValidationError,
     AuthorizationError,
+    QueryValidationError,
 )
 from fhirbug.Fhir.resources import PaginatedBundle
-from fhirbug.server.requestparser import generate_query_string
+from fhirbug.server.requestparser import (
+    generate_query_string,
+    parse_chained_param,
+    parse_reverse_chained_param,
+    parse_url,
+)
 
 from fhirbug.config import settings
+from fhirbug.utils import run_sync
 
 
 def get_pagination_info(query):
@@ -37,6 +47,23 @@ def get_pagination_info(query):
     return page, count, next_offset, prev_offset
 
 
+def format_version(version, last_updated):
+    """
+    Format the values of the ``__Version__`` and ``__LastUpdated__`` attributes of a
+    mapping as they appear in ``meta.versionId`` and ``meta.lastUpdated``.
+
+    :returns: A ``(versionId, lastUpdated)`` tuple of strings, either of which may be ``None``
+    """
+    if version is not None:
+        version = str(version)
+    if last_updated is not None:
+        if isinstance(last_updated, datetime) and last_updated.tzinfo is None:
+            # Instants must have a timezone, naive datetimes are assumed to be in UTC
+            last_updated = last_updated.replace(tzinfo=timezone.utc)
+        last_updated = last_updated.isoformat()
+    return version, last_updated
+
+
 class FhirAbstractBaseMixin:
     """
     Adds additional fhir related functionality to all models.
@@ -46,12 +73,128 @@ class FhirAbstractBaseMixin:
     nested class.
     """
 
+    @classmethod
+    def _close_thread_session(cls):
+        """
+        Release any database session or connection the backend holds for the current thread.
+        It is called in worker threads after they have run a query. Backends override it,
+        by default it does nothing.
+        """
+        pass
+
+    @classmethod
+    @contextmanager
+    def atomic(cls):
+        """
+        A context manager that runs the writes made inside it in a single database
+        transaction, which is committed when the block exits or rolled back if it raises.
+        Backends without transactions override nothing and writes are applied as they are made.
+        """
+        yield
+
+    @classmethod
+    def _flush(cls):
+        """
+        Send the pending writes of the current transaction to the database so generated
+        values like primary keys are assigned. By default it does nothing.
+        """
+        pass
+
+    @classmethod
+    def _bulk_insert(cls, instances):
+        """
+        Insert several new instances, created by :meth:`from_resource`, in a single
+        transaction. Backends override it to use bulk inserts, by default each instance
+        is saved with ``_after_create``.
+
+        Batches that fail are inserted again one instance at a time, so backends whose
+        bulk inserts are not transactional must not insert the instances they kept
+        twice.
+        """
+        with cls.atomic():
+            for instance in instances:
+                cls._after_create(instance)
+
+    @classmethod
+    def _iterate(cls, query, batch_size):
+        """
+        Iterate over the results of ``query`` without loading all of them in memory,
+        fetching ``batch_size`` rows at a time. Backends override it to use server side
+        cursors, by default the results are fetched a page at a time using ``_slice``.
+        """
+        offset = 0
+        while True:
+            items = cls._slice(query, offset, batch_size)
+            yield from items
+            if len(items) < batch_size:
+                return
+            offset += batch_size
+
+    @classmethod
+    def _pk_bounds(cls, query):
+        """
+        Return the ``(lowest, highest)`` primary keys among the results of ``query`` if
+        the primary key is an integer, so results can be split in ranges that are read
+        in parallel. Returns ``None`` if it is not supported, which is the default.
+
+        Backends that support it also implement ``_filter_pk_range(query, low, high)``,
+        which filters ``query`` to the results whose primary key is in ``[low, high)``.
+        """
+        return None
+
+    @classmethod
+    def _delete_query(cls, query):
+        """
+        Delete all the results of ``query`` with a single statement and return how many
+        were deleted. Returns ``None`` if it is not supported, which is the default, and
+        the results are deleted one at a time.
+        """
+        return None
+
     @classmethod
     def _get_resource_cls(cls):
         resource_name = getattr(cls, "__Resource__", cls.__name__)
         Resource = getattr(resources, resource_name)
         return Resource
 
+    @classmethod
+    def _version_attributes(cls):
+        """
+        Return the names of the attributes declared as ``__Version__`` and
+        ``__LastUpdated__``, or ``None`` for the ones that are not declared.
+        """
+        return (
+            getattr(cls, "__Version__", None),
+            getattr(cls, "__LastUpdated__", None),
+        )
+
+    @classmethod
+    def is_versioned(cls):
+        """
+        Whether the mapping exposes a version or a last updated attribute
+        """
+        return any(cls._version_attributes())
+
+    def get_version(self):
+        """
+        Return a ``(versionId, lastUpdated)`` tuple for this instance, read from the
+        attributes declared as ``__Version__`` and ``__LastUpdated__``. Either of them
+        may be ``None``.
+        """
+        return tuple(
+            getattr(self, name, None) if name else None
+            for name in self._version_attributes()
+        )
+
+    @classmethod
+    def _get_version(cls, pk):
+        """
+        Return the ``(versionId, lastUpdated)`` tuple of the row with primary key ``pk``.
+        Backends override it to only read the version columns, by default the whole
+        item is fetched. Raises :class:`DoesNotExistError` if the row does not exist.
+        """
+        return cls._get_item_from_pk(pk).get_version()
+
     def to_fhir(self, *args, query=None, **kwargs):
         """
         Convert from a BaseModel to a Fhir Resource and return it.
@@ -83,8 +226,26 @@ class FhirAbstractBaseMixin:
         if self._contained_items:
             resource.contained = self._contained_items
 
+        if self.is_versioned():
+            self.set_meta_version(resource)
+
         return resource
 
+    def set_meta_version(self, resource):
+        """
+        Fill ``meta.versionId`` and ``meta.lastUpdated`` of ``resource`` from the
+        version of this instance.
+        """
+        version_id, last_updated = format_version(*self.get_version())
+        if version_id is None and last_updated is None:
+            return
+        if resource.meta is None:
+            resource.meta = resources.Meta()
+        if version_id is not None:
+            resource.meta.versionId = version_id
+        if last_updated is not None:
+            resource.meta.lastUpdated = resources.FHIRDate(last_updated)
+
     def get_params_dict(self, resource, elements=None):
         """
         Return a dictionary of all valid values this instance can provide for a resource of the type ``resource``.
@@ -94,20 +255,25 @@ class FhirAbstractBaseMixin:
         """
         # TODO: Allow for a fields attribute to manually specify which fields to be used?
 
-        # Read this instances available attributes
-        attributes = [prop for prop in dir(self.Fhir) if not prop.startswith("_")]
+        mapping = registry.lookup(self.__class__)
+        if mapping is not None and mapping.Resource is resource:
+            # Use the fields the registry has already matched to the resource
+            attributes, mandatory = mapping.fields, mapping.mandatory
+        else:
+            # Read this instances available attributes
+            attributes = [prop for prop in dir(self.Fhir) if not prop.startswith("_")]
 
-        # Create a mock resource for comparison
-        mock = resource()
+            # Create a mock resource for comparison
+            mock = resource()
+            attributes = [attr for attr in attributes if hasattr(mock, attr)]
+            mandatory = mock.mandatoryFields()
 
         # If the _elements paramater has been passed, return the elements specified there,
         # along with all mandatory ones
         # TODO: toggle inclusion of mandatory based on a setting
         if elements:
             attributes = [
-                attr
-                for attr in attributes
-                if attr in elements + mock.mandatoryFields() + ["id"]
+                attr for attr in attributes if attr in elements + mandatory + ["id"]
             ]
 
         hidden_attrs = getattr(self, "_hidden_attributes", [])
@@ -117,7 +283,7 @@ class FhirAbstractBaseMixin:
         param_dict = {
             attribute: getattr(self.Fhir, attribute)
             for attribute in attributes
-            if hasattr(mock, attribute) and attribute.lower() not in hidden_attrs
+            if attribute.lower() not in hidden_attrs
         }
         return param_dict
 
@@ -136,6 +302,12 @@ class FhirAbstractBaseMixin:
             revincludes = query.modifiers.get("_revinclude")
             for rev in revincludes:
                 resource_name, field, *_ = rev.split(":")
+                prefetched = includes.prefetched_revinclude(
+                    self, resource_name, field, self.Fhir.id
+                )
+                if prefetched is not None:
+                    self._contained_items += prefetched
+                    continue
                 Resource = getattr(models, resource_name)
                 # sql_query = cls.searchables()[search](cls, search, value, sql_query, query)
                 if field in Resource.searchables():
@@ -178,15 +350,26 @@ class FhirAbstractBaseMixin:
 
     @classmethod
     def create_from_resource(cls, resource, query=None):
+        from fhirbug.models import cache
+
         obj = cls.from_resource(resource, query)
         obj = cls._after_create(obj)
+        cache.invalidate(cls)
         return obj
 
-
+    @classmethod
+    async def acreate_from_resource(cls, resource, query=None):
+        """
+        Async version of :meth:`create_from_resource`. The write runs in an executor
+        thread so it does not block the event loop.
+        """
+        return await run_sync(cls.create_from_resource, resource, query)
 
     def update_from_resource(self, resource, query=None):
         """
-        Edits an existing row from a Fhir.Resource object
+        Edits an existing row from a Fhir.Resource object. Attributes that already
+        have the value of the resource are not set and if none of them changes the row
+        is not saved at all.
         """
 
         # Audit the update if implemented
@@ -206,16 +389,88 @@ class FhirAbstractBaseMixin:
         ]
 
         self.Fhir._query = query
+        self.Fhir._changed = set()
+        self.Fhir._tracked = set()
 
         # for path in own_attributes:
         for path in own_attributes:
             value = getattr(resource, path.replace("_", "."), None)
             if value is not None:
-                setattr(self.Fhir, path, value)
+                self._set_attribute(path, value)
+
+        return self._save_changes(query)
+
+    def patch_from_resource(self, resource, elements, query=None):
+        """
+        Edits an existing row from a patched Fhir.Resource object. Only the attributes
+        of the top level ``elements`` that the patch changed are set, and the ones that
+        are missing from ``resource`` are set to None, so the rest of the row is not
+        written.
+
+        :param resource: The patched resource
+        :param list elements: The names of the top level elements the patch changed,
+                              see :func:`fhirbug.server.jsonpatch.touched_elements`
+        """
 
+        # Audit the update if implemented
+        if hasattr(self, "audit_update"):
+            auditEvent = self.audit_update(query)
+            if auditEvent.outcome != AUDIT_SUCCESS:
+                raise AuthorizationError(auditEvent=auditEvent)
+
+        # Get the protected fields
+        protected_attrs = getattr(self, "_protected_attributes", [])
+
+        # Read the attributes of the FhirMap class for the patched elements
+        own_attributes = [
+            prop
+            for prop, type in self.FhirMap.__dict__.items()
+            if isinstance(type, Attribute)
+            and prop not in protected_attrs
+            and prop.rstrip("_").split("_")[0] in elements
+        ]
+
+        self.Fhir._query = query
+        self.Fhir._changed = set()
+        self.Fhir._tracked = set()
+
+        for path in own_attributes:
+            value = getattr(resource, path.replace("_", "."), None)
+            self._set_attribute(path, value)
+
+        return self._save_changes(query)
+
+    def _set_attribute(self, name, value):
+        """
+        Set the ``FhirMap`` attribute ``name`` during an update. Attributes whose
+        ``__set__`` does not call :meth:`Attribute.__set__
+        <fhirbug.models.attributes.Attribute.__set__>` can not tell whether they
+        changed anything, so they are assumed to have.
+        """
+        setattr(self.Fhir, name, value)
+        if name not in self.Fhir._tracked:
+            self.Fhir._changed.add(name)
+
+    def _save_changes(self, query=None):
+        """
+        Save the attributes set by an update. If none of them changed, nothing is
+        written and the item is returned as it is.
+        """
+        self.Fhir.__dict__.pop("_tracked", None)
+        # The names of the FhirMap attributes that the update changed
+        self._changed_attributes = self.Fhir.__dict__.pop("_changed", set())
+        if not self._changed_attributes:
+            return self
         new = self.__class__._after_update(self)
+        self._invalidate_cache(query)
         return new
 
+    async def aupdate_from_resource(self, resource, query=None):
+        """
+        Async version of :meth:`update_from_resource`.
+        """
+        return await run_sync(self.update_from_resource, resource, query)
+
     @classmethod
     def delete_item(cls, item, query=None):
         # Audit the update if needed
@@ -223,7 +478,27 @@ class FhirAbstractBaseMixin:
             auditEvent = item.audit_delete(query)
             if auditEvent.outcome != AUDIT_SUCCESS:
                 raise AuthorizationError(auditEvent=auditEvent)
-        return cls._delete_item(item)
+        deleted = cls._delete_item(item)
+        item._invalidate_cache(query)
+        return deleted
+
+    @classmethod
+    async def adelete_item(cls, item, query=None):
+        """
+        Async version of :meth:`delete_item`.
+        """
+        return await run_sync(cls.delete_item, item, query)
+
+    def _invalidate_cache(self, query=None):
+        """
+        Remove this item from the caches, see :mod:`fhirbug.models.cache`
+        """
+        from fhirbug.models import cache
+
+        id = None
+        if cache.read_cache() is not None:
+            id = getattr(query, "resourceId", None) or getattr(self.Fhir, "id", None)
+        cache.invalidate(self.__class__, id)
 
     def protect_attributes(self, attribute_names=[]):
         """
@@ -250,63 +525,311 @@ class FhirBaseModelMixin:
     """
     """
 
+    @classmethod
+    def read(cls, query, *args, **kwargs):
+        """
+        Fetch the item requested by a ``Resource/id`` query and render it.
+        """
+        # item = cls._get_orm_query().get(query.resourceId)
+        try:
+            item = cls._get_item_from_pk(query.resourceId)
+        except DoesNotExistError:
+            raise MappingValidationError(
+                f'Resource "{query.resource}/{query.resourceId}" does not exist.'
+            )
+        if hasattr(item, "audit_read"):
+            auditEvent = item.audit_read(query)
+            if auditEvent.outcome != AUDIT_SUCCESS:
+                raise AuthorizationError(auditEvent=auditEvent)
+        includes.prefetch([item], query)
+        res = item.to_fhir(*args, query=query, **kwargs)
+        return res.as_json()
+
     @classmethod
     def get(cls, query, *args, **kwargs):
         """
         Handle a GET request
         """
+        from fhirbug.models import cache
+
         if query.resourceId:
-            # item = cls._get_orm_query().get(query.resourceId)
-            try:
-                item = cls._get_item_from_pk(query.resourceId)
-            except DoesNotExistError:
-                raise MappingValidationError(
-                    f'Resource "{query.resource}/{query.resourceId}" does not exist.'
-                )
-            if hasattr(item, "audit_read"):
-                auditEvent = item.audit_read(query)
-                if auditEvent.outcome != AUDIT_SUCCESS:
-                    raise AuthorizationError(auditEvent=auditEvent)
-            res = item.to_fhir(*args, query=query, **kwargs)
-            return res.as_json()
+            return cache.cached_read(
+                cls, query, lambda: cls.read(query, *args, **kwargs)
+            )
+        return cache.cached_search(
+            cls, query, lambda: cls.search(query, *args, **kwargs)
+        )
 
-        else:
-            # Handle search
-            sql_query = cls._get_orm_query()
-            for search in [
-                *query.search_params,
-                *query.modifiers,
-            ]:  # TODO: Do we really need to check the modifiers here?
-                if cls.has_searcher(search):
-                    values = query.search_params.get(
-                        search, query.modifiers.get(search)
+    @classmethod
+    def search_query(cls, query):
+        """
+        Return the ORM query of the items that match the compartment and the search
+        parameters of ``query``.
+        """
+        sql_query = cls._get_orm_query()
+        if query.compartment:
+            sql_query = cls.apply_compartment(query.compartment, sql_query, query)
+        for search in [
+            *query.search_params,
+            *query.modifiers,
+        ]:  # TODO: Do we really need to check the modifiers here?
+            if (
+                search in query.chained_params
+                or search in query.reverse_chained_params
+            ):
+                values = query.search_params.get(
+                    search, query.modifiers.get(search)
+                )
+                for value in values:
+                    sql_query = cls.apply_search(search, value, sql_query, query)
+            elif cls.has_searcher(search):
+                values = query.search_params.get(
+                    search, query.modifiers.get(search)
+                )
+                for value in values:
+                    sql_query = cls.get_searcher(search)(
+                        cls, search, value, sql_query, query
                     )
-                    for value in values:
-                        sql_query = cls.get_searcher(search)(
-                            cls, search, value, sql_query, query
-                        )
-
-            # TODO: Handle sorting
-
-            # Handle pagination
-            page, count, next_offset, prev_offset = get_pagination_info(query)
-            pagination = cls.paginate(sql_query, page, count)
-            url_queries = generate_query_string(query)
-            params = {
-                "items": [
-                    item.to_fhir(*args, query=query, **kwargs)
-                    for item in pagination.items
-                    if not hasattr(item, "audit_read")
-                    or item.audit_read(query).outcome == AUDIT_SUCCESS
-                ],
-                "total": pagination.total,
-                "pages": pagination.pages,
-                "has_next": pagination.has_next,
-                "has_previous": pagination.has_previous,
-                "next_page": f"{cls.__name__}/?_count={count}&search-offset={next_offset}{url_queries}",
-                "previous_page": f"{cls.__name__}/?_count={count}&search-offset={prev_offset}{url_queries}",
-            }
-            return PaginatedBundle(pagination=params).as_json()
+        return sql_query
+
+    @classmethod
+    def validate_search(cls, query, strict=False):
+        """
+        Check the search parameters of ``query`` against the searchers of the mapping
+        before the search runs, see :mod:`fhirbug.models.validation`. Parameters no
+        searcher matches, or with a modifier their searcher does not implement, are
+        removed from ``query`` unless ``strict`` is set.
+
+        :returns: The names of the parameters that were removed
+        :raises: :exc:`QueryValidationError <fhirbug.exceptions.QueryValidationError>`
+                 if a value is invalid, or a parameter is unsupported and ``strict`` is
+                 set
+        """
+        return validation.search_validator(cls).validate(query, strict)
+
+    @classmethod
+    def conditional_matches(cls, query):
+        """
+        Return at most two of the items that match the search parameters of ``query``,
+        enough to tell whether the criteria of a conditional create, update or delete
+        match none, one or several resources. They are fetched with a single query
+        limited to two rows.
+
+        :raises: :exc:`QueryValidationError <fhirbug.exceptions.QueryValidationError>`
+                 if ``query`` has no search parameters or has parameters the mapping
+                 can not search, which would otherwise match every resource
+        """
+        cls._validate_conditional(query)
+        return cls._slice(cls.search_query(query), 0, 2)
+
+    @classmethod
+    def delete_matches(cls, query):
+        """
+        Delete all the items that match the search parameters of ``query`` and return
+        how many were deleted.
+
+        Mappings without ``audit_delete`` or indexes are deleted with a single DELETE
+        statement if the backend supports it and no read cache is configured, since the
+        ids of the deleted items are not known. Otherwise the items are fetched and
+        deleted one at a time, in a single transaction.
+
+        :raises: :exc:`QueryValidationError <fhirbug.exceptions.QueryValidationError>`
+                 like :meth:`conditional_matches`
+        """
+        from fhirbug.models import cache
+
+        cls._validate_conditional(query)
+        sql_query = cls.search_query(query)
+        if not (
+            hasattr(cls, "audit_delete")
+            or cls._fulltext_indexed()
+            or cls._indexed_parameters()
+            or cache.read_cache() is not None
+        ):
+            deleted = cls._delete_query(sql_query)
+            if deleted is not None:
+                cache.invalidate(cls)
+                return deleted
+
+        with cls.atomic():
+            items = list(cls._iterate(sql_query, 1000))
+            for item in items:
+                cls.delete_item(item, query)
+        return len(items)
+
+    @classmethod
+    def _validate_conditional(cls, query):
+        if not query.search_params and not query.reverse_chained_params:
+            raise QueryValidationError("Conditional operations need search parameters")
+        for name in query.search_params:
+            if name not in query.chained_params and not cls.has_searcher(name):
+                raise QueryValidationError(
+                    f'Searching {cls.__name__} by "{name}" is not supported'
+                )
+
+    @classmethod
+    def search(cls, query, *args, **kwargs):
+        """
+        Run the search of ``query`` and render a page of its results as a searchset Bundle.
+        """
+        sql_query = cls.search_query(query)
+
+        # TODO: Handle sorting
+
+        # Handle pagination
+        page, count, next_offset, prev_offset = get_pagination_info(query)
+        pagination = cls.paginate(sql_query, page, count)
+        url_queries = generate_query_string(query)
+        base_url = cls.__name__
+        if query.compartment:
+            base_url = "{}/{}/{}".format(*query.compartment, cls.__name__)
+        items = [
+            item
+            for item in pagination.items
+            if not hasattr(item, "audit_read")
+            or item.audit_read(query).outcome == AUDIT_SUCCESS
+        ]
+        # Fetch the included resources of the whole page concurrently
+        includes.prefetch(items, query)
+        params = {
+            "items": [item.to_fhir(*args, query=query, **kwargs) for item in items],
+            "total": pagination.total,
+            "pages": pagination.pages,
+            "has_next": pagination.has_next,
+            "has_previous": pagination.has_previous,
+            "next_page": f"{base_url}/?_count={count}&search-offset={next_offset}{url_queries}",
+            "previous_page": f"{base_url}/?_count={count}&search-offset={prev_offset}{url_queries}",
+        }
+        return PaginatedBundle(pagination=params).as_json()
+
+    @classmethod
+    def iter_search(cls, query, batch_size=1000):
+        """
+        Iterate over all the items that match the search parameters of ``query``,
+        without paginating them. Rows are streamed from the database ``batch_size`` at a
+        time using the backend's server side cursors, so memory use does not grow with
+        the number of results. Items that fail ``audit_read`` are skipped, like in
+        :meth:`search`::
+
+            for patient in Patient.iter_search("Patient?gender=female"):
+                print(patient.to_fhir().as_json())
+
+        :param query: A :class:`FhirRequestQuery <fhirbug.server.requestparser.FhirRequestQuery>`
+                      or a url to parse into one
+        :param int batch_size: How many rows are fetched from the database at a time
+        :returns: A generator of model instances
+        """
+        if isinstance(query, str):
+            query = parse_url(query)
+        for item in cls._iterate(cls.search_query(query), batch_size):
+            if (
+                not hasattr(item, "audit_read")
+                or item.audit_read(query).outcome == AUDIT_SUCCESS
+            ):
+                yield item
+
+    @classmethod
+    async def aget(cls, query, *args, **kwargs):
+        """
+        Async version of :meth:`get`. The queries run in an executor thread so they
+        do not block the event loop.
+        """
+        return await run_sync(cls.get, query, *args, **kwargs)
+
+    @classmethod
+    def apply_search(cls, search, value, sql_query, query):
+        """
+        Filter ``sql_query`` by the search parameter ``search``.
+
+        Chained (``subject:Patient.name``) and reverse chained (``_has:Observation:subject:code``)
+        parameters are resolved through the reference attributes of the mappings involved and are
+        compiled by the backend into a single query instead of being resolved in python.
+
+        :param str search: The name of the search parameter
+        :param str value: The value to search for
+        :param sql_query: The ORM query to filter
+        :param query: The :class:`fhirbug.server.requestparser.FhirRequestQuery` of the current request
+        :returns: The filtered ORM query
+        :raises: :exc:`fhirbug.exceptions.QueryValidationError` if the parameter is not supported
+        """
+        chain = parse_chained_param(search)
+        if chain:
+            reference, resource_type, param = chain
+            searcher = cls.get_reference_attribute(reference).chained_searcher(
+                resource_type
+            )
+            return searcher(cls, param, value, sql_query, query)
+
+        reverse_chain = parse_reverse_chained_param(search)
+        if reverse_chain:
+            resource_type, reference, param = reverse_chain
+            Source = getattr(import_models(), resource_type, None)
+            if Source is None:
+                raise QueryValidationError(f'Resource "{resource_type}" does not exist.')
+            searcher = Source.get_reference_attribute(
+                reference
+            ).reverse_chained_searcher(Source, cls._get_resource_cls().__name__)
+            return searcher(cls, param, value, sql_query, query)
+
+        if not cls.has_searcher(search):
+            raise QueryValidationError(
+                f"Searching {cls.__name__} by {search} is not supported."
+            )
+        return cls.get_searcher(search)(cls, search, value, sql_query, query)
+
+    @classmethod
+    def compartment_searcher(cls, resource_type):
+        """
+        Return a searcher that filters resources belonging to the compartment of a
+        ``resource_type``, or ``None`` if this resource can not be a member of it.
+
+        Membership is determined by the reference attributes of the FhirMap that
+        can reference a ``resource_type``. All of them are combined in a single
+        predicate so the compartment is searched with one query.
+
+        :param str resource_type: The compartment type, eg ``'Patient'``
+        """
+        columns = [
+            prop.reference_column
+            for prop in cls.FhirMap.__dict__.values()
+            if hasattr(prop, "references") and prop.references(resource_type)
+        ]
+        if not columns:
+            return None
+        searches = import_searches()
+        return searches.CompartmentSearch(*columns)
+
+    @classmethod
+    def apply_compartment(cls, compartment, sql_query, query):
+        """
+        Filter ``sql_query`` so that it only contains resources in ``compartment``
+
+        :param tuple compartment: A ``(compartment type, compartment id)`` tuple
+        :raises: :exc:`fhirbug.exceptions.QueryValidationError` if this resource
+                 can not be a member of the compartment
+        """
+        compartment_type, compartment_id = compartment
+        searcher = cls.compartment_searcher(compartment_type)
+        if searcher is None:
+            raise QueryValidationError(
+                f"{cls.__name__} is not a member of the {compartment_type} compartment."
+            )
+        return searcher(cls, compartment_type, compartment_id, sql_query, query)
+
+    @classmethod
+    def get_reference_attribute(cls, name):
+        """
+        Return the reference Attribute that has been assigned to ``name`` in the FhirMap
+
+        :param str name: The name of the Fhir attribute
+        :raises: :exc:`fhirbug.exceptions.QueryValidationError` if ``name`` is not a reference
+        """
+        attribute = cls.FhirMap.__dict__.get(name)
+        if not hasattr(attribute, "chained_searcher"):
+            raise QueryValidationError(
+                f"{name} is not a reference attribute of {cls.__name__}."
+            )
+        return attribute
 
     @classmethod
     def has_searcher(cls, query_string):
@@ -319,6 +842,9 @@ class FhirBaseModelMixin:
 
         :returns: bool
         """
+        mapping = registry.lookup(cls)
+        if mapping is not None:
+            return any(regex.match(query_string) for regex, _ in mapping.searchers)
         for srch in cls.searchables():
             if re.match(srch, query_string):
                 return True
@@ -335,11 +861,17 @@ class FhirBaseModelMixin:
 
         :returns: function
         """
-        searchers = [
-            func
-            for srch, func in cls.searchables().items()
-            if re.match(srch, query_string)
-        ]
+        mapping = registry.lookup(cls)
+        if mapping is not None:
+            searchers = [
+                func for regex, func in mapping.searchers if regex.match(query_string)
+            ]
+        else:
+            searchers = [
+                func
+                for srch, func in cls.searchables().items()
+                if re.match(srch, query_string)
+            ]
         if len(searchers) == 0:
             raise AttributeError(f"Searcher does not exist: {query_string}")
         return searchers[0]
@@ -350,6 +882,13 @@ class FhirBaseModelMixin:
         Returns a list od two-tuples containing the name of a searchable attribute and the function that searches for it based
         on the Attribute definitions in the FhirMap subclass.
         """
+        mapping = registry.lookup(cls)
+        if mapping is not None:
+            return mapping.searchables
+        return cls._collect_searchables()
+
+    @classmethod
+    def _collect_searchables(cls):
         searchables = {}
         for name, prop in cls.FhirMap.__dict__.items():
             if isinstance(prop, Attribute) and prop.searcher:
@@ -357,6 +896,40 @@ class FhirBaseModelMixin:
                 searchables[key] = prop.searcher
         return searchables
 
+    @classmethod
+    def _indexed_parameters(cls):
+        """
+        The codes of the search parameters of this mapping that are stored in the
+        search index tables, which are the ones using an indexed searcher.
+
+        :raises: :exc:`fhirbug.exceptions.MappingValidationError` if an indexed searcher
+                 without a ``param`` is declared with a ``search_regex``, since the
+                 code of its parameter is not known
+        """
+        params = []
+        for name, searcher in cls.searchables().items():
+            if not hasattr(searcher, "indexed_parameter"):
+                continue
+            code = searcher.indexed_parameter
+            if code is None and not validation.PLAIN_NAME.fullmatch(name):
+                raise MappingValidationError(
+                    f"The indexed searcher of {cls.__name__} declared with the "
+                    f'search_regex "{name}" must be given the code of its parameter'
+                )
+            params.append(code or name)
+        return params
+
+    @classmethod
+    def _fulltext_indexed(cls):
+        """
+        Whether the resources of this mapping should be kept in the full text index, which is
+        true if any of its searchers is a full text search.
+        """
+        return any(
+            hasattr(searcher, "fulltext_field")
+            for searcher in cls.searchables().values()
+        )
+
     @property
     def Fhir(self):
         """
@@ -367,11 +940,16 @@ class FhirBaseModelMixin:
         if not hasattr(self, "_Fhir"):
             self._Fhir = self.FhirMap()
             self._Fhir._model = self
-            self._Fhir._properties = [
-                prop
-                for prop, typ in self.FhirMap.__dict__.items()
-                if isinstance(typ, Attribute)
-            ]
+            mapping = registry.lookup(self.__class__)
+            self._Fhir._properties = (
+                mapping.properties
+                if mapping is not None
+                else [
+                    prop
+                    for prop, typ in self.FhirMap.__dict__.items()
+                    if isinstance(typ, Attribute)
+                ]
+            )
             # self._Fhir._searchables = [(name, prop.searcher) for name, prop in self.FhirMap.__dict__.items() if name in self._Fhir._properties and prop.searcher]
 
         # Return the singleton
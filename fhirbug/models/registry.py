@@ -0,0 +1,173 @@
+"""
+A registry of the mappings of the models module.
+
+Request handlers find the mapping of each request by name in the registry, instead of
+importing the models module and looking it up on every request. The registry is built
+the first time it is used after the settings are configured, and holds what fhirbug
+would otherwise work out from the ``FhirMap`` of a mapping every time it renders or
+searches it:
+
+- the Fhir resource class of the mapping
+- its searchers, with their names compiled to regular expressions
+- the names of the ``FhirMap`` attributes and the ones that exist on the resource
+- a validator of the parameters of its searches, see :mod:`fhirbug.models.validation`
+
+Pre-fork servers, such as gunicorn with ``preload_app``, should call :func:`warmup`,
+or :func:`fhirbug.server.preload.preload` which also imports the resources and freezes
+the heap, before forking, so the workers share the registry and the imported modules
+instead of building them on their first request::
+
+    from fhirbug.config import settings
+    settings.configure("settings")
+
+    from fhirbug.models.registry import warmup
+    warmup()
+"""
+import re
+import threading
+from types import SimpleNamespace
+
+from fhirbug.config import import_backend, import_models, import_searches, settings
+
+
+class Mapping:
+    """
+    What the registry knows about a mapping.
+
+    :param str name: The name of the mapping in the models module
+    :param Model: The mapping class
+    """
+
+    def __init__(self, name, Model):
+        from fhirbug.models.attributes import Attribute
+        from fhirbug.models.search_index import search_parameter_types
+        from fhirbug.models.validation import SearchValidator
+
+        #: The name of the mapping in the models module
+        self.name = name
+        #: The mapping class
+        self.Model = Model
+        try:
+            #: The Fhir resource class the mapping renders, or None if it has none
+            self.Resource = Model._get_resource_cls()
+        except AttributeError:
+            self.Resource = None
+        #: The searchers of the mapping by name or regular expression
+        self.searchables = Model._collect_searchables()
+        #: ``(compiled regular expression, searcher)`` tuples of the searchers
+        self.searchers = [
+            (re.compile(key), searcher) for key, searcher in self.searchables.items()
+        ]
+        resource_type = self.Resource.__name__ if self.Resource is not None else name
+        #: The :class:`SearchValidator <fhirbug.models.validation.SearchValidator>` of
+        #: the parameters of its searches
+        self.validator = SearchValidator(
+            resource_type,
+            self.searchables,
+            search_parameter_types().get(resource_type),
+        )
+        #: The names of the Attributes of the ``FhirMap``
+        self.properties = [
+            name
+            for name, value in Model.FhirMap.__dict__.items()
+            if isinstance(value, Attribute)
+        ]
+        #: The public ``FhirMap`` attributes that are fields of the resource
+        self.fields = []
+        #: The mandatory fields of the resource
+        self.mandatory = []
+        if self.Resource is not None:
+            mock = self.Resource()
+            self.fields = [
+                field
+                for field in dir(Model.FhirMap)
+                if not field.startswith("_") and hasattr(mock, field)
+            ]
+            self.mandatory = mock.mandatoryFields()
+
+
+class Registry:
+    """
+    The mappings of a models module.
+
+    :param module: The models module
+    """
+
+    def __init__(self, module):
+        from fhirbug.models.mixins import FhirBaseModelMixin
+
+        #: The mappings by their name in the models module
+        self.mappings = {}
+        #: The mappings by the type of the resource they render
+        self.by_resource = {}
+        #: The mappings by class
+        self.by_model = {}
+        for name, Model in vars(module).items():
+            if not (
+                isinstance(Model, type)
+                and issubclass(Model, FhirBaseModelMixin)
+                and hasattr(Model, "FhirMap")
+            ):
+                continue
+            mapping = Mapping(name, Model)
+            self.mappings[name] = mapping
+            self.by_model[Model] = mapping
+            if mapping.Resource is not None:
+                self.by_resource.setdefault(mapping.Resource.__name__, mapping)
+        #: A namespace of the mapping classes by name, a stand in for the models module
+        self.models = SimpleNamespace(
+            **{name: mapping.Model for name, mapping in self.mappings.items()}
+        )
+        #: A namespace of the resource classes of the mappings by name
+        self.resources = SimpleNamespace(
+            **{
+                name: mapping.Resource
+                for name, mapping in self.mappings.items()
+                if mapping.Resource is not None
+            }
+        )
+
+
+_registry = None
+_registry_settings = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """
+    Return the registry of the models module of the settings, building it on the
+    first call and again if the settings are configured anew.
+
+    :raises: :exc:`fhirbug.exceptions.ConfigurationError` if the settings are not configured
+    """
+    global _registry, _registry_settings
+    configured = settings._wrapped
+    if _registry is not None and _registry_settings is configured:
+        return _registry
+    with _registry_lock:
+        if _registry is None or _registry_settings is not settings._wrapped:
+            module = import_models()
+            _registry, _registry_settings = Registry(module), settings._wrapped
+        return _registry
+
+
+def lookup(Model):
+    """
+    Return the :class:`Mapping` of ``Model`` if the registry has been built and
+    contains it, else ``None``. It never builds the registry.
+    """
+    registry = _registry
+    return registry.by_model.get(Model) if registry is not None else None
+
+
+def warmup():
+    """
+    Build the registry and import the modules of the database backend, so that the first
+    requests do not have to.
+
+    :returns: The :class:`Registry`
+    """
+    registry = get_registry()
+    import_backend("models")
+    import_searches()
+    return registry
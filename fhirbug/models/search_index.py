@@ -0,0 +1,338 @@
+"""
+Extract the values of search parameters from resources so they can be stored in
+search index tables, similar to the SPIDX tables of other FHIR servers.
+
+Search parameters are read from the ``search-parameters.json`` bundle published with
+the FHIR specification, at ``settings.SEARCH_PARAMETERS_PATH``. Only the subset of
+FHIRPath that search parameter expressions use for simple paths is supported: element
+paths, unions, choice types (``as``/``ofType``) and ``where()`` filters on a field value
+or on the type of a reference. Parameters with other expressions are not indexed.
+
+Supported parameter types are ``string``, ``token``, ``date``, ``quantity`` and ``reference``.
+"""
+import json
+import re
+from datetime import datetime, timezone
+
+from fhirbug.config import settings
+from fhirbug.exceptions import ConfigurationError, QueryValidationError
+from fhirbug.utils import transform_date, date_ceil
+
+INDEXED_TYPES = ("string", "token", "date", "quantity", "reference")
+
+_search_parameters = None
+_search_parameter_types = None
+
+
+def search_parameters():
+    """
+    Load the search parameter definitions.
+
+    :returns: A dict like ``{'Patient': {'name': ('string', [paths]), ...}, ...}``
+              where each path is a list of ``(element, type, condition)`` steps
+    """
+    global _search_parameters
+    if _search_parameters is None:
+        path = getattr(settings, "SEARCH_PARAMETERS_PATH", None)
+        if not path:
+            raise ConfigurationError(
+                "The SEARCH_PARAMETERS_PATH setting is required for indexed searches"
+            )
+        with open(path, "r") as f:
+            bundle = json.load(f)
+        definitions = {}
+        for entry in bundle.get("entry", []):
+            resource = entry["resource"]
+            if resource.get("type") not in INDEXED_TYPES:
+                continue
+            code = resource.get("code", resource.get("name"))
+            for base in resource.get("base", []):
+                paths = parse_expression(resource.get("expression", ""), base)
+                if paths:
+                    definitions.setdefault(base, {})[code] = (resource["type"], paths)
+        _search_parameters = definitions
+    return _search_parameters
+
+
+def search_parameter_types():
+    """
+    Load the types of all the search parameters, including the ones that can not be
+    indexed. Unlike :func:`search_parameters` it does not require
+    ``SEARCH_PARAMETERS_PATH``.
+
+    :returns: A dict like ``{'Patient': {'name': 'string', 'birthdate': 'date', ...}, ...}``,
+              empty if ``SEARCH_PARAMETERS_PATH`` is not set
+    """
+    global _search_parameter_types
+    if _search_parameter_types is None:
+        path = getattr(settings, "SEARCH_PARAMETERS_PATH", None)
+        types = {}
+        if path:
+            with open(path, "r") as f:
+                bundle = json.load(f)
+            for entry in bundle.get("entry", []):
+                resource = entry["resource"]
+                code = resource.get("code", resource.get("name"))
+                for base in resource.get("base", []):
+                    types.setdefault(base, {})[code] = resource.get("type")
+        _search_parameter_types = types
+    return _search_parameter_types
+
+
+def get_search_parameter(resource_type, code):
+    """
+    Return the ``(type, paths)`` definition of a search parameter.
+    Raises a :class:`QueryValidationError` if it does not exist.
+    """
+    try:
+        return search_parameters()[resource_type][code]
+    except KeyError:
+        raise QueryValidationError(
+            f"{code} is not an indexed search parameter of {resource_type}"
+        )
+
+
+def _split(expression, separator):
+    """
+    Split ``expression`` on ``separator`` when it is not inside parentheses or quotes.
+
+    >>> _split("Patient.name.where(use='a.b').given", ".")
+    ['Patient', 'name', "where(use='a.b')", 'given']
+    """
+    parts, depth, quoted, current = [], 0, False, ""
+    i = 0
+    while i < len(expression):
+        char = expression[i]
+        if char == "'":
+            quoted = not quoted
+        elif not quoted and char == "(":
+            depth += 1
+        elif not quoted and char == ")":
+            depth -= 1
+        if not quoted and depth == 0 and expression.startswith(separator, i):
+            parts.append(current)
+            current = ""
+            i += len(separator)
+            continue
+        current += char
+        i += 1
+    parts.append(current)
+    return parts
+
+
+def parse_expression(expression, resource_type):
+    """
+    Parse the paths of a search parameter expression that apply to ``resource_type``.
+
+    >>> parse_expression("Observation.code | Condition.code", "Condition")
+    [[('code', None, None)]]
+    >>> parse_expression("(Observation.value as Quantity)", "Observation")
+    [[('value', 'Quantity', None)]]
+    >>> parse_expression("Observation.subject.where(resolve() is Patient)", "Observation")
+    [[('subject', None, ('resolve', 'Patient'))]]
+    >>> parse_expression("Patient.telecom.where(system='phone')", "Patient")
+    [[('telecom', None, ('system', 'phone'))]]
+    >>> parse_expression("Patient.deceased.exists() and Patient.deceased != false", "Patient")
+    []
+    """
+    paths = []
+    for member in _split(expression, "|"):
+        member = member.strip()
+        if member.startswith("(") and member.endswith(")"):
+            member = member[1:-1].strip()
+        element_type = None
+        match = re.match(r"^(.+) as (\w+)$", member)
+        if match:
+            member, element_type = match.groups()
+        parts = _split(member, ".")
+        if parts[0] != resource_type or len(parts) < 2:
+            continue
+        steps = []
+        for part in parts[1:]:
+            function = re.match(r"^(\w+)\((.*)\)$", part)
+            if function is None and re.match(r"^\w+$", part):
+                steps.append([part, None, None])
+                continue
+            if function is None or not steps:
+                break
+            name, argument = function.groups()
+            resolve = re.match(r"^resolve\(\) is (\w+)$", argument)
+            equals = re.match(r"^(\w+)\s*=\s*'([^']*)'$", argument)
+            if name in ("as", "ofType") and re.match(r"^\w+$", argument):
+                steps[-1][1] = argument
+            elif name == "where" and resolve:
+                steps[-1][2] = ("resolve", resolve.group(1))
+            elif name == "where" and equals:
+                steps[-1][2] = equals.groups()
+            else:
+                break
+        else:
+            if element_type:
+                steps[-1][1] = element_type
+            paths.append([tuple(step) for step in steps])
+    return paths
+
+
+def _matches(value, condition):
+    if condition is None:
+        return True
+    if not isinstance(value, dict):
+        return False
+    field, expected = condition
+    if field == "resolve":
+        return value.get("reference", "").split("/")[-2:-1] == [expected]
+    return value.get(field) == expected
+
+
+def evaluate_path(resource_json, path):
+    """
+    Return all the values found at ``path`` of a resource in json form.
+
+    >>> evaluate_path(
+    ...     {"effectiveDateTime": "2012", "component": [{"code": {"text": "a"}}, {"code": {"text": "b"}}]},
+    ...     [("component", None, None), ("code", None, None)],
+    ... )
+    [{'text': 'a'}, {'text': 'b'}]
+    >>> evaluate_path({"effectiveDateTime": "2012"}, [("effective", None, None)])
+    ['2012']
+    """
+    values = [resource_json]
+    for name, element_type, condition in path:
+        found = []
+        for value in values:
+            if not isinstance(value, dict):
+                continue
+            if element_type:
+                keys = [name + element_type[0].upper() + element_type[1:]]
+            elif name in value:
+                keys = [name]
+            else:
+                # A choice type, eg effectiveDateTime for effective
+                keys = [
+                    key
+                    for key in value
+                    if key.startswith(name) and key[len(name) : len(name) + 1].isupper()
+                ]
+            for key in keys:
+                item = value.get(key)
+                items = item if isinstance(item, list) else [item]
+                found += [i for i in items if i is not None and _matches(i, condition)]
+        values = found
+    return values
+
+
+def _strings(value):
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            if key not in ("use", "system", "period", "extension"):
+                yield from _strings(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from _strings(item)
+
+
+def normalize_string(value):
+    """
+    >>> normalize_string("  Émile   Zola ")
+    'émile zola'
+    """
+    return " ".join(value.split()).lower()[:255]
+
+
+def _tokens(value):
+    if isinstance(value, bool):
+        yield None, "true" if value else "false"
+    elif isinstance(value, (str, int)):
+        yield None, str(value)
+    elif isinstance(value, dict):
+        if "coding" in value:
+            for coding in value["coding"]:
+                yield from _tokens(coding)
+        elif "code" in value:
+            yield value.get("system"), value["code"]
+        elif "value" in value:
+            # Identifier and ContactPoint
+            yield value.get("system"), str(value["value"])
+
+
+def to_utc(value):
+    """
+    Convert timezone aware datetimes to naive utc datetimes so they can be compared
+    with the values stored in the index.
+    """
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def date_range(value):
+    """
+    Return the range of datetimes covered by a date, dateTime or instant string.
+
+    >>> date_range("2012-03")
+    (datetime.datetime(2012, 3, 1, 0, 0), datetime.datetime(2012, 3, 31, 23, 59, 59, 59))
+    """
+    low = to_utc(transform_date(value, trim=False, to_datetime=True))
+    if len(value) <= 19:
+        high = date_ceil(value, trim=False)
+    else:
+        high = low
+    return low, high
+
+
+def _dates(value):
+    if isinstance(value, str):
+        yield date_range(value)
+    elif isinstance(value, dict) and ("start" in value or "end" in value):
+        # Period
+        low = date_range(value["start"])[0] if "start" in value else datetime.min
+        high = date_range(value["end"])[1] if "end" in value else datetime.max
+        yield low, high
+
+
+def _rows(param_type, value):
+    if param_type == "string":
+        return [
+            {"value": normalize_string(string), "exact": string[:255]}
+            for string in _strings(value)
+        ]
+    if param_type == "token":
+        return [{"system": system, "code": code} for system, code in _tokens(value)]
+    if param_type == "date":
+        try:
+            return [{"low": low, "high": high} for low, high in _dates(value)]
+        except QueryValidationError:
+            return []
+    if param_type == "quantity" and isinstance(value, dict) and "value" in value:
+        code = value.get("code", value.get("unit"))
+        return [{"value": float(value["value"]), "system": value.get("system"), "code": code}]
+    if param_type == "reference" and isinstance(value, dict) and "reference" in value:
+        return [{"target": "/".join(value["reference"].split("/")[-2:])}]
+    return []
+
+
+def extract_index_values(resource_json, params):
+    """
+    Extract the values of the search parameters ``params`` from a resource in json form.
+
+    :param dict resource_json: The resource
+    :param list params: The codes of the search parameters to extract
+    :returns: A dict from parameter types to lists of rows, eg
+              ``{'token': [{'param': 'code', 'system': 'http://loinc.org', 'code': '1234-5'}]}``
+    """
+    definitions = search_parameters().get(resource_json["resourceType"], {})
+    rows = {param_type: [] for param_type in INDEXED_TYPES}
+    for param in params:
+        if param not in definitions:
+            raise ConfigurationError(
+                f"{param} is not an indexed search parameter of {resource_json['resourceType']}"
+            )
+        param_type, paths = definitions[param]
+        for path in paths:
+            for value in evaluate_path(resource_json, path):
+                rows[param_type] += [
+                    {"param": param, **row} for row in _rows(param_type, value)
+                ]
+    return rows
@@ -0,0 +1,180 @@
+"""
+Validate the parameters of a search against the searchers of a mapping before it runs.
+
+Searchers are matched to parameters by name or by a regular expression, and parameters
+no searcher matches used to be silently ignored, so a typo in a parameter name returned
+every resource of the type. A :class:`SearchValidator` is compiled once per mapping,
+and is kept in the :mod:`registry <fhirbug.models.registry>`, from:
+
+- the searchers of the mapping, so a request is only looked up in a dict by the name
+  of each of its parameters
+- the types of the parameters, from the ``search_type`` of the searchers of fhirbug or
+  the search parameter definitions at ``settings.SEARCH_PARAMETERS_PATH``, which tell
+  the modifiers, prefixes and value formats a parameter accepts
+
+Unsupported parameters are rejected or ignored according to the ``handling``
+preference of the request, see :meth:`FhirBaseModelMixin.validate_search
+<fhirbug.models.mixins.FhirBaseModelMixin.validate_search>`. Values in the wrong format
+are always rejected.
+"""
+import re
+
+from fhirbug.exceptions import QueryValidationError, UnsupportedParameterError
+from fhirbug.models import registry
+from fhirbug.models.search_index import search_parameter_types
+from fhirbug.server.requestparser import RESULT_PARAMETERS
+
+#: The modifiers the searchers of fhirbug implement for each type of parameter.
+#: Reference parameters also accept a resource type as a modifier, eg ``subject:Patient``
+MODIFIERS = {
+    "string": ("exact", "contains"),
+    "token": (),
+    "reference": (),
+    "date": (),
+    "number": (),
+    "quantity": (),
+    "uri": (),
+    "special": (),
+    "composite": (),
+}
+
+PREFIX = r"(eq|ne|gt|lt|ge|le|sa|eb|ap)?"
+NUMBER = r"[+-]?(\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?"
+DATE = (
+    r"\d{4}(-\d{2}(-\d{2}(T\d{2}(:\d{2}(:\d{2}(\.\d+)?)?)?"
+    r"(Z|[+-]\d{2}:\d{2})?)?)?)?"
+)
+
+#: Regular expressions of the values of the types of parameters whose format is known
+VALUES = {
+    "number": re.compile(f"{PREFIX}{NUMBER}"),
+    "date": re.compile(f"{PREFIX}{DATE}"),
+    "quantity": re.compile(rf"{PREFIX}{NUMBER}(\|[^|]*(\|[^|]*)?)?"),
+}
+
+# Names of searchers that are not regular expressions
+PLAIN_NAME = re.compile(r"[\w-]+")
+
+
+class SearchValidator:
+    """
+    The search parameters of a mapping, compiled for validating requests.
+
+    :param str resource_type: The type of the resource of the mapping, used for its
+                              search parameter definitions and in error messages
+    :param dict searchables: The searchers of the mapping by name or regular expression,
+                             see :meth:`searchables <fhirbug.models.mixins.FhirBaseModelMixin.searchables>`
+    :param dict definitions: The types of the search parameters of the resource by code
+    """
+
+    def __init__(self, resource_type, searchables, definitions=None):
+        definitions = definitions or {}
+        self.resource_type = resource_type
+        #: The types of parameters by name, ``None`` if it is not known
+        self.parameters = {}
+        #: ``(compiled regular expression, type)`` tuples of the other searchers
+        self.patterns = []
+        for key, searcher in searchables.items():
+            code = getattr(searcher, "indexed_parameter", None) or key
+            search_type = getattr(searcher, "search_type", None) or definitions.get(
+                code
+            )
+            if PLAIN_NAME.fullmatch(key):
+                self.parameters[key] = search_type
+            else:
+                self.patterns.append((re.compile(key), search_type))
+
+    def parameter_type(self, name):
+        """
+        Return the type of the searcher of the parameter ``name``, which may have a
+        modifier, or ``None`` if it is not known.
+
+        :raises UnsupportedParameterError: If no searcher matches the parameter
+        """
+        base = name.partition(":")[0]
+        if base in self.parameters:
+            return self.parameters[base]
+        for regex, search_type in self.patterns:
+            if regex.fullmatch(name) or regex.fullmatch(base):
+                return search_type
+        raise UnsupportedParameterError(
+            f'Searching {self.resource_type} by "{base}" is not supported'
+        )
+
+    def check(self, name, values):
+        """
+        Check that the searcher of the parameter ``name`` supports its modifier and
+        that ``values`` are in the format of its type.
+
+        :raises UnsupportedParameterError: If the parameter or its modifier are not
+                                           supported
+        :raises QueryValidationError: If a value is invalid
+        """
+        search_type = self.parameter_type(name)
+        if search_type is None:
+            return
+        base, _, modifier = name.partition(":")
+        if modifier and modifier not in MODIFIERS.get(search_type, ()):
+            if not (search_type == "reference" and modifier[0].isupper()):
+                raise UnsupportedParameterError(
+                    f'The "{modifier}" modifier is not supported by "{base}"'
+                )
+        regex = VALUES.get(search_type)
+        if regex is None:
+            return
+        for value in values:
+            if not regex.fullmatch(value):
+                raise QueryValidationError(
+                    f'"{value}" is not a valid {search_type} value for "{base}"'
+                )
+
+    def validate(self, query, strict=False):
+        """
+        Validate the search parameters of ``query``. Chained and reverse chained
+        parameters are validated by the mappings they refer to while the search is
+        compiled, and parameters that control the results are left to the code that
+        handles them.
+
+        :param query: The :class:`FhirRequestQuery <fhirbug.server.requestparser.FhirRequestQuery>`
+        :param bool strict: Whether unsupported parameters are rejected, otherwise they
+                            are removed from ``query``
+        :returns: The names of the parameters that were removed
+        :raises QueryValidationError: If a parameter is invalid, or it is unsupported
+                                      and ``strict`` is set
+        """
+        ignored = []
+        for params in (query.search_params, query.modifiers):
+            for name in list(params):
+                if (
+                    name in RESULT_PARAMETERS
+                    or name in query.chained_params
+                    or name in query.reverse_chained_params
+                ):
+                    continue
+                try:
+                    self.check(name, params[name])
+                except UnsupportedParameterError:
+                    if strict:
+                        raise
+                    del params[name]
+                    ignored.append(name)
+        return ignored
+
+
+def search_validator(Model):
+    """
+    Return the :class:`SearchValidator` of ``Model``, from the registry if it holds
+    the mapping.
+    """
+    mapping = registry.lookup(Model)
+    if mapping is not None:
+        return mapping.validator
+    try:
+        resource_type = Model._get_resource_cls().__name__
+    except AttributeError:
+        resource_type = Model.__name__
+    return SearchValidator(
+        resource_type,
+        Model._collect_searchables(),
+        search_parameter_types().get(resource_type),
+    )
@@ -0,0 +1,346 @@
+"""
+WSGI and ASGI applications that serve the request handlers over HTTP.
+
+They route requests to the handler of their method, pick the response format from
+the ``_format`` parameter or the ``Accept`` header and turn errors into OperationOutcomes.
+Bundles are serialized and sent in chunks, without a ``Content-Length``, so servers
+use chunked transfer encoding and large searchsets never need a single response string.
+
+WSGI::
+
+    from fhirbug.server.app import WSGIApplication
+    application = WSGIApplication(prefix="/r4")
+
+ASGI::
+
+    from fhirbug.server.app import ASGIApplication
+    application = ASGIApplication(prefix="/r4")
+"""
+import json
+import traceback
+from http import HTTPStatus
+from urllib.parse import parse_qs
+
+from fhirbug.config import settings
+from fhirbug.exceptions import OperationError
+from fhirbug.server.requesthandlers import (
+    GetRequestHandler,
+    PostRequestHandler,
+    PutRequestHandler,
+    PatchRequestHandler,
+    DeleteRequestHandler,
+    AsyncGetRequestHandler,
+    AsyncPostRequestHandler,
+    AsyncPutRequestHandler,
+    AsyncPatchRequestHandler,
+    AsyncDeleteRequestHandler,
+)
+
+JSON_MIMETYPES = ["application/fhir+json", "application/json", "json"]
+XML_MIMETYPES = ["application/fhir+xml", "application/xml", "text/xml", "xml"]
+
+#: Serialized bodies are sent in chunks of this many bytes
+CHUNK_SIZE = 64 * 1024
+
+
+class Request:
+    """
+    The parts of an HTTP request the handlers need. It is passed to the handlers as
+    the ``query_context`` so it is available to auditing methods as ``query.context``.
+    """
+
+    def __init__(self, method, path, query_string, headers, body=b""):
+        #: The request method, eg ``'GET'``
+        self.method = method
+        #: The path of the request relative to the application's prefix, eg ``'Patient/123'``
+        self.path = path
+        #: The query string of the request, without the leading ``?``
+        self.query_string = query_string
+        #: A dict of the request headers with lowercase names
+        self.headers = headers
+        #: The body of the request as bytes
+        self.body = body
+
+    @property
+    def url(self):
+        """
+        The url the handlers receive, eg ``'Patient?name=Jo'``
+        """
+        return f"{self.path}?{self.query_string}" if self.query_string else self.path
+
+
+def negotiate_format(request):
+    """
+    Pick the response format using the ``_format`` parameter, or the ``Accept`` header
+    if it is not present.
+
+    :returns: A ``(format, mimetype)`` tuple where format is ``'json'`` or ``'xml'``,
+              or ``(None, None)`` if none of the requested formats is supported
+
+    >>> negotiate_format(Request("GET", "Patient", "_format=xml", {}))
+    ('xml', 'application/fhir+xml')
+    >>> negotiate_format(Request("GET", "Patient", "", {"accept": "application/json"}))
+    ('json', 'application/json')
+    >>> negotiate_format(Request("GET", "Patient", "", {"accept": "text/html, */*;q=0.8"}))
+    ('json', 'application/fhir+json')
+    >>> negotiate_format(Request("GET", "Patient", "", {"accept": "text/html"}))
+    (None, None)
+    """
+    requested = parse_qs(request.query_string).get("_format")
+    if requested:
+        accepted = [requested[0].strip()]
+    else:
+        accept = request.headers.get("accept", "") or "*/*"
+        accepted = [media.split(";")[0].strip() for media in accept.split(",")]
+
+    for mimetype in accepted:
+        if mimetype in JSON_MIMETYPES:
+            return "json", mimetype if "/" in mimetype else JSON_MIMETYPES[0]
+        if mimetype in XML_MIMETYPES:
+            return "xml", mimetype if "/" in mimetype else XML_MIMETYPES[0]
+        if mimetype in ("*/*", "application/*"):
+            return "json", JSON_MIMETYPES[0]
+    return None, None
+
+
+def chunks(content, size=CHUNK_SIZE):
+    """
+    Serialize a Bundle to json one entry at a time and yield it in chunks of about ``size`` bytes.
+
+    >>> list(chunks({"resourceType": "Bundle", "entry": [{"a": 1}, {"b": 2}]}, size=8))
+    [b'{"resourceType": "Bundle", "entry": [{"a": 1}', b', {"b": 2}', b']}']
+    """
+    entries = content.get("entry")
+    if not entries:
+        yield json.dumps(content).encode("utf-8")
+        return
+    head = json.dumps({key: value for key, value in content.items() if key != "entry"})
+    buffer = [head[:-1] + (", " if len(head) > 2 else "") + '"entry": [']
+    length = len(buffer[0])
+    for index, entry in enumerate(entries):
+        part = (", " if index else "") + json.dumps(entry)
+        buffer.append(part)
+        length += len(part)
+        if length >= size:
+            yield "".join(buffer).encode("utf-8")
+            buffer, length = [], 0
+    buffer.append("]}")
+    yield "".join(buffer).encode("utf-8")
+
+
+class FhirApplication:
+    """
+    Routing, content negotiation and error handling shared by :class:`WSGIApplication`
+    and :class:`ASGIApplication`.
+
+    :param str prefix: The path the server is mounted on, eg ``'/r4'``
+    :param dict handlers: Overrides the handler class used for each request method, eg
+                          ``{'GET': MyGetRequestHandler}``
+    """
+
+    handlers = {
+        "GET": GetRequestHandler,
+        "POST": PostRequestHandler,
+        "PUT": PutRequestHandler,
+        "PATCH": PatchRequestHandler,
+        "DELETE": DeleteRequestHandler,
+    }
+
+    def __init__(self, prefix="", handlers=None):
+        self.prefix = prefix.strip("/")
+        self.handlers = {**self.handlers, **(handlers or {})}
+
+    def relative_path(self, path):
+        path = path.strip("/")
+        if self.prefix and (path == self.prefix or path.startswith(self.prefix + "/")):
+            path = path[len(self.prefix) :]
+        return path.strip("/")
+
+    def error(self, status, code, diagnostics):
+        error = OperationError("error", code, diagnostics, status)
+        return error.to_fhir().as_json(), status
+
+    def handler_arguments(self, request):
+        """
+        Return the handler class and the arguments for its ``handle`` method,
+        or an error response tuple if the request can not be handled.
+        """
+        Handler = self.handlers.get(request.method)
+        if Handler is None:
+            return None, self.error(
+                405, "not-supported", f"{request.method} is not supported"
+            )
+        if request.method not in ("POST", "PUT", "PATCH"):
+            return Handler, (request.url,)
+        try:
+            body = json.loads(request.body or b"null")
+        except ValueError as e:
+            return None, self.error(400, "invalid", f"Invalid json body: {e}")
+        return Handler, (request.url, body)
+
+    def unexpected_error(self, exception):
+        diagnostics = f"{exception}"
+        if settings.DEBUG:
+            diagnostics += " " + traceback.format_exc()
+        return self.error(500, "exception", diagnostics)
+
+    def response(self, request, content, status, extra_headers=None):
+        """
+        Serialize the response of a handler.
+
+        :param dict extra_headers: Headers set by the handler, eg ``Content-Location``
+        :returns: A tuple ``(status, headers, body)`` where body is an iterable of bytes
+        """
+        extra_headers = list((extra_headers or {}).items())
+        if status == 304:
+            # Not Modified responses have no body
+            return status, extra_headers, []
+        if content is None:
+            # Writes with a ``Prefer: return=minimal`` header
+            return status, [("Content-Length", "0")] + extra_headers, []
+        format, mimetype = negotiate_format(request)
+        if format is None:
+            content, status = self.error(
+                406, "not-supported", "The requested format is not supported"
+            )
+            format, mimetype = "json", JSON_MIMETYPES[0]
+        if format == "xml":
+            try:
+                import dicttoxml
+            except ImportError:
+                content, status = self.error(
+                    406, "not-supported", "xml responses require the dicttoxml package"
+                )
+                format, mimetype = "json", JSON_MIMETYPES[0]
+            else:
+                body = dicttoxml.dicttoxml(content, attr_type=False)
+                return status, self.headers(mimetype, len(body)) + extra_headers, [body]
+
+        if content.get("resourceType") == "Bundle":
+            return status, self.headers(mimetype) + extra_headers, chunks(content)
+        body = json.dumps(content).encode("utf-8")
+        return status, self.headers(mimetype, len(body)) + extra_headers, [body]
+
+    def headers(self, mimetype, length=None):
+        headers = [("Content-Type", f"{mimetype}; charset=utf-8")]
+        if length is not None:
+            headers.append(("Content-Length", str(length)))
+        return headers
+
+
+class WSGIApplication(FhirApplication):
+    """
+    A `WSGI <https://www.python.org/dev/peps/pep-3333/>`_ application serving the request handlers.
+    """
+
+    def __call__(self, environ, start_response):
+        headers = {
+            key[5:].replace("_", "-").lower(): value
+            for key, value in environ.items()
+            if key.startswith("HTTP_")
+        }
+        for key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            if environ.get(key):
+                headers[key.replace("_", "-").lower()] = environ[key]
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            length = 0
+        request = Request(
+            method=environ["REQUEST_METHOD"].upper(),
+            path=self.relative_path(environ.get("PATH_INFO", "")),
+            query_string=environ.get("QUERY_STRING", ""),
+            headers=headers,
+            body=environ["wsgi.input"].read(length) if length else b"",
+        )
+
+        Handler, arguments = self.handler_arguments(request)
+        extra_headers = {}
+        if Handler is None:
+            content, status = arguments
+        else:
+            try:
+                handler = Handler()
+                content, status = handler.handle(*arguments, query_context=request)
+                extra_headers = getattr(handler, "response_headers", {})
+            except Exception as e:
+                content, status = self.unexpected_error(e)
+
+        status, headers, body = self.response(request, content, status, extra_headers)
+        start_response(f"{status} {HTTPStatus(status).phrase}", headers)
+        return body
+
+
+class ASGIApplication(FhirApplication):
+    """
+    An `ASGI <https://asgi.readthedocs.io/>`_ application serving the request handlers.
+    Requests are handled by the async handlers, so slow queries do not block the event loop.
+    """
+
+    handlers = {
+        "GET": AsyncGetRequestHandler,
+        "POST": AsyncPostRequestHandler,
+        "PUT": AsyncPutRequestHandler,
+        "PATCH": AsyncPatchRequestHandler,
+        "DELETE": AsyncDeleteRequestHandler,
+    }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            raise ValueError(f"Unsupported ASGI scope type {scope['type']}")
+
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        request = Request(
+            method=scope["method"].upper(),
+            path=self.relative_path(scope["path"]),
+            query_string=scope.get("query_string", b"").decode("latin-1"),
+            headers={
+                name.decode("latin-1").lower(): value.decode("latin-1")
+                for name, value in scope.get("headers", [])
+            },
+            body=body,
+        )
+
+        Handler, arguments = self.handler_arguments(request)
+        extra_headers = {}
+        if Handler is None:
+            content, status = arguments
+        else:
+            try:
+                handler = Handler()
+                content, status = await handler.handle(*arguments, query_context=request)
+                extra_headers = getattr(handler, "response_headers", {})
+            except Exception as e:
+                content, status = self.unexpected_error(e)
+
+        status, headers, body = self.response(request, content, status, extra_headers)
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in headers
+                ],
+            }
+        )
+        for chunk in body:
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
@@ -0,0 +1,318 @@
+"""
+An asynchronous pipeline that writes the AuditEvents of requests in batches.
+
+It is disabled by default, so :meth:`log_request
+<fhirbug.server.requesthandlers.AbstractRequestHandler.log_request>` returns the
+AuditEvent of each request and nothing is persisted. Set ``settings.AUDIT_SINK`` to
+enable it and ``log_request`` instead adds the request to a bounded queue and returns
+immediately. A background thread takes requests from the queue, creates their
+AuditEvents with :meth:`audit_event
+<fhirbug.server.requesthandlers.AbstractRequestHandler.audit_event>` and passes them to
+the sink in batches of up to ``AUDIT_BATCH_SIZE``, at least every
+``AUDIT_FLUSH_INTERVAL`` seconds.
+
+A sink is any callable that receives a list of AuditEvent resources, eg::
+
+    AUDIT_SINK = lambda events: logger.info("%s", [event.as_json() for event in events])
+
+or one of:
+
+- :class:`NDJSONSink`, which appends the events to NDJSON files and rotates them
+- :class:`ModelSink`, which inserts the events in the table of a mapping
+
+``AUDIT_SAMPLE_RATE`` keeps a fraction of the events of successful requests, while
+the events of requests that failed are always kept. When the queue is full,
+``AUDIT_OVERFLOW`` decides whether the new event is dropped (``"drop"``), the oldest
+event in the queue is dropped to make room for it (``"drop_oldest"``), or the request
+waits for up to ``AUDIT_BLOCK_TIMEOUT`` seconds (``"block"``).
+
+The queue is flushed when the interpreter exits, or by calling :func:`shutdown`. The
+counts of events submitted, sampled out, dropped, written and failed are returned by
+:func:`stats`.
+"""
+import atexit
+import json
+import os
+import queue
+import random
+import threading
+import time
+import traceback
+
+from fhirbug.config import settings
+
+#: The policies for events submitted while the queue is full
+OVERFLOW_POLICIES = ("drop", "drop_oldest", "block")
+
+# Put in the queue to stop the writer
+_STOP = object()
+
+
+class NDJSONSink:
+    """
+    Append AuditEvents to a file, one json resource per line. When the file would grow
+    larger than ``max_bytes`` it is renamed to ``path.1``, ``path.1`` to ``path.2`` and
+    so on, keeping at most ``backup_count`` old files.
+
+    :param str path: The path of the file
+    :param int max_bytes: The size at which the file is rotated, ``0`` to never rotate
+    :param int backup_count: How many rotated files are kept
+    """
+
+    def __init__(self, path, max_bytes=100 * 1024 * 1024, backup_count=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._file = None
+
+    def __call__(self, events):
+        content = "".join(json.dumps(event.as_json()) + "\n" for event in events)
+        content = content.encode("utf-8")
+        if self._file is None:
+            self._file = open(self.path, "ab")
+        if self.max_bytes and self._file.tell() + len(content) > self.max_bytes:
+            self.rotate()
+        self._file.write(content)
+        self._file.flush()
+
+    def rotate(self):
+        self.close()
+        if self.backup_count:
+            for index in range(self.backup_count - 1, 0, -1):
+                source = f"{self.path}.{index}"
+                if os.path.exists(source):
+                    os.replace(source, f"{self.path}.{index + 1}")
+            if os.path.exists(self.path):
+                os.replace(self.path, f"{self.path}.1")
+        self._file = open(self.path, "wb")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class ModelSink:
+    """
+    Insert AuditEvents in the table of a mapping, one batch at a time.
+
+    :param str resource: The name of the mapping in the models module, it is imported
+                         on the first write
+    """
+
+    def __init__(self, resource="AuditEvent"):
+        self.resource = resource
+
+    def __call__(self, events):
+        from fhirbug.config import import_models
+
+        Model = getattr(import_models(), self.resource)
+        try:
+            Model._bulk_insert([Model.from_resource(event) for event in events])
+        finally:
+            Model._close_thread_session()
+
+
+class AuditPipeline:
+    """
+    A bounded queue of requests to audit and the thread that writes their AuditEvents.
+
+    :param sink: A callable that receives a list of AuditEvents
+    :param int queue_size: The most events that may wait to be written
+    :param int batch_size: The most events passed to the sink at a time
+    :param float flush_interval: The most seconds an event waits for its batch to fill
+    :param float sample_rate: The fraction of the events of successful requests kept
+    :param str overflow: One of :data:`OVERFLOW_POLICIES`
+    :param float block_timeout: How long the ``"block"`` policy waits for room
+    """
+
+    def __init__(
+        self,
+        sink,
+        queue_size=10000,
+        batch_size=100,
+        flush_interval=1.0,
+        sample_rate=1.0,
+        overflow="drop",
+        block_timeout=1.0,
+    ):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(
+                f"overflow must be one of {', '.join(OVERFLOW_POLICIES)}, not {overflow}"
+            )
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.sample_rate = sample_rate
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.queue = queue.Queue(queue_size)
+        self.closed = False
+        self._lock = threading.Lock()
+        self.counts = {
+            "submitted": 0,
+            "sampled_out": 0,
+            "dropped": 0,
+            "written": 0,
+            "errors": 0,
+        }
+        self._thread = threading.Thread(
+            target=self._run, name="fhirbug-audit", daemon=True
+        )
+        self._thread.start()
+
+    def _add(self, name, count=1):
+        with self._lock:
+            self.counts[name] += count
+
+    def submit(self, status, build):
+        """
+        Queue the AuditEvent of a request.
+
+        :param int status: The status code of the response, used for sampling
+        :param build: A callable that creates the AuditEvent in the writer thread
+        :returns: ``True`` if the event was queued
+        """
+        self._add("submitted")
+        if self.closed:
+            self._add("dropped")
+            return False
+        if status < 400 and random.random() >= self.sample_rate:
+            self._add("sampled_out")
+            return False
+        try:
+            if self.overflow == "block":
+                self.queue.put(build, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(build)
+            return True
+        except queue.Full:
+            pass
+        if self.overflow == "drop_oldest":
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self._add("dropped")
+                self.queue.put_nowait(build)
+                return True
+            except (queue.Empty, queue.Full):
+                pass
+        self._add("dropped")
+        return False
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while batch[-1] is not _STOP and len(batch) < self.batch_size:
+            timeout = max(0, deadline - time.monotonic())
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            stop = batch[-1] is _STOP
+            builds = batch[:-1] if stop else batch
+            try:
+                self._write(builds)
+            finally:
+                for item in batch:
+                    self.queue.task_done()
+            if stop:
+                return
+
+    def _write(self, builds):
+        events = []
+        for build in builds:
+            try:
+                events.append(build())
+            except Exception:
+                self._add("errors")
+                traceback.print_exc()
+        if not events:
+            return
+        try:
+            self.sink(events)
+            self._add("written", len(events))
+        except Exception:
+            self._add("errors", len(events))
+            traceback.print_exc()
+
+    def flush(self):
+        """
+        Wait until all the queued events have been written.
+        """
+        self.queue.join()
+
+    def close(self, timeout=None):
+        """
+        Write the queued events, stop the writer and close the sink. Events submitted
+        afterwards are dropped.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(_STOP)
+        self._thread.join(timeout)
+        if hasattr(self.sink, "close"):
+            self.sink.close()
+
+    def stats(self):
+        with self._lock:
+            return {**self.counts, "queued": self.queue.qsize()}
+
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+
+def pipeline():
+    """
+    Return the pipeline configured in the settings, starting it on the first call, or
+    ``None`` if ``settings.AUDIT_SINK`` is not set.
+    """
+    global _pipeline
+    if _pipeline is not None:
+        return _pipeline
+    sink = settings.AUDIT_SINK
+    if sink is None:
+        return None
+    with _pipeline_lock:
+        if _pipeline is None:
+            _pipeline = AuditPipeline(
+                sink,
+                queue_size=settings.AUDIT_QUEUE_SIZE,
+                batch_size=settings.AUDIT_BATCH_SIZE,
+                flush_interval=settings.AUDIT_FLUSH_INTERVAL,
+                sample_rate=settings.AUDIT_SAMPLE_RATE,
+                overflow=settings.AUDIT_OVERFLOW,
+                block_timeout=settings.AUDIT_BLOCK_TIMEOUT,
+            )
+            atexit.register(shutdown)
+        return _pipeline
+
+
+def shutdown(timeout=None):
+    """
+    Write the queued events and stop the pipeline. A new one is started if more
+    requests are audited.
+    """
+    global _pipeline
+    with _pipeline_lock:
+        current, _pipeline = _pipeline, None
+    if current is not None:
+        current.close(timeout)
+
+
+def stats():
+    """
+    Return the counts of the pipeline, eg::
+
+        {"submitted": 120, "sampled_out": 80, "dropped": 0, "written": 40, "errors": 0, "queued": 0}
+
+    or ``None`` if it has not been started.
+    """
+    return _pipeline.stats() if _pipeline is not None else None
@@ -0,0 +1,319 @@
+"""
+Handle ``batch`` and ``transaction`` Bundles posted to the base of the server.
+
+Batch entries are independent, so each one is handled by the request handler of its
+method and committed on its own, possibly concurrently on ``settings.BATCH_WORKERS``
+threads. A failing entry does not affect the others.
+
+Transaction entries are all written in a single database transaction, in the order
+the specification requires (DELETE, POST, PUT, GET), and if any of them fails none of
+them is applied. Created resources are inserted in rounds: each round contains the
+entries whose ``urn:uuid`` references point only to resources created in earlier
+rounds. All the inserts of a round are flushed together, which lets the ORM insert the
+rows of each resource type in bulk. References to the ``fullUrl`` of created entries are
+then replaced with their new location.
+"""
+import traceback
+from http import HTTPStatus
+
+from fhirbug.config import import_backend, settings
+from fhirbug.exceptions import OperationError, QueryValidationError
+from fhirbug.models.registry import get_registry
+from fhirbug.server.requesthandlers import (
+    AbstractRequestHandler,
+    GetRequestHandler,
+    PostRequestHandler,
+    PutRequestHandler,
+    DeleteRequestHandler,
+    write_response,
+)
+from fhirbug.server.requestparser import parse_url
+from fhirbug.utils import concurrent_map
+
+METHOD_ORDER = ["DELETE", "POST", "PUT", "GET"]
+
+
+def status_line(status):
+    """
+    >>> status_line(201)
+    '201 Created'
+    """
+    return f"{status} {HTTPStatus(status).phrase}"
+
+
+def find_references(value):
+    """
+    Yield all the ``reference`` values in a resource in json form.
+
+    >>> list(find_references({"subject": {"reference": "urn:uuid:1"}, "a": [{"reference": "B/2"}]}))
+    ['urn:uuid:1', 'B/2']
+    """
+    if isinstance(value, dict):
+        if isinstance(value.get("reference"), str):
+            yield value["reference"]
+        for item in value.values():
+            yield from find_references(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from find_references(item)
+
+
+def replace_references(value, locations):
+    """
+    Return a copy of a resource in json form, with the references found in ``locations``
+    replaced by their new location.
+
+    >>> replace_references({"subject": {"reference": "urn:uuid:1"}}, {"urn:uuid:1": "Patient/3"})
+    {'subject': {'reference': 'Patient/3'}}
+    """
+    if isinstance(value, dict):
+        value = {key: replace_references(item, locations) for key, item in value.items()}
+        if value.get("reference") in locations:
+            value["reference"] = locations[value["reference"]]
+        return value
+    if isinstance(value, list):
+        return [replace_references(item, locations) for item in value]
+    return value
+
+
+def creation_rounds(entries):
+    """
+    Group POST entries so that the ``urn:uuid`` references of the entries of each
+    round point only to entries of earlier rounds.
+
+    >>> entries = [
+    ...     {"fullUrl": "urn:uuid:2", "resource": {"subject": {"reference": "urn:uuid:1"}}},
+    ...     {"fullUrl": "urn:uuid:1", "resource": {}},
+    ... ]
+    >>> [[entry["fullUrl"] for entry in round] for round in creation_rounds(entries)]
+    [['urn:uuid:1'], ['urn:uuid:2']]
+    """
+    full_urls = {entry.get("fullUrl") for entry in entries if entry.get("fullUrl")}
+    pending = [
+        (entry, set(find_references(entry.get("resource", {}))) & full_urls)
+        for entry in entries
+    ]
+    created = set()
+    rounds = []
+    while pending:
+        ready = [entry for entry, references in pending if references <= created]
+        if not ready:
+            raise OperationError(
+                severity="error",
+                code="invalid",
+                diagnostics="The transaction contains circular references",
+                status_code=400,
+            )
+        rounds.append(ready)
+        created |= {entry.get("fullUrl") for entry in ready}
+        pending = [(e, references) for e, references in pending if e not in ready]
+    return rounds
+
+
+class BundleRequestHandler(AbstractRequestHandler):
+    """
+    Receive a batch or transaction Bundle posted to the base url of the server and handle
+    every entry. It returns a tuple ``(response json, status code)`` where the response is a
+    ``batch-response`` or ``transaction-response`` Bundle with an entry for each request entry,
+    in the same order.
+
+    If a transaction fails, the OperationOutcome of the failing entry is returned instead.
+    """
+
+    handlers = {
+        "GET": GetRequestHandler,
+        "POST": PostRequestHandler,
+        "PUT": PutRequestHandler,
+        "DELETE": DeleteRequestHandler,
+    }
+
+    def handle(self, url, body, query_context=None):
+        try:
+            self.parse_url(url, query_context)
+            self.query_context = query_context
+            self._audit_request(self.query)
+            bundle_type, entries = self.validate_bundle(body)
+
+            if bundle_type == "transaction":
+                responses = self.transaction(entries)
+            else:
+                responses = self.batch(entries)
+
+            return (
+                {
+                    "resourceType": "Bundle",
+                    "type": f"{bundle_type}-response",
+                    "entry": responses,
+                },
+                200,
+            )
+        except OperationError as e:
+            return e.to_fhir().as_json(), e.status_code
+
+    def validate_bundle(self, body):
+        if not isinstance(body, dict) or body.get("resourceType") != "Bundle":
+            raise OperationError(
+                severity="error",
+                code="invalid",
+                diagnostics="Only Bundles can be posted to the base of the server",
+                status_code=400,
+            )
+        bundle_type = body.get("type")
+        if bundle_type not in ("batch", "transaction"):
+            raise OperationError(
+                severity="error",
+                code="invalid",
+                diagnostics=f'Bundles of type "{bundle_type}" can not be processed, '
+                "use batch or transaction",
+                status_code=400,
+            )
+        entries = body.get("entry", [])
+        for index, entry in enumerate(entries):
+            request = entry.get("request", {})
+            if request.get("method") not in self.handlers or "url" not in request:
+                raise OperationError(
+                    severity="error",
+                    code="invalid",
+                    diagnostics=f"Entry {index} does not have a valid request",
+                    status_code=400,
+                )
+        return bundle_type, entries
+
+    def handle_entry(self, entry, locations=None):
+        """
+        Handle the request of a single entry using the handler of its method.
+
+        :returns: A response entry
+        """
+        method = entry["request"]["method"]
+        url = entry["request"]["url"]
+        handler = self.handlers[method]()
+        if method in ("POST", "PUT"):
+            resource = replace_references(entry.get("resource"), locations or {})
+            content, status = handler.handle(url, resource, self.query_context)
+        else:
+            content, status = handler.handle(url, self.query_context)
+        return self.response_entry(content, status, handler.response_headers)
+
+    def response_entry(self, content, status, headers=None):
+        response = {"status": status_line(status)}
+        if status >= 400:
+            response["outcome"] = content
+            return {"response": response}
+        headers = headers or {}
+        if "Location" in headers:
+            response["location"] = headers["Location"]
+        if "ETag" in headers:
+            response["etag"] = headers["ETag"]
+        if content is None:
+            # The entry was written with a ``Prefer: return=minimal`` header
+            return {"response": response}
+        if content.get("resourceType") not in (None, "OperationOutcome"):
+            if content.get("id") and content["resourceType"] != "Bundle":
+                response["location"] = f"{content['resourceType']}/{content['id']}"
+            return {"response": response, "resource": content}
+        return {"response": response}
+
+    def batch(self, entries):
+        Model = import_backend("models").AbstractBaseModel
+        return concurrent_map(
+            self.handle_entry,
+            entries,
+            settings.BATCH_WORKERS,
+            cleanup=lambda entry: Model._close_thread_session(),
+        )
+
+    def transaction(self, entries):
+        by_method = {method: [] for method in METHOD_ORDER}
+        for index, entry in enumerate(entries):
+            by_method[entry["request"]["method"]].append((index, entry))
+
+        responses = [None] * len(entries)
+        locations = {}
+        Model = import_backend("models").AbstractBaseModel
+        try:
+            with Model.atomic():
+                for index, entry in by_method["DELETE"]:
+                    responses[index] = self.check(self.handle_entry(entry))
+
+                indexes = {id(entry): index for index, entry in by_method["POST"]}
+                for round in creation_rounds([entry for _, entry in by_method["POST"]]):
+                    created = [(entry, self.create(entry, locations)) for entry in round]
+                    Model._flush()
+                    for entry, instance in created:
+                        content, headers = write_response(
+                            instance, self.query, "created"
+                        )
+                        response = self.response_entry(content, 201, headers)
+                        if entry.get("fullUrl"):
+                            locations[entry["fullUrl"]] = response["response"]["location"]
+                        responses[indexes[id(entry)]] = response
+
+                for index, entry in by_method["PUT"] + by_method["GET"]:
+                    responses[index] = self.check(self.handle_entry(entry, locations))
+        except OperationError:
+            raise
+        except Exception as e:
+            # Database errors raised while flushing or committing, eg a unique or
+            # foreign key violation. The transaction has been rolled back.
+            diag = f"The transaction failed: {e}"
+            if settings.DEBUG:
+                diag += " {}".format(traceback.format_exc())
+            raise OperationError(
+                severity="error", code="invalid", diagnostics=diag, status_code=422
+            )
+        finally:
+            # Entries were invalidated before the transaction was committed or rolled
+            # back, and reads inside it may have cached data that was never committed
+            self.invalidate_cache(
+                [entry["request"]["url"] for entry in entries] + list(locations.values())
+            )
+        return responses
+
+    def invalidate_cache(self, urls):
+        """
+        Remove the resources of ``urls`` from the caches, see :mod:`fhirbug.models.cache`
+        """
+        from fhirbug.models import cache
+
+        if cache.read_cache() is None and cache.search_cache() is None:
+            return
+        models = get_registry().models
+        for url in urls:
+            try:
+                query = parse_url(url)
+            except QueryValidationError:
+                continue
+            Model = getattr(models, query.resource or "", None)
+            if Model is not None:
+                cache.invalidate(Model, query.resourceId)
+
+    def create(self, entry, locations):
+        """
+        Create the resource of a POST entry without committing it.
+        """
+        handler = PostRequestHandler()
+        try:
+            handler.body = replace_references(entry.get("resource"), locations)
+            handler.parse_url(entry["request"]["url"], self.query_context)
+            return handler.create_from_request()
+        except OperationError as e:
+            self.fail(e.to_fhir().as_json(), e.status_code)
+
+    def check(self, response):
+        """
+        Abort the transaction if an entry failed.
+        """
+        status = int(response["response"]["status"].split()[0])
+        if status >= 400:
+            self.fail(response["response"]["outcome"], status)
+        return response
+
+    def fail(self, outcome, status):
+        issue = outcome.get("issue", [{}])[0]
+        raise OperationError(
+            severity="error",
+            code=issue.get("code", "exception"),
+            diagnostics=f"The transaction failed: {issue.get('diagnostics', '')}",
+            status_code=status,
+        )
@@ -0,0 +1,169 @@
+"""
+Apply `JSON Patch <https://tools.ietf.org/html/rfc6902>`_ documents to resources.
+
+A patch is a list of operations, each of them an ``op`` applied to the element at the
+`JSON Pointer <https://tools.ietf.org/html/rfc6901>`_ ``path``::
+
+    [
+        {"op": "replace", "path": "/gender", "value": "female"},
+        {"op": "add", "path": "/name/-", "value": {"family": "Doe"}},
+        {"op": "remove", "path": "/telecom/0"}
+    ]
+
+>>> apply_patch({"gender": "male"}, [{"op": "replace", "path": "/gender", "value": "female"}])
+{'gender': 'female'}
+>>> touched_elements([{"op": "move", "from": "/name/1", "path": "/contact/0/name"}])
+['contact', 'name']
+"""
+import copy
+
+from fhirbug.exceptions import InvalidOperationError, QueryValidationError
+
+OPERATIONS = ("add", "remove", "replace", "move", "copy", "test")
+
+
+def parse_pointer(pointer):
+    """
+    Split a JSON Pointer in its reference tokens.
+
+    >>> parse_pointer("/name/0/given~1family")
+    ['name', '0', 'given/family']
+    """
+    if not isinstance(pointer, str) or (pointer and not pointer.startswith("/")):
+        raise QueryValidationError(f'"{pointer}" is not a valid JSON Pointer')
+    if not pointer:
+        return []
+    return [
+        token.replace("~1", "/").replace("~0", "~") for token in pointer[1:].split("/")
+    ]
+
+
+def validate_patch(patch):
+    """
+    Check that ``patch`` is a list of well formed operations.
+
+    :raises: :exc:`QueryValidationError <fhirbug.exceptions.QueryValidationError>`
+    """
+    if not isinstance(patch, list):
+        raise QueryValidationError("A JSON Patch document must be a list of operations")
+    for operation in patch:
+        if not isinstance(operation, dict) or operation.get("op") not in OPERATIONS:
+            raise QueryValidationError(f"Invalid JSON Patch operation {operation}")
+        required = ["path"]
+        if operation["op"] in ("add", "replace", "test"):
+            required.append("value")
+        if operation["op"] in ("move", "copy"):
+            required.append("from")
+        for member in required:
+            if member not in operation:
+                raise QueryValidationError(
+                    f'The {operation["op"]} operation {operation} has no "{member}"'
+                )
+        for member in ("path", "from"):
+            if member in operation:
+                parse_pointer(operation[member])
+
+
+def touched_elements(patch):
+    """
+    Return the sorted names of the top level elements that the operations of ``patch``
+    may change. Elements that are only tested or copied from are not included.
+    """
+    elements = set()
+    for operation in patch:
+        if operation["op"] == "test":
+            continue
+        pointers = [operation["path"]]
+        if operation["op"] == "move":
+            pointers.append(operation["from"])
+        for pointer in pointers:
+            tokens = parse_pointer(pointer)
+            if not tokens:
+                raise InvalidOperationError("The whole resource can not be patched")
+            elements.add(tokens[0])
+    return sorted(elements)
+
+
+def apply_patch(document, patch):
+    """
+    Apply the operations of ``patch`` to a copy of ``document`` and return it. The
+    operations are applied in order and if any of them fails none of them is.
+
+    :raises: :exc:`QueryValidationError <fhirbug.exceptions.QueryValidationError>` if
+             the patch is malformed and :exc:`InvalidOperationError
+             <fhirbug.exceptions.InvalidOperationError>` if it can not be applied, eg
+             because a path does not exist or a ``test`` failed
+    """
+    validate_patch(patch)
+    document = copy.deepcopy(document)
+    for operation in patch:
+        op = operation["op"]
+        path = parse_pointer(operation["path"])
+        if op == "add":
+            document = _add(document, path, copy.deepcopy(operation["value"]))
+        elif op == "remove":
+            document, _ = _remove(document, path)
+        elif op == "replace":
+            document, _ = _remove(document, path)
+            document = _add(document, path, copy.deepcopy(operation["value"]))
+        elif op == "move":
+            source = parse_pointer(operation["from"])
+            if path[: len(source)] == source and path != source:
+                raise InvalidOperationError(
+                    f'Can not move {operation["from"]} into one of its children'
+                )
+            document, value = _remove(document, source)
+            document = _add(document, path, value)
+        elif op == "copy":
+            value = _get(document, parse_pointer(operation["from"]))
+            document = _add(document, path, copy.deepcopy(value))
+        elif op == "test":
+            if _get(document, path) != operation["value"]:
+                raise InvalidOperationError(f'The test of {operation["path"]} failed')
+    return document
+
+
+def _get(document, tokens):
+    for token in tokens:
+        if isinstance(document, dict) and token in document:
+            document = document[token]
+        elif isinstance(document, list):
+            document = document[_index(document, token)]
+        else:
+            raise InvalidOperationError(f'The path "/{"/".join(tokens)}" does not exist')
+    return document
+
+
+def _index(array, token, adding=False):
+    if token == "-" and adding:
+        return len(array)
+    if not token.isdigit() or (token != "0" and token.startswith("0")):
+        raise InvalidOperationError(f'"{token}" is not a valid array index')
+    index = int(token)
+    if index > len(array) or (index == len(array) and not adding):
+        raise InvalidOperationError(f"The array index {token} is out of bounds")
+    return index
+
+
+def _add(document, tokens, value):
+    if not tokens:
+        return value
+    parent = _get(document, tokens[:-1])
+    if isinstance(parent, dict):
+        parent[tokens[-1]] = value
+    elif isinstance(parent, list):
+        parent.insert(_index(parent, tokens[-1], adding=True), value)
+    else:
+        raise InvalidOperationError(f'The path "/{"/".join(tokens)}" does not exist')
+    return document
+
+
+def _remove(document, tokens):
+    if not tokens:
+        return None, document
+    parent = _get(document, tokens[:-1])
+    if isinstance(parent, dict) and tokens[-1] in parent:
+        return document, parent.pop(tokens[-1])
+    if isinstance(parent, list):
+        return document, parent.pop(_index(parent, tokens[-1]))
+    raise InvalidOperationError(f'The path "/{"/".join(tokens)}" does not exist')
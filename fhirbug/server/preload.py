@@ -0,0 +1,48 @@
+"""
+Load everything a server needs before it forks its workers.
+
+Pre-forking servers, such as gunicorn with ``preload_app``, import the application
+once and fork it into workers. Whatever is loaded before the fork is shared by the
+workers through copy-on-write, whatever is loaded after it is loaded again by every
+worker. :func:`preload` imports the Fhir resources, the models module and the request
+handlers, builds the model registry and freezes the garbage collector, so that the
+collector does not write to, and copy, the shared pages in every worker.
+
+No database connections are opened. The SQLAlchemy backend creates its engine on first
+use and drops the connections inherited from the parent in the child of every fork.
+
+In a gunicorn configuration file::
+
+    from fhirbug.config import settings
+    settings.configure("settings")
+
+    preload_app = True
+
+    def on_starting(server):
+        from fhirbug.server.preload import preload
+        preload()
+"""
+import gc
+
+from fhirbug.models.registry import warmup
+
+
+def preload(freeze=True):
+    """
+    Import and build everything the request handlers use, then move all the objects
+    allocated so far out of the reach of the garbage collector.
+
+    :param bool freeze: Call ``gc.freeze()`` once everything is loaded. Not available
+                        before python 3.7, where it is skipped.
+    :returns: The :class:`Registry <fhirbug.models.registry.Registry>` of the models
+    """
+    # Importing fhirbug.Fhir loads every resource class
+    import fhirbug.Fhir
+    import fhirbug.server.app
+    import fhirbug.server.bundles
+
+    registry = warmup()
+    if freeze and hasattr(gc, "freeze"):
+        gc.collect()
+        gc.freeze()
+    return registry
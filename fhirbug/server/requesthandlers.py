@@ -1,7 +1,11 @@
-import threading
+import contextvars
+import functools
 import traceback
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
 
+from fhirbug.server import jsonpatch
 from fhirbug.server.requestparser import parse_url
 from fhirbug.exceptions import (
     MappingValidationError,
@@ -10,6 +14,9 @@ from fhirbug.exceptions import (
     OperationError,
     DoesNotExistError,
     AuthorizationError,
+    UnsupportedOperationError,
+    InvalidOperationError,
+    UnsupportedParameterError,
 )
 
 from fhirbug.Fhir.resources import (
@@ -18,18 +25,178 @@ from fhirbug.Fhir.resources import (
     AuditEvent,
     FHIRDate,
 )
-from fhirbug.config import import_models, settings
+from fhirbug.config import import_backend, settings
+from fhirbug.db.routing import read_only
+from fhirbug.models.registry import get_registry
+from fhirbug.constants import AUDIT_SUCCESS
+from fhirbug.utils import run_sync
 
 
-ctx = threading.local()
+# The query of the request being handled. Context variables are local to each thread
+# and to each asyncio task, so concurrent requests never see each other's context.
+ctx = contextvars.ContextVar("fhirbug_request_context", default=None)
 
 
 def register_request_context(context):
-    ctx.context = context
+    ctx.set(context)
 
 
 def get_request_context():
-    return getattr(ctx, "context", None)
+    return ctx.get()
+
+
+def request_headers(query):
+    """
+    Return the headers of the request, if the ``query_context`` passed to the handler has any.
+    """
+    return getattr(getattr(query, "context", None), "headers", None) or {}
+
+
+def parse_last_updated(last_updated):
+    """
+    Parse the ``meta.lastUpdated`` of a resource. Values without a timezone, like the
+    ones of date columns, are assumed to be in UTC like
+    :func:`fhirbug.models.mixins.format_version` assumes for naive datetimes.
+
+    :returns: A datetime with a timezone, or ``None`` if ``last_updated`` is not a date
+    """
+    try:
+        parsed = datetime.fromisoformat(last_updated.replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def version_headers(version_id, last_updated):
+    """
+    Return the ``ETag`` and ``Last-Modified`` headers of a version of a resource.
+
+    :param str version_id: The ``meta.versionId`` of the resource
+    :param str last_updated: The ``meta.lastUpdated`` of the resource
+    """
+    headers = {}
+    if version_id is not None or last_updated is not None:
+        headers["ETag"] = f'W/"{version_id if version_id is not None else last_updated}"'
+    modified = parse_last_updated(last_updated)
+    if modified is not None:
+        headers["Last-Modified"] = format_datetime(
+            modified.astimezone(timezone.utc), usegmt=True
+        )
+    return headers
+
+
+def is_conditional(query):
+    """
+    Whether ``query`` is the url of a conditional update or delete, a search like
+    ``Patient?identifier=123`` instead of a resource id.
+    """
+    return query.resourceId is None and bool(
+        query.search_params or query.reverse_chained_params
+    )
+
+
+def preferences(query):
+    """
+    Return the preferences of the ``Prefer`` header of the request as a dictionary, eg
+    ``{'return': 'minimal', 'handling': 'strict'}``. Preferences without a value are
+    mapped to ``None``.
+    """
+    prefer = request_headers(query).get("prefer")
+    if not isinstance(prefer, str):
+        return {}
+    values = {}
+    for preference in prefer.replace(";", ",").split(","):
+        name, _, value = preference.partition("=")
+        if name.strip():
+            values[name.strip().lower()] = value.strip().strip('"') or None
+    return values
+
+
+def write_response(instance, query, action):
+    """
+    Return the content and the headers of the response to the create or update of
+    ``instance``, as requested by the ``return`` preference of the request:
+
+    - ``representation``, the default, responds with the resource.
+    - ``minimal`` responds with no content at all.
+    - ``OperationOutcome`` responds with an informational OperationOutcome.
+
+    The last two do not render the resource, only its id and its version are read
+    for the ``Location`` and ``ETag`` headers.
+
+    :param instance: The created or updated model instance
+    :param query: The :class:`FhirRequestQuery
+                  <fhirbug.server.requestparser.FhirRequestQuery>` of the request
+    :param str action: What happened to the resource, eg ``"created"``
+    :returns: A tuple ``(content, headers)``
+    """
+    preference = preferences(query).get("return")
+    if preference in ("minimal", "OperationOutcome"):
+        from fhirbug.models.mixins import format_version
+
+        resource_type = instance._get_resource_cls().resource_type
+        id = instance.Fhir.id
+        version_id, last_updated = (
+            format_version(*instance.get_version())
+            if instance.is_versioned()
+            else (None, None)
+        )
+        content = None
+        if preference == "OperationOutcome":
+            content = OperationOutcome(
+                issue={
+                    "severity": "information",
+                    "code": "informational",
+                    "details": {"text": f"{resource_type}/{id} was {action}"},
+                }
+            ).as_json()
+    else:
+        content = instance.to_fhir().as_json()
+        resource_type, id = content["resourceType"], content.get("id")
+        meta = content.get("meta") or {}
+        version_id, last_updated = meta.get("versionId"), meta.get("lastUpdated")
+
+    headers = version_headers(version_id, last_updated)
+    if id is not None:
+        headers["Location"] = f"{resource_type}/{id}"
+    return content, headers
+
+
+def not_modified(headers, version_id, last_updated):
+    """
+    Check the ``If-None-Match`` and ``If-Modified-Since`` headers of a conditional read
+    against the current version of a resource.
+
+    :returns: ``True`` if the client's copy is current and a 304 should be returned
+    """
+    if_none_match = headers.get("if-none-match")
+    if if_none_match:
+        # If-Modified-Since is ignored when If-None-Match is present
+        current = version_headers(version_id, last_updated).get("ETag")
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        # ETags are compared weakly
+        return "*" in tags or (
+            current is not None
+            and current[2:] in [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+        )
+
+    if_modified_since = headers.get("if-modified-since")
+    modified = parse_last_updated(last_updated)
+    if if_modified_since and modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        # HTTP dates have a resolution of a second
+        modified = modified.replace(microsecond=0)
+        try:
+            return modified <= since
+        except TypeError:
+            # The header had no timezone
+            return False
+    return False
 
 
 class AbstractRequestHandler:
@@ -37,6 +204,11 @@ class AbstractRequestHandler:
     Base class for request handlers
     """
 
+    def __init__(self):
+        #: Headers to add to the response, eg ``{'Content-Location': '...'}``.
+        #: They are set by ``handle`` and applications should send them with its result.
+        self.response_headers = {}
+
     def parse_url(self, url, context=None):
         try:
             self.query = parse_url(url)
@@ -51,8 +223,12 @@ class AbstractRequestHandler:
             )
 
     def import_models(self):
+        """
+        Return the mappings of the models module, from the registry of
+        :mod:`fhirbug.models.registry`
+        """
         try:
-            models = import_models()
+            models = get_registry().models
         except ConfigurationError:
             raise OperationError(
                 severity="error",
@@ -77,6 +253,70 @@ class AbstractRequestHandler:
             )
         return Resource
 
+    @contextmanager
+    def unit_of_work(self):
+        """
+        A context manager for the writes of a request. If ``settings.UNIT_OF_WORK`` is
+        set they run in a single :meth:`atomic
+        <fhirbug.models.mixins.FhirAbstractBaseMixin.atomic>` block that is committed
+        when it exits, otherwise each write is committed as it is made. Errors while
+        committing are raised as OperationErrors, like errors of the writes themselves.
+        """
+        if not settings.UNIT_OF_WORK:
+            yield
+            return
+        Model = import_backend("models").AbstractBaseModel
+        try:
+            with Model.atomic():
+                yield
+        except OperationError:
+            raise
+        except Exception as e:
+            diag = "{}".format(e)
+            if settings.DEBUG:
+                diag += " {}".format(traceback.format_exc())
+            raise OperationError(
+                severity="error", code="invalid", diagnostics=diag, status_code=422
+            )
+
+    def conditional_match(self, Model, query):
+        """
+        Resolve the criteria of a conditional create, update or delete, see
+        :meth:`fhirbug.models.mixins.FhirBaseModelMixin.conditional_matches`.
+
+        :returns: The only item of ``Model`` that matches ``query``, or ``None``
+        :raises OperationError: If the criteria are invalid or match several items
+        """
+        try:
+            matches = Model.conditional_matches(query)
+        except QueryValidationError as e:
+            raise OperationError(
+                severity="error", code="invalid", diagnostics=f"{e}", status_code=400
+            )
+        if len(matches) > 1:
+            raise OperationError(
+                severity="error",
+                code="multiple-matches",
+                diagnostics=f"The criteria match more than one {query.resource}",
+                status_code=412,
+            )
+        return matches[0] if matches else None
+
+    def invalidate_cache(self, Model, item=None):
+        """
+        Remove the resource of the request from the caches after it has been written,
+        see :mod:`fhirbug.models.cache`
+
+        :param item: The item that was written, whose id is used for conditional
+                     requests, which have none in their url
+        """
+        from fhirbug.models import cache
+
+        id = self.query.resourceId
+        if id is None and item is not None:
+            id = getattr(item.Fhir, "id", None)
+        cache.invalidate(Model, id)
+
     def log_request(
         self,
         url,
@@ -86,10 +326,13 @@ class AbstractRequestHandler:
         resource=None,
         OperationOutcome=None,
         request_body=None,
-        time=datetime.now(),
+        time=None,
     ):
         """
-        Create an AuditEvent resource that contains details about the request.
+        Log a request once it has been processed. By default it returns the AuditEvent
+        created by :meth:`audit_event`. If ``settings.AUDIT_SINK`` is set, the request is
+        queued instead, its AuditEvent is created and written by a background thread,
+        see :mod:`fhirbug.server.audit`, and ``None`` is returned.
 
         :param string url: The initial url that was requested
         :param FhirRequestQuery query: The FhirRequestQuery that was generated
@@ -98,8 +341,45 @@ class AbstractRequestHandler:
         :param FhirResource resource: A Fhir resource, possibly a bundle, of the resources that were accessed or modified during the request
         :param OperationOutcome OperationOutcome: An OperationOutcome related to the requset
         :param request_body: The body of the request
-        :param datetime time: The time the request occured
+        :param datetime time: The time the request occured, defaults to now
 
+        """
+        from fhirbug.server import audit
+
+        if time is None:
+            time = datetime.now()
+        arguments = (
+            url,
+            query,
+            status,
+            method,
+            resource,
+            OperationOutcome,
+            request_body,
+            time,
+        )
+        pipeline = audit.pipeline()
+        if pipeline is not None:
+            pipeline.submit(status, functools.partial(self.audit_event, *arguments))
+            return None
+        return self.audit_event(*arguments)
+
+    def audit_event(
+        self,
+        url,
+        query,
+        status,
+        method,
+        resource=None,
+        OperationOutcome=None,
+        request_body=None,
+        time=None,
+    ):
+        """
+        Create an AuditEvent resource that contains details about the request. It
+        receives the arguments of :meth:`log_request`. Override it to add more details
+        to the AuditEvents written by the audit pipeline, keeping in mind that it is then
+        called in a background thread.
         """
         auditEvent = AuditEvent(
             type={
@@ -107,7 +387,7 @@ class AbstractRequestHandler:
                 "code": "110100",
                 "display": "Application Activity",
             },
-            recorded=FHIRDate(time),
+            recorded=FHIRDate(time or datetime.now()),
             source={"site": "fhirbug", "observer": {"display": "fhirbug"}},
             agent={"requestor": True},
             strict=False,
@@ -162,16 +442,60 @@ class GetRequestHandler(AbstractRequestHandler):
     """
 
     def handle(self, url, query_context=None):
+        # GET requests only read, so they may be served by read replicas
+        with read_only():
+            return self.handle_read(url, query_context)
+
+    def handle_read(self, url, query_context=None):
         try:
             self.parse_url(url, query_context)
             # Authorize the request if implemented
             self._audit_request(self.query)
+            if self.is_export_request():
+                items, status = self.bulk_export(url)
+                self.log_request(
+                    url=url, query=self.query, status=status, method="GET"
+                )
+                return items, status
+
             # Import the model mappings
             models = self.import_models()
-            # Get the Resource
-            Model = self.get_resource(models)
+            if self.query.resource == "*":
+                # Search across all types of a compartment, eg Patient/123/*
+                from fhirbug.models.compartments import Compartment
+
+                Model = Compartment
+            else:
+                # Get the Resource
+                Model = self.get_resource(models)
+
+            if self.query.operation == "$everything":
+                from fhirbug.models.compartments import Everything
+
+                Model = Everything
+
+            is_read = self.query.resourceId is not None and self.query.operation is None
+            ignored = []
+            if self.query.resourceId is None and self.query.operation in (
+                None,
+                "_search",
+            ):
+                ignored = self.validate_search(Model)
+            if is_read and self.is_not_modified(Model):
+                self.log_request(url=url, query=self.query, status=304, method="GET")
+                return None, 304
 
             items = self.fetch_items(Model)
+            if ignored:
+                items = {
+                    **items,
+                    "entry": [*items.get("entry", []), self.ignored_outcome(ignored)],
+                }
+            if is_read:
+                meta = items.get("meta") or {}
+                self.response_headers.update(
+                    version_headers(meta.get("versionId"), meta.get("lastUpdated"))
+                )
 
             self.log_request(
                 url=url, query=self.query, resource=items, status=200, method="GET"
@@ -188,6 +512,144 @@ class GetRequestHandler(AbstractRequestHandler):
             )
             return e.to_fhir().as_json(), e.status_code
 
+    def validate_search(self, Model):
+        """
+        Validate the parameters of a search before it runs, see
+        :meth:`fhirbug.models.mixins.FhirBaseModelMixin.validate_search`. Unsupported
+        parameters are refused if the request has a ``Prefer: handling=strict`` header,
+        or it has none and ``settings.SEARCH_HANDLING`` is ``"strict"``.
+
+        :returns: The names of the unsupported parameters that were ignored
+        :raises OperationError: If the parameters are invalid, or unsupported and
+                                handling is strict
+        """
+        if not hasattr(Model, "validate_search"):
+            # Searches across the types of a compartment
+            return []
+        handling = preferences(self.query).get("handling") or settings.SEARCH_HANDLING
+        try:
+            return Model.validate_search(self.query, strict=handling == "strict")
+        except UnsupportedParameterError as e:
+            raise OperationError(
+                severity="error",
+                code="not-supported",
+                diagnostics=f"{e}",
+                status_code=400,
+            )
+        except QueryValidationError as e:
+            raise OperationError(
+                severity="error", code="invalid", diagnostics=f"{e}", status_code=400
+            )
+
+    def ignored_outcome(self, ignored):
+        """
+        Return the Bundle entry of an OperationOutcome that warns about the ignored
+        parameters of a search.
+        """
+        outcome = OperationOutcome(
+            {
+                "issue": [
+                    {
+                        "severity": "warning",
+                        "code": "not-supported",
+                        "diagnostics": f'The parameter "{name}" was ignored',
+                    }
+                    for name in ignored
+                ]
+            }
+        )
+        return {"resource": outcome.as_json(), "search": {"mode": "outcome"}}
+
+    def is_not_modified(self, Model):
+        """
+        Answer conditional reads of versioned mappings, see
+        :meth:`fhirbug.models.mixins.FhirAbstractBaseMixin.is_versioned`. Only the
+        version of the resource is read from the database, it is not mapped or serialized.
+
+        :returns: ``True`` if the request's ``If-None-Match`` or ``If-Modified-Since``
+                  header matches the current version of the resource
+        """
+        headers = request_headers(self.query)
+        if not (headers.get("if-none-match") or headers.get("if-modified-since")):
+            return False
+        if not getattr(Model, "is_versioned", lambda: False)():
+            return False
+        from fhirbug.models.mixins import format_version
+
+        try:
+            if hasattr(Model, "audit_read"):
+                # The item is needed to authorize the read
+                item = Model._get_item_from_pk(self.query.resourceId)
+                if item.audit_read(self.query).outcome != AUDIT_SUCCESS:
+                    # Let the full read report the error
+                    return False
+                version = item.get_version()
+            else:
+                version = Model._get_version(self.query.resourceId)
+        except DoesNotExistError:
+            return False
+
+        version_id, last_updated = format_version(*version)
+        if not not_modified(headers, version_id, last_updated):
+            return False
+        self.response_headers.update(version_headers(version_id, last_updated))
+        return True
+
+    def is_export_request(self):
+        return "$export" in (
+            self.query.resource,
+            self.query.resourceId,
+            self.query.operation,
+        ) or self.query.resource in ("$export-poll-status", "$import-poll-status")
+
+    def bulk_export(self, url):
+        """
+        Start a bulk data export or return the status of an export or import, see
+        :mod:`fhirbug.models.export`
+        """
+        from fhirbug.models import export
+
+        try:
+            if self.query.resource in ("$export-poll-status", "$import-poll-status"):
+                content, status, headers = export.export_status(self.query.resourceId)
+                self.response_headers.update(headers)
+                return content, status
+            job = export.start_export(self.query, url)
+        except QueryValidationError as e:
+            raise OperationError(
+                severity="error", code="invalid", diagnostics=f"{e}", status_code=400
+            )
+        except DoesNotExistError as e:
+            raise OperationError(
+                severity="error",
+                code="not-found",
+                diagnostics=f"Export job {e.pk} was not found on the server.",
+                status_code=404,
+            )
+        except MappingValidationError as e:
+            raise OperationError(
+                severity="error", code="not-found", diagnostics=f"{e}", status_code=404
+            )
+        except AuthorizationError as e:
+            raise OperationError(
+                severity="error",
+                code="security",
+                diagnostics="{}".format(e.auditEvent.as_json()),
+                status_code=403,
+            )
+
+        self.response_headers["Content-Location"] = f"$export-poll-status/{job.id}"
+        return (
+            OperationOutcome(
+                issue={
+                    "severity": "information",
+                    "code": "informational",
+                    "details": {"text": f"Export job {job.id} has started"},
+                }
+            ).as_json(),
+            202,
+        )
+
     def fetch_items(self, Model):
         # Try to fetch the requested resource(s)
         try:
@@ -200,6 +662,13 @@ class GetRequestHandler(AbstractRequestHandler):
                 diagnostics="{}".format(e),
                 status_code=404,
             )
+        except QueryValidationError as e:
+            raise OperationError(
+                severity="error",
+                code="invalid",
+                diagnostics="{}".format(e),
+                status_code=400,
+            )
         except AuthorizationError as e:
             raise OperationError(
                 severity="error",
@@ -244,21 +713,41 @@ class PostRequestHandler(AbstractRequestHandler):
         try:
             self.body = body
             self.parse_url(url, query_context)
+            if self.query.resource is None:
+                # A batch or transaction Bundle posted to the server's base
+                from fhirbug.server.bundles import BundleRequestHandler
+
+                return BundleRequestHandler().handle(url, body, query_context)
+            if self.query.resource == "$import":
+                content, status = self.bulk_import(url)
+                self.log_request(
+                    url=url,
+                    query=self.query,
+                    status=status,
+                    method="POST",
+                    request_body=self.body,
+                )
+                return content, status
+
+            with self.unit_of_work():
+                existing = self.match_existing()
+                if existing is None:
+                    created_resource = self.create_from_request()
+            if existing is not None:
+                # A conditional create that matched, nothing is created
+                self.log_request(
+                    url=url,
+                    query=self.query,
+                    resource=existing,
+                    status=200,
+                    method="POST",
+                    request_body=self.body,
+                )
+                content, headers = write_response(existing, self.query, "found")
+                self.response_headers.update(headers)
+                return content, 200
 
-            self._audit_request(self.query)
-            # Import the model mappings
-            models = self.import_models()
-            # Get the Model class
-            Model = self.get_resource(models)
-
-            from fhirbug.Fhir import resources
-
-            # Get the Resource class
-            Resource = self.get_resource(resources)
-            # Validate the incoming json and instantiate the Fhir resource
-            resource = self.request_body_to_resource(Resource)
-
-            created_resource = self.create(Model, resource)
+            self.invalidate_cache(created_resource.__class__)
             self.log_request(
                 url=url,
                 query=self.query,
@@ -267,7 +756,9 @@ class PostRequestHandler(AbstractRequestHandler):
                 method="POST",
                 request_body=self.body,
             )
-            return created_resource.to_fhir().as_json(), 201
+            content, headers = write_response(created_resource, self.query, "created")
+            self.response_headers.update(headers)
+            return content, 201
 
         except OperationError as e:
             self.log_request(
@@ -280,6 +771,77 @@ class PostRequestHandler(AbstractRequestHandler):
             )
             return e.to_fhir().as_json(), e.status_code
 
+    def match_existing(self):
+        """
+        Resolve the ``If-None-Exist`` header of a conditional create, eg
+        ``If-None-Exist: identifier=123``.
+
+        :returns: The item that matches the criteria of the header, or ``None`` if
+                  there is no header or nothing matches it
+        """
+        criteria = request_headers(self.query).get("if-none-exist")
+        if not isinstance(criteria, str) or not criteria.strip():
+            return None
+        self._audit_request(self.query)
+        Model = self.get_resource(self.import_models())
+        try:
+            query = parse_url(f"{self.query.resource}?{criteria.split('?')[-1]}")
+        except QueryValidationError as e:
+            raise OperationError(
+                severity="error", code="invalid", diagnostics=f"{e}", status_code=400
+            )
+        return self.conditional_match(Model, query)
+
+    def create_from_request(self):
+        """
+        Validate the parsed request and create the posted resource.
+
+        :returns: The new model instance
+        """
+        self._audit_request(self.query)
+        # Import the model mappings
+        models = self.import_models()
+        # Get the Model class
+        Model = self.get_resource(models)
+
+        # Get the Resource class
+        Resource = self.get_resource(get_registry().resources)
+        # Validate the incoming json and instantiate the Fhir resource
+        resource = self.request_body_to_resource(Resource)
+
+        return self.create(Model, resource)
+
+    def bulk_import(self, url):
+        """
+        Start importing the NDJSON files listed in the posted Parameters resource,
+        see :mod:`fhirbug.models.bulk_import`
+        """
+        from fhirbug.models import bulk_import
+
+        self._audit_request(self.query)
+        try:
+            job_id = bulk_import.start_import(self.body, url, self.query)
+        except QueryValidationError as e:
+            raise OperationError(
+                severity="error", code="invalid", diagnostics=f"{e}", status_code=400
+            )
+        except UnsupportedOperationError as e:
+            raise OperationError(
+                severity="error", code="not-supported", diagnostics=f"{e}", status_code=400
+            )
+
+        self.response_headers["Content-Location"] = f"$import-poll-status/{job_id}"
+        return (
+            OperationOutcome(
+                issue={
+                    "severity": "information",
+                    "code": "informational",
+                    "details": {"text": f"Import job {job_id} has started"},
+                }
+            ).as_json(),
+            202,
+        )
+
     def request_body_to_resource(self, Resource):
         # Validate the incoming json
         try:
@@ -340,36 +902,51 @@ class PutRequestHandler(PostRequestHandler):
             # Get the Model class
             Model = self.get_resource(models)
 
-            try:
-                instance = Model._get_item_from_pk(self.query.resourceId)
-            except DoesNotExistError as e:
-                raise OperationError(
-                    severity="error",
-                    code="not-found",
-                    diagnostics="{}/{} was not found on the server.".format(
-                        e.resource_type, e.pk
-                    ),
-                    status_code=404,
-                )
-
-            from fhirbug.Fhir import resources
-
-            # Get the Resource class
-            Resource = self.get_resource(resources)
-            # Validate the incoming json and instantiate the Fhir resource
-            resource = self.request_body_to_resource(Resource)
-
-            updated_resource = self.update(instance, resource)
+            with self.unit_of_work():
+                if is_conditional(self.query):
+                    # A conditional update, eg PUT Patient?identifier=123
+                    instance = self.conditional_match(Model, self.query)
+                else:
+                    try:
+                        instance = Model._get_item_from_pk(self.query.resourceId)
+                    except DoesNotExistError as e:
+                        raise OperationError(
+                            severity="error",
+                            code="not-found",
+                            diagnostics="{}/{} was not found on the server.".format(
+                                e.resource_type, e.pk
+                            ),
+                            status_code=404,
+                        )
+
+                # Get the Resource class
+                Resource = self.get_resource(get_registry().resources)
+                # Validate the incoming json and instantiate the Fhir resource
+                resource = self.request_body_to_resource(Resource)
+
+                if instance is None:
+                    # Conditional updates that match nothing create the resource
+                    updated_resource = self.create(Model, resource)
+                else:
+                    self.check_conditional_id(instance, resource)
+                    updated_resource = self.update(instance, resource)
+            status = 201 if instance is None else 202
+            # Updates that change nothing are not written and leave the caches alone
+            if getattr(updated_resource, "_changed_attributes", True):
+                self.invalidate_cache(Model, updated_resource)
 
             self.log_request(
                 url=url,
                 query=self.query,
                 resource=updated_resource,
-                status=202,
+                status=status,
                 method="PUT",
                 request_body=getattr(self, "body", None),
             )
-            return updated_resource.to_fhir().as_json(), 202
+            action = "created" if instance is None else "updated"
+            content, headers = write_response(updated_resource, self.query, action)
+            self.response_headers.update(headers)
+            return content, status
 
         except OperationError as e:
             self.log_request(
@@ -382,6 +959,22 @@ class PutRequestHandler(PostRequestHandler):
             )
             return e.to_fhir().as_json(), e.status_code
 
+    def check_conditional_id(self, instance, resource):
+        """
+        Refuse conditional updates whose resource has an id other than the id of the
+        item that matched their criteria.
+        """
+        if not is_conditional(self.query) or not getattr(resource, "id", None):
+            return
+        if str(resource.id) != str(instance.Fhir.id):
+            raise OperationError(
+                severity="error",
+                code="invalid",
+                diagnostics=f"The criteria match {self.query.resource}/"
+                f"{instance.Fhir.id}, not the resource with id {resource.id}",
+                status_code=400,
+            )
+
     def update(self, instance, resource):
         try:
             updated_resource = instance.update_from_resource(resource, query=self.query)
@@ -399,6 +992,134 @@ class PutRequestHandler(PostRequestHandler):
         return updated_resource
 
 
+class PatchRequestHandler(PutRequestHandler):
+    """
+    Receive a request url and a `JSON Patch <https://tools.ietf.org/html/rfc6902>`_ body
+    of a PATCH request and apply it to the requested resource. Only the attributes of the
+    elements the patch changes are set on the model, see
+    :meth:`patch_from_resource <fhirbug.models.mixins.FhirAbstractBaseMixin.patch_from_resource>`.
+    It returns a tuple (response json, status code).
+    If an error occurs during the process, an OperationOutcome is returned.
+
+    :param url: a string containing the path of the request. It should not contain the server
+                path. For example: `Patients/123`
+    :type url: string
+    :param body: a list of JSON Patch operations
+    :type body: list
+
+    :returns: A tuple ``(response_json, status code)``, where response_json may be the patched
+              resource or an OperationOutcome in case of an error.
+    :rtype: tuple
+
+    """
+
+    def handle(self, url, body, query_context=None):
+        try:
+            self.body = body
+            self.parse_url(url, query_context)
+            self._audit_request(self.query)
+            # Import the model mappings
+            models = self.import_models()
+            # Get the Model class
+            Model = self.get_resource(models)
+
+            with self.unit_of_work():
+                try:
+                    instance = Model._get_item_from_pk(self.query.resourceId)
+                except DoesNotExistError as e:
+                    raise OperationError(
+                        severity="error",
+                        code="not-found",
+                        diagnostics="{}/{} was not found on the server.".format(
+                            e.resource_type, e.pk
+                        ),
+                        status_code=404,
+                    )
+
+                resource, elements = self.apply_patch(instance)
+                updated_resource = self.patch(instance, resource, elements)
+            # Updates that change nothing are not written and leave the caches alone
+            if getattr(updated_resource, "_changed_attributes", True):
+                self.invalidate_cache(Model)
+
+            self.log_request(
+                url=url,
+                query=self.query,
+                resource=updated_resource,
+                status=200,
+                method="PATCH",
+                request_body=self.body,
+            )
+            content, headers = write_response(updated_resource, self.query, "updated")
+            self.response_headers.update(headers)
+            return content, 200
+
+        except OperationError as e:
+            self.log_request(
+                url=url,
+                query=getattr(self, "query", None),
+                status=e.status_code,
+                method="PATCH",
+                request_body=getattr(self, "body", None),
+                OperationOutcome=e.to_fhir(),
+            )
+            return e.to_fhir().as_json(), e.status_code
+
+    def apply_patch(self, instance):
+        """
+        Apply the patch of the request to the current version of ``instance``.
+
+        :returns: A tuple ``(resource, elements)`` of the validated patched resource
+                  and the names of the top level elements the patch changes
+        """
+        try:
+            jsonpatch.validate_patch(self.body)
+            elements = jsonpatch.touched_elements(self.body)
+            if "id" in elements or "resourceType" in elements:
+                raise InvalidOperationError(
+                    "The id and type of a resource can not be patched"
+                )
+            patched = jsonpatch.apply_patch(instance.to_fhir().as_json(), self.body)
+        except QueryValidationError as e:
+            raise OperationError(
+                severity="error", code="invalid", diagnostics=f"{e}", status_code=400
+            )
+        except InvalidOperationError as e:
+            raise OperationError(
+                severity="error", code="processing", diagnostics=f"{e}", status_code=422
+            )
+
+        Resource = self.get_resource(get_registry().resources)
+        try:
+            resource = Resource(patched)
+        except Exception as e:
+            raise OperationError(
+                severity="error",
+                code="invalid",
+                diagnostics=f"The patched resource is not valid: {e}",
+                status_code=422,
+            )
+        return resource, elements
+
+    def patch(self, instance, resource, elements):
+        try:
+            updated_resource = instance.patch_from_resource(
+                resource, elements, query=self.query
+            )
+        except Exception as e:
+            diag = "{}".format(e)
+            if settings.DEBUG:
+                tb = traceback.format_exc()
+                diag += " {}".format(tb)
+            raise OperationError(
+                severity="error",
+                code="invalid",
+                diagnostics="{}".format(diag),
+                status_code=422,
+            )
+        return updated_resource
+
+
 class DeleteRequestHandler(AbstractRequestHandler):
     """
     Receive a request url and the request body of a DELETE request and handle it. This includes parsing the string into a
@@ -422,24 +1143,30 @@ class DeleteRequestHandler(AbstractRequestHandler):
             self.parse_url(url, query_context)
             # Authorize the request if implemented
             self._audit_request(self.query)
+            if self.query.resource == "$export-poll-status":
+                return self.cancel_export(url)
             # Import the model mappings
             models = self.import_models()
             # Get the Resource
             Model = self.get_resource(models)
-
-            try:
-                instance = Model._get_item_from_pk(self.query.resourceId)
-            except DoesNotExistError as e:
-                raise OperationError(
-                    severity="error",
-                    code="not-found",
-                    diagnostics="{}/{} was not found on the server.".format(
-                        e.resource_type, e.pk
-                    ),
-                    status_code=404,
-                )
-
-            Model._delete_item(instance)
+            if is_conditional(self.query):
+                return self.conditional_delete(url, Model)
+
+            with self.unit_of_work():
+                try:
+                    instance = Model._get_item_from_pk(self.query.resourceId)
+                except DoesNotExistError as e:
+                    raise OperationError(
+                        severity="error",
+                        code="not-found",
+                        diagnostics="{}/{} was not found on the server.".format(
+                            e.resource_type, e.pk
+                        ),
+                        status_code=404,
+                    )
+
+                self.delete(Model, instance)
+            self.invalidate_cache(Model)
 
             self.log_request(
                 url=url,
@@ -469,3 +1196,144 @@ class DeleteRequestHandler(AbstractRequestHandler):
             ).as_json(),
             200,
         )
+
+    def delete(self, Model, instance):
+        """
+        Delete ``instance``, after authorizing it with the ``audit_delete`` method of
+        the mapping if it has one.
+        """
+        try:
+            Model.delete_item(instance, self.query)
+        except AuthorizationError as e:
+            raise OperationError(
+                severity="error",
+                code="security",
+                diagnostics="{}".format(e.auditEvent.as_json()),
+                status_code=403,
+            )
+
+    def conditional_delete(self, url, Model):
+        """
+        Delete the resources that match the search parameters of the request, eg
+        ``DELETE Patient?identifier=123``. If they match several resources, they are
+        all deleted if ``settings.CONDITIONAL_DELETE`` is ``"multiple"``, see
+        :meth:`delete_matches <fhirbug.models.mixins.FhirBaseModelMixin.delete_matches>`,
+        otherwise the request fails with 412 Precondition Failed.
+        """
+        with self.unit_of_work():
+            if settings.CONDITIONAL_DELETE == "multiple":
+                try:
+                    deleted = Model.delete_matches(self.query)
+                except QueryValidationError as e:
+                    raise OperationError(
+                        severity="error",
+                        code="invalid",
+                        diagnostics=f"{e}",
+                        status_code=400,
+                    )
+                except AuthorizationError as e:
+                    raise OperationError(
+                        severity="error",
+                        code="security",
+                        diagnostics="{}".format(e.auditEvent.as_json()),
+                        status_code=403,
+                    )
+            else:
+                instance = self.conditional_match(Model, self.query)
+                deleted = 0
+                if instance is not None:
+                    self.delete(Model, instance)
+                    deleted = 1
+
+        self.log_request(url=url, query=self.query, status=200, method="DELETE")
+        return (
+            OperationOutcome(
+                issue={
+                    "severity": "information",
+                    "code": "informational",
+                    "details": {"text": f"Deleted {deleted} {self.query.resource}"},
+                }
+            ).as_json(),
+            200,
+        )
+
+    def cancel_export(self, url):
+        """
+        Cancel a bulk data export and delete its files, see :mod:`fhirbug.models.export`
+        """
+        from fhirbug.models import export
+
+        try:
+            export.cancel_export(self.query.resourceId)
+        except DoesNotExistError as e:
+            raise OperationError(
+                severity="error",
+                code="not-found",
+                diagnostics=f"Export job {e.pk} was not found on the server.",
+                status_code=404,
+            )
+        self.log_request(url=url, query=self.query, status=202, method="DELETE")
+        return (
+            OperationOutcome(
+                issue={
+                    "severity": "information",
+                    "code": "informational",
+                    "details": {"text": f"Export job {self.query.resourceId} was cancelled"},
+                }
+            ).as_json(),
+            202,
+        )
+
+
+class AsyncRequestHandlerMixin:
+    """
+    Makes the ``handle`` method of a request handler awaitable, eg for use in ASGI
+    applications. The request is handled in an executor thread, so a slow query only
+    occupies a thread of the executor and the event loop keeps serving other requests.
+    Each request runs in a copy of the caller's context, so the request context of
+    concurrent requests is kept apart, and the db session of the executor thread is
+    closed when it is done.
+    """
+
+    #: The :class:`concurrent.futures.Executor` requests are handled in.
+    #: ``None`` uses the default executor of the event loop
+    executor = None
+
+    async def handle(self, *args, **kwargs):
+        return await run_sync(self._handle_in_thread, *args, executor=self.executor, **kwargs)
+
+    def _handle_in_thread(self, *args, **kwargs):
+        try:
+            return super().handle(*args, **kwargs)
+        finally:
+            import_backend("models").AbstractBaseModel._close_thread_session()
+
+
+class AsyncGetRequestHandler(AsyncRequestHandlerMixin, GetRequestHandler):
+    """
+    Async version of :class:`GetRequestHandler`
+    """
+
+
+class AsyncPostRequestHandler(AsyncRequestHandlerMixin, PostRequestHandler):
+    """
+    Async version of :class:`PostRequestHandler`
+    """
+
+
+class AsyncPutRequestHandler(AsyncRequestHandlerMixin, PutRequestHandler):
+    """
+    Async version of :class:`PutRequestHandler`
+    """
+
+
+class AsyncPatchRequestHandler(AsyncRequestHandlerMixin, PatchRequestHandler):
+    """
+    Async version of :class:`PatchRequestHandler`
+    """
+
+
+class AsyncDeleteRequestHandler(AsyncRequestHandlerMixin, DeleteRequestHandler):
+    """
+    Async version of :class:`DeleteRequestHandler`
+    """
@@ -1,7 +1,34 @@
+import re
 from urllib.parse import urlparse, parse_qs
 
 from fhirbug.exceptions import QueryValidationError
 
+
+# reference[:Type].parameter, eg ``subject:Patient.name``
+CHAINED_PARAM_RE = re.compile(r"^(?P<reference>[\w-]+)(:(?P<type>[A-Z]\w*))?\.(?P<param>.+)$")
+
+# _has:Type:reference:parameter, eg ``_has:Observation:subject:code``
+REVERSE_CHAINED_PARAM_RE = re.compile(
+    r"^_has:(?P<type>[A-Z]\w*):(?P<reference>[\w-]+):(?P<param>.+)$"
+)
+
+# parameter[:modifier], eg ``name:exact`` or ``subject:Patient``
+PARAM_NAME_RE = re.compile(r"^[A-Za-z_][\w-]*(:[A-Za-z][\w-]*)?$")
+
+#: Parameters that control the results of a search instead of filtering them
+RESULT_PARAMETERS = (
+    "_count",
+    "_elements",
+    "_format",
+    "_include",
+    "_outputFormat",
+    "_revinclude",
+    "_since",
+    "_type",
+    "search-offset",
+)
+
+
 def generate_query_string(query):
     '''
     Convert a ``FhirRequestQuery`` back to a query string.
@@ -28,6 +55,44 @@ def split_join(lst):
     return [e for elem in lst for e in elem.split(",")]
 
 
+def parse_chained_param(param):
+    """
+    Split a `chained <https://www.hl7.org/fhir/search.html#chaining>`_ search parameter
+    into a ``(reference, resource type, parameter)`` tuple. The resource type is ``None``
+    if it has not been specified. Returns ``None`` if the parameter is not chained.
+
+    >>> parse_chained_param('subject:Patient.name')
+    ('subject', 'Patient', 'name')
+    >>> parse_chained_param('subject.name:exact')
+    ('subject', None, 'name:exact')
+    >>> parse_chained_param('subject:Patient.organization:Organization.name')
+    ('subject', 'Patient', 'organization:Organization.name')
+    >>> parse_chained_param('name:contains')
+    """
+    match = CHAINED_PARAM_RE.match(param)
+    if match is None:
+        return None
+    return match.group("reference"), match.group("type"), match.group("param")
+
+
+def parse_reverse_chained_param(param):
+    """
+    Split a `reverse chained <https://www.hl7.org/fhir/search.html#has>`_ search parameter
+    into a ``(resource type, reference, parameter)`` tuple. Returns ``None`` if the
+    parameter is not a ``_has`` parameter.
+
+    >>> parse_reverse_chained_param('_has:Observation:subject:code')
+    ('Observation', 'subject', 'code')
+    >>> parse_reverse_chained_param('_has:Observation:subject:_has:AuditEvent:entity:user')
+    ('Observation', 'subject', '_has:AuditEvent:entity:user')
+    >>> parse_reverse_chained_param('_count')
+    """
+    match = REVERSE_CHAINED_PARAM_RE.match(param)
+    if match is None:
+        return None
+    return match.group("type"), match.group("reference"), match.group("param")
+
+
 class FhirRequestQuery:
     """
   Represents parsed parameters from requests.
@@ -43,6 +108,7 @@ class FhirRequestQuery:
         search_params={},
         body=None,
         request=None,
+        compartment=None,
     ):
         #: A string containing the name of the requested Resource. eg: ``'Procedure'``
         self.resource = resource
@@ -67,6 +133,29 @@ class FhirRequestQuery:
         #: For example ``Patient/123?_format=json`` would have a modifiers value of ``{'_format': 'json'}``
         self.search_params = search_params
 
+        #: Dictionary. Keys are chained search parameters, eg ``subject:Patient.name``
+        #: and values are the ``(reference, resource type, parameter)`` tuples
+        #: returned by :func:`parse_chained_param`
+        self.chained_params = {
+            param: parse_chained_param(param)
+            for param in search_params
+            if parse_chained_param(param)
+        }
+
+        #: Dictionary. Keys are ``_has`` parameters, eg ``_has:Observation:subject:code``
+        #: and values are the ``(resource type, reference, parameter)`` tuples
+        #: returned by :func:`parse_reverse_chained_param`
+        self.reverse_chained_params = {
+            param: parse_reverse_chained_param(param)
+            for param in modifiers
+            if parse_reverse_chained_param(param)
+        }
+
+        #: A ``(compartment type, compartment id)`` tuple if a compartment search like
+        #: ``Patient/123/Observation`` was requested, else ``None``. In that case ``resource``
+        #: holds the type of the searched resources, or ``'*'`` for all types in the compartment.
+        self.compartment = compartment
+
         self.body = body
         self.request = request
 
@@ -87,6 +176,12 @@ def parse_url(url):
   >>> p.search_params
   {}
 
+  Compartment searches are recognized and the requested resource type is moved to ``resource``:
+
+  >>> p = parse_url('Patient/123/Observation?code=1234-5')
+  >>> p.resource, p.resourceId, p.operation, p.compartment
+  ('Observation', None, None, ('Patient', '123'))
+
   :param url: a string containing the path of the request. It should not contain the server
               path. For example: `Patients/123?name:contains=Jo`
   :returns: A :class:`FhirRequestQuery` object
@@ -118,6 +213,13 @@ def parse_url(url):
         operation = path.pop(0) if path else None
     operationId = path.pop(0) if operation and path else None
 
+    # Compartment searches like `Patient/123/Observation` or `Patient/123/*`. Operations
+    # start with `$` or `_` while resource types are capitalized.
+    compartment = None
+    if resourceId and operation and (operation == "*" or operation[0].isupper()):
+        compartment = (resource, resourceId)
+        resource, resourceId, operation, operationId = operation, None, None, None
+
     # parse the query strings
     qs = parse_qs(parsed.query)
 
@@ -145,6 +247,7 @@ def parse_url(url):
         "operationId": operationId,
         "modifiers": modifiers,
         "search_params": search_params,
+        "compartment": compartment,
     }
     validate_params(params)
     return FhirRequestQuery(**params)
@@ -152,13 +255,35 @@ def parse_url(url):
 
 def validate_params(params):
     """
-  Validate a parameter dictionary. If the parameters are invalid, raise a
-  QueryValidationError with the details.
-
-  :param params: Parameter dictionary produced by parse_url
-  :return:
-  :raises: :exc:`fhirbug.exceptions.QueryValidationError`
-  """
-    pass
-    # if not_valid(params):
-    #   raise QueryValidationError(f'Invalid request string')
+    Validate a parameter dictionary. If the parameters are invalid, raise a
+    QueryValidationError with the details.
+
+    Only the syntax of the parameters is checked here, since it does not depend on the
+    searched resource: their names and modifiers and the values of ``_count`` and
+    ``search-offset``. Whether a mapping supports the parameters and the format of their
+    values are checked by :meth:`validate_search
+    <fhirbug.models.mixins.FhirBaseModelMixin.validate_search>`.
+
+    >>> validate_params({'search_params': {'name:': ['Jo']}, 'modifiers': {}})
+    Traceback (most recent call last):
+    ...
+    fhirbug.exceptions.QueryValidationError: "name:" is not a valid search parameter
+
+    :param params: Parameter dictionary produced by parse_url
+    :return:
+    :raises: :exc:`fhirbug.exceptions.QueryValidationError`
+    """
+    for name in [*params["search_params"], *params["modifiers"]]:
+        if parse_chained_param(name) or parse_reverse_chained_param(name):
+            continue
+        if not PARAM_NAME_RE.match(name):
+            raise QueryValidationError(f'"{name}" is not a valid search parameter')
+    for name, values in [
+        ("_count", params["modifiers"].get("_count", [])),
+        ("search-offset", params["search_params"].get("search-offset", [])),
+    ]:
+        for value in values:
+            if not value.isdigit() or int(value) < 1:
+                raise QueryValidationError(
+                    f'{name} must be a positive integer, not "{value}"'
+                )
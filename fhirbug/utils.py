@@ -1,5 +1,10 @@
+import re
+import asyncio
+import contextvars
+import functools
 import isodate
 import calendar
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from fhirbug.exceptions import QueryValidationError
 
@@ -62,3 +67,88 @@ def date_ceil(value, trim=True):
         )
     else:
         return value
+
+
+def concurrent_map(func, items, max_workers, cleanup=None):
+    """
+    Call ``func`` for each of ``items`` on a bounded thread pool and return the results
+    in the same order. If ``max_workers`` is 1 or less the calls are made sequentially in
+    the current thread. Calls run in a copy of the caller's context, so the request
+    context is available to them.
+
+    :param callable func: The function to call
+    :param list items: The arguments ``func`` will be called with
+    :param int max_workers: The maximum number of threads to use
+    :param callable cleanup: If provided, it is called with the same argument in the worker
+                             thread after each call, eg to release the thread's db session.
+                             It is never called when running sequentially.
+
+    >>> concurrent_map(lambda x: x * 2, [1, 2, 3], max_workers=2)
+    [2, 4, 6]
+    """
+    items = list(items)
+    if max_workers <= 1 or not items:
+        return [func(item) for item in items]
+
+    def task(item):
+        try:
+            return func(item)
+        finally:
+            if cleanup is not None:
+                cleanup(item)
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, task, item)
+            for item in items
+        ]
+        return [future.result() for future in futures]
+
+
+async def run_sync(func, *args, executor=None, **kwargs):
+    """
+    Run a blocking function in an executor without blocking the event loop and return
+    its result. The function runs in a copy of the current context, so the request
+    context registered by the caller is available to it.
+
+    :param callable func: The function to call with ``args`` and ``kwargs``
+    :param executor: A :class:`concurrent.futures.Executor`, by default the event loop's default executor
+
+    >>> asyncio.run(run_sync(sorted, [3, 1, 2], reverse=True))
+    [3, 2, 1]
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        executor, functools.partial(context.run, func, *args, **kwargs)
+    )
+
+
+def fulltext_values(resource_json):
+    """
+    Extract the text that is indexed for full text searches from a resource in json form.
+    Returns a ``(content, text)`` tuple where ``content`` contains every string value of the
+    resource and ``text`` the narrative without any markup.
+
+    >>> fulltext_values({
+    ...     "resourceType": "Observation", "id": "1", "status": "final",
+    ...     "code": {"coding": [{"display": "Glucose"}]},
+    ...     "text": {"status": "generated", "div": "<div>Fasting <b>glucose</b></div>"},
+    ... })
+    ('final Glucose generated Fasting glucose', 'Fasting glucose')
+    """
+    narrative = resource_json.get("text", {}).get("div", "")
+    narrative = " ".join(re.sub(r"<[^>]*>", " ", narrative).split())
+
+    def strings(value, key=None):
+        if isinstance(value, dict):
+            for k, v in value.items():
+                yield from strings(v, k)
+        elif isinstance(value, list):
+            for v in value:
+                yield from strings(v, key)
+        elif isinstance(value, str) and key not in ("resourceType", "id", "div"):
+            yield value
+
+    content = " ".join([*strings(resource_json), narrative]).strip()
+    return content, narrative
@@ -5,9 +5,9 @@ import doctest
 from fhirbug.Fhir.Resources import fhirabstractbase
 from fhirbug.Fhir.Resources import extensions
 from fhirbug.Fhir import resources
-from fhirbug.server import requestparser
+from fhirbug.server import requestparser, app, bundles, jsonpatch
 from fhirbug.db.backends import SQLAlchemy
-from fhirbug.models import attributes, pagination
+from fhirbug.models import attributes, pagination, search_index
 
 
 def testResourceContructor(verbose=False):
@@ -34,6 +34,11 @@ def testResourceContructor(verbose=False):
     doctest.testmod(
         requestparser, optionflags=doctest.NORMALIZE_WHITESPACE, verbose=verbose
     )
+    doctest.testmod(app, optionflags=doctest.NORMALIZE_WHITESPACE, verbose=verbose)
+    doctest.testmod(bundles, optionflags=doctest.NORMALIZE_WHITESPACE, verbose=verbose)
+    doctest.testmod(
+        jsonpatch, optionflags=doctest.NORMALIZE_WHITESPACE, verbose=verbose
+    )
     doctest.testmod(
         SQLAlchemy, optionflags=doctest.NORMALIZE_WHITESPACE, verbose=verbose
     )
@@ -43,6 +48,9 @@ def testResourceContructor(verbose=False):
     doctest.testmod(
         pagination, optionflags=doctest.NORMALIZE_WHITESPACE, verbose=verbose
     )
+    doctest.testmod(
+        search_index, optionflags=doctest.NORMALIZE_WHITESPACE, verbose=verbose
+    )
 
 
 if __name__ == "__main__":
@@ -7,5 +7,6 @@ setup(
     author="Vangelis Kostalas",
     author_email="kostalas.v@gmail.com",
     description="A Fhir server",
-    python_requires=">=3.6",
+    python_requires=">=3.7",
+    extras_require={"sqlalchemy": ["SQLAlchemy>=1.4.33"]},
 )
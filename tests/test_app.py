@@ -0,0 +1,170 @@
+import asyncio
+import io
+import json
+import unittest
+from unittest.mock import Mock, ANY
+
+from fhirbug.server.app import WSGIApplication, ASGIApplication, Request, chunks
+
+
+def wsgi_request(app, method, path, query_string="", body=b"", headers={}):
+    environ = {
+        "REQUEST_METHOD": method,
+        "PATH_INFO": path,
+        "QUERY_STRING": query_string,
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.input": io.BytesIO(body),
+        **{"HTTP_" + name.upper().replace("-", "_"): v for name, v in headers.items()},
+    }
+    start_response = Mock()
+    body = b"".join(app(environ, start_response))
+    status, response_headers = start_response.call_args[0]
+    return status, dict(response_headers), body
+
+
+class TestWSGIApplication(unittest.TestCase):
+    def setUp(self):
+        self.handler = Mock()
+        self.handler().handle.return_value = ({"resourceType": "Patient"}, 200)
+        self.handler().response_headers = {}
+        self.app = WSGIApplication(
+            prefix="/r4", handlers={"GET": self.handler, "POST": self.handler}
+        )
+
+    def test_get(self):
+        status, headers, body = wsgi_request(self.app, "GET", "/r4/Patient/1", "a=b")
+        request = self.handler().handle.call_args[1]["query_context"]
+        self.handler().handle.assert_called_with("Patient/1?a=b", query_context=request)
+        self.assertIsInstance(request, Request)
+        self.assertEqual(status, "200 OK")
+        self.assertEqual(json.loads(body), {"resourceType": "Patient"})
+        self.assertEqual(headers["Content-Length"], str(len(body)))
+        self.assertEqual(headers["Content-Type"], "application/fhir+json; charset=utf-8")
+
+    def test_post(self):
+        wsgi_request(self.app, "POST", "/r4/Patient", body=b'{"resourceType": "Patient"}')
+        self.handler().handle.assert_called_with(
+            "Patient", {"resourceType": "Patient"}, query_context=ANY
+        )
+
+    def test_invalid_body(self):
+        status, headers, body = wsgi_request(
+            self.app, "POST", "/r4/Patient", body=b"{"
+        )
+        self.assertEqual(status, "400 Bad Request")
+        self.assertEqual(json.loads(body)["resourceType"], "OperationOutcome")
+
+    def test_method_not_allowed(self):
+        status, headers, body = wsgi_request(self.app, "TRACE", "/r4/Patient/1")
+        self.assertEqual(status, "405 Method Not Allowed")
+
+    def test_not_acceptable(self):
+        status, headers, body = wsgi_request(
+            self.app, "GET", "/r4/Patient/1", headers={"Accept": "text/html"}
+        )
+        self.assertEqual(status, "406 Not Acceptable")
+
+    def test_unexpected_error(self):
+        self.handler().handle.side_effect = Exception("Boom")
+        status, headers, body = wsgi_request(self.app, "GET", "/r4/Patient/1")
+        self.assertEqual(status, "500 Internal Server Error")
+        self.assertIn("Boom", json.loads(body)["issue"][0]["diagnostics"])
+
+    def test_response_headers(self):
+        """
+        Headers set by the handler are added to the response
+        """
+        self.handler().response_headers = {"Content-Location": "$export-poll-status/1"}
+        status, headers, body = wsgi_request(self.app, "GET", "/r4/$export")
+        self.assertEqual(headers["Content-Location"], "$export-poll-status/1")
+
+    def test_not_modified(self):
+        self.handler().handle.return_value = (None, 304)
+        self.handler().response_headers = {"ETag": 'W/"3"'}
+        status, headers, body = wsgi_request(self.app, "GET", "/r4/Patient/1")
+        self.assertEqual(status, "304 Not Modified")
+        self.assertEqual(headers["ETag"], 'W/"3"')
+        self.assertEqual(body, b"")
+
+    def test_minimal(self):
+        self.handler().handle.return_value = (None, 201)
+        self.handler().response_headers = {"Location": "Patient/1"}
+        status, headers, body = wsgi_request(
+            self.app,
+            "POST",
+            "/r4/Patient",
+            body=b'{"resourceType": "Patient"}',
+            headers={"Prefer": "return=minimal"},
+        )
+        self.assertEqual(status, "201 Created")
+        self.assertEqual(headers["Location"], "Patient/1")
+        self.assertEqual(headers["Content-Length"], "0")
+        self.assertEqual(body, b"")
+
+    def test_bundles_are_streamed(self):
+        bundle = {"resourceType": "Bundle", "entry": [{"resource": {"id": "1"}}]}
+        self.handler().handle.return_value = (bundle, 200)
+        status, headers, body = wsgi_request(self.app, "GET", "/r4/Patient")
+        self.assertNotIn("Content-Length", headers)
+        self.assertEqual(json.loads(body), bundle)
+
+
+class TestASGIApplication(unittest.TestCase):
+    def request(self, app, method, path, body=b""):
+        messages = [
+            {"type": "http.request", "body": body[:1], "more_body": True},
+            {"type": "http.request", "body": body[1:], "more_body": False},
+        ]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {
+            "type": "http",
+            "method": method,
+            "path": path,
+            "query_string": b"",
+            "headers": [(b"accept", b"application/json")],
+        }
+        asyncio.run(app(scope, receive, send))
+        return sent
+
+    def test_post(self):
+        handle = Mock(return_value=({"resourceType": "Patient"}, 201))
+
+        class Handler:
+            async def handle(self, *args, **kwargs):
+                return handle(*args, **kwargs)
+
+        app = ASGIApplication(handlers={"POST": Handler})
+        sent = self.request(app, "POST", "/Patient", b'{"resourceType": "Patient"}')
+
+        self.assertEqual(handle.call_args[0], ("Patient", {"resourceType": "Patient"}))
+        request = handle.call_args[1]["query_context"]
+        self.assertEqual(request.headers["accept"], "application/json")
+        self.assertEqual(sent[0]["status"], 201)
+        self.assertIn(
+            (b"content-type", b"application/json; charset=utf-8"), sent[0]["headers"]
+        )
+        body = b"".join(message.get("body", b"") for message in sent[1:])
+        self.assertEqual(json.loads(body), {"resourceType": "Patient"})
+        self.assertFalse(sent[-1]["more_body"])
+
+
+class TestChunks(unittest.TestCase):
+    def test_chunks(self):
+        content = {
+            "resourceType": "Bundle",
+            "entry": [{"id": str(i)} for i in range(100)],
+        }
+        parts = list(chunks(content, size=100))
+        self.assertGreater(len(parts), 1)
+        self.assertEqual(json.loads(b"".join(parts)), content)
+
+    def test_chunks_without_entries(self):
+        content = {"resourceType": "Bundle", "total": 0}
+        self.assertEqual(json.loads(b"".join(chunks(content))), content)
@@ -168,6 +168,22 @@ class TestReferenceAttributes(unittest.TestCase):
             [call(), call().get(12), call().get()._as_display()]
         )
 
+    def test_setter_literal_reference(self):
+        """
+        When the reference has no identifier, the id should be read from a literal
+        reference to the target resource type
+        """
+        from fhirbug.models.attributes import ReferenceAttribute
+
+        setter = Mock()
+        attribute = ReferenceAttribute(models.ReferenceTarget, "ref_id", "ref", setter=setter)
+        attribute.__set__(Mock(), SimpleNamespace(reference="ReferenceTarget/12"))
+        setter.assert_called_once()
+        self.assertEqual(setter.call_args[0][1], "12")
+
+        with self.assertRaises(MappingValidationError):
+            attribute.__set__(Mock(), SimpleNamespace(reference="Other/12"))
+
     def test_with_contained(self):
         """
         If the attribue's name is the model's `_contained_names` list, we
@@ -0,0 +1,174 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
+
+from fhirbug.server import audit
+from fhirbug.server.requesthandlers import AbstractRequestHandler
+
+
+class Event:
+    def __init__(self, number):
+        self.number = number
+
+    def as_json(self):
+        return {"resourceType": "AuditEvent", "id": str(self.number)}
+
+
+def build(number):
+    return lambda: Event(number)
+
+
+class TestAuditPipeline(unittest.TestCase):
+    def pipeline(self, **kwargs):
+        self.written = []
+        pipeline = audit.AuditPipeline(self.written.append, **kwargs)
+        self.addCleanup(pipeline.close)
+        return pipeline
+
+    def test_batches(self):
+        pipeline = self.pipeline(batch_size=2, flush_interval=10)
+        for number in range(5):
+            pipeline.submit(200, build(number))
+        pipeline.close()
+        self.assertEqual([len(batch) for batch in self.written], [2, 2, 1])
+        self.assertEqual(
+            pipeline.stats(),
+            {
+                "submitted": 5,
+                "sampled_out": 0,
+                "dropped": 0,
+                "written": 5,
+                "errors": 0,
+                "queued": 0,
+            },
+        )
+
+    def test_flush_interval(self):
+        """
+        Batches that do not fill up are written after flush_interval seconds
+        """
+        pipeline = self.pipeline(batch_size=100, flush_interval=0.01)
+        pipeline.submit(200, build(1))
+        pipeline.flush()
+        self.assertEqual(len(self.written), 1)
+
+    def test_sampling(self):
+        """
+        Only the events of successful requests are sampled
+        """
+        pipeline = self.pipeline(sample_rate=0)
+        pipeline.submit(200, build(1))
+        pipeline.submit(404, build(2))
+        pipeline.flush()
+        self.assertEqual([event.number for event in self.written[0]], [2])
+        self.assertEqual(pipeline.stats()["sampled_out"], 1)
+
+    def overflow(self, policy):
+        """
+        Submit 3 events to a pipeline with room for 2 while its sink is busy
+        """
+        busy = threading.Event()
+        release = threading.Event()
+        written = []
+
+        def sink(events):
+            busy.set()
+            release.wait()
+            written.extend(event.number for event in events)
+
+        pipeline = audit.AuditPipeline(
+            sink, queue_size=2, batch_size=1, overflow=policy, block_timeout=0.01
+        )
+        self.addCleanup(pipeline.close)
+        pipeline.submit(200, build(0))
+        busy.wait()
+        for number in range(1, 4):
+            pipeline.submit(200, build(number))
+        release.set()
+        pipeline.close()
+        self.assertEqual(pipeline.stats()["dropped"], 1)
+        return written
+
+    def test_overflow(self):
+        self.assertEqual(self.overflow("drop"), [0, 1, 2])
+        self.assertEqual(self.overflow("block"), [0, 1, 2])
+        self.assertEqual(self.overflow("drop_oldest"), [0, 2, 3])
+        with self.assertRaises(ValueError):
+            audit.AuditPipeline(print, overflow="wait")
+
+    def test_errors(self):
+        """
+        Errors of the sink or of creating events are counted and do not stop the writer
+        """
+
+        def fail():
+            raise ValueError
+
+        sink = Mock(side_effect=[ConnectionError, None])
+        pipeline = audit.AuditPipeline(sink, batch_size=1)
+        with patch("fhirbug.server.audit.traceback"):
+            pipeline.submit(500, fail)
+            pipeline.submit(200, build(1))
+            pipeline.submit(200, build(2))
+            pipeline.close()
+        self.assertEqual(pipeline.stats()["errors"], 2)
+        self.assertEqual(pipeline.stats()["written"], 1)
+        # Closed pipelines drop new events
+        self.assertFalse(pipeline.submit(200, build(3)))
+
+
+class TestNDJSONSink(unittest.TestCase):
+    def test_rotation(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "audit.ndjson")
+            sink = audit.NDJSONSink(path, max_bytes=80, backup_count=2)
+            for number in range(4):
+                sink([Event(number)])
+            sink.close()
+            self.assertEqual(
+                sorted(os.listdir(directory)),
+                ["audit.ndjson", "audit.ndjson.1", "audit.ndjson.2"],
+            )
+            with open(path) as file:
+                lines = [json.loads(line) for line in file]
+            self.assertEqual(lines, [Event(3).as_json()])
+
+
+class TestLogRequest(unittest.TestCase):
+    def test_time(self):
+        """
+        Each request is logged with the time it was logged at
+        """
+        with patch("fhirbug.server.requesthandlers.datetime") as datetimeMock:
+            with patch("fhirbug.server.requesthandlers.FHIRDate") as FHIRDateMock:
+                AbstractRequestHandler().log_request("url", None, 200, "GET")
+                datetimeMock.now.return_value = "later"
+                AbstractRequestHandler().log_request("url", None, 200, "GET")
+        FHIRDateMock.assert_called_with("later")
+
+    def test_pipeline(self):
+        """
+        When a sink is configured, AuditEvents are created and written in the background
+        """
+        written = []
+        settings = SimpleNamespace(
+            AUDIT_SINK=written.extend,
+            AUDIT_QUEUE_SIZE=10,
+            AUDIT_BATCH_SIZE=10,
+            AUDIT_FLUSH_INTERVAL=0.01,
+            AUDIT_SAMPLE_RATE=1,
+            AUDIT_OVERFLOW="drop",
+            AUDIT_BLOCK_TIMEOUT=1,
+        )
+        handler = AbstractRequestHandler()
+        with patch("fhirbug.server.audit.settings", settings):
+            self.addCleanup(audit.shutdown)
+            self.assertIsNone(handler.log_request("url", None, 200, "GET"))
+            audit.shutdown()
+        entity = written[0].as_json()["entity"][0]
+        self.assertEqual(entity["detail"][0]["valueString"], "url")
+        self.assertIsNone(audit.stats())
@@ -1,5 +1,5 @@
 import unittest
-from unittest.mock import Mock, patch, call
+from unittest.mock import ANY, Mock, patch, call
 from types import SimpleNamespace
 from fhirbug.config import settings
 
@@ -15,12 +15,15 @@ from fhirbug.exceptions import (
     AuthorizationError,
     DoesNotExistError,
     MappingValidationError,
+    QueryValidationError,
 )
+from fhirbug.models.attributes import Attribute
 from fhirbug.models.mixins import (
     FhirAbstractBaseMixin,
     FhirBaseModelMixin,
     get_pagination_info,
 )
+from fhirbug.server.requestparser import parse_url
 
 
 class TestAbstractBaseMixin(unittest.TestCase):
@@ -100,6 +103,26 @@ class TestAbstractBaseMixin(unittest.TestCase):
             inst_as_fhir.as_json(), {"active": True, "resourceType": "Patient"}
         )
 
+    def test_to_fhir_with_version(self):
+        """
+        to_fhir should fill meta.versionId and meta.lastUpdated of versioned mappings
+        """
+        from datetime import datetime
+
+        class VersionedModel(models.BetterBaseMixinModel):
+            __Version__ = "_version"
+            __LastUpdated__ = "_updated"
+            _version = 3
+            _updated = datetime(2020, 1, 2, 3, 4, 5)
+
+        self.assertFalse(models.BetterBaseMixinModel.is_versioned())
+        self.assertTrue(VersionedModel.is_versioned())
+        inst_as_fhir = VersionedModel().to_fhir()
+        self.assertEqual(
+            inst_as_fhir.as_json()["meta"],
+            {"versionId": "3", "lastUpdated": "2020-01-02T03:04:05+00:00"},
+        )
+
     @patch("fhirbug.models.mixins.import_models")
     def test_rev_includes(self, import_modelsMock):
         from fhirbug.server.requestparser import parse_url
@@ -214,6 +237,120 @@ class TestBaseModelMixin(unittest.TestCase):
         self.assertTrue(hasattr(inst.Fhir, "_properties"))
 
 
+class TestChainedSearches(unittest.TestCase):
+    def test_apply_search_simple(self):
+        """
+        apply_search should call the searcher registered for a simple parameter
+        """
+        cls = models.WithSearcher
+        with patch.object(cls, "get_searcher") as get_searcherMock:
+            res = cls.apply_search("name", "bob", "sql_query", "query")
+        get_searcherMock.assert_called_with("name")
+        get_searcherMock().assert_called_with(cls, "name", "bob", "sql_query", "query")
+        self.assertEqual(res, get_searcherMock()())
+
+    def test_apply_search_unsupported(self):
+        """
+        apply_search should raise a QueryValidationError for parameters without a searcher
+        """
+        with self.assertRaises(QueryValidationError):
+            models.WithSearcher.apply_search("age", "12", "sql_query", "query")
+
+    def test_apply_search_chained(self):
+        """
+        Chained parameters should be resolved through the reference attribute
+        """
+        cls = models.WithSearcher
+        with patch.object(cls, "get_reference_attribute") as get_referenceMock:
+            res = cls.apply_search("subject:Patient.name", "bob", "sql_query", "query")
+        get_referenceMock.assert_called_with("subject")
+        chained_searcher = get_referenceMock().chained_searcher
+        chained_searcher.assert_called_with("Patient")
+        chained_searcher().assert_called_with(cls, "name", "bob", "sql_query", "query")
+        self.assertEqual(res, chained_searcher()())
+
+    @patch("fhirbug.models.mixins.import_models")
+    def test_apply_search_reverse_chained(self, import_modelsMock):
+        """
+        Reverse chained parameters should be resolved through the reference attribute
+        of the source resource
+        """
+        cls = models.MixinModelWithSetters
+        Source = import_modelsMock().Observation
+        res = cls.apply_search(
+            "_has:Observation:subject:code", "1234", "sql_query", "query"
+        )
+        Source.get_reference_attribute.assert_called_with("subject")
+        reverse_searcher = Source.get_reference_attribute().reverse_chained_searcher
+        reverse_searcher.assert_called_with(Source, "Patient")
+        reverse_searcher().assert_called_with(cls, "code", "1234", "sql_query", "query")
+        self.assertEqual(res, reverse_searcher()())
+
+    def test_get_reference_attribute(self):
+        with self.assertRaises(QueryValidationError):
+            models.WithSearcher.get_reference_attribute("name")
+        with self.assertRaises(QueryValidationError):
+            models.WithSearcher.get_reference_attribute("nothing")
+
+        class WithReference(models.WithSearcher):
+            class FhirMap:
+                subject = models.ReferenceAttribute(models.ReferenceTarget, "ref_id", "subject")
+
+        self.assertIs(
+            WithReference.get_reference_attribute("subject"),
+            WithReference.FhirMap.__dict__["subject"],
+        )
+
+
+class TestFullTextIndexed(unittest.TestCase):
+    def test_fulltext_indexed(self):
+        """
+        Mappings are indexed only if one of their searchers is a full text search
+        """
+        self.assertFalse(models.WithSearcher._fulltext_indexed())
+
+        search = Mock(spec=["fulltext_field"])
+        with patch.object(
+            models.WithSearcher, "searchables", return_value={"_content": search}
+        ):
+            self.assertTrue(models.WithSearcher._fulltext_indexed())
+
+
+class TestCompartments(unittest.TestCase):
+    @patch("fhirbug.models.mixins.import_searches")
+    def test_compartment_searcher(self, import_searchesMock):
+        """
+        compartment_searcher should combine all references to the compartment type
+        """
+
+        class WithReferences(models.WithSearcher):
+            class FhirMap:
+                subject = models.ReferenceAttribute(models.ReferenceTarget, "subject_id", "subject")
+                performer = models.ReferenceAttribute(models.ReferenceTarget, "performer_id", "performer")
+                name = models.Attribute("_name")
+
+        searcher = WithReferences.compartment_searcher("ReferenceTarget")
+        import_searchesMock().CompartmentSearch.assert_called_with(
+            "subject_id", "performer_id"
+        )
+        self.assertEqual(searcher, import_searchesMock().CompartmentSearch())
+        self.assertIsNone(WithReferences.compartment_searcher("Practitioner"))
+
+    def test_apply_compartment(self):
+        cls = models.WithSearcher
+        with patch.object(cls, "compartment_searcher") as searcherMock:
+            res = cls.apply_compartment(("Patient", "123"), "sql_query", "query")
+            searcherMock.assert_called_with("Patient")
+            searcherMock().assert_called_with(
+                cls, "Patient", "123", "sql_query", "query"
+            )
+            self.assertEqual(res, searcherMock()())
+
+        with patch.object(cls, "compartment_searcher", return_value=None):
+            with self.assertRaises(QueryValidationError):
+                cls.apply_compartment(("Patient", "123"), "sql_query", "query")
+
+
 class TestCRUDMethods(unittest.TestCase):
     def test_update_from_resource(self):
         """
@@ -229,6 +366,58 @@ class TestCRUDMethods(unittest.TestCase):
         self.assertEquals(inst.Fhir.active, False)
         _after_update_mock.assert_called_with(inst)
 
+    def test_patch_from_resource(self):
+        """
+        Only the attributes of the patched elements are set, and removed ones are cleared
+        """
+        _after_update_mock = models.MixinModelWithSetters_after_update
+        inst = models.MixinModelWithSetters()
+        name = inst._name
+        inst.patch_from_resource(SimpleNamespace(active=None, name=None), ["active"])
+
+        self.assertEqual(inst._active, None)
+        self.assertIs(inst._name, name)
+        _after_update_mock.assert_called_with(inst)
+
+    def test_update_without_changes(self):
+        """
+        Updates that set every attribute to the value it already has are not saved
+        """
+        _after_update_mock = models.MixinModelWithSetters_after_update
+        inst = models.MixinModelWithSetters()
+        inst._active = False
+        _after_update_mock.reset_mock()
+
+        self.assertIs(inst.update_from_resource(SimpleNamespace(active=False)), inst)
+        self.assertEqual(inst._changed_attributes, set())
+        _after_update_mock.assert_not_called()
+
+        inst.update_from_resource(SimpleNamespace(active=True))
+        self.assertEqual(inst._changed_attributes, {"active"})
+        _after_update_mock.assert_called_once_with(inst)
+
+    def test_update_with_untracked_attribute(self):
+        """
+        Attributes whose __set__ does not call Attribute.__set__ are always saved
+        """
+
+        class UntrackedAttribute(Attribute):
+            def __set__(self, instance, value):
+                instance._model._active = value
+
+        class WithUntracked(models.MixinModelWithSetters):
+            _after_update = Mock()
+
+            class FhirMap:
+                name = Attribute("_name", "_name")
+                active = UntrackedAttribute("_active")
+
+        inst = WithUntracked()
+        inst.update_from_resource(SimpleNamespace(active=True))
+        self.assertEqual(inst._changed_attributes, {"active"})
+        WithUntracked._after_update.assert_called_once_with(inst)
+        self.assertNotIn("_tracked", inst.Fhir.__dict__)
+
     def test_update_with_auditing(self):
         """
         When calling update_from_resource, if the class has a method called `audit_update`, the method should be called
@@ -408,7 +597,7 @@ class TestGetMethodSingleItem(unittest.TestCase):
         ``_get_item_from_pk`` for that id and return the result in json form
         """
         cls = FhirBaseModelMixin
-        queryMock = Mock()
+        queryMock = Mock(modifiers={})
         cls._get_item_from_pk = Mock()
         del (cls._get_item_from_pk().audit_read)
 
@@ -421,7 +610,7 @@ class TestGetMethodSingleItem(unittest.TestCase):
         ``_get_item_from_pk`` for that id and return the result in json form
         """
         cls = FhirBaseModelMixin
-        queryMock = Mock()
+        queryMock = Mock(modifiers={})
         cls._get_item_from_pk = Mock()
         cls._get_item_from_pk().audit_read = Mock(
             return_value=SimpleNamespace(outcome=AUDIT_SUCCESS)
@@ -585,3 +774,93 @@ class TestGetMethodBundledItems(unittest.TestCase):
                 "previous_page": "FhirBaseModelMixin/?_count=2&search-offset=4mock",
             }
         )
+
+
+class TestIterSearch(unittest.TestCase):
+    def test_iter_search(self):
+        """
+        All the items that match the searches are streamed from ``_iterate``
+        """
+
+        class Model(FhirAbstractBaseMixin, FhirBaseModelMixin):
+            _get_orm_query = Mock()
+            _iterate = Mock()
+
+            class FhirMap:
+                pass
+
+        searcher = Mock()
+        allowed = Mock(**{"audit_read.return_value.outcome": AUDIT_SUCCESS})
+        denied = Mock(**{"audit_read.return_value.outcome": AUDIT_MINOR_FAILURE})
+        plain = SimpleNamespace()
+        Model._iterate.return_value = iter([allowed, denied, plain])
+
+        with patch.object(Model, "has_searcher", return_value=True), patch.object(
+            Model, "get_searcher", return_value=searcher
+        ):
+            items = list(Model.iter_search("Model?name=Jo", batch_size=10))
+
+        self.assertEqual(items, [allowed, plain])
+        self.assertEqual(
+            searcher.call_args[0][:4], (Model, "name", "Jo", Model._get_orm_query())
+        )
+        Model._iterate.assert_called_once_with(searcher(), 10)
+
+
+class TestConditional(unittest.TestCase):
+    def model(self):
+        class Model(FhirAbstractBaseMixin, FhirBaseModelMixin):
+            _get_orm_query = Mock()
+            _slice = Mock(return_value=["item"])
+            _delete_query = Mock(return_value=3)
+            _iterate = Mock()
+            _delete_item = Mock()
+
+            class FhirMap:
+                pass
+
+        return Model
+
+    def test_conditional_matches(self):
+        """
+        Matches are fetched with a single query limited to two rows
+        """
+        Model = self.model()
+        with patch.object(Model, "has_searcher", return_value=True):
+            self.assertEqual(
+                Model.conditional_matches(parse_url("Model?name=Jo")), ["item"]
+            )
+        Model._slice.assert_called_once_with(ANY, 0, 2)
+
+    def test_unsupported_criteria(self):
+        """
+        Criteria that would match everything are rejected
+        """
+        Model = self.model()
+        for url in ["Model", "Model?nmae=Jo"]:
+            with self.subTest(url=url), patch.object(
+                Model, "has_searcher", return_value=False
+            ):
+                with self.assertRaises(QueryValidationError):
+                    Model.conditional_matches(parse_url(url))
+        Model._slice.assert_not_called()
+
+    @patch("fhirbug.models.cache.read_cache", return_value=None)
+    def test_delete_matches(self, read_cache):
+        """
+        Matches are deleted with a single statement unless items must be deleted one
+        at a time
+        """
+        Model = self.model()
+        query = parse_url("Model?name=Jo")
+        with patch.object(Model, "has_searcher", return_value=True):
+            self.assertEqual(Model.delete_matches(query), 3)
+            Model._iterate.assert_not_called()
+
+            Model.audit_delete = Mock(**{"return_value.outcome": AUDIT_SUCCESS})
+            item = Model()
+            item._invalidate_cache = Mock()
+            Model._iterate.return_value = iter([item])
+            self.assertEqual(Model.delete_matches(query), 1)
+        Model._delete_query.assert_called_once()
+        Model._delete_item.assert_called_once_with(item)
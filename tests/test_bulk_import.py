@@ -0,0 +1,280 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
+
+from fhirbug.config import settings
+
+if not settings.is_configured():
+    settings.configure(
+        {"DB_BACKEND": "SQLAlchemy", "SQLALCHEMY_CONFIG": {"URI": "sqlite:///memory"}}
+    )
+from pymodm import MongoModel, fields
+from pymongo.errors import BulkWriteError
+
+from fhirbug.db.backends.pymodm import models as pymodm_models
+from fhirbug.exceptions import QueryValidationError, UnsupportedOperationError
+from fhirbug.models import bulk_import
+from fhirbug.server.requesthandlers import GetRequestHandler, PostRequestHandler
+
+
+def line(**resource):
+    return json.dumps({"resourceType": "Patient", **resource}) + "\n"
+
+
+class FakeModel:
+    def __init__(self):
+        self.batches = []
+
+    def from_resource(self, resource, query=None):
+        if resource.gender == "unknown":
+            raise Exception("Unmapped gender")
+        return resource.id
+
+    def _bulk_insert(self, instances):
+        if "fail" in instances:
+            raise Exception("Constraint failed")
+        self.batches.append(list(instances))
+
+
+class TestValidation(unittest.TestCase):
+    def test_validate_lines(self):
+        results = bulk_import.validate_lines(
+            [
+                (1, line(id="1")),
+                (2, "{not json"),
+                (3, json.dumps({"resourceType": "Nope"})),
+                (4, line(gender=1)),
+            ]
+        )
+        self.assertEqual([number for number, _, _ in results], [1, 2, 3, 4])
+        self.assertEqual(results[0][1].id, "1")
+        self.assertIsNone(results[0][2])
+        for number, resource, error in results[1:]:
+            self.assertIsNone(resource)
+            self.assertTrue(error)
+
+    def test_read_chunks(self):
+        """
+        Blank lines are skipped and line numbers are kept
+        """
+        chunks = list(bulk_import.read_chunks(["a", "\n", "b", "c"], 2))
+        self.assertEqual(chunks, [[(1, "a"), (3, "b")], [(4, "c")]])
+
+
+class TestBulkImport(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.errors = os.path.join(self.path, "errors.ndjson")
+        self.model = FakeModel()
+        patcher = patch(
+            "fhirbug.models.export.exported_models",
+            Mock(return_value={"Patient": self.model}),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def importer(self):
+        return bulk_import.BulkImport(errors=self.errors, batch_size=2, workers=1)
+
+    def read_errors(self):
+        with open(self.errors) as f:
+            return [json.loads(line)["issue"][0]["diagnostics"] for line in f]
+
+    def test_batches(self):
+        """
+        Resources are inserted in batches of batch_size
+        """
+        importer = self.importer()
+        count = importer.run([line(id=str(i)) for i in range(5)], "Patient")
+        self.assertEqual(count, 5)
+        self.assertEqual(self.model.batches, [["0", "1"], ["2", "3"], ["4"]])
+        self.assertFalse(os.path.exists(self.errors))
+
+    def test_errors(self):
+        """
+        Lines that can not be imported are written to the error file
+        """
+        importer = self.importer()
+        lines = [
+            line(id="1"),
+            "{not json\n",
+            json.dumps({"resourceType": "Observation"}),
+            line(id="2", gender="unknown"),
+        ]
+        count = importer.run(lines, "Patient", "Patient.ndjson")
+        importer.close()
+        self.assertEqual(count, 1)
+        self.assertEqual(importer.error_count, 3)
+        errors = self.read_errors()
+        self.assertEqual(
+            [error.split(":")[:2] for error in errors],
+            [["Patient.ndjson", "2"], ["Patient.ndjson", "3"], ["Patient.ndjson", "4"]],
+        )
+        self.assertIn("Unmapped gender", errors[2])
+
+    def test_failed_batch(self):
+        """
+        If a batch fails its rows are inserted one by one
+        """
+        importer = self.importer()
+        count = importer.run([line(id="1"), line(id="fail"), line(id="2")])
+        importer.close()
+        self.assertEqual(count, 2)
+        self.assertEqual(self.model.batches, [["1"], ["2"]])
+        self.assertIn("Constraint failed", self.read_errors()[0])
+
+
+class TestPeakMemory(unittest.TestCase):
+    @patch("fhirbug.models.bulk_import._resource")
+    def test_units(self, resource):
+        """
+        macOS reports the peak memory in bytes and Linux in kilobytes
+        """
+        resource.getrusage().ru_maxrss = 60 * 1024 * 1024
+        with patch("fhirbug.models.bulk_import.sys.platform", "darwin"):
+            self.assertEqual(bulk_import.peak_memory(), 60 * 1024 * 1024)
+        resource.getrusage().ru_maxrss = 60 * 1024
+        with patch("fhirbug.models.bulk_import.sys.platform", "linux"):
+            self.assertEqual(bulk_import.peak_memory(), 60 * 1024 * 1024)
+
+
+class Collection:
+    """
+    Ordered inserts of a MongoDB collection, that keep the documents before the one
+    that fails
+    """
+
+    def __init__(self):
+        self.documents = {}
+
+    def bulk_create(self, instances):
+        for index, instance in enumerate(instances):
+            if instance.pk in self.documents:
+                error = {"index": index, "code": 11000, "keyPattern": {"_id": 1}}
+            elif instance.name == "fail":
+                error = {"index": index, "code": 121, "errmsg": "Validation failed"}
+            else:
+                self.documents[instance.pk] = instance.name
+                continue
+            raise BulkWriteError({"writeErrors": [error], "nInserted": index})
+
+
+class MongoPatient(MongoModel, pymodm_models.FhirBaseModel):
+    name = fields.CharField()
+
+    class Meta:
+        connection_alias = "test"
+
+
+class TestPymodmBulkImport(unittest.TestCase):
+    @patch.object(MongoPatient, "_fulltext_indexed", Mock(return_value=False))
+    @patch("fhirbug.models.cache.invalidate", Mock())
+    @patch("fhirbug.models.export.exported_models", Mock(return_value={}))
+    def test_failed_batch(self):
+        """
+        The documents a failed batch inserted before the one that failed are not
+        inserted again when its documents are retried one by one
+        """
+        collection = Collection()
+        names = ["a", "b", "fail", "c"]
+        batch = [(number, MongoPatient(name=name)) for number, name in enumerate(names)]
+        importer = bulk_import.BulkImport(workers=1)
+        with patch.object(MongoPatient, "objects", collection):
+            importer.insert(MongoPatient, batch, "Patient.ndjson")
+            self.assertEqual(importer.count, 3)
+            self.assertEqual(importer.error_count, 1)
+            self.assertEqual(sorted(collection.documents.values()), ["a", "b", "c"])
+
+            # Ids that were not generated for the import are conflicts
+            existing = MongoPatient(name="d")
+            existing.pk = batch[0][1].pk
+            importer.insert(MongoPatient, [(5, existing)], "Patient.ndjson")
+            self.assertEqual(importer.count, 3)
+            self.assertEqual(importer.error_count, 2)
+
+
+class TestImportInputs(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        with open(os.path.join(self.path, "Patient.ndjson"), "w") as f:
+            f.write(line(id="1"))
+        patcher = patch(
+            "fhirbug.models.bulk_import.settings", SimpleNamespace(IMPORT_PATH=self.path)
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def parameters(self, url):
+        return {
+            "resourceType": "Parameters",
+            "parameter": [
+                {
+                    "name": "input",
+                    "part": [
+                        {"name": "type", "valueCode": "Patient"},
+                        {"name": "url", "valueUri": url},
+                    ],
+                }
+            ],
+        }
+
+    def test_inputs(self):
+        path = os.path.join(self.path, "Patient.ndjson")
+        self.assertEqual(
+            bulk_import.import_inputs(self.parameters(f"file://{path}")),
+            [("Patient", path, f"file://{path}")],
+        )
+        self.assertEqual(
+            bulk_import.import_inputs(self.parameters("Patient.ndjson"))[0][1], path
+        )
+
+    def test_outside_import_path(self):
+        """
+        Only files under IMPORT_PATH can be imported
+        """
+        for url in ["../Patient.ndjson", "file:///etc/passwd", "https://a.test/P.ndjson"]:
+            with self.assertRaises(QueryValidationError):
+                bulk_import.import_inputs(self.parameters(url))
+
+    def test_disabled(self):
+        with patch.object(bulk_import.settings, "IMPORT_PATH", None):
+            with self.assertRaises(UnsupportedOperationError):
+                bulk_import.import_inputs(self.parameters("Patient.ndjson"))
+
+
+class TestImportRequests(unittest.TestCase):
+    def handler(self, Handler, *args):
+        handler = Handler()
+        handler.log_request = Mock()
+        return handler, handler.handle(*args)
+
+    @patch("fhirbug.models.bulk_import.start_import")
+    def test_kick_off(self, start_import):
+        start_import.return_value = "123"
+        body = {"resourceType": "Parameters"}
+        handler, (ret, status) = self.handler(PostRequestHandler, "$import", body)
+        self.assertEqual(status, 202)
+        self.assertEqual(
+            handler.response_headers, {"Content-Location": "$import-poll-status/123"}
+        )
+        self.assertEqual(start_import.call_args[0][:2], (body, "$import"))
+
+    @patch("fhirbug.models.bulk_import.start_import")
+    def test_kick_off_disabled(self, start_import):
+        start_import.side_effect = UnsupportedOperationError("Disabled")
+        handler, (ret, status) = self.handler(PostRequestHandler, "$import", {})
+        self.assertEqual(status, 400)
+        self.assertEqual(ret["issue"][0]["code"], "not-supported")
+
+    @patch("fhirbug.models.export.export_status")
+    def test_status(self, export_status):
+        export_status.return_value = ({"output": []}, 200, {})
+        handler, (ret, status) = self.handler(GetRequestHandler, "$import-poll-status/1")
+        export_status.assert_called_with("1")
+        self.assertEqual(status, 200)
@@ -0,0 +1,235 @@
+import unittest
+from contextlib import contextmanager
+from unittest.mock import patch, Mock
+
+from fhirbug.exceptions import OperationError
+from fhirbug.server.bundles import BundleRequestHandler, creation_rounds
+from fhirbug.server.requesthandlers import PostRequestHandler
+
+
+def entry(method, url, resource=None, full_url=None):
+    entry = {"request": {"method": method, "url": url}}
+    if resource is not None:
+        entry["resource"] = resource
+    if full_url is not None:
+        entry["fullUrl"] = full_url
+    return entry
+
+
+class FakeModel:
+    """
+    Records atomic blocks and flushes instead of touching a database
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    @contextmanager
+    def atomic(self):
+        self.calls.append("begin")
+        try:
+            yield
+        except BaseException:
+            self.calls.append("rollback")
+            raise
+        self.calls.append("commit")
+
+    def _flush(self):
+        self.calls.append("flush")
+
+    def _close_thread_session(self):
+        pass
+
+
+@patch("fhirbug.server.bundles.import_backend")
+class TestBundleRequestHandler(unittest.TestCase):
+    def setUp(self):
+        self.model = FakeModel()
+
+    def handle(self, import_backend, body, handlers=None):
+        import_backend.return_value.AbstractBaseModel = self.model
+        handler = BundleRequestHandler()
+        handler.parse_url = Mock()
+        handler.query = Mock()
+        if handlers:
+            for Handler in handlers.values():
+                Handler.return_value.response_headers = {}
+            handler.handlers = handlers
+        return handler, handler.handle("", body)
+
+    def test_rejects_other_resources(self, import_backend):
+        """
+        Only Bundles can be posted to the base url
+        """
+        handler, (ret, status) = self.handle(import_backend, {"resourceType": "Patient"})
+        self.assertEqual(status, 400)
+        self.assertEqual(ret["resourceType"], "OperationOutcome")
+
+    def test_rejects_other_bundle_types(self, import_backend):
+        body = {"resourceType": "Bundle", "type": "collection"}
+        handler, (ret, status) = self.handle(import_backend, body)
+        self.assertEqual(status, 400)
+
+    def test_rejects_entries_without_request(self, import_backend):
+        body = {"resourceType": "Bundle", "type": "batch", "entry": [{"resource": {}}]}
+        handler, (ret, status) = self.handle(import_backend, body)
+        self.assertEqual(status, 400)
+
+    def test_batch(self, import_backend):
+        """
+        Every entry of a batch is handled on its own and failures are reported
+        in the response entries
+        """
+        get = Mock()
+        get.return_value.handle.return_value = (
+            {"resourceType": "Patient", "id": "1"},
+            200,
+        )
+        delete = Mock()
+        delete.return_value.handle.return_value = (
+            {"resourceType": "OperationOutcome", "issue": []},
+            404,
+        )
+        body = {
+            "resourceType": "Bundle",
+            "type": "batch",
+            "entry": [entry("DELETE", "Patient/2"), entry("GET", "Patient/1")],
+        }
+        handler, (ret, status) = self.handle(
+            import_backend, body, {"GET": get, "DELETE": delete}
+        )
+
+        self.assertEqual(status, 200)
+        self.assertEqual(ret["type"], "batch-response")
+        self.assertEqual(
+            ret["entry"][0]["response"],
+            {
+                "status": "404 Not Found",
+                "outcome": {"resourceType": "OperationOutcome", "issue": []},
+            },
+        )
+        self.assertEqual(
+            ret["entry"][1],
+            {
+                "response": {"status": "200 OK", "location": "Patient/1"},
+                "resource": {"resourceType": "Patient", "id": "1"},
+            },
+        )
+        self.assertNotIn("begin", self.model.calls)
+
+    def test_transaction(self, import_backend):
+        """
+        Transaction entries are processed in a single atomic block, entries are created
+        after the ones they reference and references to them are replaced
+        """
+        created = {}
+
+        def create(self_, entry, locations):
+            instance = Mock()
+            resource = {**entry["resource"], "id": str(len(created) + 1)}
+            instance.to_fhir.return_value.as_json.return_value = resource
+            created[entry["fullUrl"]] = (resource, dict(locations))
+            return instance
+
+        body = {
+            "resourceType": "Bundle",
+            "type": "transaction",
+            "entry": [
+                entry(
+                    "POST",
+                    "Observation",
+                    {
+                        "resourceType": "Observation",
+                        "subject": {"reference": "urn:uuid:p"},
+                    },
+                    full_url="urn:uuid:o",
+                ),
+                entry("POST", "Patient", {"resourceType": "Patient"}, "urn:uuid:p"),
+            ],
+        }
+        with patch.object(BundleRequestHandler, "create", create):
+            handler, (ret, status) = self.handle(import_backend, body)
+
+        self.assertEqual(status, 200)
+        self.assertEqual(ret["type"], "transaction-response")
+        self.assertEqual(self.model.calls, ["begin", "flush", "flush", "commit"])
+        # The patient was created first and its location was known to the observation
+        self.assertEqual(created["urn:uuid:p"][1], {})
+        self.assertEqual(created["urn:uuid:o"][1], {"urn:uuid:p": "Patient/1"})
+        # The responses are in the order of the request entries
+        self.assertEqual(ret["entry"][0]["response"]["location"], "Observation/2")
+        self.assertEqual(ret["entry"][1]["response"]["location"], "Patient/1")
+
+    def test_transaction_failure(self, import_backend):
+        """
+        If an entry fails, the transaction is rolled back and its outcome is returned
+        """
+        get = Mock()
+        get.return_value.handle.return_value = (
+            {"resourceType": "OperationOutcome", "issue": [{"code": "not-found"}]},
+            404,
+        )
+        put = Mock()
+        put.return_value.handle.return_value = ({"resourceType": "Patient"}, 202)
+        body = {
+            "resourceType": "Bundle",
+            "type": "transaction",
+            "entry": [entry("GET", "Patient/1"), entry("PUT", "Patient/2", {})],
+        }
+        handler, (ret, status) = self.handle(
+            import_backend, body, {"GET": get, "PUT": put}
+        )
+
+        self.assertEqual(status, 404)
+        self.assertEqual(ret["resourceType"], "OperationOutcome")
+        self.assertEqual(ret["issue"][0]["code"], "not-found")
+        self.assertEqual(self.model.calls, ["begin", "rollback"])
+        # PUT entries are processed before GET entries
+        put.return_value.handle.assert_called_once()
+
+    def test_transaction_database_error(self, import_backend):
+        """
+        Errors of the database while flushing are returned as an OperationOutcome
+        """
+
+        def flush():
+            self.model.calls.append("flush")
+            raise Exception("UNIQUE constraint failed: patients.identifier")
+
+        self.model._flush = flush
+        body = {
+            "resourceType": "Bundle",
+            "type": "transaction",
+            "entry": [entry("POST", "Patient", {"resourceType": "Patient"})],
+        }
+        with patch.object(BundleRequestHandler, "create", Mock()):
+            handler, (ret, status) = self.handle(import_backend, body)
+
+        self.assertEqual(status, 422)
+        self.assertEqual(ret["resourceType"], "OperationOutcome")
+        self.assertIn("UNIQUE constraint", ret["issue"][0]["diagnostics"])
+        self.assertEqual(self.model.calls, ["begin", "flush", "rollback"])
+
+    def test_creation_rounds_circular(self, import_backend):
+        entries = [
+            entry("POST", "A", {"a": {"reference": "urn:uuid:2"}}, "urn:uuid:1"),
+            entry("POST", "B", {"b": {"reference": "urn:uuid:1"}}, "urn:uuid:2"),
+        ]
+        with self.assertRaises(OperationError) as e:
+            creation_rounds(entries)
+        self.assertEqual(e.exception.status_code, 400)
+
+
+class TestPostBundle(unittest.TestCase):
+    def test_post_to_base(self):
+        """
+        Bundles posted to the base url are handled by BundleRequestHandler
+        """
+        handler = PostRequestHandler()
+        handler.parse_url = Mock()
+        handler.query = Mock(resource=None)
+        body = {"resourceType": "Bundle", "type": "batch"}
+        with patch.object(BundleRequestHandler, "handle") as handle:
+            ret = handler.handle("", body)
+        handle.assert_called_with("", body, None)
+        self.assertEqual(ret, handle())
@@ -0,0 +1,285 @@
+import unittest
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
+
+from fhirbug.exceptions import DoesNotExistError
+from fhirbug.models import cache
+from fhirbug.server.requestparser import parse_url
+
+
+class TestLocalCache(unittest.TestCase):
+    def test_lru(self):
+        """
+        The least recently used entries are evicted first
+        """
+        local = cache.LocalCache(max_entries=2, max_bytes=100)
+        local.set("a", "1")
+        local.set("b", "2")
+        local.get("a")
+        local.set("c", "3")
+        self.assertEqual(local.get("a"), "1")
+        self.assertIsNone(local.get("b"))
+        self.assertEqual(local.stats(), {"entries": 2, "bytes": 2})
+
+    def test_max_bytes(self):
+        local = cache.LocalCache(max_entries=10, max_bytes=10)
+        local.set("a", "x" * 6)
+        local.set("b", "x" * 6)
+        self.assertIsNone(local.get("a"))
+        self.assertEqual(local.stats(), {"entries": 1, "bytes": 6})
+        # Values larger than the cache are not kept
+        local.set("c", "x" * 11)
+        self.assertIsNone(local.get("c"))
+
+    @patch("fhirbug.models.cache.time.monotonic")
+    def test_timeout(self, monotonic):
+        monotonic.return_value = 100
+        local = cache.LocalCache(max_entries=10, max_bytes=10)
+        local.set("a", "1", timeout=5)
+        self.assertEqual(local.get("a"), "1")
+        monotonic.return_value = 106
+        self.assertIsNone(local.get("a"))
+        self.assertEqual(local.stats()["entries"], 0)
+
+    def test_delete(self):
+        local = cache.LocalCache(max_entries=10, max_bytes=10)
+        local.set("a", "1")
+        local.delete("a")
+        local.delete("b")
+        self.assertIsNone(local.get("a"))
+        self.assertEqual(local.stats()["bytes"], 0)
+
+
+class TestSharedCache(unittest.TestCase):
+    def test_client(self):
+        """
+        Keys are prefixed and a LocalCache can stand in for the client
+        """
+        client = cache.LocalCache(max_entries=10, max_bytes=100)
+        shared = cache.SharedCache(client, prefix="app:", timeout=30)
+        shared.set("a", "1")
+        self.assertEqual(client.get("app:a"), "1")
+        self.assertEqual(shared.get("a"), "1")
+        shared.delete("a")
+        self.assertIsNone(shared.get("a"))
+
+    def test_client_errors(self):
+        """
+        A cache that is down is treated as empty
+        """
+        client = Mock()
+        client.get.side_effect = ConnectionError
+        client.set.side_effect = ConnectionError
+        shared = cache.SharedCache(client)
+        self.assertIsNone(shared.get("a"))
+        shared.set("a", "1")
+        self.assertEqual(shared.stats(), {"errors": 2})
+
+
+class Model:
+    versioned = False
+
+    @classmethod
+    def is_versioned(cls):
+        return cls.versioned
+
+    @classmethod
+    def _get_version(cls, pk):
+        if pk == "404":
+            raise DoesNotExistError(pk, "Model")
+        return (cls.version, None)
+
+
+class TestCachedRead(unittest.TestCase):
+    def setUp(self):
+        self.cache = cache.LocalCache(max_entries=10, max_bytes=10000)
+        patcher = patch(
+            "fhirbug.models.cache.settings",
+            SimpleNamespace(
+                READ_CACHE=self.cache, READ_CACHE_TTL=60, SEARCH_CACHE=None
+            ),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cache.read_metrics.reset()
+        self.renders = 0
+
+    def render(self):
+        self.renders += 1
+        return {"resourceType": "Patient", "id": "1", "render": self.renders}
+
+    def read(self, url, Model=Model):
+        return cache.cached_read(Model, parse_url(url), self.render)
+
+    def test_hit(self):
+        self.assertEqual(self.read("Patient/1")["render"], 1)
+        self.assertEqual(self.read("Patient/1")["render"], 1)
+        stats = cache.stats()["read"]
+        self.assertEqual(
+            stats, {"hits": 1, "misses": 1, "invalidations": 0, "entries": 1, **stats}
+        )
+        self.assertGreater(stats["bytes"], 0)
+
+    def test_elements(self):
+        """
+        Each _elements parameter is cached separately
+        """
+        self.assertEqual(self.read("Patient/1?_elements=name,gender")["render"], 1)
+        self.assertEqual(self.read("Patient/1?_elements=gender,name")["render"], 1)
+        self.assertEqual(self.read("Patient/1")["render"], 2)
+        self.assertEqual(self.read("Patient/1?_elements=name")["render"], 3)
+
+    def test_invalidate(self):
+        self.read("Patient/1")
+        cache.invalidate(Model, "1")
+        self.assertEqual(self.read("Patient/1")["render"], 2)
+        self.assertEqual(cache.read_metrics.counts["invalidations"], 1)
+
+    def test_version(self):
+        """
+        The entries of versioned mappings are replaced when the version changes
+        """
+
+        class Versioned(Model):
+            versioned = True
+            version = 1
+
+        self.assertEqual(self.read("Patient/1", Versioned)["render"], 1)
+        self.assertEqual(self.read("Patient/1", Versioned)["render"], 1)
+        Versioned.version = 2
+        self.assertEqual(self.read("Patient/1", Versioned)["render"], 2)
+        # Not found errors are reported by render
+        self.read("Patient/404", Versioned)
+        self.assertEqual(self.renders, 3)
+
+    @patch("fhirbug.models.cache.time.monotonic")
+    def test_ttl(self, monotonic):
+        """
+        Entries of unversioned mappings expire, since other processes don't see their
+        invalidations, while versioned ones are checked on every hit
+        """
+
+        class Versioned(Model):
+            versioned = True
+            version = 1
+
+        monotonic.return_value = 100
+        self.read("Patient/1")
+        self.read("Patient/2", Versioned)
+        monotonic.return_value = 161
+        self.assertEqual(self.read("Patient/1")["render"], 3)
+        self.assertEqual(self.read("Patient/2", Versioned)["render"], 2)
+
+    def test_uncacheable(self):
+        """
+        Mappings that audit reads and reads with includes are not cached
+        """
+
+        class Audited(Model):
+            def audit_read(self, query):
+                pass
+
+        self.read("Patient/1", Audited)
+        self.read("Patient/1", Audited)
+        self.read("Patient/1?_revinclude=Observation:subject")
+        self.read("Patient/1?_revinclude=Observation:subject")
+        self.assertEqual(self.renders, 4)
+
+    def test_disabled(self):
+        with patch.object(cache.settings, "READ_CACHE", None):
+            self.read("Patient/1")
+            self.read("Patient/1")
+        self.assertEqual(self.renders, 2)
+
+
+class Observation:
+    pass
+
+
+class Patient:
+    pass
+
+
+class TestCachedSearch(unittest.TestCase):
+    def setUp(self):
+        self.cache = cache.LocalCache(max_entries=100, max_bytes=10000)
+        self.settings = SimpleNamespace(
+            READ_CACHE=None,
+            SEARCH_CACHE=self.cache,
+            SEARCH_CACHE_TTL=10,
+            SEARCH_CACHE_CONTEXT=None,
+        )
+        patcher = patch("fhirbug.models.cache.settings", self.settings)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cache.search_metrics.reset()
+        self.renders = 0
+
+    def render(self):
+        self.renders += 1
+        return {"resourceType": "Bundle", "render": self.renders}
+
+    def search(self, url, Model=Observation, authorization=None):
+        query = parse_url(url)
+        query.context = SimpleNamespace(headers={"authorization": authorization})
+        return cache.cached_search(Model, query, self.render)["render"]
+
+    def test_hit(self):
+        """
+        Searches with the same parameters in any order share a cache entry
+        """
+        self.assertEqual(self.search("Observation?code=1&status=final&_count=5"), 1)
+        self.assertEqual(self.search("Observation?_count=5&status=final&code=1"), 1)
+        self.assertEqual(self.search("Observation?code=1&status=final&_count=6"), 2)
+        self.assertEqual(
+            cache.stats()["search"],
+            {"hits": 1, "misses": 2, "invalidations": 0, **cache.stats()["search"]},
+        )
+
+    def test_context(self):
+        """
+        Users never share cached searches
+        """
+        self.assertEqual(self.search("Observation", authorization="Bearer a"), 1)
+        self.assertEqual(self.search("Observation", authorization="Bearer b"), 2)
+        self.settings.SEARCH_CACHE_CONTEXT = lambda query: "everyone"
+        self.assertEqual(self.search("Observation", authorization="Bearer a"), 3)
+        self.assertEqual(self.search("Observation", authorization="Bearer b"), 3)
+
+    def test_invalidate(self):
+        """
+        Writes invalidate the searches that involve their resource type
+        """
+        self.search("Observation?code=1")
+        self.search("Observation?subject:Patient.name=Jo")
+        cache.invalidate(Patient, "1")
+        self.assertEqual(self.search("Observation?code=1"), 1)
+        self.assertEqual(self.search("Observation?subject:Patient.name=Jo"), 3)
+        cache.invalidate(Observation)
+        self.assertEqual(self.search("Observation?code=1"), 4)
+
+    def test_unknown_types(self):
+        """
+        Searches on references of unknown types are invalidated by any write
+        """
+        self.search("Observation?subject.name=Jo")
+        cache.invalidate(Patient)
+        self.assertEqual(self.search("Observation?subject.name=Jo"), 2)
+
+    def test_searched_types(self):
+        query = parse_url(
+            "Patient/1/Observation?subject:Patient.organization:Organization.name=A"
+            "&_has:AuditEvent:entity:agent=B&_revinclude=Provenance:target"
+        )
+        self.assertEqual(
+            cache.searched_types(Observation, query),
+            {"Observation", "Patient", "Organization", "AuditEvent", "Provenance"},
+        )
+
+    def test_opt_out(self):
+        class Audited(Observation):
+            __SearchCache__ = False
+
+        self.search("Observation", Audited)
+        self.search("Observation", Audited)
+        self.assertEqual(self.renders, 2)
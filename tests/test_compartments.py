@@ -0,0 +1,269 @@
+import unittest
+from unittest.mock import Mock, patch
+from types import SimpleNamespace
+
+from fhirbug.config import settings
+
+if not settings.is_configured():
+    settings.configure(
+        {"DB_BACKEND": "SQLAlchemy", "SQLALCHEMY_CONFIG": {"URI": "sqlite:///memory"}}
+    )
+from fhirbug.exceptions import (
+    QueryValidationError,
+    DoesNotExistError,
+    MappingValidationError,
+)
+from fhirbug.models.compartments import (
+    Compartment,
+    Everything,
+    compartment_members,
+    compartment_queries,
+    multi_type_searchset,
+)
+from fhirbug.server.requestparser import parse_url
+from . import models
+
+
+def model_with_results(name, results):
+    Model = Mock()
+    Model.__name__ = name
+    Model._count = Mock(return_value=len(results))
+    Model._slice = Mock(
+        side_effect=lambda query, offset, limit: results[offset : offset + limit]
+    )
+    return Model
+
+
+def result(id):
+    item = Mock()
+    del item.audit_read
+    item.to_fhir = Mock(return_value=id)
+    return item
+
+
+@patch("fhirbug.models.compartments.PaginatedBundle")
+class TestMultiTypeSearchset(unittest.TestCase):
+    def test_single_page(self, PaginatedBundleMock):
+        """
+        All queries should be counted and fetched if they fit in one page
+        """
+        First = model_with_results("First", [result(1), result(2)])
+        Second = model_with_results("Second", [result(3)])
+        query = parse_url("Patient/1/*?_count=10")
+        multi_type_searchset(
+            [(First, lambda: "q1"), (Second, lambda: "q2")], query, "Patient/1/*"
+        )
+
+        First._count.assert_called_with("q1")
+        First._slice.assert_called_with("q1", 0, 2)
+        Second._slice.assert_called_with("q2", 0, 1)
+        pagination = PaginatedBundleMock.call_args[1]["pagination"]
+        self.assertEqual(pagination["items"], [1, 2, 3])
+        self.assertEqual(pagination["total"], 3)
+        self.assertFalse(pagination["has_next"])
+        self.assertFalse(pagination["has_previous"])
+
+    def test_page_across_types(self, PaginatedBundleMock):
+        """
+        Pages should continue from one type to the next and skip types with no
+        results in the requested page
+        """
+        First = model_with_results("First", [result(1), result(2), result(3)])
+        Second = model_with_results("Second", [result(4), result(5)])
+        Third = model_with_results("Third", [result(6)])
+        query = parse_url("Patient/1/*?_count=2&search-offset=3")
+        multi_type_searchset(
+            [(First, lambda: "q1"), (Second, lambda: "q2"), (Third, lambda: "q3")],
+            query,
+            "Patient/1/*",
+        )
+
+        First._slice.assert_called_with("q1", 2, 1)
+        Second._slice.assert_called_with("q2", 0, 1)
+        Third._slice.assert_not_called()
+        pagination = PaginatedBundleMock.call_args[1]["pagination"]
+        self.assertEqual(pagination["items"], [3, 4])
+        self.assertEqual(pagination["total"], 6)
+        self.assertTrue(pagination["has_next"])
+        self.assertTrue(pagination["has_previous"])
+        self.assertEqual(
+            pagination["next_page"], "Patient/1/*?_count=2&search-offset=5"
+        )
+
+
+    def test_leading_items(self, PaginatedBundleMock):
+        """
+        Leading items should be placed before the query results and count towards the total
+        """
+        First = model_with_results("First", [result(1), result(2)])
+        query = parse_url("Patient/1/$everything?_count=2")
+        multi_type_searchset(
+            [(First, lambda: "q1")], query, "Patient/1/$everything", ["patient"], "&_type=First"
+        )
+
+        First._slice.assert_called_with("q1", 0, 1)
+        pagination = PaginatedBundleMock.call_args[1]["pagination"]
+        self.assertEqual(pagination["items"], ["patient", 1])
+        self.assertEqual(pagination["total"], 3)
+        self.assertEqual(
+            pagination["next_page"],
+            "Patient/1/$everything?_count=2&search-offset=3&_type=First",
+        )
+
+    def test_sessions_are_released(self, PaginatedBundleMock):
+        """
+        Queries run on worker threads so the sessions of those threads should be released
+        """
+        First = model_with_results("First", [result(1)])
+        Second = model_with_results("Second", [result(2)])
+        query = parse_url("Patient/1/*")
+        multi_type_searchset(
+            [(First, lambda: "q1"), (Second, lambda: "q2")], query, "Patient/1/*"
+        )
+        self.assertEqual(First._close_thread_session.call_count, 2)
+        self.assertEqual(Second._close_thread_session.call_count, 2)
+
+
+class TestCompartment(unittest.TestCase):
+    @patch("fhirbug.models.compartments.get_registry")
+    def test_compartment_members(self, registryMock):
+        """
+        compartment_members should return the mappings that can be members of the compartment
+        """
+
+        class Member(models.WithSearcher):
+            class FhirMap:
+                subject = models.ReferenceAttribute(
+                    models.ReferenceTarget, "subject_id", "subject"
+                )
+
+        registryMock.return_value.mappings = {
+            "Member": SimpleNamespace(Model=Member),
+            "NotMember": SimpleNamespace(Model=models.WithSearcher),
+        }
+        with patch.object(Member, "compartment_searcher") as searcherMock:
+            members = compartment_members("ReferenceTarget")
+        self.assertEqual(members, [(Member, searcherMock())])
+
+    def test_get_without_compartment(self):
+        with self.assertRaises(QueryValidationError):
+            Compartment.get(parse_url("*"))
+
+    @patch("fhirbug.models.compartments.multi_type_searchset")
+    @patch("fhirbug.models.compartments.compartment_members")
+    def test_get(self, membersMock, searchsetMock):
+        Model = Mock()
+        searcher = Mock()
+        membersMock.return_value = [(Model, searcher)]
+        Model.has_searcher = Mock(return_value=True)
+        query = parse_url("Patient/1/*?code=12")
+
+        res = Compartment.get(query)
+        membersMock.assert_called_with("Patient")
+        [(model, build_query)], *_ = searchsetMock.call_args[0]
+        self.assertEqual(model, Model)
+        sql_query = build_query()
+        searcher.assert_called_with(Model, "Patient", "1", Model._get_orm_query(), query)
+        Model.apply_search.assert_called_with("code", "12", searcher(), query)
+        self.assertEqual(sql_query, Model.apply_search())
+        searchsetMock.assert_called_with(
+            [(Model, build_query)], query, "Patient/1/*"
+        )
+        self.assertEqual(res, searchsetMock())
+
+    @patch("fhirbug.models.compartments.compartment_members")
+    def test_compartment_queries_types(self, membersMock):
+        """
+        compartment_queries should only include the requested types
+        """
+        Observation, Condition = Mock(), Mock()
+        Observation._get_resource_cls().__name__ = "Observation"
+        Condition._get_resource_cls().__name__ = "Condition"
+        membersMock.return_value = [(Condition, Mock()), (Observation, Mock())]
+        query = parse_url("Patient/1/$everything")
+
+        queries = compartment_queries("Patient", "1", query, ["Observation"])
+        self.assertEqual([model for model, _ in queries], [Observation])
+        queries = compartment_queries("Patient", "1", query)
+        self.assertEqual([model for model, _ in queries], [Condition, Observation])
+
+
+@patch("fhirbug.models.compartments.multi_type_searchset")
+@patch("fhirbug.models.compartments.compartment_queries")
+@patch("fhirbug.models.compartments.get_registry")
+class TestEverything(unittest.TestCase):
+    def test_everything(self, registryMock, queriesMock, searchsetMock):
+        """
+        $everything should return the resource followed by its compartment
+        """
+        Patient = registryMock().models.Patient
+        del Patient._get_item_from_pk().audit_read
+        query = parse_url("Patient/1/$everything")
+
+        res = Everything.get(query)
+        Patient._get_item_from_pk.assert_called_with("1")
+        queriesMock.assert_called_with("Patient", "1", query, None)
+        searchsetMock.assert_called_with(
+            queriesMock(),
+            query,
+            "Patient/1/$everything",
+            [Patient._get_item_from_pk().to_fhir()],
+            "",
+        )
+        self.assertEqual(res, searchsetMock())
+
+    @patch("fhirbug.models.compartments.import_searches")
+    def test_everything_type_and_since(
+        self, import_searchesMock, registryMock, queriesMock, searchsetMock
+    ):
+        """
+        _type should filter the resource types and _since should use the
+        _lastUpdated searcher, or else the __LastUpdated__ column of each type
+        """
+        Patient = registryMock().models.Patient
+        del Patient._get_item_from_pk().audit_read
+        WithSearcher = Mock()
+        WithSearcher.has_searcher = Mock(return_value=True)
+        WithColumn = Mock(__LastUpdated__="updated_at")
+        WithColumn.has_searcher = Mock(return_value=False)
+        build_1, build_2 = Mock(), Mock()
+        queriesMock.return_value = [(WithSearcher, build_1), (WithColumn, build_2)]
+        query = parse_url("Patient/1/$everything?_type=Observation&_since=2019-01-01")
+
+        Everything.get(query)
+        queriesMock.assert_called_with("Patient", "1", query, ["Observation"])
+        queries, _, _, leading_items, url_queries = searchsetMock.call_args[0]
+        self.assertEqual(leading_items, [])
+        self.assertEqual(url_queries, "&_type=Observation&_since=2019-01-01")
+
+        (model_1, query_1), (model_2, query_2) = queries
+        query_1()
+        WithSearcher.apply_search.assert_called_with(
+            "_lastUpdated", "ge2019-01-01", build_1(), query
+        )
+        DateSearch = import_searchesMock().DateSearch
+        DateSearch.assert_called_with("updated_at")
+        self.assertEqual(query_2(), DateSearch().return_value)
+        DateSearch().assert_called_with(
+            WithColumn, "_lastUpdated", "ge2019-01-01", build_2(), query
+        )
+
+    def test_everything_since_unsupported(
+        self, registryMock, queriesMock, searchsetMock
+    ):
+        """
+        _since is refused if a type has no way to filter by it
+        """
+        del registryMock().models.Patient._get_item_from_pk().audit_read
+        Unversioned = Mock(spec=["has_searcher"], __name__="Unversioned")
+        Unversioned.has_searcher.return_value = False
+        queriesMock.return_value = [(Unversioned, Mock())]
+        with self.assertRaises(QueryValidationError):
+            Everything.get(parse_url("Patient/1/$everything?_since=2019-01-01"))
+
+    def test_everything_not_found(self, registryMock, queriesMock, searchsetMock):
+        registryMock().models.Patient._get_item_from_pk = Mock(
+            side_effect=DoesNotExistError
+        )
+        with self.assertRaises(MappingValidationError):
+            Everything.get(parse_url("Patient/1/$everything"))
@@ -0,0 +1,239 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
+
+from fhirbug.config import settings
+
+if not settings.is_configured():
+    settings.configure(
+        {"DB_BACKEND": "SQLAlchemy", "SQLALCHEMY_CONFIG": {"URI": "sqlite:///memory"}}
+    )
+from fhirbug.exceptions import QueryValidationError, DoesNotExistError
+from fhirbug.models import export
+from fhirbug.server.requestparser import parse_url
+from fhirbug.server.requesthandlers import GetRequestHandler, DeleteRequestHandler
+
+
+def export_settings(path, **kwargs):
+    return SimpleNamespace(
+        **{
+            "EXPORT_PATH": path,
+            "EXPORT_URL": None,
+            "EXPORT_WORKERS": 2,
+            "EXPORT_PARTITION_SIZE": 10,
+            "EXPORT_BATCH_SIZE": 5,
+            **kwargs,
+        }
+    )
+
+
+def item(id):
+    item = Mock(spec=["to_fhir"])
+    item.to_fhir.return_value.as_json.return_value = {
+        "resourceType": "Patient",
+        "id": id,
+    }
+    return item
+
+
+class TestPartitions(unittest.TestCase):
+    @patch("fhirbug.models.export.settings", export_settings(None))
+    def test_pk_partitions(self):
+        """
+        Queries should be split in ranges of primary keys of about EXPORT_PARTITION_SIZE rows
+        """
+        Model = Mock()
+        Model._pk_bounds.return_value = (1, 25)
+        Model._count.return_value = 25
+        build_query = Mock()
+        partitions = export.pk_partitions(Model, build_query)
+        self.assertEqual(len(partitions), 3)
+        for partition in partitions:
+            partition()
+        ranges = [call[0][1:] for call in Model._filter_pk_range.call_args_list]
+        self.assertEqual(ranges, [(1, 10), (10, 19), (19, 28)])
+
+    def test_pk_partitions_unsupported(self):
+        """
+        Queries are not split if the backend can not read primary key ranges
+        """
+        Model = Mock()
+        Model._pk_bounds.return_value = None
+        build_query = Mock()
+        self.assertEqual(export.pk_partitions(Model, build_query), [build_query])
+        # Or if it reads the bounds but can not filter by them
+        Model = Mock(spec=["_pk_bounds", "_count"])
+        Model._pk_bounds.return_value = (1, 25)
+        self.assertEqual(export.pk_partitions(Model, build_query), [build_query])
+
+    def test_job_path(self):
+        with self.assertRaises(DoesNotExistError):
+            export.job_path("../../etc")
+
+    def test_make_job_path(self):
+        """
+        Job directories, and EXPORT_PATH if it is created, are private to the server
+        """
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        path = os.path.join(root, "exports")
+        with patch("fhirbug.models.export.settings", export_settings(path)):
+            job_path = export.make_job_path("a" * 32)
+        self.assertEqual(job_path, os.path.join(path, "a" * 32))
+        for directory in (path, job_path):
+            self.assertEqual(os.stat(directory).st_mode & 0o777, 0o700)
+
+
+class TestExportJob(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        patcher = patch("fhirbug.models.export.settings", export_settings(self.path))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def start(self, sources):
+        job = export.ExportJob(parse_url("$export"), "$export", sources)
+        export.make_job_path(job.id)
+        export.jobs[job.id] = job
+        return job
+
+    def test_run(self):
+        """
+        Each file of the plan should be written to an NDJSON file and listed in the manifest
+        """
+        Model = Mock()
+        plan = lambda: [lambda: [item("1"), item("2")], lambda: [item("3")], lambda: []]
+        job = self.start([("Patient", Model, plan)])
+
+        self.assertEqual(export.export_status(job.id)[1], 202)
+        job.run()
+
+        manifest, status, headers = export.export_status(job.id)
+        self.assertEqual(status, 200)
+        self.assertEqual(manifest["request"], "$export")
+        self.assertEqual(
+            [(file["type"], file["count"]) for file in manifest["output"]],
+            [("Patient", 2), ("Patient", 1)],
+        )
+        with open(os.path.join(job.path, "Patient.1.ndjson")) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual([line["id"] for line in lines], ["1", "2"])
+        # Empty files are not kept
+        self.assertFalse(os.path.exists(os.path.join(job.path, "Patient.3.ndjson")))
+        self.assertNotIn(job.id, export.jobs)
+
+    def test_run_failure(self):
+        """
+        If a file can not be written the job fails with an OperationOutcome
+        """
+
+        def items():
+            raise Exception("Boom")
+
+        job = self.start([("Patient", Mock(), lambda: [items])])
+        job.run()
+        outcome, status, headers = export.export_status(job.id)
+        self.assertEqual(status, 500)
+        self.assertIn("Boom", outcome["issue"][0]["diagnostics"])
+
+    def test_cancel(self):
+        """
+        Cancelled jobs stop writing and remove their files
+        """
+        job = self.start([("Patient", Mock(), lambda: [lambda: [item("1")]])])
+        export.cancel_export(job.id)
+        job.run()
+        self.assertFalse(os.path.exists(job.path))
+        with self.assertRaises(DoesNotExistError):
+            export.export_status(job.id)
+
+    def test_cancel_finished(self):
+        """
+        Cancelling a finished job removes its files
+        """
+        job = self.start([("Patient", Mock(), lambda: [lambda: [item("1")]])])
+        job.run()
+        export.cancel_export(job.id)
+        self.assertFalse(os.path.exists(job.path))
+
+    def test_file_url(self):
+        job_id = "0" * 32
+        with patch.object(export.settings, "EXPORT_URL", "https://files.test/export/"):
+            self.assertEqual(
+                export.file_url(job_id, "Patient.1.ndjson"),
+                f"https://files.test/export/{job_id}/Patient.1.ndjson",
+            )
+
+
+@patch("fhirbug.models.export.exported_models", Mock(return_value={}))
+class TestExportSources(unittest.TestCase):
+    def test_output_format(self):
+        with self.assertRaises(QueryValidationError):
+            export.export_sources(parse_url("$export?_outputFormat=text/csv"))
+
+    def test_since(self):
+        with self.assertRaises(QueryValidationError):
+            export.export_sources(parse_url("$export?_since=yesterday"))
+
+    def test_types(self):
+        with self.assertRaises(QueryValidationError):
+            export.export_sources(parse_url("$export?_type=Patient"))
+
+    def test_level(self):
+        """
+        Exports are only supported at system level, on Patient and on Group
+        """
+        with self.assertRaises(QueryValidationError):
+            export.export_sources(parse_url("Observation/$export"))
+        with self.assertRaises(QueryValidationError):
+            export.export_sources(parse_url("Patient/1/$export"))
+
+
+class TestExportRequests(unittest.TestCase):
+    def handler(self, Handler, url):
+        handler = Handler()
+        handler.log_request = Mock()
+        return handler, handler.handle(url)
+
+    @patch("fhirbug.models.export.start_export")
+    def test_kick_off(self, start_export):
+        start_export.return_value = SimpleNamespace(id="123")
+        handler, (ret, status) = self.handler(GetRequestHandler, "$export?_type=Patient")
+        self.assertEqual(status, 202)
+        self.assertEqual(
+            handler.response_headers, {"Content-Location": "$export-poll-status/123"}
+        )
+        self.assertEqual(start_export.call_args[0][1], "$export?_type=Patient")
+
+    @patch("fhirbug.models.export.start_export")
+    def test_kick_off_invalid(self, start_export):
+        start_export.side_effect = QueryValidationError("Invalid")
+        handler, (ret, status) = self.handler(GetRequestHandler, "$export")
+        self.assertEqual(status, 400)
+
+    @patch("fhirbug.models.export.export_status")
+    def test_status(self, export_status):
+        export_status.return_value = ({}, 202, {"X-Progress": "in progress"})
+        handler, (ret, status) = self.handler(GetRequestHandler, "$export-poll-status/1")
+        export_status.assert_called_with("1")
+        self.assertEqual(status, 202)
+        self.assertEqual(handler.response_headers, {"X-Progress": "in progress"})
+
+    @patch("fhirbug.models.export.export_status")
+    def test_status_not_found(self, export_status):
+        export_status.side_effect = DoesNotExistError("1", "$export")
+        handler, (ret, status) = self.handler(GetRequestHandler, "$export-poll-status/1")
+        self.assertEqual(status, 404)
+
+    @patch("fhirbug.models.export.cancel_export")
+    def test_cancel(self, cancel_export):
+        handler, (ret, status) = self.handler(
+            DeleteRequestHandler, "$export-poll-status/1"
+        )
+        cancel_export.assert_called_with("1")
+        self.assertEqual(status, 202)
@@ -0,0 +1,77 @@
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from fhirbug.models import includes
+from fhirbug.models.attributes import Attribute, ReferenceAttribute
+from fhirbug.models.mixins import FhirAbstractBaseMixin, FhirBaseModelMixin
+from fhirbug.server.requestparser import parse_url
+
+
+class Organization(FhirAbstractBaseMixin, FhirBaseModelMixin):
+    class FhirMap:
+        id = Attribute("id")
+
+
+class Patient(FhirAbstractBaseMixin, FhirBaseModelMixin):
+    def __init__(self, id, organization_id):
+        self.id = id
+        self.organization_id = organization_id
+
+    class FhirMap:
+        id = Attribute("id")
+        managingOrganization = ReferenceAttribute(
+            Organization, "organization_id", "organization"
+        )
+
+
+class TestIncludes(unittest.TestCase):
+    def test_plan(self):
+        """
+        Every include and revinclude of the page is fetched once
+        """
+        items = [Patient("1", 10), Patient("2", 10)]
+        query = parse_url(
+            "Patient?_include=organization&_revinclude=Observation:subject"
+        )
+        self.assertEqual(
+            includes.plan(items, query),
+            [
+                ("include", Organization, 10),
+                ("revinclude", "Observation", "subject", "1"),
+                ("revinclude", "Observation", "subject", "2"),
+            ],
+        )
+
+    def test_prefetch(self):
+        items = [Patient("1", 10), Patient("2", 11)]
+        query = parse_url("Patient?_include=organization")
+        resource = SimpleNamespace(id="10")
+        fetched = []
+
+        def fetch(key, query):
+            fetched.append(key)
+            return resource, "Acme"
+
+        with patch("fhirbug.models.includes.fetch", fetch), patch(
+            "fhirbug.models.includes.import_backend"
+        ):
+            includes.prefetch(items, query)
+        self.assertEqual(len(fetched), 2)
+        # Each use gets its own copy of the resource
+        copy, display = includes.prefetched_include(items[1], Organization, 11)
+        self.assertEqual((copy.id, display), ("10", "Acme"))
+        self.assertIsNot(copy, resource)
+        self.assertIsNone(includes.prefetched_include(items[1], Organization, 12))
+
+    def test_prefetch_sequential(self):
+        """
+        Nothing is prefetched without a thread pool or with a single query
+        """
+        items = [Patient("1", 10), Patient("2", 11)]
+        with patch("fhirbug.models.includes.fetch") as fetch:
+            includes.prefetch(items[:1], parse_url("Patient?_include=organization"))
+            with patch("fhirbug.models.includes.settings") as settings:
+                settings.MAX_QUERY_WORKERS = 1
+                includes.prefetch(items, parse_url("Patient?_include=organization"))
+        fetch.assert_not_called()
@@ -0,0 +1,73 @@
+import unittest
+
+from fhirbug.exceptions import InvalidOperationError, QueryValidationError
+from fhirbug.server.jsonpatch import apply_patch, touched_elements, validate_patch
+
+
+class TestJsonPatch(unittest.TestCase):
+    def setUp(self):
+        self.document = {
+            "resourceType": "Patient",
+            "gender": "male",
+            "name": [{"family": "Doe", "given": ["Jane"]}],
+        }
+
+    def test_operations(self):
+        patch = [
+            {"op": "replace", "path": "/gender", "value": "female"},
+            {"op": "add", "path": "/name/0/given/-", "value": "Mary"},
+            {"op": "add", "path": "/name/0", "value": {"family": "Roe"}},
+            {"op": "copy", "from": "/gender", "path": "/active"},
+            {"op": "move", "from": "/active", "path": "/birthDate"},
+            {"op": "remove", "path": "/birthDate"},
+            {"op": "test", "path": "/name/1/given/1", "value": "Mary"},
+        ]
+        self.assertEqual(
+            apply_patch(self.document, patch),
+            {
+                "resourceType": "Patient",
+                "gender": "female",
+                "name": [{"family": "Roe"}, {"family": "Doe", "given": ["Jane", "Mary"]}],
+            },
+        )
+        # The document itself is not changed
+        self.assertEqual(self.document["gender"], "male")
+
+    def test_escaped_pointers(self):
+        document = {"a/b": {"m~n": 1}}
+        patch = [{"op": "replace", "path": "/a~1b/m~0n", "value": 2}]
+        self.assertEqual(apply_patch(document, patch), {"a/b": {"m~n": 2}})
+
+    def test_failures(self):
+        """
+        Operations that can not be applied raise InvalidOperationError
+        """
+        for patch in [
+            [{"op": "replace", "path": "/birthDate", "value": "2000"}],
+            [{"op": "remove", "path": "/name/1"}],
+            [{"op": "add", "path": "/name/01", "value": {}}],
+            [{"op": "test", "path": "/gender", "value": "female"}],
+            [{"op": "move", "from": "/name", "path": "/name/0/family"}],
+        ]:
+            with self.subTest(patch=patch), self.assertRaises(InvalidOperationError):
+                apply_patch(self.document, patch)
+
+    def test_malformed(self):
+        for patch in [
+            {"op": "remove", "path": "/gender"},
+            [{"op": "delete", "path": "/gender"}],
+            [{"op": "add", "path": "/gender"}],
+            [{"op": "remove", "path": "gender"}],
+        ]:
+            with self.subTest(patch=patch), self.assertRaises(QueryValidationError):
+                validate_patch(patch)
+
+    def test_touched_elements(self):
+        patch = [
+            {"op": "test", "path": "/id", "value": "1"},
+            {"op": "copy", "from": "/telecom/0", "path": "/telecom/-"},
+            {"op": "move", "from": "/name/1", "path": "/contact/0/name"},
+        ]
+        self.assertEqual(touched_elements(patch), ["contact", "name", "telecom"])
+        with self.assertRaises(InvalidOperationError):
+            touched_elements([{"op": "replace", "path": "", "value": {}}])
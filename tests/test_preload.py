@@ -0,0 +1,80 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+
+from fhirbug.config import settings
+
+if not settings.is_configured():
+    settings.configure(
+        {"DB_BACKEND": "SQLAlchemy", "SQLALCHEMY_CONFIG": {"URI": "sqlite:///memory"}}
+    )
+from fhirbug.db.backends.SQLAlchemy import base
+from fhirbug.server import preload
+
+
+class TestLazyEngine(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        config = {"URI": f"sqlite:///{os.path.join(directory.name, 'db')}"}
+        for patcher in (
+            patch.object(base, "_engine", None),
+            patch.object(base, "_replicas", None),
+            patch.object(settings._wrapped, "SQLALCHEMY_CONFIG", config, create=True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_get_engine(self):
+        """
+        The engine is created on first use and reused
+        """
+        engine = base.get_engine()
+        self.addCleanup(engine.dispose)
+        self.assertIs(base.engine, engine)
+        self.assertIs(base.get_engine(), engine)
+        self.assertEqual(base.get_replicas(), [])
+
+    def test_reset_engines(self):
+        """
+        Inherited connections are dropped without closing them
+        """
+        base._engine, replica = Mock(), Mock()
+        base._replicas = [replica]
+        base.reset_engines()
+        base._engine.dispose.assert_called_once_with(close=False)
+        replica.dispose.assert_called_once_with(close=False)
+
+    @unittest.skipUnless(hasattr(os, "register_at_fork"), "requires os.fork")
+    def test_fork(self):
+        """
+        Children of a fork do not use the connections of their parent
+        """
+        engine = base.get_engine()
+        self.addCleanup(engine.dispose)
+        with engine.connect():
+            pass
+        self.assertEqual(engine.pool.checkedin(), 1)
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.write(write, str(engine.pool.checkedin()).encode())
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(os.read(read, 10), b"0")
+        os.close(read)
+        os.close(write)
+        self.assertEqual(engine.pool.checkedin(), 1)
+
+
+class TestPreload(unittest.TestCase):
+    @patch("fhirbug.server.preload.gc")
+    @patch("fhirbug.server.preload.warmup")
+    def test_preload(self, warmup, gc):
+        self.assertEqual(preload.preload(), warmup.return_value)
+        gc.freeze.assert_called_once_with()
+
+        gc.reset_mock()
+        preload.preload(freeze=False)
+        gc.freeze.assert_not_called()
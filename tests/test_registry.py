@@ -0,0 +1,84 @@
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from fhirbug.Fhir.resources import Patient
+from fhirbug.models import registry
+from fhirbug.models.attributes import Attribute, const
+from fhirbug.models.mixins import FhirAbstractBaseMixin, FhirBaseModelMixin
+
+
+def search_name(cls, field_name, value, sql_query, query):
+    return sql_query
+
+
+class PatientMapping(FhirAbstractBaseMixin, FhirBaseModelMixin):
+    _name = "hello"
+    _age = 12
+    __Resource__ = "Patient"
+
+    class FhirMap:
+        active = Attribute(const(True))
+        name = Attribute("_name", searcher=search_name, search_regex=r"(name|NAME)")
+        age = Attribute("_age")
+
+
+class NoResource(FhirAbstractBaseMixin, FhirBaseModelMixin):
+    class FhirMap:
+        name = Attribute("_name")
+
+
+def registered():
+    module = SimpleNamespace(
+        PatientMapping=PatientMapping, NoResource=NoResource, helper=len
+    )
+    return registry.Registry(module)
+
+
+class TestRegistry(unittest.TestCase):
+    def test_mappings(self):
+        """
+        The registry holds the mappings of the module by name and by resource type
+        """
+        built = registered()
+        self.assertEqual(
+            built.models,
+            SimpleNamespace(PatientMapping=PatientMapping, NoResource=NoResource),
+        )
+        self.assertEqual(built.resources, SimpleNamespace(PatientMapping=Patient))
+        self.assertEqual(list(built.by_resource), ["Patient"])
+        mapping = built.by_model[PatientMapping]
+        self.assertEqual(sorted(mapping.fields), ["active", "name"])
+        self.assertEqual(mapping.properties, ["active", "name", "age"])
+
+    def test_lookup(self):
+        """
+        Mappings use the searchers and fields of the registry once it has been built
+        """
+        built = registered()
+        self.assertIsNone(registry.lookup(PatientMapping))
+        with patch("fhirbug.models.registry._registry", built):
+            mapping = built.mappings["PatientMapping"]
+            self.assertIs(registry.lookup(PatientMapping), mapping)
+            self.assertIs(PatientMapping.searchables(), mapping.searchables)
+            regex, searcher = mapping.searchers[0]
+            self.assertTrue(regex.match("NAME"))
+            self.assertEqual(
+                PatientMapping().get_params_dict(Patient, ["name"]),
+                {"name": "hello"},
+            )
+
+    def test_get_registry(self):
+        """
+        The registry is built once for each configuration of the settings
+        """
+        module = SimpleNamespace(PatientMapping=PatientMapping)
+        settings = SimpleNamespace(_wrapped=object())
+        with patch("fhirbug.models.registry.settings", settings), patch(
+            "fhirbug.models.registry.import_models", return_value=module
+        ) as import_models, patch("fhirbug.models.registry._registry", None):
+            first = registry.get_registry()
+            self.assertIs(registry.get_registry(), first)
+            settings._wrapped = object()
+            self.assertIsNot(registry.get_registry(), first)
+            self.assertEqual(import_models.call_count, 2)
@@ -0,0 +1,114 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+from fhirbug.config import settings
+
+if not settings.is_configured():
+    settings.configure(
+        {"DB_BACKEND": "SQLAlchemy", "SQLALCHEMY_CONFIG": {"URI": "sqlite:///memory"}}
+    )
+from fhirbug.db.backends.SQLAlchemy import base, models
+from fhirbug.db.routing import is_read_only, read_only
+from fhirbug.utils import concurrent_map
+
+RowBase = declarative_base()
+
+
+class Row(RowBase):
+    __tablename__ = "rows"
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+
+
+class Item(models.FhirBaseModel):
+    __tablename__ = "replica_items"
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+
+    class FhirMap:
+        pass
+
+
+class TestReplicaRouting(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        engines = {}
+        for name in ("primary", "replica"):
+            engine = create_engine(f"sqlite:///{os.path.join(directory.name, name)}")
+            self.addCleanup(engine.dispose)
+            RowBase.metadata.create_all(engine)
+            Item.__table__.create(engine)
+            with engine.begin() as connection:
+                connection.execute(Row.__table__.insert(), {"id": 1, "name": name})
+            engines[name] = engine
+        for patcher in (
+            patch.object(base, "_replicas", [engines["replica"]]),
+            patch.dict(base._written_tables, clear=True),
+            patch.dict(settings.SQLALCHEMY_CONFIG, {"REPLICA_LAG": 60}),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.session = sessionmaker(
+            bind=engines["primary"], class_=base.RoutingSession
+        )()
+        self.addCleanup(self.session.close)
+
+    def name(self):
+        self.session.expire_all()
+        return self.session.get(Row, 1).name
+
+    def test_reads(self):
+        """
+        Only reads inside read_only blocks go to the replicas
+        """
+        self.assertEqual(self.name(), "primary")
+        with read_only():
+            self.assertEqual(self.name(), "replica")
+
+    def test_writes(self):
+        """
+        Writes, reads in the same transaction and reads shortly after a write go to the primary
+        """
+        with read_only():
+            self.session.add(Row(id=2, name="new"))
+            self.session.flush()
+            self.assertEqual(self.name(), "primary")
+            self.session.commit()
+            self.assertEqual(self.name(), "primary")
+            with patch.dict(settings.SQLALCHEMY_CONFIG, {"REPLICA_LAG": 0}):
+                self.assertEqual(self.name(), "replica")
+        self.assertEqual(self.session.query(Row).count(), 2)
+
+    def test_bulk_insert(self):
+        """
+        Bulk inserts, which do not flush, send the reads of their tables to the primary
+        """
+        with patch.object(models, "session", self.session), read_only():
+            Item._bulk_insert([Item(id=1, name="new")])
+            self.session.expire_all()
+            self.assertEqual(self.session.get(Item, 1).name, "new")
+            self.assertEqual(self.name(), "replica")
+
+    def test_worker_threads(self):
+        """
+        Queries that run concurrently on worker threads, eg of includes, are reads too
+        """
+        with read_only():
+            self.assertEqual(
+                concurrent_map(lambda _: is_read_only(), [1, 2, 3], 2), [True] * 3
+            )
+        self.assertEqual(
+            concurrent_map(lambda _: is_read_only(), [1, 2], 2), [False] * 2
+        )
+
+    def test_engine_options(self):
+        config = {"URI": "sqlite://", "POOL_RECYCLE": 3600, "POOL_PRE_PING": True}
+        self.assertEqual(
+            base.engine_options(config), {"pool_recycle": 3600, "pool_pre_ping": True}
+        )
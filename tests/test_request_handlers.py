@@ -1,14 +1,25 @@
+import asyncio
 import unittest
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import date, datetime
 from types import SimpleNamespace
 from unittest.mock import patch, Mock
+from fhirbug.models.mixins import format_version
 from fhirbug.server.requestparser import parse_url, split_join
 from fhirbug.server.requesthandlers import (
     AbstractRequestHandler,
     GetRequestHandler,
     PostRequestHandler,
     PutRequestHandler,
+    PatchRequestHandler,
     DeleteRequestHandler,
+    AsyncGetRequestHandler,
+    register_request_context,
+    get_request_context,
+    not_modified,
+    preferences,
+    version_headers,
+    write_response,
 )
 from fhirbug.exceptions import (
     QueryValidationError,
@@ -17,6 +28,7 @@ from fhirbug.exceptions import (
     AuthorizationError,
     MappingValidationError,
     DoesNotExistError,
+    UnsupportedParameterError,
 )
 
 
@@ -48,22 +60,22 @@ class TestAbstractRequestHandler(unittest.TestCase):
 
     def test_import_models_success(self):
         """
-        import_models should call ``fhirbug.config.import_models`` and return the result
+        import_models should return the mappings of the model registry
         """
-        with patch("fhirbug.server.requesthandlers.import_models") as importMock:
+        with patch("fhirbug.server.requesthandlers.get_registry") as registryMock:
             handler = AbstractRequestHandler()
             models = handler.import_models()
-            importMock.assert_called_once()
-            self.assertEqual(models, importMock())
+            registryMock.assert_called_once()
+            self.assertEqual(models, registryMock().models)
 
     def test_import_models_failure(self):
         """
-        When ``fhirbug.config.import_models`` throws a ConfigurationError,
+        When the model registry throws a ConfigurationError,
         it should throw an OperationError
         """
         mock_parser = Mock(side_effect=ConfigurationError)
         with patch(
-            "fhirbug.server.requesthandlers.import_models", new=mock_parser
+            "fhirbug.server.requesthandlers.get_registry", new=mock_parser
         ) as query:
             handler = AbstractRequestHandler()
             with self.assertRaises(OperationError) as e:
@@ -225,6 +237,48 @@ class TestGetRequestHandler(unittest.TestCase):
         self.assertEqual(ret, handler.fetch_items())
         self.assertEqual(status, 200)
 
+    def test_handle_compartment(self):
+        """
+        Searches on all types of a compartment should be handled by ``Compartment``
+        """
+        from fhirbug.models.compartments import Compartment
+
+        handler = GetRequestHandler()
+        handler.parse_url = Mock()
+        handler.query = SimpleNamespace(resource="*", resourceId=None, operation=None)
+        handler._audit_request = Mock()
+        handler.import_models = Mock()
+        handler.get_resource = Mock()
+        handler.fetch_items = Mock()
+        handler.log_request = Mock()
+
+        ret, status = handler.handle("Patient/123/*")
+        handler.get_resource.assert_not_called()
+        handler.fetch_items.assert_called_with(Compartment)
+        self.assertEqual(status, 200)
+
+    def test_handle_everything(self):
+        """
+        The $everything operation should be handled by ``Everything``
+        """
+        from fhirbug.models.compartments import Everything
+
+        handler = GetRequestHandler()
+        handler.parse_url = Mock()
+        handler.query = SimpleNamespace(
+            resource="Patient", resourceId="1", operation="$everything"
+        )
+        handler._audit_request = Mock()
+        handler.import_models = Mock()
+        handler.get_resource = Mock()
+        handler.fetch_items = Mock()
+        handler.log_request = Mock()
+
+        ret, status = handler.handle("Patient/123/$everything")
+        handler.get_resource.assert_called_with(handler.import_models())
+        handler.fetch_items.assert_called_with(Everything)
+        self.assertEqual(status, 200)
+
     def test_handle_failure(self):
         handler = GetRequestHandler()
         handler.parse_url = Mock(side_effect=OperationError)
@@ -249,6 +303,257 @@ class TestGetRequestHandler(unittest.TestCase):
         self.assertEqual(status, 500)
 
 
+class TestConditionalRead(unittest.TestCase):
+    LAST_UPDATED = "2020-01-02T03:04:05+00:00"
+
+    def test_version_headers(self):
+        self.assertEqual(
+            version_headers("3", self.LAST_UPDATED),
+            {"ETag": 'W/"3"', "Last-Modified": "Thu, 02 Jan 2020 03:04:05 GMT"},
+        )
+        self.assertEqual(version_headers(None, None), {})
+
+    def test_version_headers_without_timezone(self):
+        """
+        Dates and datetimes without a timezone are in UTC, and values that are not
+        dates have no Last-Modified header
+        """
+        self.assertEqual(
+            version_headers(*format_version(None, date(2019, 1, 1))),
+            {
+                "ETag": 'W/"2019-01-01"',
+                "Last-Modified": "Tue, 01 Jan 2019 00:00:00 GMT",
+            },
+        )
+        self.assertEqual(
+            version_headers("3", "2020-01-02T05:04:05+02:00")["Last-Modified"],
+            "Thu, 02 Jan 2020 03:04:05 GMT",
+        )
+        self.assertEqual(version_headers("3", "yesterday"), {"ETag": 'W/"3"'})
+        since = "Tue, 01 Jan 2019 00:00:00 GMT"
+        self.assertTrue(not_modified({"if-modified-since": since}, None, "2019-01-01"))
+        self.assertFalse(not_modified({"if-modified-since": since}, None, "2019-01-02"))
+
+    def test_not_modified(self):
+        self.assertTrue(not_modified({"if-none-match": 'W/"3"'}, "3", None))
+        self.assertTrue(not_modified({"if-none-match": '"2", "3"'}, "3", None))
+        self.assertTrue(not_modified({"if-none-match": "*"}, "3", None))
+        self.assertFalse(not_modified({"if-none-match": 'W/"2"'}, "3", None))
+        since = "Thu, 02 Jan 2020 03:04:05 GMT"
+        self.assertTrue(
+            not_modified({"if-modified-since": since}, "3", self.LAST_UPDATED)
+        )
+        self.assertFalse(
+            not_modified(
+                {"if-modified-since": since}, "3", "2020-01-02T03:04:06+00:00"
+            )
+        )
+        # If-Modified-Since is ignored if If-None-Match is present
+        self.assertFalse(
+            not_modified(
+                {"if-none-match": 'W/"2"', "if-modified-since": since},
+                "3",
+                self.LAST_UPDATED,
+            )
+        )
+        self.assertFalse(not_modified({"if-modified-since": "yesterday"}, "3", None))
+
+    def handle(self, Model, headers):
+        handler = GetRequestHandler()
+        handler.import_models = Mock()
+        handler.get_resource = Mock(return_value=Model)
+        handler.log_request = Mock()
+        handler.fetch_items = Mock(
+            return_value={"resourceType": "Patient", "meta": {"versionId": "3"}}
+        )
+        context = SimpleNamespace(headers=headers)
+        return handler, handler.handle("Patient/1", query_context=context)
+
+    def test_handle_not_modified(self):
+        """
+        Conditional reads of current versions return 304 without fetching the item
+        """
+        Model = Mock(spec=["is_versioned", "_get_version"])
+        Model.is_versioned.return_value = True
+        Model._get_version.return_value = (3, None)
+
+        handler, (ret, status) = self.handle(Model, {"if-none-match": 'W/"3"'})
+        self.assertEqual(status, 304)
+        self.assertIsNone(ret)
+        Model._get_version.assert_called_with("1")
+        handler.fetch_items.assert_not_called()
+        self.assertEqual(handler.response_headers, {"ETag": 'W/"3"'})
+
+    def test_handle_modified(self):
+        Model = Mock(spec=["is_versioned", "_get_version"])
+        Model.is_versioned.return_value = True
+        Model._get_version.return_value = (4, None)
+
+        handler, (ret, status) = self.handle(Model, {"if-none-match": 'W/"3"'})
+        self.assertEqual(status, 200)
+        handler.fetch_items.assert_called_with(Model)
+        # The headers describe the returned version
+        self.assertEqual(handler.response_headers, {"ETag": 'W/"3"'})
+
+    def test_handle_date_last_updated(self):
+        """
+        Reads of mappings whose __LastUpdated__ is a date get a Last-Modified header
+        """
+        Model = Mock(spec=["is_versioned", "_get_version"])
+        Model.is_versioned.return_value = True
+        Model._get_version.return_value = (None, date(2019, 1, 1))
+        since = {"if-modified-since": "Tue, 01 Jan 2019 00:00:00 GMT"}
+
+        handler, (ret, status) = self.handle(Model, since)
+        self.assertEqual(status, 304)
+        self.assertEqual(
+            handler.response_headers["Last-Modified"], "Tue, 01 Jan 2019 00:00:00 GMT"
+        )
+
+        handler = GetRequestHandler()
+        handler.import_models = Mock()
+        handler.get_resource = Mock(return_value=Model)
+        handler.log_request = Mock()
+        handler.fetch_items = Mock(
+            return_value={
+                "resourceType": "Patient",
+                "meta": {"lastUpdated": "2019-01-01"},
+            }
+        )
+        ret, status = handler.handle("Patient/1")
+        self.assertEqual(status, 200)
+        self.assertEqual(
+            handler.response_headers["Last-Modified"], "Tue, 01 Jan 2019 00:00:00 GMT"
+        )
+
+    def test_handle_not_modified_with_auditing(self):
+        """
+        Mappings that audit reads are fetched to authorize the request
+        """
+        Model = Mock(spec=["is_versioned", "_get_item_from_pk", "audit_read"])
+        Model.is_versioned.return_value = True
+        item = Model._get_item_from_pk.return_value
+        item.get_version.return_value = (3, None)
+        item.audit_read.return_value = SimpleNamespace(outcome="8")
+
+        handler, (ret, status) = self.handle(Model, {"if-none-match": 'W/"3"'})
+        self.assertEqual(status, 200)
+        item.audit_read.return_value = SimpleNamespace(outcome="0")
+        handler, (ret, status) = self.handle(Model, {"if-none-match": 'W/"3"'})
+        self.assertEqual(status, 304)
+
+
+class TestSearchValidation(unittest.TestCase):
+    def handle(self, Model, headers={}, url="Patient?nme=Jo"):
+        handler = GetRequestHandler()
+        handler.import_models = Mock()
+        handler.get_resource = Mock(return_value=Model)
+        handler.log_request = Mock()
+        handler.fetch_items = Mock(
+            return_value={"resourceType": "Bundle", "entry": [{"resource": {}}]}
+        )
+        context = SimpleNamespace(headers=headers)
+        return handler, handler.handle(url, query_context=context)
+
+    def test_lenient(self):
+        """
+        Ignored parameters are reported in an OperationOutcome entry of the Bundle
+        """
+        Model = Mock(spec=["validate_search"])
+        Model.validate_search.return_value = ["nme"]
+        handler, (ret, status) = self.handle(Model)
+        self.assertEqual(status, 200)
+        self.assertEqual(Model.validate_search.call_args[1], {"strict": False})
+        self.assertEqual(len(ret["entry"]), 2)
+        self.assertEqual(ret["entry"][1]["search"], {"mode": "outcome"})
+        issue = ret["entry"][1]["resource"]["issue"][0]
+        self.assertEqual(issue["severity"], "warning")
+        self.assertIn('"nme"', issue["diagnostics"])
+
+    def test_strict(self):
+        """
+        Unsupported parameters are refused before the search runs
+        """
+        Model = Mock(spec=["validate_search"])
+        Model.validate_search.side_effect = UnsupportedParameterError("nme")
+        handler, (ret, status) = self.handle(Model, {"prefer": "handling=strict"})
+        self.assertEqual(status, 400)
+        self.assertEqual(ret["issue"][0]["code"], "not-supported")
+        self.assertEqual(Model.validate_search.call_args[1], {"strict": True})
+        handler.fetch_items.assert_not_called()
+
+    @patch("fhirbug.server.requesthandlers.settings")
+    def test_strict_setting(self, settingsMock):
+        settingsMock.SEARCH_HANDLING = "strict"
+        Model = Mock(spec=["validate_search"])
+        Model.validate_search.return_value = []
+        self.handle(Model)
+        self.assertEqual(Model.validate_search.call_args[1], {"strict": True})
+        self.handle(Model, {"prefer": "handling=lenient"})
+        self.assertEqual(Model.validate_search.call_args[1], {"strict": False})
+
+    def test_invalid(self):
+        Model = Mock(spec=["validate_search"])
+        Model.validate_search.side_effect = QueryValidationError("Invalid date")
+        handler, (ret, status) = self.handle(Model)
+        self.assertEqual(status, 400)
+        self.assertEqual(ret["issue"][0]["code"], "invalid")
+        handler.fetch_items.assert_not_called()
+
+    def test_reads_are_not_validated(self):
+        Model = Mock(spec=["validate_search"])
+        handler, (ret, status) = self.handle(Model, url="Patient/1?_elements=id")
+        Model.validate_search.assert_not_called()
+        # Neither are the searches of compartment types without a mapping
+        handler, (ret, status) = self.handle(Mock(spec=[]), url="Patient/1/*?a=b")
+        self.assertEqual(status, 200)
+
+
+class TestPreferReturn(unittest.TestCase):
+    def query(self, prefer):
+        return SimpleNamespace(context=SimpleNamespace(headers={"prefer": prefer}))
+
+    def instance(self):
+        instance = Mock()
+        instance._get_resource_cls().resource_type = "Patient"
+        instance.Fhir.id = "1"
+        instance.get_version.return_value = (3, None)
+        instance.to_fhir().as_json.return_value = {
+            "resourceType": "Patient",
+            "id": "1",
+            "meta": {"versionId": "3"},
+        }
+        return instance
+
+    def test_preferences(self):
+        self.assertEqual(
+            preferences(self.query('return=minimal, handling="strict"; respond-async')),
+            {"return": "minimal", "handling": "strict", "respond-async": None},
+        )
+        self.assertEqual(preferences(SimpleNamespace(context=None)), {})
+
+    def test_write_response(self):
+        """
+        Only return=representation renders the resource, all of them set the headers
+        """
+        headers = {"ETag": 'W/"3"', "Location": "Patient/1"}
+        for prefer, expected in [
+            ("return=representation", "Patient"),
+            ("", "Patient"),
+            ("return=minimal", None),
+            ("return=OperationOutcome", "OperationOutcome"),
+        ]:
+            with self.subTest(prefer=prefer):
+                instance = self.instance()
+                instance.to_fhir.reset_mock()
+                content, ret_headers = write_response(
+                    instance, self.query(prefer), "created"
+                )
+                self.assertEqual(ret_headers, headers)
+                self.assertEqual(instance.to_fhir.called, expected == "Patient")
+                self.assertEqual(content and content["resourceType"], expected)
+
+
 class TestPostRequestHandler(unittest.TestCase):
     def test_request_body_to_resource(self):
         handler = PostRequestHandler()
@@ -292,8 +597,8 @@ class TestPostRequestHandler(unittest.TestCase):
 
         self.assertEqual(e.exception.status_code, 422)
 
-    @patch("fhirbug.Fhir.resources")
-    def test_handle_success(self, resourcesMock):
+    @patch("fhirbug.server.requesthandlers.get_registry")
+    def test_handle_success(self, registryMock):
         handler = PostRequestHandler()
         handler.parse_url = Mock()
         handler.query = Mock()
@@ -302,6 +607,10 @@ class TestPostRequestHandler(unittest.TestCase):
         handler.get_resource = Mock()
         handler.request_body_to_resource = Mock()
         handler.create = Mock()
+        handler.create().to_fhir().as_json.return_value = {
+            "resourceType": "Patient",
+            "id": "1",
+        }
 
         handler.log_request = Mock()
 
@@ -311,7 +620,7 @@ class TestPostRequestHandler(unittest.TestCase):
         handler.parse_url.assert_called_with(urlMock, None)
         handler._audit_request.assert_called_with(handler.query)
         handler.import_models.assert_called_once()
-        handler.get_resource.assert_called_with(resourcesMock)
+        handler.get_resource.assert_called_with(registryMock().resources)
         handler.create.assert_called_with(
             handler.get_resource(), handler.request_body_to_resource()
         )
@@ -358,8 +667,8 @@ class TestPutRequestHandler(unittest.TestCase):
 
         self.assertEqual(e.exception.status_code, 422)
 
-    @patch("fhirbug.Fhir.resources")
-    def test_handle_success(self, resourcesMock):
+    @patch("fhirbug.server.requesthandlers.get_registry")
+    def test_handle_success(self, registryMock):
         handler = PutRequestHandler()
         handler.parse_url = Mock()
         handler.query = Mock()
@@ -368,6 +677,10 @@ class TestPutRequestHandler(unittest.TestCase):
         handler.get_resource = Mock()
         handler.request_body_to_resource = Mock()
         handler.update = Mock()
+        handler.update().to_fhir().as_json.return_value = {
+            "resourceType": "Patient",
+            "id": "1",
+        }
 
         handler.log_request = Mock()
 
@@ -377,7 +690,7 @@ class TestPutRequestHandler(unittest.TestCase):
         handler.parse_url.assert_called_with(urlMock, None)
         handler._audit_request.assert_called_with(handler.query)
         handler.import_models.assert_called_once()
-        handler.get_resource.assert_called_with(resourcesMock)
+        handler.get_resource.assert_called_with(registryMock().resources)
         handler.update.assert_called_with(
             handler.get_resource()._get_item_from_pk(),
             handler.request_body_to_resource(),
@@ -387,6 +700,33 @@ class TestPutRequestHandler(unittest.TestCase):
         self.assertEqual(ret, handler.update().to_fhir().as_json())
         self.assertEqual(status, 202)
 
+    @patch("fhirbug.server.requesthandlers.get_registry")
+    def test_handle_unchanged(self, registryMock):
+        """
+        Updates that change nothing leave the caches alone
+        """
+        for changed, invalidated in [(set(), False), ({"active"}, True)]:
+            with self.subTest(changed=changed):
+                handler = PutRequestHandler()
+                handler.parse_url = Mock()
+                handler.query = Mock()
+                handler._audit_request = Mock()
+                handler.import_models = Mock()
+                handler.get_resource = Mock()
+                handler.request_body_to_resource = Mock()
+                handler.update = Mock()
+                handler.update()._changed_attributes = changed
+                handler.update().to_fhir().as_json.return_value = {
+                    "resourceType": "Patient"
+                }
+                handler.invalidate_cache = Mock()
+                handler.log_request = Mock()
+
+                ret, status = handler.handle("Patient/1", Mock())
+
+                self.assertEqual(status, 202)
+                self.assertEqual(handler.invalidate_cache.called, invalidated)
+
     def test_handle_failure(self):
         handler = PutRequestHandler()
         handler.query = Mock()
@@ -432,6 +772,62 @@ class TestPutRequestHandler(unittest.TestCase):
         )
 
 
+class TestPatchRequestHandler(unittest.TestCase):
+    def handler(self):
+        from fhirbug.Fhir.resources import Patient
+
+        handler = PatchRequestHandler()
+        handler.parse_url = Mock()
+        handler.query = Mock()
+        handler._audit_request = Mock()
+        handler.import_models = Mock()
+        handler.log_request = Mock()
+        self.instance = Mock()
+        self.instance.to_fhir().as_json.return_value = {
+            "resourceType": "Patient",
+            "id": "1",
+            "gender": "male",
+        }
+        patched = self.instance.patch_from_resource.return_value
+        patched.to_fhir.return_value.as_json.return_value = {
+            "resourceType": "Patient",
+            "id": "1",
+        }
+        Model = Mock(**{"_get_item_from_pk.return_value": self.instance})
+        # The mapping first, then the resource class
+        handler.get_resource = Mock(side_effect=[Model, Patient])
+        return handler
+
+    @patch("fhirbug.server.requesthandlers.get_registry")
+    def test_handle(self, registryMock):
+        handler = self.handler()
+        ret, status = handler.handle(
+            "Patient/1", [{"op": "replace", "path": "/gender", "value": "female"}]
+        )
+
+        self.assertEqual(status, 200)
+        resource, elements = self.instance.patch_from_resource.call_args[0]
+        self.assertEqual(resource.gender, "female")
+        self.assertEqual(elements, ["gender"])
+        self.assertEqual(ret, self.instance.patch_from_resource().to_fhir().as_json())
+        self.assertEqual(handler.log_request.call_args[1]["method"], "PATCH")
+
+    @patch("fhirbug.server.requesthandlers.get_registry")
+    def test_handle_errors(self, registryMock):
+        for body, expected in [
+            ({"op": "replace"}, 400),
+            ([{"op": "remove", "path": "/birthDate"}], 422),
+            ([{"op": "replace", "path": "/id", "value": "2"}], 422),
+            ([{"op": "replace", "path": "/gender", "value": 1}], 422),
+        ]:
+            with self.subTest(body=body):
+                handler = self.handler()
+                ret, status = handler.handle("Patient/1", body)
+                self.assertEqual(status, expected)
+                self.instance.patch_from_resource.assert_not_called()
+                handler.log_request.assert_called_once()
+
+
 class TestDeleteRequestHandler(unittest.TestCase):
     def test_handle(self):
         handler = DeleteRequestHandler()
@@ -440,7 +836,6 @@ class TestDeleteRequestHandler(unittest.TestCase):
         handler._audit_request = Mock()
         handler.import_models = Mock()
         handler.get_resource = Mock()
-        handler.get_resource()._delete_item = Mock()
         handler.log_request = Mock()
 
         urlMock = Mock()
@@ -454,6 +849,9 @@ class TestDeleteRequestHandler(unittest.TestCase):
         handler.get_resource()._get_item_from_pk.assert_called_with(
             handler.query.resourceId
         )
+        handler.get_resource().delete_item.assert_called_with(
+            handler.get_resource()._get_item_from_pk(), handler.query
+        )
         handler.log_request.assert_called_once()
 
         self.assertEqual(
@@ -500,3 +898,225 @@ class TestDeleteRequestHandler(unittest.TestCase):
                 "resourceType": "OperationOutcome",
             },
         )
+
+
+class TestConditionalRequests(unittest.TestCase):
+    def handler(self, Handler, url, headers={}, matches=()):
+        handler = Handler()
+        handler.query = parse_url(url)
+        handler.query.context = SimpleNamespace(headers=headers)
+        handler.parse_url = Mock()
+        handler._audit_request = Mock()
+        handler.import_models = Mock()
+        handler.log_request = Mock()
+        self.Model = Mock(**{"conditional_matches.return_value": list(matches)})
+        self.Model.create_from_resource().to_fhir().as_json.return_value = {
+            "resourceType": "Patient",
+            "id": "2",
+        }
+        handler.get_resource = Mock(return_value=self.Model)
+        handler.request_body_to_resource = Mock(return_value=SimpleNamespace(id=None))
+        return handler
+
+    @patch("fhirbug.server.requesthandlers.get_registry")
+    def test_conditional_create(self, registryMock):
+        """
+        Resources are not created if the criteria of If-None-Exist match one
+        """
+        existing = Mock()
+        existing.to_fhir().as_json.return_value = {"resourceType": "Patient", "id": "1"}
+        handler = self.handler(
+            PostRequestHandler,
+            "Patient",
+            {"if-none-exist": "identifier=123"},
+            [existing],
+        )
+        ret, status = handler.handle("Patient", {})
+        self.assertEqual(status, 200)
+        self.assertEqual(handler.response_headers["Location"], "Patient/1")
+        query = self.Model.conditional_matches.call_args[0][0]
+        self.assertEqual(query.search_params, {"identifier": ["123"]})
+        self.Model.create_from_resource.assert_called_once_with()
+
+        handler = self.handler(
+            PostRequestHandler, "Patient", {"if-none-exist": "identifier=123"}
+        )
+        ret, status = handler.handle("Patient", {})
+        self.assertEqual(status, 201)
+
+    @patch("fhirbug.server.requesthandlers.get_registry")
+    def test_conditional_update(self, registryMock):
+        """
+        Conditional updates update the only match or create the resource
+        """
+        handler = self.handler(PutRequestHandler, "Patient?identifier=123")
+        ret, status = handler.handle("Patient?identifier=123", {})
+        self.assertEqual(status, 201)
+        self.Model._get_item_from_pk.assert_not_called()
+
+        existing = Mock()
+        existing.update_from_resource().to_fhir().as_json.return_value = {
+            "resourceType": "Patient",
+            "id": "1",
+        }
+        for matches, expected in [([existing], 202), ([existing, existing], 412)]:
+            with self.subTest(matches=len(matches)):
+                handler = self.handler(
+                    PutRequestHandler, "Patient?identifier=123", matches=matches
+                )
+                ret, status = handler.handle("Patient?identifier=123", {})
+                self.assertEqual(status, expected)
+
+    @patch("fhirbug.server.requesthandlers.get_registry")
+    @patch("fhirbug.models.cache.invalidate")
+    def test_conditional_update_invalidates_match(self, invalidate, registryMock):
+        """
+        The cached reads of the resource a conditional update matched are invalidated
+        """
+        existing = Mock()
+        existing.update_from_resource().Fhir.id = "1"
+        existing.update_from_resource().to_fhir().as_json.return_value = {
+            "resourceType": "Patient",
+            "id": "1",
+        }
+        handler = self.handler(
+            PutRequestHandler, "Patient?identifier=123", matches=[existing]
+        )
+        handler.handle("Patient?identifier=123", {})
+        invalidate.assert_called_once_with(self.Model, "1")
+
+    @patch("fhirbug.server.requesthandlers.settings")
+    def test_conditional_delete(self, settingsMock):
+        settingsMock.UNIT_OF_WORK = False
+        settingsMock.CONDITIONAL_DELETE = "single"
+        existing = Mock()
+        handler = self.handler(
+            DeleteRequestHandler, "Patient?identifier=123", matches=[existing]
+        )
+        ret, status = handler.handle("Patient?identifier=123")
+        self.assertEqual(status, 200)
+        self.Model.delete_item.assert_called_once_with(existing, handler.query)
+        self.Model.delete_matches.assert_not_called()
+
+        # Deleting the match is authorized like a DELETE of its id
+        handler = self.handler(
+            DeleteRequestHandler, "Patient?identifier=123", matches=[existing]
+        )
+        self.Model.delete_item.side_effect = AuthorizationError(Mock())
+        ret, status = handler.handle("Patient?identifier=123")
+        self.assertEqual(status, 403)
+
+        handler = self.handler(
+            DeleteRequestHandler, "Patient?identifier=123", matches=[existing] * 2
+        )
+        ret, status = handler.handle("Patient?identifier=123")
+        self.assertEqual(status, 412)
+
+        settingsMock.CONDITIONAL_DELETE = "multiple"
+        handler = self.handler(DeleteRequestHandler, "Patient?identifier=123")
+        ret, status = handler.handle("Patient?identifier=123")
+        self.assertEqual(status, 200)
+        self.Model.delete_matches.assert_called_once_with(handler.query)
+        self.Model.conditional_matches.assert_not_called()
+
+
+@patch("fhirbug.server.requesthandlers.import_backend")
+class TestUnitOfWork(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        patcher = patch("fhirbug.server.requesthandlers.settings")
+        self.settings = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.settings.UNIT_OF_WORK = True
+        self.settings.DEBUG = False
+
+    def atomic(self, commit_error=None):
+        @contextmanager
+        def atomic():
+            self.events.append("begin")
+            yield
+            if commit_error:
+                raise commit_error
+            self.events.append("commit")
+
+        return atomic
+
+    def delete_handler(self):
+        handler = DeleteRequestHandler()
+        handler.parse_url = Mock()
+        handler.query = Mock()
+        handler._audit_request = Mock()
+        handler.import_models = Mock()
+        handler.get_resource = Mock()
+        handler.get_resource().delete_item = Mock(
+            side_effect=lambda item, query: self.events.append("delete")
+        )
+        handler.log_request = Mock()
+        return handler
+
+    def test_disabled(self, import_backendMock):
+        """
+        Writes are committed as they are made by default
+        """
+        self.settings.UNIT_OF_WORK = False
+        import_backendMock().AbstractBaseModel.atomic = self.atomic()
+        ret, status = self.delete_handler().handle(Mock())
+        self.assertEqual(status, 200)
+        self.assertEqual(self.events, ["delete"])
+
+    def test_commit_once(self, import_backendMock):
+        import_backendMock().AbstractBaseModel.atomic = self.atomic()
+        handler = self.delete_handler()
+        ret, status = handler.handle(Mock())
+        self.assertEqual(status, 200)
+        self.assertEqual(self.events, ["begin", "delete", "commit"])
+
+    def test_commit_failure(self, import_backendMock):
+        """
+        Errors while committing are returned as OperationOutcomes
+        """
+        import_backendMock().AbstractBaseModel.atomic = self.atomic(
+            commit_error=Exception("constraint failed")
+        )
+        handler = self.delete_handler()
+        ret, status = handler.handle(Mock())
+        self.assertEqual(status, 422)
+        self.assertEqual(ret["issue"][0]["diagnostics"], "constraint failed")
+        handler.log_request.assert_called_once()
+        self.assertEqual(handler.log_request.call_args[1]["status"], 422)
+
+
+@patch("fhirbug.server.requesthandlers.import_backend")
+class TestAsyncRequestHandlers(unittest.TestCase):
+    def test_handle(self, import_backendMock):
+        """
+        Async handlers should return the result of the synchronous handler
+        and close the db session of the thread it ran in
+        """
+        with patch.object(GetRequestHandler, "handle", return_value=({}, 200)) as handle:
+            result = asyncio.run(AsyncGetRequestHandler().handle("Patient", "context"))
+        handle.assert_called_with("Patient", "context")
+        self.assertEqual(result, ({}, 200))
+        import_backendMock.assert_called_with("models")
+        import_backendMock().AbstractBaseModel._close_thread_session.assert_called()
+
+    def test_request_context_is_isolated(self, import_backendMock):
+        """
+        Concurrent requests should not see each other's request context
+        """
+
+        def handle(self, url, query_context=None):
+            register_request_context(url)
+            return get_request_context()
+
+        async def main():
+            handler = AsyncGetRequestHandler()
+            return await asyncio.gather(
+                *[handler.handle(f"Patient/{i}") for i in range(10)]
+            )
+
+        register_request_context("main")
+        with patch.object(GetRequestHandler, "handle", handle):
+            results = asyncio.run(main())
+        self.assertEqual(results, [f"Patient/{i}" for i in range(10)])
+        self.assertEqual(get_request_context(), "main")
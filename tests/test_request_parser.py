@@ -4,6 +4,9 @@ from fhirbug.server.requestparser import (
     split_join,
     generate_query_string,
     FhirRequestQuery,
+    parse_chained_param,
+    parse_reverse_chained_param,
+    validate_params,
 )
 from fhirbug.exceptions import QueryValidationError
 
@@ -83,6 +86,27 @@ class TestUrlParsing(unittest.TestCase):
         self.assertEquals(query.operation, "_search")
 
 
+class TestCompartmentParsing(unittest.TestCase):
+    def test_compartment(self):
+        url = "Patient/123/Observation?code=1234"
+        query = parse_url(url)
+        self.assertEqual(query.resource, "Observation")
+        self.assertEqual(query.resourceId, None)
+        self.assertEqual(query.operation, None)
+        self.assertEqual(query.compartment, ("Patient", "123"))
+        self.assertEqual(query.search_params, {"code": ["1234"]})
+
+    def test_compartment_all_types(self):
+        query = parse_url("Patient/123/*")
+        self.assertEqual(query.resource, "*")
+        self.assertEqual(query.compartment, ("Patient", "123"))
+
+    def test_not_compartment(self):
+        for url in ["Patient/123/_history", "Patient/123/$everything", "Patient/123", "Patient"]:
+            query = parse_url(url)
+            self.assertEqual(query.compartment, None)
+
+
 class TestParameterParsing(unittest.TestCase):
     def test_modifiers(self):
         url = "Patient?_count=12"
@@ -126,3 +150,73 @@ class TestParameterParsing(unittest.TestCase):
             query.modifiers, {"_count": ["12"], "_include": ["Observation:Subject"]}
         )
         self.assertEquals(query.search_params, {"subject.name": ["John"]})
+
+
+class TestChainedParameters(unittest.TestCase):
+    def test_parse_chained_param(self):
+        self.assertEqual(
+            parse_chained_param("subject:Patient.name"), ("subject", "Patient", "name")
+        )
+        self.assertEqual(parse_chained_param("subject.name"), ("subject", None, "name"))
+        self.assertEqual(
+            parse_chained_param("subject.name:exact"), ("subject", None, "name:exact")
+        )
+        self.assertIsNone(parse_chained_param("name:exact"))
+        self.assertIsNone(parse_chained_param("name"))
+
+    def test_parse_reverse_chained_param(self):
+        self.assertEqual(
+            parse_reverse_chained_param("_has:Observation:subject:code"),
+            ("Observation", "subject", "code"),
+        )
+        self.assertIsNone(parse_reverse_chained_param("_has:Observation:subject"))
+        self.assertIsNone(parse_reverse_chained_param("_count"))
+
+    def test_query_chained_params(self):
+        url = "Observation?subject:Patient.name=smith&code=1"
+        query = parse_url(url)
+        self.assertEqual(
+            query.search_params, {"subject:Patient.name": ["smith"], "code": ["1"]}
+        )
+        self.assertEqual(
+            query.chained_params, {"subject:Patient.name": ("subject", "Patient", "name")}
+        )
+        self.assertEqual(query.reverse_chained_params, {})
+
+    def test_query_reverse_chained_params(self):
+        url = "Patient?_has:Observation:subject:code=1234-5"
+        query = parse_url(url)
+        self.assertEqual(query.modifiers, {"_has:Observation:subject:code": ["1234-5"]})
+        self.assertEqual(
+            query.reverse_chained_params,
+            {"_has:Observation:subject:code": ("Observation", "subject", "code")},
+        )
+        self.assertEqual(query.chained_params, {})
+
+
+class TestValidateParams(unittest.TestCase):
+    def test_names(self):
+        for url in [
+            "Patient?name:exact=Jo",
+            "Observation?subject:Patient=1",
+            "Observation?subject:Patient.name:contains=Jo",
+            "Patient?_has:Observation:subject:code=1234-5",
+            "Patient?_count=10&search-offset=11",
+        ]:
+            parse_url(url)
+        for url in ["Patient?name:=Jo", "Patient?na%20me=Jo", "Patient?name:a:b=Jo"]:
+            with self.assertRaises(QueryValidationError):
+                parse_url(url)
+
+    def test_count_and_offset(self):
+        """
+        ``_count`` and ``search-offset`` are used for paginating so they must be
+        positive integers
+        """
+        for params in [
+            {"modifiers": {"_count": ["0"]}, "search_params": {}},
+            {"modifiers": {"_count": ["ten"]}, "search_params": {}},
+            {"modifiers": {}, "search_params": {"search-offset": ["-1"]}},
+        ]:
+            with self.assertRaises(QueryValidationError):
+                validate_params(params)
@@ -0,0 +1,218 @@
+import json
+import unittest
+from datetime import datetime
+from unittest.mock import patch, mock_open
+
+from fhirbug.exceptions import (
+    ConfigurationError,
+    MappingValidationError,
+    QueryValidationError,
+)
+from fhirbug.models import search_index
+from . import models
+
+SEARCH_PARAMETERS = {
+    "resourceType": "Bundle",
+    "entry": [
+        {
+            "resource": {
+                "code": "code",
+                "type": "token",
+                "base": ["Observation", "Condition"],
+                "expression": "Condition.code | Observation.code",
+            }
+        },
+        {
+            "resource": {
+                "code": "date",
+                "type": "date",
+                "base": ["Observation"],
+                "expression": "Observation.effective",
+            }
+        },
+        {
+            "resource": {
+                "code": "value-quantity",
+                "type": "quantity",
+                "base": ["Observation"],
+                "expression": "(Observation.value as Quantity)",
+            }
+        },
+        {
+            "resource": {
+                "code": "patient",
+                "type": "reference",
+                "base": ["Observation"],
+                "expression": "Observation.subject.where(resolve() is Patient)",
+            }
+        },
+        {
+            "resource": {
+                "code": "note",
+                "type": "string",
+                "base": ["Observation"],
+                "expression": "Observation.note",
+            }
+        },
+        {
+            "resource": {
+                "code": "code-value-quantity",
+                "type": "composite",
+                "base": ["Observation"],
+                "expression": "Observation",
+            }
+        },
+    ],
+}
+
+
+class TestSearchParameters(unittest.TestCase):
+    def setUp(self):
+        search_index._search_parameters = None
+        search_index._search_parameter_types = None
+
+    def tearDown(self):
+        search_index._search_parameters = None
+        search_index._search_parameter_types = None
+
+    @patch("fhirbug.models.search_index.settings")
+    def test_search_parameters_requires_setting(self, settingsMock):
+        settingsMock.SEARCH_PARAMETERS_PATH = None
+        with self.assertRaises(ConfigurationError):
+            search_index.search_parameters()
+
+    @patch("fhirbug.models.search_index.settings")
+    def test_search_parameters(self, settingsMock):
+        """
+        Definitions should be grouped by base resource and unsupported types skipped
+        """
+        settingsMock.SEARCH_PARAMETERS_PATH = "search-parameters.json"
+        with patch("builtins.open", mock_open(read_data=json.dumps(SEARCH_PARAMETERS))):
+            definitions = search_index.search_parameters()
+        self.assertEqual(
+            definitions["Condition"], {"code": ("token", [[("code", None, None)]])}
+        )
+        self.assertEqual(
+            set(definitions["Observation"]),
+            {"code", "date", "value-quantity", "patient", "note"},
+        )
+        with self.assertRaises(QueryValidationError):
+            search_index.get_search_parameter("Observation", "code-value-quantity")
+
+    @patch("fhirbug.models.search_index.settings")
+    def test_search_parameter_types(self, settingsMock):
+        """
+        The types of all parameters should be loaded, including the ones that can not
+        be indexed, and none without the setting
+        """
+        settingsMock.SEARCH_PARAMETERS_PATH = None
+        self.assertEqual(search_index.search_parameter_types(), {})
+
+        search_index._search_parameter_types = None
+        settingsMock.SEARCH_PARAMETERS_PATH = "search-parameters.json"
+        with patch("builtins.open", mock_open(read_data=json.dumps(SEARCH_PARAMETERS))):
+            types = search_index.search_parameter_types()
+        self.assertEqual(types["Condition"], {"code": "token"})
+        self.assertEqual(types["Observation"]["code-value-quantity"], "composite")
+        self.assertEqual(types["Observation"]["value-quantity"], "quantity")
+
+
+class TestExtractIndexValues(unittest.TestCase):
+    def setUp(self):
+        settings_patch = patch("fhirbug.models.search_index.settings")
+        self.addCleanup(settings_patch.stop)
+        settings_patch.start().SEARCH_PARAMETERS_PATH = "search-parameters.json"
+        with patch("builtins.open", mock_open(read_data=json.dumps(SEARCH_PARAMETERS))):
+            search_index._search_parameters = None
+            search_index.search_parameters()
+
+    def tearDown(self):
+        search_index._search_parameters = None
+
+    def test_extract_index_values(self):
+        resource = {
+            "resourceType": "Observation",
+            "code": {
+                "coding": [
+                    {"system": "http://loinc.org", "code": "1234-5"},
+                    {"code": "abc"},
+                ]
+            },
+            "effectivePeriod": {"start": "2012-01-01"},
+            "valueQuantity": {"value": 5, "unit": "mg"},
+            "subject": {"reference": "http://example.com/fhir/Patient/1"},
+            "note": [{"text": "Fasting  Sample"}],
+        }
+        rows = search_index.extract_index_values(
+            resource, ["code", "date", "value-quantity", "patient", "note"]
+        )
+        self.assertEqual(
+            rows["token"],
+            [
+                {"param": "code", "system": "http://loinc.org", "code": "1234-5"},
+                {"param": "code", "system": None, "code": "abc"},
+            ],
+        )
+        self.assertEqual(
+            rows["date"],
+            [{"param": "date", "low": datetime(2012, 1, 1), "high": datetime.max}],
+        )
+        self.assertEqual(
+            rows["quantity"],
+            [{"param": "value-quantity", "value": 5.0, "system": None, "code": "mg"}],
+        )
+        self.assertEqual(rows["reference"], [{"param": "patient", "target": "Patient/1"}])
+        self.assertEqual(
+            rows["string"],
+            [{"param": "note", "value": "fasting sample", "exact": "Fasting  Sample"}],
+        )
+
+    def test_extract_index_values_filters_references(self):
+        resource = {"resourceType": "Observation", "subject": {"reference": "Group/1"}}
+        rows = search_index.extract_index_values(resource, ["patient"])
+        self.assertEqual(rows["reference"], [])
+
+    def test_extract_index_values_unknown_parameter(self):
+        with self.assertRaises(ConfigurationError):
+            search_index.extract_index_values({"resourceType": "Condition"}, ["date"])
+
+
+class TestIndexedParameters(unittest.TestCase):
+    def test_indexed_parameters(self):
+        """
+        Parameters with an indexed searcher should be named after the searcher or the attribute
+        """
+
+        def searcher():
+            pass
+
+        def named_searcher():
+            pass
+
+        searcher.indexed_parameter = None
+        named_searcher.indexed_parameter = "value-quantity"
+        searchables = {"code": searcher, "value_quantity": named_searcher, "id": len}
+        with patch.object(
+            models.WithSearcher, "searchables", return_value=searchables
+        ):
+            self.assertEqual(
+                models.WithSearcher._indexed_parameters(), ["code", "value-quantity"]
+            )
+
+    def test_indexed_parameters_with_regex(self):
+        """
+        Indexed searchers declared with a search_regex must name their parameter
+        """
+
+        def searcher():
+            pass
+
+        searcher.indexed_parameter = None
+        searchables = {r"(family|given)(:\w*)?": searcher}
+        with patch.object(
+            models.WithSearcher, "searchables", return_value=searchables
+        ):
+            with self.assertRaises(MappingValidationError):
+                models.WithSearcher._indexed_parameters()
+            searcher.indexed_parameter = "name"
+            self.assertEqual(models.WithSearcher._indexed_parameters(), ["name"])
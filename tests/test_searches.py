@@ -247,6 +247,46 @@ class TestSQLAlchemyDate(unittest.TestCase):
         )
 
 
+class TestSQLAlchemyChained(unittest.TestCase):
+    @patch("fhirbug.db.backends.SQLAlchemy.searches.inspect")
+    def test_chained_search(self, inspectMock):
+        """
+        ChainedSearch should apply the search on the target and use it as a subquery
+        """
+        column = Mock()
+        cls = SimpleNamespace(ref_id=column)
+        target_cls = Mock()
+        sql_query = Mock()
+        search = searches_sqla.ChainedSearch("ref_id", target_cls)
+        search(cls, "name", "bob", sql_query, "query")
+
+        target_cls.apply_search.assert_called_with(
+            "name", "bob", target_cls._get_orm_query(), "query"
+        )
+        pk = inspectMock(target_cls).primary_key[0]
+        target_cls.apply_search().with_entities.assert_called_with(pk)
+        column.in_.assert_called_with(target_cls.apply_search().with_entities())
+        sql_query.filter.assert_called_with(column.in_())
+
+    @patch("fhirbug.db.backends.SQLAlchemy.searches.inspect")
+    def test_reverse_chained_search(self, inspectMock):
+        """
+        ReverseChainedSearch should filter by the references of the matching sources
+        """
+        source_cls = Mock()
+        sql_query = Mock()
+        search = searches_sqla.ReverseChainedSearch(source_cls, "ref_id")
+        search("cls", "code", "123", sql_query, "query")
+
+        source_cls.apply_search.assert_called_with(
+            "code", "123", source_cls._get_orm_query(), "query"
+        )
+        source_cls.apply_search().with_entities.assert_called_with(source_cls.ref_id)
+        pk = inspectMock("cls").primary_key[0]
+        pk.in_.assert_called_with(source_cls.apply_search().with_entities())
+        sql_query.filter.assert_called_with(pk.in_())
+
+
 ###
 # Django
 ###
@@ -596,6 +636,50 @@ class TestPyModmDate(unittest.TestCase):
         )
 
 
+class TestPyModmFullText(unittest.TestCase):
+    @patch("fhirbug.db.backends.pymodm.fulltext.search")
+    def test_fulltext_search(self, searchMock):
+        """
+        FullTextSearch should search the index field it was created for
+        """
+        search = searches_pymodm.FullTextSearch("text")
+        self.assertEqual(search.fulltext_field, "text")
+        res = search("cls", "_text", "glucose", "sql_query", "query")
+        searchMock.assert_called_with("cls", "text", "glucose", "sql_query")
+        self.assertEqual(res, searchMock())
+
+    @patch("fhirbug.db.backends.pymodm.fulltext.get_collection")
+    def test_fulltext_index_search(self, get_collectionMock):
+        """
+        The ids of the best matches of the index should be used in an $in filter
+        """
+        from fhirbug.db.backends.pymodm import fulltext
+
+        cls = Mock()
+        cls._get_resource_cls().__name__ = "Observation"
+        find = get_collectionMock().find
+        find().sort().limit.return_value = [{"resource_id": 1}, {"resource_id": 2}]
+        sql_query = Mock()
+        fulltext.search(cls, "content", "glucose", sql_query)
+
+        find.assert_called_with(
+            {
+                "resource_type": "Observation",
+                "field": "content",
+                "$text": {"$search": "glucose"},
+            },
+            {"resource_id": True, "score": {"$meta": "textScore"}},
+        )
+        find().sort().limit.assert_called_with(fulltext.settings.FULLTEXT_MAX_RESULTS)
+        sql_query.raw.assert_called_with({"_id": {"$in": [1, 2]}})
+
+    def test_fulltext_index_search_invalid_field(self):
+        from fhirbug.db.backends.pymodm import fulltext
+
+        with self.assertRaises(ValueError):
+            fulltext.search("cls", "div", "glucose", "sql_query")
+
+
 class TestUtils(unittest.TestCase):
     def test_transform_date(self):
         from fhirbug.utils import transform_date
@@ -0,0 +1,152 @@
+import unittest
+from unittest.mock import patch
+
+from fhirbug.exceptions import QueryValidationError, UnsupportedParameterError
+from fhirbug.models.mixins import FhirAbstractBaseMixin, FhirBaseModelMixin
+from fhirbug.models.attributes import Attribute
+from fhirbug.models.validation import SearchValidator, search_validator
+from fhirbug.server.requestparser import parse_url
+
+
+def searcher(search_type=None):
+    def search(cls, field_name, value, sql_query, query):
+        return sql_query
+
+    if search_type:
+        search.search_type = search_type
+    return search
+
+
+def indexed(cls, field_name, value, sql_query, query):
+    return sql_query
+
+
+indexed.indexed_parameter = "subject"
+
+
+SEARCHABLES = {
+    "name": searcher("string"),
+    "birthdate": searcher("date"),
+    "length": searcher("number"),
+    "value-quantity": searcher("quantity"),
+    "code": searcher(),
+    "patient": indexed,
+    r"(family|given)(:\w*)?": searcher("string"),
+}
+
+
+class TestSearchValidator(unittest.TestCase):
+    def setUp(self):
+        self.validator = SearchValidator(
+            "Observation", SEARCHABLES, {"code": "token", "subject": "reference"}
+        )
+
+    def test_types(self):
+        """
+        Types are read from the searchers, or the definitions of their parameters
+        """
+        self.assertEqual(self.validator.parameter_type("name:exact"), "string")
+        self.assertEqual(self.validator.parameter_type("code"), "token")
+        self.assertEqual(self.validator.parameter_type("patient"), "reference")
+        self.assertEqual(self.validator.parameter_type("given:contains"), "string")
+        self.assertEqual(self.validator.parameter_type("birthdate"), "date")
+        self.assertEqual(
+            self.validator.parameters,
+            {
+                "name": "string",
+                "birthdate": "date",
+                "length": "number",
+                "value-quantity": "quantity",
+                "code": "token",
+                "patient": "reference",
+            },
+        )
+
+    def test_unsupported(self):
+        """
+        Parameters are matched by their whole name, not just a prefix of it
+        """
+        for name in ["nam", "names", "familyname", "status"]:
+            with self.assertRaises(UnsupportedParameterError):
+                self.validator.parameter_type(name)
+
+    def test_modifiers(self):
+        self.validator.check("name:contains", ["Jo"])
+        self.validator.check("patient:Patient", ["1"])
+        for name in ["name:missing", "birthdate:exact", "patient:identifier"]:
+            with self.assertRaises(UnsupportedParameterError):
+                self.validator.check(name, ["1"])
+
+    def test_values(self):
+        valid = {
+            "birthdate": ["2012", "ge2012-03", "lt2012-03-04T10:00:00+02:00"],
+            "length": ["12", "gt1.5", "ap-3e2"],
+            "value-quantity": ["5.4", "le5.4|http://unitsofmeasure.org|mg", "5|mg"],
+            "code": ["http://loinc.org|1234-5"],
+        }
+        for name, values in valid.items():
+            self.validator.check(name, values)
+        invalid = {
+            "birthdate": "2012-3",
+            "length": "twelve",
+            "value-quantity": "xx5.4",
+        }
+        for name, value in invalid.items():
+            with self.assertRaises(QueryValidationError) as context:
+                self.validator.check(name, [value])
+            self.assertNotIsInstance(context.exception, UnsupportedParameterError)
+
+    def test_validate_strict(self):
+        query = parse_url("Observation?nme=Jo&birthdate=2012")
+        with self.assertRaises(UnsupportedParameterError):
+            self.validator.validate(query, strict=True)
+        self.assertIn("nme", query.search_params)
+
+    def test_validate_lenient(self):
+        """
+        Unsupported parameters are removed from the query, while chained parameters
+        and the ones that control the results are left alone
+        """
+        query = parse_url(
+            "Observation?nme=Jo&name:foo=Jo&subject.name=Jo&_lastUpdated=2012"
+            "&_has:Provenance:target:agent=1&_count=10&search-offset=11&code=1"
+        )
+        ignored = self.validator.validate(query)
+        self.assertEqual(ignored, ["nme", "name:foo", "_lastUpdated"])
+        self.assertEqual(
+            query.search_params,
+            {"subject.name": ["Jo"], "search-offset": ["11"], "code": ["1"]},
+        )
+        self.assertEqual(
+            query.modifiers,
+            {"_has:Provenance:target:agent": ["1"], "_count": ["10"]},
+        )
+
+    def test_invalid_values_are_always_refused(self):
+        query = parse_url("Observation?birthdate=yesterday")
+        with self.assertRaises(QueryValidationError):
+            self.validator.validate(query)
+
+
+class Mapping(FhirAbstractBaseMixin, FhirBaseModelMixin):
+    __Resource__ = "Observation"
+
+    class FhirMap:
+        code = Attribute("code", searcher=searcher("token"))
+        status = Attribute("status")
+
+
+class TestSearchValidatorOfModel(unittest.TestCase):
+    @patch("fhirbug.models.validation.search_parameter_types", return_value={})
+    def test_search_validator(self, search_parameter_types):
+        """
+        Mappings that are not in the registry get a validator of their searchers
+        """
+        validator = search_validator(Mapping)
+        self.assertEqual(validator.resource_type, "Observation")
+        self.assertEqual(validator.parameters, {"code": "token"})
+
+        query = parse_url("Observation?code=1&status=final")
+        self.assertEqual(Mapping.validate_search(query), ["status"])
+        with self.assertRaises(UnsupportedParameterError):
+            Mapping.validate_search(parse_url("Observation?status=final"), strict=True)
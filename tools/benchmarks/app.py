@@ -0,0 +1,126 @@
+"""
+Compare the built-in WSGI application with the Flask glue of
+``examples/pymodm_autogenerated/flask_app.py``, serving the same mappings
+from a SQLite database. Requests are made in process, so only the
+time spent in the applications is measured.
+
+Usage: python tools/benchmarks/app.py [--requests 200] [--patients 100]
+"""
+import argparse
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from fhirbug.config import settings
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "benchmark.sqlite")
+settings.configure(
+    {
+        "DB_BACKEND": "SQLAlchemy",
+        "SQLALCHEMY_CONFIG": {"URI": f"sqlite:///{DB_PATH}"},
+        "MODELS_PATH": "__main__",
+        "MAX_BUNDLE_SIZE": 1000,
+    }
+)
+
+from sqlalchemy import Column, Integer, String
+from fhirbug.db.backends.SQLAlchemy.base import Base, engine, session
+from fhirbug.db.backends.SQLAlchemy.models import FhirBaseModel
+from fhirbug.db.backends.SQLAlchemy.searches import StringSearch
+from fhirbug.models.attributes import Attribute
+from fhirbug.server import GetRequestHandler
+from fhirbug.server.app import WSGIApplication
+
+
+class Patient(FhirBaseModel):
+    __tablename__ = "patients"
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+
+    class FhirMap:
+        id = Attribute(("id", str))
+        name = Attribute(
+            lambda i: [{"family": i._model.name, "given": ["John", "Paul"]}],
+            searcher=StringSearch("name"),
+        )
+
+
+def flask_app():
+    try:
+        import flask
+    except ImportError:
+        return None
+
+    app = flask.Flask(__name__)
+
+    @app.route("/r4/<path:path>", methods=["GET"])
+    def request(path):
+        url = flask.request.full_path[1:].partition("/")[2]
+        content, status = GetRequestHandler().handle(url, query_context=flask.request)
+        return flask.Response(json.dumps(content), status, mimetype="application/json")
+
+    return app
+
+
+def call(app, path, query_string):
+    environ = {
+        "REQUEST_METHOD": "GET",
+        "PATH_INFO": path,
+        "QUERY_STRING": query_string,
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "80",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(),
+        "wsgi.errors": sys.stderr,
+    }
+    status = []
+    start = time.perf_counter()
+    body = b"".join(app(environ, lambda s, headers, exc_info=None: status.append(s)))
+    elapsed = time.perf_counter() - start
+    assert status[0].startswith("200"), body
+    return elapsed
+
+
+def measure(name, app, path, query_string, requests):
+    call(app, path, query_string)
+    times = sorted(call(app, path, query_string) for _ in range(requests))
+    print(
+        f"{name:<8} {path + '?' + query_string:<36} {requests / sum(times):8.1f} req/s"
+        f"  p50 {statistics.median(times) * 1000:6.2f} ms"
+        f"  p95 {times[int(len(times) * 0.95)] * 1000:6.2f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--patients", type=int, default=100)
+    args = parser.parse_args()
+
+    Base.metadata.create_all(engine)
+    session.add_all(
+        [Patient(id=i, name=f"Smith {i}") for i in range(1, args.patients + 1)]
+    )
+    session.commit()
+
+    apps = [("fhirbug", WSGIApplication(prefix="/r4")), ("flask", flask_app())]
+    for path, query_string in [
+        ("/r4/Patient/1", ""),
+        ("/r4/Patient", f"_count={args.patients}"),
+    ]:
+        for name, app in apps:
+            if app is None:
+                print(f"{name:<8} not installed")
+                continue
+            measure(name, app, path, query_string, args.requests)
+
+
+if __name__ == "__main__":
+    main()
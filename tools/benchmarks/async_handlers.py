@@ -0,0 +1,106 @@
+"""
+Compare the throughput of the synchronous and the async request handlers.
+
+A file based SQLite database stands in for a real server. Every search calls a
+``delay()`` SQL function that sleeps for ``--latency`` seconds to simulate a slow
+query, so a blocked handler holds its thread without using the CPU.
+
+Usage: python tools/benchmarks/async_handlers.py [--requests 64] [--latency 0.02]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from fhirbug.config import settings
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "benchmark.sqlite")
+settings.configure(
+    {
+        "DB_BACKEND": "SQLAlchemy",
+        "SQLALCHEMY_CONFIG": {"URI": f"sqlite:///{DB_PATH}"},
+        "MODELS_PATH": "__main__",
+    }
+)
+
+from sqlalchemy import Column, Integer, String, event, func
+from fhirbug.db.backends.SQLAlchemy.base import Base, engine, session
+from fhirbug.db.backends.SQLAlchemy.models import FhirBaseModel
+from fhirbug.models.attributes import Attribute
+from fhirbug.server import GetRequestHandler, AsyncGetRequestHandler
+
+LATENCY = 0.02
+
+
+@event.listens_for(engine, "connect")
+def register_delay(connection, record):
+    def delay(value):
+        time.sleep(LATENCY)
+        return value
+
+    connection.create_function("delay", 1, delay)
+
+
+def slow_search(cls, field_name, value, sql_query, query):
+    return sql_query.filter(func.delay(cls.name) == value)
+
+
+class Patient(FhirBaseModel):
+    __tablename__ = "patients"
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+
+    class FhirMap:
+        id = Attribute(("id", str))
+        name = Attribute(lambda i: [{"family": i._model.name}], searcher=slow_search)
+
+
+def run_sync(urls):
+    handler = GetRequestHandler()
+    for url in urls:
+        handler.handle(url)
+
+
+async def run_async(urls, workers):
+    handler = AsyncGetRequestHandler()
+    handler.executor = ThreadPoolExecutor(max_workers=workers)
+    await asyncio.gather(*[handler.handle(url) for url in urls])
+    handler.executor.shutdown()
+
+
+def main():
+    global LATENCY
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--latency", type=float, default=0.02)
+    args = parser.parse_args()
+    LATENCY = args.latency
+
+    Base.metadata.create_all(engine)
+    session.add(Patient(id=1, name="smith"))
+    session.commit()
+    session.remove()
+    urls = ["Patient?name=smith"] * args.requests
+
+    start = time.perf_counter()
+    run_sync(urls)
+    baseline = time.perf_counter() - start
+    print(f"sync            {args.requests / baseline:8.1f} req/s")
+
+    for workers in [1, 2, 4, 8, 16]:
+        start = time.perf_counter()
+        asyncio.run(run_async(urls, workers))
+        elapsed = time.perf_counter() - start
+        print(
+            f"async {workers:>2} threads {args.requests / elapsed:8.1f} req/s"
+            f"  ({baseline / elapsed:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Compare loading an NDJSON file by creating each resource on its own with loading it
+with :class:`fhirbug.models.bulk_import.BulkImport`.
+
+``create_from_resource`` commits every resource, while the bulk import validates lines
+on a process pool and inserts them in batches with one commit each. A file based SQLite
+database is used so that commits are not free.
+
+Usage: python tools/benchmarks/bulk_import.py [--resources 5000] [--workers 2]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from fhirbug.config import settings
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "benchmark.sqlite")
+settings.configure(
+    {
+        "DB_BACKEND": "SQLAlchemy",
+        "SQLALCHEMY_CONFIG": {"URI": f"sqlite:///{DB_PATH}"},
+        "MODELS_PATH": "__main__",
+    }
+)
+
+from sqlalchemy import Column, Integer, String, Date
+from fhirbug.db.backends.SQLAlchemy.base import Base, engine, session
+from fhirbug.db.backends.SQLAlchemy.models import FhirBaseModel
+from fhirbug.Fhir.resources import Patient as PatientResource
+from fhirbug.models.attributes import Attribute, DateAttribute
+from fhirbug.models.bulk_import import BulkImport, peak_memory
+
+
+class Patient(FhirBaseModel):
+    __tablename__ = "patients"
+    id = Column(Integer, primary_key=True)
+    family = Column(String)
+    gender = Column(String)
+    birth_date = Column(Date)
+
+    class FhirMap:
+        id = Attribute(("id", str))
+        name = Attribute(
+            lambda i: [{"family": i.family}],
+            lambda i, value: setattr(i, "family", value[0].family),
+        )
+        gender = Attribute("gender", "gender")
+        birthDate = DateAttribute("birth_date")
+
+
+def write_file(path, count):
+    with open(path, "w") as f:
+        for index in range(count):
+            resource = {
+                "resourceType": "Patient",
+                "name": [{"family": f"Family {index}", "given": ["Jo"]}],
+                "gender": "female" if index % 2 else "male",
+                "birthDate": f"19{index % 90 + 10}-01-01",
+            }
+            f.write(json.dumps(resource) + "\n")
+
+
+def one_by_one(path, workers):
+    with open(path) as f:
+        for line in f:
+            Patient.create_from_resource(PatientResource(json.loads(line)))
+
+
+def bulk(path, workers):
+    importer = BulkImport(workers=workers)
+    with open(path) as f:
+        importer.run(f, "Patient")
+    assert importer.error_count == 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resources", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    Base.metadata.create_all(engine)
+    path = os.path.join(tempfile.mkdtemp(), "Patient.ndjson")
+    write_file(path, args.resources)
+
+    results = {}
+    for name, run in [("one by one", one_by_one), ("bulk import", bulk)]:
+        start = time.perf_counter()
+        run(path, args.workers)
+        results[name] = args.resources / (time.perf_counter() - start)
+        session.remove()
+    assert Patient.query.count() == args.resources * 2
+    baseline = results["one by one"]
+    for name, rate in results.items():
+        print(f"{name:<12} {rate:8.1f} resources/s  ({rate / baseline:.1f}x)")
+    memory = peak_memory()
+    if memory:
+        print(f"peak memory  {memory / 2 ** 20:8.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
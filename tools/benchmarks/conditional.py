@@ -0,0 +1,133 @@
+"""
+Compare conditional requests with the round trips they replace:
+
+- a search for an identifier followed by a create when it matched nothing, with a
+  create that has an ``If-None-Exist`` header
+- a DELETE request for every resource that matches a search, with one conditional
+  DELETE of the search and ``CONDITIONAL_DELETE = "multiple"``
+
+It prints the time, the requests and the SQL statements each of them takes. A file
+based SQLite database stands in for a real server.
+
+Usage: python tools/benchmarks/conditional.py [--resources 1000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from fhirbug.config import settings
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "benchmark.sqlite")
+settings.configure(
+    {
+        "DB_BACKEND": "SQLAlchemy",
+        "SQLALCHEMY_CONFIG": {"URI": f"sqlite:///{DB_PATH}"},
+        "MODELS_PATH": "__main__",
+        "CONDITIONAL_DELETE": "multiple",
+    }
+)
+
+from sqlalchemy import Column, Integer, String, event
+from fhirbug.db.backends.SQLAlchemy.base import Base, engine
+from fhirbug.db.backends.SQLAlchemy.models import FhirBaseModel
+from fhirbug.db.backends.SQLAlchemy.searches import StringSearch
+from fhirbug.models.attributes import Attribute
+from fhirbug.server import DeleteRequestHandler, GetRequestHandler, PostRequestHandler
+
+statements = []
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def record(connection, cursor, statement, parameters, context, executemany):
+    statements.append(statement)
+
+
+class Patient(FhirBaseModel):
+    __tablename__ = "patients"
+    id = Column(Integer, primary_key=True)
+    identifier = Column(String, index=True)
+    city = Column(String)
+
+    class FhirMap:
+        id = Attribute(("id", str))
+        identifier = Attribute(
+            ("identifier", lambda value: [{"value": value}]),
+            lambda instance, value: setattr(
+                instance._model, "identifier", value[0].value
+            ),
+            searcher=StringSearch("identifier"),
+        )
+        address = Attribute(
+            ("city", lambda city: [{"city": city}]),
+            lambda instance, value: setattr(instance._model, "city", value[0].city),
+            searcher=StringSearch("city"),
+        )
+
+
+def patient(index, city):
+    return {
+        "resourceType": "Patient",
+        "identifier": [{"value": f"id-{index}"}],
+        "address": [{"city": city}],
+    }
+
+
+def report(label, start, requests):
+    elapsed = (time.perf_counter() - start) * 1000
+    print(f"{label:<36}{elapsed:>10.1f} ms{requests:>10}{len(statements):>8}")
+    statements.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resources", type=int, default=1000)
+    args = parser.parse_args()
+
+    Base.metadata.create_all(engine)
+    print(f"{'':<36}{'time':>13}{'requests':>10}{'SQL':>8}")
+
+    statements.clear()
+    start = time.perf_counter()
+    for index in range(args.resources):
+        content, status = GetRequestHandler().handle(
+            f"Patient?identifier=id-{index}&_count=1"
+        )
+        if not content.get("entry"):
+            PostRequestHandler().handle("Patient", patient(index, "Athens"))
+    report("search, then create", start, args.resources * 2)
+
+    start = time.perf_counter()
+    for index in range(args.resources, args.resources * 2):
+        context = SimpleNamespace(headers={"if-none-exist": f"identifier=id-{index}"})
+        content, status = PostRequestHandler().handle(
+            "Patient", patient(index, "Sparta"), context
+        )
+        assert status == 201, content
+    report("create with If-None-Exist", start, args.resources)
+
+    start = time.perf_counter()
+    requests = 0
+    while True:
+        # Searches return at most MAX_BUNDLE_SIZE resources
+        content, status = GetRequestHandler().handle("Patient?address=Athens")
+        requests += 1
+        if not content.get("entry"):
+            break
+        for entry in content["entry"]:
+            DeleteRequestHandler().handle(f"Patient/{entry['resource']['id']}")
+            requests += 1
+    report("search, then delete each", start, requests)
+
+    start = time.perf_counter()
+    content, status = DeleteRequestHandler().handle("Patient?address=Sparta")
+    assert status == 200, content
+    report("conditional delete", start, 1)
+
+
+if __name__ == "__main__":
+    main()
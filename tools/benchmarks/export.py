@@ -0,0 +1,94 @@
+"""
+Compare reading every Observation by paging through searchsets with reading them
+with the $export operation.
+
+Paging with ``_count=100`` needs a request per page and each page is fetched with an
+``OFFSET`` that the database has to skip, while $export streams each range of primary
+keys to its own NDJSON file with a cursor.
+
+Usage: python tools/benchmarks/export.py [--resources 20000] [--workers 4]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from fhirbug.config import settings
+
+DIRECTORY = tempfile.mkdtemp()
+settings.configure(
+    {
+        "DB_BACKEND": "SQLAlchemy",
+        "SQLALCHEMY_CONFIG": {"URI": f"sqlite:///{DIRECTORY}/benchmark.sqlite"},
+        "MODELS_PATH": "__main__",
+        "EXPORT_PATH": os.path.join(DIRECTORY, "export"),
+        "EXPORT_PARTITION_SIZE": 5000,
+    }
+)
+
+from sqlalchemy import Column, Integer, String
+from fhirbug.db.backends.SQLAlchemy.base import Base, engine, session
+from fhirbug.db.backends.SQLAlchemy.models import FhirBaseModel
+from fhirbug.models.attributes import Attribute
+from fhirbug.server import GetRequestHandler
+
+
+class Observation(FhirBaseModel):
+    __tablename__ = "observations"
+    id = Column(Integer, primary_key=True)
+    status = Column(String)
+
+    class FhirMap:
+        id = Attribute(("id", str))
+        status = Attribute("status", "status")
+        code = Attribute(lambda i: {"text": "weight"})
+
+
+def paging(count):
+    handler = GetRequestHandler()
+    read = 0
+    for offset in range(1, count + 1, 100):
+        bundle, status = handler.handle(f"Observation?_count=100&search-offset={offset}")
+        read += len(bundle.get("entry", []))
+    assert read == count, read
+
+
+def bulk_export(count):
+    handler = GetRequestHandler()
+    content, status = handler.handle("$export?_type=Observation")
+    location = handler.response_headers["Content-Location"]
+    while status != 200:
+        time.sleep(0.01)
+        manifest, status = GetRequestHandler().handle(location)
+    assert sum(file["count"] for file in manifest["output"]) == count, manifest
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resources", type=int, default=20000)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+    settings.EXPORT_WORKERS = args.workers
+
+    Base.metadata.create_all(engine)
+    session.bulk_save_objects(
+        [Observation(id=i, status="final") for i in range(1, args.resources + 1)]
+    )
+    session.commit()
+
+    results = {}
+    for name, run in [("paging", paging), ("$export", bulk_export)]:
+        start = time.perf_counter()
+        run(args.resources)
+        results[name] = args.resources / (time.perf_counter() - start)
+        session.remove()
+    baseline = results["paging"]
+    for name, rate in results.items():
+        print(f"{name:<8} {rate:9.1f} resources/s  ({rate / baseline:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
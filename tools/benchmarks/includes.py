@@ -0,0 +1,139 @@
+"""
+Measure the latency of searches with ``_include`` and ``_revinclude`` when the extra
+queries of a page run one after the other and when they run on a thread pool.
+
+A file based SQLite database stands in for a real server. Every query sleeps for
+``--latency`` seconds before it is executed to simulate the round trip to a remote
+database. The search includes two references and revincludes one resource type for
+every Patient of the page.
+
+Usage: python tools/benchmarks/includes.py [--requests 10] [--count 10] [--latency 0.005]
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from fhirbug.config import settings
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "benchmark.sqlite")
+settings.configure(
+    {
+        "DB_BACKEND": "SQLAlchemy",
+        "SQLALCHEMY_CONFIG": {"URI": f"sqlite:///{DB_PATH}"},
+        "MODELS_PATH": "__main__",
+    }
+)
+
+from sqlalchemy import Column, Integer, String, event
+from fhirbug.db.backends.SQLAlchemy.base import Base, engine, session
+from fhirbug.db.backends.SQLAlchemy.models import FhirBaseModel
+from fhirbug.db.backends.SQLAlchemy.searches import SimpleSearch
+from fhirbug.models.attributes import Attribute, ReferenceAttribute, const
+from fhirbug.server import GetRequestHandler
+
+LATENCY = 0.005
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def delay(*args):
+    time.sleep(LATENCY)
+
+
+class Organization(FhirBaseModel):
+    __tablename__ = "organizations"
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+
+    class FhirMap:
+        id = Attribute(("id", str))
+        name = Attribute("name")
+
+
+class Practitioner(FhirBaseModel):
+    __tablename__ = "practitioners"
+    id = Column(Integer, primary_key=True)
+
+    class FhirMap:
+        id = Attribute(("id", str))
+
+
+class Patient(FhirBaseModel):
+    __tablename__ = "patients"
+    id = Column(Integer, primary_key=True)
+    organization_id = Column(Integer)
+    practitioner_id = Column(Integer)
+
+    class FhirMap:
+        id = Attribute(("id", str))
+        managingOrganization = ReferenceAttribute(
+            Organization, "organization_id", "organization"
+        )
+        generalPractitioner = ReferenceAttribute(
+            Practitioner, "practitioner_id", "general-practitioner"
+        )
+
+
+class Observation(FhirBaseModel):
+    __tablename__ = "observations"
+    id = Column(Integer, primary_key=True)
+    patient_id = Column(Integer)
+    status = Column(String)
+
+    class FhirMap:
+        id = Attribute(("id", str))
+        status = Attribute("status")
+        code = Attribute(const({"text": "Heart rate"}))
+        subject = ReferenceAttribute(
+            Patient, "patient_id", "subject", searcher=SimpleSearch("patient_id")
+        )
+
+
+def measure(urls, workers):
+    settings.MAX_QUERY_WORKERS = workers
+    handler = GetRequestHandler()
+    latencies = []
+    for url in urls:
+        start = time.perf_counter()
+        content, status = handler.handle(url)
+        latencies.append(time.perf_counter() - start)
+        assert status == 200, content
+    return statistics.median(latencies) * 1000
+
+
+def main():
+    global LATENCY
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=10)
+    parser.add_argument("--count", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.005)
+    args = parser.parse_args()
+
+    Base.metadata.create_all(engine)
+    for id in range(1, args.count + 1):
+        session.add(Organization(id=id, name=f"org {id}"))
+        session.add(Practitioner(id=id))
+        session.add(Patient(id=id, organization_id=id, practitioner_id=id))
+        session.add(Observation(id=id, patient_id=id, status="final"))
+    session.commit()
+    session.remove()
+    LATENCY = args.latency
+
+    url = (
+        f"Patient?_count={args.count}&_include=organization"
+        "&_include=general-practitioner&_revinclude=Observation:subject"
+    )
+    urls = [url] * args.requests
+    baseline = measure(urls, 1)
+    print(f"sequential        {baseline:8.1f} ms")
+    for workers in [2, 4, 8]:
+        elapsed = measure(urls, workers)
+        print(f"{workers:>2} workers        {elapsed:8.1f} ms  ({baseline / elapsed:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Compare changing one field of a resource with a PUT of the whole resource and with a
+JSON Patch PATCH: the size of the request bodies, the SQL statements that are run and
+the columns that are written, and the time each request takes. A PUT of the resource
+as it already is shows the cost of an update that changes nothing.
+
+A file based SQLite database stands in for a real server.
+
+Usage: python tools/benchmarks/patch.py [--requests 200]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from fhirbug.config import settings
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "benchmark.sqlite")
+settings.configure(
+    {
+        "DB_BACKEND": "SQLAlchemy",
+        "SQLALCHEMY_CONFIG": {"URI": f"sqlite:///{DB_PATH}"},
+        "MODELS_PATH": "__main__",
+    }
+)
+
+from sqlalchemy import Boolean, Column, Integer, String, event
+from fhirbug.db.backends.SQLAlchemy.base import Base, engine, session
+from fhirbug.db.backends.SQLAlchemy.models import FhirBaseModel
+from fhirbug.models.attributes import Attribute
+from fhirbug.server import PatchRequestHandler, PutRequestHandler
+
+statements = []
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def record(connection, cursor, statement, parameters, context, executemany):
+    statements.append(statement)
+
+
+class Patient(FhirBaseModel):
+    __tablename__ = "patients"
+    id = Column(Integer, primary_key=True)
+    family = Column(String)
+    given = Column(String)
+    gender = Column(String)
+    active = Column(Boolean)
+    phone = Column(String)
+    email = Column(String)
+    city = Column(String)
+    line = Column(String)
+
+    class FhirMap:
+        id = Attribute(("id", str))
+        active = Attribute("active", "active")
+        gender = Attribute("gender", "gender")
+        name = Attribute(
+            lambda instance: [
+                {"family": instance._model.family, "given": instance._model.given.split()}
+            ],
+            lambda instance, value: (
+                setattr(instance._model, "family", value[0].family),
+                setattr(instance._model, "given", " ".join(value[0].given or [])),
+            ),
+        )
+        telecom = Attribute(
+            lambda instance: [
+                {"system": "phone", "value": instance._model.phone},
+                {"system": "email", "value": instance._model.email},
+            ],
+            lambda instance, value: (
+                setattr(instance._model, "phone", value[0].value),
+                setattr(instance._model, "email", value[1].value),
+            ),
+        )
+        address = Attribute(
+            lambda instance: [
+                {"city": instance._model.city, "line": [instance._model.line]}
+            ],
+            lambda instance, value: (
+                setattr(instance._model, "city", value[0].city),
+                setattr(instance._model, "line", value[0].line[0]),
+            ),
+        )
+
+
+def measure(label, Handler, url, make_body, requests):
+    handler = Handler()
+    sizes, writes = [], []
+    start = time.perf_counter()
+    for index in range(requests):
+        body = make_body(index)
+        sizes.append(len(json.dumps(body)))
+        statements.clear()
+        content, status = handler.handle(url, body)
+        assert status < 300, content
+        writes.append(list(statements))
+    elapsed = (time.perf_counter() - start) / requests * 1000
+    updates = [s for s in writes[-1] if s.startswith("UPDATE")]
+    print(
+        f"{label:<22}{sum(sizes) / len(sizes):>8.0f} B{len(writes[-1]):>6}"
+        f"{elapsed:>10.2f} ms   {updates[0] if updates else '-'}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    Base.metadata.create_all(engine)
+    session.add(
+        Patient(
+            id=1,
+            family="Doe",
+            given="Jane Mary",
+            gender="male",
+            active=True,
+            phone="555-0100",
+            email="jane@example.com",
+            city="Athens",
+            line="Main St 1",
+        )
+    )
+    session.commit()
+    current = session.get(Patient, 1).to_fhir().as_json()
+    session.remove()
+
+    genders = ["female", "male"]
+
+    def put_body(index):
+        return {**current, "gender": genders[index % 2]}
+
+    def patch_body(index):
+        return [{"op": "replace", "path": "/gender", "value": genders[index % 2]}]
+
+    print(f"{'':<22}{'body':>10}{'SQL':>6}{'time':>13}   UPDATE")
+    measure("PUT", PutRequestHandler, "Patient/1", put_body, args.requests)
+    measure("PATCH", PatchRequestHandler, "Patient/1", patch_body, args.requests)
+    measure(
+        "PUT, unchanged",
+        PutRequestHandler,
+        "Patient/1",
+        lambda index: current,
+        args.requests,
+    )
+
+
+if __name__ == "__main__":
+    main()
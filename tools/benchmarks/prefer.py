@@ -0,0 +1,146 @@
+"""
+Measure the throughput of creating and updating resources with each ``return``
+preference of the ``Prefer`` header, and the SQL statements run per request.
+
+``return=representation``, the default, maps and serializes the written resource for
+the response. ``return=minimal`` and ``return=OperationOutcome`` only read its id and
+version for the ``Location`` and ``ETag`` headers.
+
+A file based SQLite database stands in for a real server. Its commits are not synced
+to the disk, so that their timing noise does not hide the cost of the responses.
+
+Usage: python tools/benchmarks/prefer.py [--requests 1000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from fhirbug.config import settings
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "benchmark.sqlite")
+settings.configure(
+    {
+        "DB_BACKEND": "SQLAlchemy",
+        "SQLALCHEMY_CONFIG": {"URI": f"sqlite:///{DB_PATH}"},
+        "MODELS_PATH": "__main__",
+    }
+)
+
+from sqlalchemy import Boolean, Column, Integer, String, event
+from fhirbug.db.backends.SQLAlchemy.base import Base, engine
+from fhirbug.db.backends.SQLAlchemy.models import FhirBaseModel
+from fhirbug.models.attributes import Attribute
+from fhirbug.server import PostRequestHandler, PutRequestHandler
+
+statements = []
+
+
+@event.listens_for(engine, "connect")
+def no_sync(connection, record):
+    connection.execute("PRAGMA synchronous = OFF")
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def record(connection, cursor, statement, parameters, context, executemany):
+    statements.append(statement)
+
+
+class Patient(FhirBaseModel):
+    __tablename__ = "patients"
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+    family = Column(String)
+    given = Column(String)
+    gender = Column(String)
+    active = Column(Boolean)
+    phone = Column(String)
+    city = Column(String)
+
+    __mapper_args__ = {"version_id_col": version}
+    __Version__ = "version"
+
+    class FhirMap:
+        id = Attribute(("id", str))
+        active = Attribute("active", "active")
+        gender = Attribute("gender", "gender")
+        name = Attribute(
+            lambda instance: [
+                {
+                    "family": instance._model.family,
+                    "given": (instance._model.given or "").split(),
+                }
+            ],
+            lambda instance, value: (
+                setattr(instance._model, "family", value[0].family),
+                setattr(instance._model, "given", " ".join(value[0].given or [])),
+            ),
+        )
+        telecom = Attribute(
+            lambda instance: [{"system": "phone", "value": instance._model.phone}],
+            lambda instance, value: setattr(instance._model, "phone", value[0].value),
+        )
+        address = Attribute(
+            lambda instance: [{"city": instance._model.city}],
+            lambda instance, value: setattr(instance._model, "city", value[0].city),
+        )
+
+
+def patient(index):
+    return {
+        "resourceType": "Patient",
+        "active": True,
+        "gender": ["female", "male"][index % 2],
+        "name": [{"family": f"Doe {index}", "given": ["Jane", "Mary"]}],
+        "telecom": [{"system": "phone", "value": f"555-{index:04}"}],
+        "address": [{"city": "Athens"}],
+    }
+
+
+PREFERENCES = ["return=representation", "return=minimal", "return=OperationOutcome"]
+
+
+def measure(Handler, make_url, prefer, requests):
+    """
+    Return the time of a request in ms, the SQL statements of the last request and
+    its response headers.
+    """
+    context = SimpleNamespace(headers={"prefer": prefer})
+    start = time.perf_counter()
+    for index in range(requests):
+        statements.clear()
+        handler = Handler()
+        content, status = handler.handle(make_url(index), patient(index), context)
+        assert status < 300, content
+    elapsed = (time.perf_counter() - start) / requests * 1000
+    return elapsed, len(statements), handler.response_headers
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    Base.metadata.create_all(engine)
+    print(f"{'':<6}{'Prefer':<26}{'time':>10}{'SQL':>6}   headers")
+    for method, Handler, make_url in [
+        ("POST", PostRequestHandler, lambda index: "Patient"),
+        ("PUT", PutRequestHandler, lambda index: f"Patient/{index % 100 + 1}"),
+    ]:
+        # Interleave the preferences and keep the best round of each
+        results = {}
+        for _ in range(args.rounds):
+            for prefer in PREFERENCES:
+                result = measure(Handler, make_url, prefer, args.requests)
+                results[prefer] = min(results.get(prefer, result), result)
+        for prefer, (elapsed, count, headers) in results.items():
+            print(f"{method:<6}{prefer:<26}{elapsed:>7.3f} ms{count:>6}   {headers}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Measure the memory of pre-forked workers when the application is loaded by each worker
+after the fork, when it is loaded once with ``preload(freeze=False)`` before it and when
+``preload()`` also freezes the heap.
+
+Each mode runs in a fresh interpreter that forks ``--workers`` workers. Every worker
+serves a read and a search of a file based SQLite database and reports its resident
+set (RSS), its proportional set (PSS, shared pages divided among the processes that
+share them) and its private memory (USS, what exiting the worker would free).
+
+Usage: python tools/benchmarks/preload.py [--workers 4]
+"""
+import argparse
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from fhirbug.config import settings
+
+
+def load_models():
+    """
+    Define the mappings of the benchmark in ``__main__``, as a models module would.
+    """
+    from sqlalchemy import Column, Integer, String
+    from fhirbug.db.backends.SQLAlchemy.models import FhirBaseModel
+    from fhirbug.models.attributes import Attribute
+
+    class Patient(FhirBaseModel):
+        __tablename__ = "patients"
+        id = Column(Integer, primary_key=True)
+        family = Column(String)
+        gender = Column(String)
+
+        class FhirMap:
+            id = Attribute(("id", str))
+            name = Attribute(
+                ("family", lambda family: [{"family": family}]),
+                searcher=lambda cls, field, value, sql_query, query: sql_query,
+            )
+            gender = Attribute("gender")
+
+    globals()["Patient"] = Patient
+
+
+def memory():
+    """
+    Return the RSS, PSS and USS of the current process in MB.
+    """
+    values = {}
+    with open("/proc/self/smaps_rollup") as smaps:
+        for line in smaps:
+            key, _, rest = line.partition(":")
+            if rest.strip().endswith("kB"):
+                values[key] = int(rest.split()[0]) / 1024
+    return {
+        "rss": values["Rss"],
+        "pss": values["Pss"],
+        "uss": values["Private_Clean"] + values["Private_Dirty"],
+    }
+
+
+def worker(pipe):
+    if "Patient" not in globals():
+        load_models()
+    from fhirbug.server import GetRequestHandler
+
+    handler = GetRequestHandler()
+    for url in ["Patient/1", "Patient?_count=20"]:
+        content, status = handler.handle(url)
+        assert status == 200, content
+    os.write(pipe, (json.dumps(memory()) + "\n").encode())
+
+
+def serve(mode, workers, db_path):
+    settings.configure(
+        {
+            "DB_BACKEND": "SQLAlchemy",
+            "SQLALCHEMY_CONFIG": {"URI": f"sqlite:///{db_path}"},
+            "MODELS_PATH": "__main__",
+        }
+    )
+    if mode != "lazy":
+        load_models()
+        from fhirbug.server.preload import preload
+
+        preload(freeze=mode == "freeze")
+
+    read, write = os.pipe()
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            os.close(read)
+            worker(write)
+            os._exit(0)
+        children.append(pid)
+    os.close(write)
+    for pid in children:
+        os.waitpid(pid, 0)
+    with os.fdopen(read) as results:
+        print(results.read(), end="")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--serve", choices=["lazy", "preload", "freeze"])
+    parser.add_argument("--db")
+    args = parser.parse_args()
+    if args.serve:
+        return serve(args.serve, args.workers, args.db)
+
+    db_path = os.path.join(tempfile.mkdtemp(), "benchmark.sqlite")
+    with sqlite3.connect(db_path) as connection:
+        connection.execute(
+            "CREATE TABLE patients (id INTEGER PRIMARY KEY, family TEXT, gender TEXT)"
+        )
+        connection.executemany(
+            "INSERT INTO patients VALUES (?, ?, ?)",
+            [(id, f"family {id}", "female") for id in range(1, 101)],
+        )
+
+    print(f"{'':<10}{'RSS':>10}{'PSS':>10}{'USS':>10}   per worker, MB")
+    for mode in ["lazy", "preload", "freeze"]:
+        output = subprocess.run(
+            [sys.executable, __file__, "--serve", mode, "--workers", str(args.workers)]
+            + ["--db", db_path],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        reports = [json.loads(line) for line in output.splitlines()]
+        averages = {
+            key: sum(report[key] for report in reports) / len(reports)
+            for key in ["rss", "pss", "uss"]
+        }
+        print(
+            f"{mode:<10}{averages['rss']:>10.1f}{averages['pss']:>10.1f}"
+            f"{averages['uss']:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Compare inserting resources with individual POST requests and with a single
+transaction Bundle.
+
+Each POST commits on its own, so every resource costs a transaction and an fsync,
+while a transaction Bundle is written with one commit and one flush per round of
+entries. A file based SQLite database is used so that commits are not free.
+
+Usage: python tools/benchmarks/transactions.py [--resources 500]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from fhirbug.config import settings
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "benchmark.sqlite")
+settings.configure(
+    {
+        "DB_BACKEND": "SQLAlchemy",
+        "SQLALCHEMY_CONFIG": {"URI": f"sqlite:///{DB_PATH}"},
+        "MODELS_PATH": "__main__",
+    }
+)
+
+from sqlalchemy import Column, Integer, String, ForeignKey
+from fhirbug.db.backends.SQLAlchemy.base import Base, engine, session
+from fhirbug.db.backends.SQLAlchemy.models import FhirBaseModel
+from fhirbug.models.attributes import Attribute, ReferenceAttribute
+from fhirbug.server import PostRequestHandler
+
+
+class Patient(FhirBaseModel):
+    __tablename__ = "patients"
+    id = Column(Integer, primary_key=True)
+    gender = Column(String)
+
+    class FhirMap:
+        id = Attribute(("id", str))
+        gender = Attribute("gender", "gender")
+
+
+class Observation(FhirBaseModel):
+    __tablename__ = "observations"
+    id = Column(Integer, primary_key=True)
+    status = Column(String)
+    patient_id = Column(Integer, ForeignKey("patients.id"))
+
+    class FhirMap:
+        id = Attribute(("id", str))
+        status = Attribute("status", "status")
+        code = Attribute(lambda i: {"text": "weight"})
+        subject = ReferenceAttribute(Patient, "patient_id", "subject", "patient_id")
+
+
+def resources(count):
+    """
+    Yield ``(fullUrl, resource)`` pairs, a Patient followed by an Observation about them
+    """
+    for index in range(count // 2):
+        yield f"urn:uuid:{index}", {"resourceType": "Patient", "gender": "female"}
+        yield None, {
+            "resourceType": "Observation",
+            "status": "final",
+            "code": {"text": "weight"},
+            "subject": {"reference": f"urn:uuid:{index}"},
+        }
+
+
+def individual_posts(count):
+    handler = PostRequestHandler()
+    locations = {}
+    for full_url, resource in resources(count):
+        if "subject" in resource:
+            resource["subject"] = {"reference": locations[resource["subject"]["reference"]]}
+        content, status = handler.handle(resource["resourceType"], resource)
+        assert status == 201, content
+        if full_url:
+            locations[full_url] = f"{content['resourceType']}/{content['id']}"
+
+
+def transaction(count):
+    bundle = {
+        "resourceType": "Bundle",
+        "type": "transaction",
+        "entry": [
+            {
+                **({"fullUrl": full_url} if full_url else {}),
+                "resource": resource,
+                "request": {"method": "POST", "url": resource["resourceType"]},
+            }
+            for full_url, resource in resources(count)
+        ],
+    }
+    content, status = PostRequestHandler().handle("", bundle)
+    assert status == 200, content
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resources", type=int, default=500)
+    args = parser.parse_args()
+
+    Base.metadata.create_all(engine)
+    results = {}
+    for name, run in [("individual POSTs", individual_posts), ("transaction", transaction)]:
+        start = time.perf_counter()
+        run(args.resources)
+        results[name] = args.resources / (time.perf_counter() - start)
+        session.remove()
+    baseline = results["individual POSTs"]
+    for name, rate in results.items():
+        print(f"{name:<17} {rate:8.1f} resources/s  ({rate / baseline:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
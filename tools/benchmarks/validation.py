@@ -0,0 +1,140 @@
+"""
+Measure what validating the parameters of searches costs and saves:
+
+- the time :meth:`validate_search` takes for searches with more and more parameters
+- a search with a misspelled parameter, which is answered with every resource when it
+  is ignored and without a query when it is refused with ``Prefer: handling=strict``
+
+It prints the time per request and the SQL statements each of them takes. A file
+based SQLite database stands in for a real server.
+
+Usage: python tools/benchmarks/validation.py [--resources 10000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from fhirbug.config import settings
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "benchmark.sqlite")
+settings.configure(
+    {
+        "DB_BACKEND": "SQLAlchemy",
+        "SQLALCHEMY_CONFIG": {"URI": f"sqlite:///{DB_PATH}"},
+        "MODELS_PATH": "__main__",
+    }
+)
+
+from sqlalchemy import Column, DateTime, Integer, String, event
+from fhirbug.db.backends.SQLAlchemy.base import Base, engine, session
+from fhirbug.db.backends.SQLAlchemy.models import FhirBaseModel
+from fhirbug.db.backends.SQLAlchemy.searches import (
+    DateSearch,
+    NumericSearch,
+    StringSearch,
+)
+from fhirbug.models.attributes import Attribute
+from fhirbug.models.registry import get_registry
+from fhirbug.server import GetRequestHandler
+from fhirbug.server.requestparser import parse_url
+
+statements = []
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def record(connection, cursor, statement, parameters, context, executemany):
+    statements.append(statement)
+
+
+class Patient(FhirBaseModel):
+    __tablename__ = "patients"
+    id = Column(Integer, primary_key=True)
+    family = Column(String)
+    gender = Column(String)
+    city = Column(String)
+    birthdate = Column(DateTime)
+
+    class FhirMap:
+        id = Attribute(("id", str), searcher=NumericSearch("id"))
+        name = Attribute(
+            lambda instance: [{"family": instance._model.family}],
+            searcher=StringSearch("family"),
+        )
+        gender = Attribute("gender", "gender", searcher=StringSearch("gender"))
+        address = Attribute(
+            lambda instance: [{"city": instance._model.city}],
+            searcher=StringSearch("city"),
+        )
+        birthDate = Attribute(
+            lambda instance: instance._model.birthdate.date().isoformat(),
+            searcher=DateSearch("birthdate"),
+        )
+
+
+PARAMETERS = [
+    "name:contains=doe",
+    "gender=female",
+    "address:exact=Athens",
+    "birthDate=ge1970-01-01",
+    "id=gt10",
+]
+
+
+def measure(url, requests):
+    """
+    Return the time the validation of the parameters of ``url`` takes in us.
+    """
+    query = parse_url(url)
+    start = time.perf_counter()
+    for _ in range(requests):
+        # Strict validation does not change the query, so it can be reused
+        Patient.validate_search(query, strict=True)
+    return (time.perf_counter() - start) / requests * 1000000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resources", type=int, default=10000)
+    parser.add_argument("--requests", type=int, default=10000)
+    args = parser.parse_args()
+
+    Base.metadata.create_all(engine)
+    session.execute(
+        Patient.__table__.insert(),
+        [
+            {
+                "family": f"Doe {index}",
+                "gender": ["female", "male"][index % 2],
+                "city": "Athens",
+                "birthdate": datetime(1950 + index % 50, 1, 1),
+            }
+            for index in range(args.resources)
+        ],
+    )
+    session.commit()
+    get_registry()
+
+    print(f"{'':<40}{'time':>12}{'SQL':>6}")
+    for count in range(1, len(PARAMETERS) + 1):
+        elapsed = measure("Patient?" + "&".join(PARAMETERS[:count]), args.requests)
+        label = f"validate {count} parameter{'s' if count > 1 else ''}"
+        print(f"{label:<40}{elapsed:>9.1f} us{0:>6}")
+
+    for prefer in ["handling=lenient", "handling=strict"]:
+        context = SimpleNamespace(headers={"prefer": prefer})
+        statements.clear()
+        start = time.perf_counter()
+        content, status = GetRequestHandler().handle("Patient?gendr=female", context)
+        elapsed = (time.perf_counter() - start) * 1000
+        label = f"misspelled, {prefer} ({status})"
+        print(f"{label:<40}{elapsed:>9.2f} ms{len(statements):>6}")
+
+
+if __name__ == "__main__":
+    main()